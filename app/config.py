@@ -1,4 +1,4 @@
-from os import path, getenv, environ
+from os import path, getenv, environ, cpu_count
 import datetime as dt
 from dotenv import load_dotenv, dotenv_values
 
@@ -29,7 +29,21 @@ class Config:
 
     DATABASE_URI = getenv('DATABASE_URI', DEFAULT_DATABASE_URI)
 
-    KEYS_DIR = INSTANCE_DIR
+    # Database connection pools are per worker process, so they are sized from the number of web workers (gunicorn's
+    # WEB_CONCURRENCY) and the threads each one runs sync routes and background jobs on (see app.database)
+    WEB_CONCURRENCY = int(getenv('WEB_CONCURRENCY', 2))
+    WEB_THREADS = int(getenv('WEB_THREADS', 40))  # AnyIO's default thread limiter
+    DB_MAX_CONNECTIONS = int(getenv('DB_MAX_CONNECTIONS', 0))  # the database's limit for this app, if any
+    DB_POOL_TIMEOUT = int(getenv('DB_POOL_TIMEOUT', 30))
+    DB_LEAK_SECONDS = int(getenv('DB_LEAK_SECONDS', 300))  # connections held longer than this are counted as leaked
+
+    # Async routes use an async engine for the same database if enabled, e.g., ASYNC_DATABASE=true, with the async
+    # driver for DATABASE_URI's flavor (asyncpg, aiomysql or aiosqlite); otherwise they use the sync engine from a
+    # thread
+    ASYNC_DATABASE = getenv('ASYNC_DATABASE', 'false').lower() in ['1', 'true', 'yes']
+    ASYNC_DATABASE_URI = getenv('ASYNC_DATABASE_URI')
+
+    KEYS_DIR = getenv('KEYS_DIR', INSTANCE_DIR)  # .pem files for SSH to model instances
     UPLOADED_FILES_DEST = INSTANCE_DIR
 
     # Email
@@ -88,9 +102,12 @@ class Config:
     # Model running
     # URL passed to the model so it can "phone home" with it's status
     HEARTBEAT_ENT = '/model'
-    # socket.io
+    # realtime updates to clients (see app.realtime)
     NETWORK_ROOM_NAME = '{source_id}-{network_id}'
     RUN_STUDY_ROOM_NAME = '{source_id}-{project_id}'
+    REALTIME_BACKEND = getenv('REALTIME_BACKEND', 'memory')  # memory (single worker), redis or amqp
+    REALTIME_BROKER_URL = getenv('REALTIME_BROKER_URL')  # e.g., redis://localhost:6379/0 or amqp://guest@localhost//
+    REALTIME_MAX_RATE = float(getenv('REALTIME_MAX_RATE', 4))  # updates per second per client, at most
 
     # Necessary if install type is server and AWS EC2 machines are used
     AWS_ACCOUNT_ID = '123456789123'
@@ -106,6 +123,10 @@ class Config:
     GOOGLE_PLACES_API_KEY = getenv('GOOGLE_PLACES_API_KEY')  # https://console.developers.google.com
     MAPBOX_ACCESS_TOKEN = ''  # Mapbox access token
 
+    # For publishing public networks to a Mapbox dataset (see also the Mapbox API keys below)
+    MAPBOX_API_URL = getenv('MAPBOX_API_URL', 'https://api.mapbox.com')
+    MAPBOX_SYNC_WORKERS = int(getenv('MAPBOX_SYNC_WORKERS', 4))
+
     AWS_S3_BUCKET = getenv('AWS_S3_BUCKET')
     NETWORK_FILES_STORAGE_LOCATION = getenv('NETWORK_FILES_STORAGE_LOCATION', 's3')
 
@@ -145,6 +166,55 @@ class Config:
     RABBITMQ_DEFAULT_USERNAME = getenv('RABBITMQ_DEFAULT_USERNAME')
     RABBITMQ_DEFAULT_PASSWORD = getenv('RABBITMQ_DEFAULT_PASSWORD')
     RABBITMQ_VHOST = getenv('RABBITMQ_VHOST')
+    RABBITMQ_POOL_LIMIT = int(getenv('RABBITMQ_POOL_LIMIT', 10))  # broker connections per model vhost, per worker
+    RABBITMQ_QUEUE_TTL = int(getenv('RABBITMQ_QUEUE_TTL', 30))  # seconds a model queue is known to exist
+
+    # Background jobs (network clones, moves, etc.)
+    JOB_WORKERS = int(getenv('JOB_WORKERS', 4))
+    JOB_HEARTBEAT_INTERVAL = int(getenv('JOB_HEARTBEAT_INTERVAL', 60))  # seconds between touches of a running job
+    JOB_STALE_AFTER = int(getenv('JOB_STALE_AFTER', 300))  # an untouched running job was left by a crash; resumable
+    S3_COPY_WORKERS = int(getenv('S3_COPY_WORKERS', 16))
+
+    # Results cubes, built from stored model results (see app.core.cubes)
+    RESULTS_CUBE_DIR = getenv('RESULTS_CUBE_DIR', path.join(DATA_DIR, 'cubes'))
+    RESULTS_LOCAL_DIR = getenv('RESULTS_LOCAL_DIR')  # read results from here rather than S3, e.g., /mnt/data
+    RESULTS_QUERY_WORKERS = int(getenv('RESULTS_QUERY_WORKERS', 8))  # concurrent cube reads per results query
+    RESULTS_CUBE_RECHECK = int(getenv('RESULTS_CUBE_RECHECK', 60))  # seconds between checks of a partial cube
+
+    # Verified credentials, datausers and studies are cached for this many seconds (see app.core.auth_cache)
+    # Invalidation (e.g., on logout, password change or API key deletion) only clears the cache of the worker that
+    # handled the change, so other workers may accept a revoked credential for up to this long. Keep it short where
+    # several workers serve the same users.
+    AUTH_CACHE_TTL = int(getenv('AUTH_CACHE_TTL', 60))
+    AUTH_CACHE_SIZE = int(getenv('AUTH_CACHE_SIZE', 4096))
+
+    # Model run progress pings are coalesced and written in bulk this often (see app.core.ping_buffer)
+    PING_FLUSH_INTERVAL = float(getenv('PING_FLUSH_INTERVAL', 2))
+    PING_BUFFER_SIZE = int(getenv('PING_BUFFER_SIZE', 5000))  # flush early if this many are waiting
+
+    # Model runs are queued and dispatched fairly across users, within these limits (see app.core.run_scheduler)
+    RUN_QUEUE_BACKEND = getenv('RUN_QUEUE_BACKEND', 'database')  # or memory, for a single worker
+    RUN_QUEUE_USER_LIMIT = int(getenv('RUN_QUEUE_USER_LIMIT', 10))  # active runs per user; 0 for no limit
+    RUN_QUEUE_MODEL_LIMIT = int(getenv('RUN_QUEUE_MODEL_LIMIT', 50))  # active runs per model; 0 for no limit
+    RUN_QUEUE_MAX_ACTIVE = int(getenv('RUN_QUEUE_MAX_ACTIVE', 0))  # active runs in all; 0 for no limit
+    RUN_QUEUE_MAX_RUNTIME = int(getenv('RUN_QUEUE_MAX_RUNTIME', 86400))  # seconds before a silent run is let go
+    RUN_QUEUE_DISPATCH_INTERVAL = int(getenv('RUN_QUEUE_DISPATCH_INTERVAL', 30))  # seconds between dispatches
+
+    # Models with the local service run as child processes of the API (see app.core.runners.local)
+    # runs at once, per API worker; by default the machine's CPUs are shared between the WEB_CONCURRENCY workers
+    LOCAL_RUN_WORKERS = int(getenv('LOCAL_RUN_WORKERS', max(1, (cpu_count() or 2) // WEB_CONCURRENCY)))
+    LOCAL_RUN_CANCEL_GRACE = int(getenv('LOCAL_RUN_CANCEL_GRACE', 10))  # seconds before a canceled run is killed
+
+    # Models with the aws service run on a shared fleet of EC2 instances (see app.core.runners.fleet)
+    FLEET_NAME = getenv('FLEET_NAME', 'openagua')  # tags the fleet's instances
+    FLEET_INSTANCE_TYPE = getenv('FLEET_INSTANCE_TYPE', 't3.large')
+    FLEET_WARM_POOLS = getenv('FLEET_WARM_POOLS', '')  # idle instances to keep ready, e.g., ami-123:2,ami-456:1
+    FLEET_MAX_SIZE = int(getenv('FLEET_MAX_SIZE', 10))  # instances per model image
+    FLEET_IDLE_TIMEOUT = int(getenv('FLEET_IDLE_TIMEOUT', 900))  # seconds before an idle instance is terminated
+    FLEET_DESCRIBE_TTL = int(getenv('FLEET_DESCRIBE_TTL', 10))  # seconds instance descriptions are reused
+    FLEET_RECONCILE_INTERVAL = int(getenv('FLEET_RECONCILE_INTERVAL', 60))
+    FLEET_CLAIM_DELAY = float(getenv('FLEET_CLAIM_DELAY', 1))  # seconds for tags to settle when claiming an instance
+    FLEET_READY_TIMEOUT = int(getenv('FLEET_READY_TIMEOUT', 600))  # seconds to wait for a new instance to start
 
     def __init__(self, mode=None):
 
@@ -5,6 +5,7 @@ from app.core.hydra import HydraConnection
 from app.core.utils import decrypt
 from app.core.users import add_dataurl, add_datauser, update_datauser, delete_datauser, get_datauser
 from app.core.security import generate_api_key
+from app.core.auth_cache import invalidate_user
 
 
 def get_data_databases(db, user_id, base_url):
@@ -52,6 +53,8 @@ def add_database(db, user_id, **kwargs):
                 **kwargs
             )
 
+    invalidate_user(user_id)
+
     return {'userid': data_user.id}
 
 
@@ -87,12 +90,15 @@ def update_database(db, user_id, **kwargs):
                 **kwargs
             )
 
+    invalidate_user(user_id)
+
     return {'userid': data_user.id}
 
 
 def remove_database(db, user_id, url):
     dataurl = db.query(DataUrl).filter_by(url=url).first()
     delete_datauser(db, user_id=user_id, dataurl_id=dataurl.id)
+    invalidate_user(user_id)
 
 
 def add_api_key(db, user_id):
@@ -115,3 +121,4 @@ def delete_api_key(db, user_id):
     if apikey:
         db.delete(apikey)
         db.commit()
+    invalidate_user(user_id)
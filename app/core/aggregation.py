@@ -0,0 +1,171 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# columns that identify the resource a value belongs to, which spatial aggregation collapses
+SPATIAL_KEYS = ['resource_key', 'resource_attr_id']
+
+# period frequency for each temporal aggregation step, and the name of the resulting time column
+TIME_STEPS = {
+    'month': ('M', 'date'),
+    'year': ('Y', 'Year'),
+}
+
+PERCENTILE_REGEX = re.compile(r'^p(\d{1,2}(?:\.\d+)?|100)$')
+
+
+def parse_function(f):
+    """Parse an aggregation function name into something groupby can apply.
+
+    Supported are sum, mean, min, max, median and percentiles given as pNN (e.g. p10, p90). Returns None for
+    unsupported or missing functions, which means no aggregation.
+    """
+    if f in ['sum', 'mean', 'min', 'max', 'median']:
+        return f
+    match = PERCENTILE_REGEX.match(f or '')
+    if match:
+        return float(match.group(1)) / 100
+    return None
+
+
+def apply_function(grouped, f):
+    return grouped.quantile(f) if isinstance(f, float) else grouped.agg(f)
+
+
+def encode_keys(data):
+    """Get the key columns of a results frame as integer codes.
+
+    Returns (names, codes, levels), where codes is a dict of int arrays and levels a dict of the distinct values they
+    index. When data is indexed by its keys, the index already holds them as codes and levels, so nothing is hashed;
+    otherwise each key column is factorized once. Grouping on these codes avoids hashing object-typed columns.
+    """
+    index = data.index
+    if isinstance(index, pd.MultiIndex):
+        names = list(dict.fromkeys(index.names))
+        positions = {name: i for i, name in reversed(list(enumerate(index.names)))}
+        codes = {name: np.asarray(index.codes[positions[name]]) for name in names}
+        levels = {name: index.levels[positions[name]] for name in names}
+        return names, codes, levels
+
+    data = data.reset_index()
+    names = [c for c in data.columns if c != 'value']
+    codes = {}
+    levels = {}
+    for name in names:
+        codes[name], levels[name] = pd.factorize(data[name])
+    return names, codes, levels
+
+
+def parse_dates(codes, uniques):
+    """Parse distinct dates into a DatetimeIndex, ordered in time, and re-code the rows that refer to them.
+
+    Each distinct date is parsed once, rather than every row. Returns (date_codes, date_index).
+    """
+    date_index = pd.DatetimeIndex(pd.to_datetime(np.asarray(uniques)))
+    order = np.argsort(date_index.values, kind='stable')
+    rank = np.empty(len(order) + 1, dtype=np.intp)
+    rank[order] = np.arange(len(order))
+    rank[-1] = -1  # missing dates
+    return rank[codes], date_index[order]
+
+
+def time_filter(date_index, date_range):
+    """Get a boolean mask over the distinct dates for a custom date range, or None if the range is not restricted"""
+    if not date_range or date_range.get('mode') != 'custom':
+        return None
+    start = date_range.get('start')
+    end = date_range.get('end')
+    if not (start or end):
+        return None
+    mask = np.ones(len(date_index), dtype=bool)
+    if start:
+        mask &= date_index >= pd.Timestamp(start)
+    if end:
+        mask &= date_index <= pd.Timestamp(end)
+    return mask
+
+
+def resample_dates(date_index, step):
+    """Map each distinct date to the start of its period (month or year), as a resample would.
+
+    Returns (period_codes, period_index).
+    """
+    freq, _ = TIME_STEPS[step]
+    starts = date_index.to_period(freq).to_timestamp()
+    period_codes, period_index = pd.factorize(starts, sort=True)
+    return period_codes, pd.DatetimeIndex(period_index)
+
+
+def aggregate(data, agg):
+    """Filter and aggregate a long results frame in space and time.
+
+    data is indexed by its key columns, which include 'date', with a single 'value' column. agg is a dict of:
+        range: {'mode': 'custom', 'start': ..., 'end': ...} to restrict dates
+        space: {'function': ...} to aggregate over resources at each date
+        time: {'function': ..., 'step': 'month' | 'year'} to resample each series
+
+    Key columns are integer coded and dates parsed once into a DatetimeIndex, so the filter is a mask lookup and each
+    aggregation a single groupby over integer codes, however large the frame. When both aggregations use the same
+    function and it composes (sum, min, max), they run as one groupby.
+
+    Returns the aggregated frame indexed by its key columns, with 'date' as the first of each period for monthly
+    steps and replaced by an integer 'Year' column for yearly steps.
+    """
+    idx_names, codes, levels = encode_keys(data)
+    keys = [k for k in idx_names if k != 'date']
+
+    date_codes, date_index = parse_dates(codes.pop('date'), levels.pop('date'))
+    values = pd.to_numeric(data['value'], errors='coerce').to_numpy(dtype=float)
+
+    # time filter, which also drops rows without a date
+    mask = time_filter(date_index, agg.get('range', {}))
+    if mask is not None or (date_codes < 0).any():
+        rows = date_codes >= 0
+        if mask is not None:
+            rows &= mask[date_codes]
+        date_codes = date_codes[rows]
+        values = values[rows]
+        codes = {k: c[rows] for k, c in codes.items()}
+
+    space_f = parse_function(agg.get('space', {}).get('function'))
+    time_f = parse_function(agg.get('time', {}).get('function'))
+    step = agg.get('time', {}).get('step')
+    if step not in TIME_STEPS:
+        time_f = None
+
+    frame = pd.DataFrame(codes)
+    frame['date'] = date_codes
+    frame['value'] = values
+
+    if space_f:
+        keys = [k for k in keys if k not in SPATIAL_KEYS]
+
+    time_name = 'date'
+    if time_f:
+        period_codes, date_index = resample_dates(date_index, step)
+        time_name = TIME_STEPS[step][1]
+        if space_f and space_f == time_f and space_f in ['sum', 'min', 'max']:
+            frame['date'] = period_codes[frame['date'].to_numpy()]
+            space_f = None
+        else:
+            if space_f:
+                frame = apply_function(frame.groupby(keys + ['date'], sort=False)['value'], space_f).reset_index()
+                space_f = None
+            frame['date'] = period_codes[frame['date'].to_numpy()]
+        frame = apply_function(frame.groupby(keys + ['date'], sort=True)['value'], time_f).reset_index()
+    elif space_f:
+        frame = apply_function(frame.groupby(keys + ['date'], sort=True)['value'], space_f).reset_index()
+
+    # the time column keeps the position of the original date column
+    cols = keys[:]
+    cols.insert(len([k for k in idx_names[:idx_names.index('date')] if k in keys]), time_name)
+    index_levels = dict(levels, **{time_name: date_index.year if time_name == 'Year' else date_index})
+    index_codes = dict(frame[keys + ['date']].rename(columns={'date': time_name}))
+
+    # build the index directly from the codes and levels, rather than decoding and re-hashing every row
+    index = pd.MultiIndex(levels=[index_levels[c] for c in cols], codes=[index_codes[c].to_numpy() for c in cols],
+                          names=cols, verify_integrity=False)
+    result = pd.DataFrame({'value': frame['value'].to_numpy()}, index=index.remove_unused_levels())
+
+    return result
@@ -0,0 +1,21 @@
+from functools import wraps
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+def run_async(fn):
+    """Make an async version of a repository function, for use in async routes.
+
+    The function's first argument is a session. Given an AsyncSession (see config.ASYNC_DATABASE), the function runs
+    on the session's sync view, with its queries awaited on the async driver. Given a regular Session, it runs in a
+    worker thread. Either way the event loop is not blocked, so the function should only do database work.
+    """
+
+    @wraps(fn)
+    async def wrapper(db, *args, **kwargs):
+        if isinstance(db, AsyncSession):
+            return await db.run_sync(fn, *args, **kwargs)
+        return await run_in_threadpool(fn, db, *args, **kwargs)
+
+    return wrapper
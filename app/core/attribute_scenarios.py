@@ -0,0 +1,151 @@
+from threading import RLock
+
+from app.core.caching import Cache, template_version
+
+# scenario classes that input data can be entered for
+INPUT_SCENARIO_CLASSES = ['baseline', 'option', 'scenario']
+
+template_index_cache = Cache(maxsize=64)
+attribute_scenario_cache = Cache(maxsize=32)
+
+
+def get_template_attr_index(template):
+    """Index a template's non-variable (input) attributes.
+
+    Returns a dict of 'attrs', the list of input attributes as {'id', 'name'}, and 'types', mapping each type id to
+    {attr_id: index in attrs}. The index is cached per template version.
+    """
+
+    def build():
+        attrs = []
+        attr_idx = {}
+        types = {}
+        for tt in template['templatetypes']:
+            types[tt['id']] = {}
+            for ta in tt['typeattrs']:
+                if ta['attr_is_var'] != 'N':
+                    continue
+                if ta['attr_id'] not in attr_idx:
+                    attr_idx[ta['attr_id']] = len(attrs)
+                    attrs.append({'id': ta['attr_id'], 'name': ta['attr']['name']})
+                types[tt['id']][ta['attr_id']] = attr_idx[ta['attr_id']]
+        return {'attrs': attrs, 'types': types}
+
+    return template_index_cache.get_or_set(template_version(template), build)
+
+
+def simplify_scenario(scenario):
+    return {
+        'id': scenario['id'],
+        'name': scenario['name'],
+        'class': scenario['layout']['class'] if 'class' in scenario['layout'] else 'baseline'
+    }
+
+
+class AttributeScenarioIndex(object):
+    """The input attributes of each node and link in a network, as index arrays into the template's attribute list.
+
+    Each resource maps to {'ids': [resource attribute ids], 'attrs': [attribute indexes]}. The index is updated
+    incrementally: when the network changes, only resources whose types or attributes changed are recomputed.
+    """
+
+    def __init__(self, template_id, template_index):
+        self.template_id = template_id
+        self.template_index = template_index
+        self.resources = {'nodes': {}, 'links': {}}
+        self._keys = {'nodes': {}, 'links': {}}
+        self._lock = RLock()
+
+    def _key(self, resource):
+        return (
+            tuple(rt['id'] for rt in resource.get('types', []) if rt['template_id'] == self.template_id),
+            tuple((ra['id'], ra['attr_id']) for ra in resource.get('attributes') or [])
+        )
+
+    def update_resource(self, res_type, resource):
+        key = self._key(resource)
+        if self._keys[res_type].get(resource['id']) == key:
+            return False
+
+        type_ids, res_attrs = key
+        tas = self.template_index['types'].get(type_ids[0]) if type_ids else None
+        if tas is None:
+            self.resources[res_type].pop(resource['id'], None)
+        else:
+            ids = []
+            attrs = []
+            for ra_id, attr_id in res_attrs:
+                idx = tas.get(attr_id)
+                if idx is not None:
+                    ids.append(ra_id)
+                    attrs.append(idx)
+            self.resources[res_type][resource['id']] = {'ids': ids, 'attrs': attrs}
+        self._keys[res_type][resource['id']] = key
+        return True
+
+    def remove_resource(self, res_type, resource_id):
+        with self._lock:
+            self.resources[res_type].pop(resource_id, None)
+            self._keys[res_type].pop(resource_id, None)
+
+    def update(self, network):
+        """Bring the index up to date with a network, returning the number of resources recomputed"""
+        updated = 0
+        with self._lock:
+            for res_type in ['nodes', 'links']:
+                resource_ids = set()
+                for resource in network.get(res_type, []):
+                    resource_ids.add(resource['id'])
+                    updated += self.update_resource(res_type, resource)
+                for resource_id in set(self._keys[res_type]) - resource_ids:
+                    self.resources[res_type].pop(resource_id, None)
+                    self._keys[res_type].pop(resource_id, None)
+                    updated += 1
+        return updated
+
+
+def get_attribute_scenarios(network, template):
+    """Get the input attributes of a network's resources, and the scenarios they can be entered for.
+
+    Returns {'scenarios': [...], 'attrs': [...], 'nodes': {node_id: {'ids': [...], 'attrs': [...]}}, 'links': {...}},
+    where 'attrs' index into the top-level attrs list, and every resource attribute applies to every scenario.
+    """
+    template_index = get_template_attr_index(template)
+    key = (network['id'], template_version(template))
+    index = attribute_scenario_cache.get(key)
+    if index is None:
+        index = attribute_scenario_cache.set(key, AttributeScenarioIndex(template['id'], template_index))
+    with index._lock:
+        index.update(network)
+        nodes = dict(index.resources['nodes'])
+        links = dict(index.resources['links'])
+
+    return {
+        'scenarios': [simplify_scenario(s) for s in network['scenarios'] if
+                      s['layout'].get('class') in INPUT_SCENARIO_CLASSES],
+        'attrs': template_index['attrs'],
+        'nodes': nodes,
+        'links': links,
+    }
+
+
+def invalidate_attribute_scenarios(network_id=None):
+    """Drop the cached index of a network, or of every network, e.g., when resource attributes are edited by id"""
+    if network_id is None:
+        attribute_scenario_cache.clear()
+    else:
+        attribute_scenario_cache.invalidate(lambda key: key[0] == network_id)
+
+
+def expand_attribute_scenarios(compact):
+    """Expand the compact form into the original form, with the attribute names and scenarios for each attribute"""
+    attrs = compact['attrs']
+    scenarios = compact['scenarios']
+    return {
+        res_type: {
+            resource_id: [{'id': ra_id, 'name': attrs[idx]['name'], 'scenarios': scenarios}
+                          for ra_id, idx in zip(entry['ids'], entry['attrs'])]
+            for resource_id, entry in compact[res_type].items()
+        }
+        for res_type in ['nodes', 'links']
+    }
@@ -0,0 +1,116 @@
+import json
+import time
+
+from app import config
+from app.core.caching import Cache, fingerprint
+
+# Resolved credentials and the per-user records looked up on every request, kept briefly so that warm requests make no
+# queries. Keys are:
+#   ('token', <hash>) or ('key', <hash>) -> (user, expires_at): a verified access token or API key
+#   ('datauser', user_id, source_id) -> datauser
+#   ('study', user_id, source_id, project_id) -> study
+# Credentials are hashed, so raw tokens and keys are never held in memory longer than the request.
+# Records are cached as read-only snapshots (below), never as ORM objects, which belong to the session that loaded
+# them and can't be shared between requests or threads.
+auth_cache = Cache(maxsize=config.AUTH_CACHE_SIZE, ttl=config.AUTH_CACHE_TTL)
+
+
+class Snapshot(object):
+    """A read-only copy of a database record's columns, detached from any session"""
+    fields = []
+
+    def __init__(self, record, **extra):
+        for field in self.fields:
+            object.__setattr__(self, field, extra[field] if field in extra else getattr(record, field, None))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is read-only'.format(type(self).__name__))
+
+    def _settings(self):
+        return json.loads(self.settings or '{}')
+
+
+class CachedUser(Snapshot):
+    fields = ['id', 'email', 'username', 'firstname', 'lastname', 'organization', 'settings']
+
+    def get(self, setting):
+        return self._settings().get(setting)
+
+    def get_settings(self):
+        return self._settings()
+
+    def to_json(self, include_id=False):
+        user = {
+            'username': self.username,
+            'email': self.email,
+        }
+        if include_id:
+            user['id'] = self.id
+
+        return user
+
+
+class CachedDataUser(Snapshot):
+    fields = ['id', 'user_id', 'dataurl_id', 'data_url', 'userid', 'username', 'settings']
+
+    def get_setting(self, setting):
+        return self._settings().get(setting)
+
+
+class CachedStudy(Snapshot):
+    fields = ['id', 'created_by', 'dataurl_id', 'project_id', 'settings', 'layout']
+
+    def get(self, setting):
+        return self._settings().get(setting)
+
+
+def snapshot(cls, record):
+    return None if record is None else cls(record)
+
+
+def credential_key(kind, credential):
+    return kind, fingerprint(credential)
+
+
+def get_cached_user(kind, credential):
+    """Get the user for a previously verified access token or API key, if still cached and not expired"""
+    entry = auth_cache.get(credential_key(kind, credential))
+    if entry is None:
+        return None
+    user, expires_at = entry
+    if expires_at and expires_at <= time.time():
+        auth_cache.pop(credential_key(kind, credential))
+        return None
+    return user
+
+
+def cache_user(kind, credential, user, expires_at=None):
+    """Cache a verified user for an access token or API key, returning the cached snapshot"""
+    user = snapshot(CachedUser, user)
+    auth_cache.set(credential_key(kind, credential), (user, expires_at))
+    return user
+
+
+def get_or_set(key, fn, cls):
+    """Get a cached record, or load it with fn() and cache a snapshot of it (as a cls)"""
+    return auth_cache.get_or_set(key, lambda: snapshot(cls, fn()))
+
+
+def invalidate_credential(kind, credential):
+    auth_cache.pop(credential_key(kind, credential))
+
+
+def invalidate_user(user_id):
+    """Forget everything cached for a user, e.g., after a password change or API key deletion. This only clears this
+    process's cache; other workers keep their copies until AUTH_CACHE_TTL expires them."""
+
+    def match(key, value):
+        if key[0] in ['token', 'key']:
+            return value[0] is not None and value[0].id == user_id
+        return key[0] == 'datauser' and key[1] == user_id
+
+    auth_cache.invalidate_items(match)
+
+
+def invalidate_studies():
+    auth_cache.invalidate(lambda key: key[0] == 'study')
@@ -0,0 +1,250 @@
+import json
+
+from app.core.edit_session import EditSession, EditSessionError
+
+
+def _error(index, item, error):
+    return {'index': index, 'id': item.get('id') if isinstance(item, dict) else item, 'error': str(error)}
+
+
+def _is_error(result):
+    return isinstance(result, dict) and 'error' in result
+
+
+def _reindex(errors, indexes):
+    """Report errors against the items' positions in the request, if the items are a selection from it"""
+    if indexes is not None:
+        for error in errors:
+            error['index'] = indexes[error['index']]
+    return errors
+
+
+def validate_resources(template, resource_type, resources):
+    """Check nodes or links against a template, returning a dict of item index to error message.
+
+    Only types belonging to the template are checked; types from other templates are passed through.
+    """
+    ttypes = {tt['id']: tt for tt in template['templatetypes']}
+    errors = {}
+    for i, resource in enumerate(resources):
+        if not resource.get('name'):
+            errors[i] = 'Missing name'
+            continue
+        if resource_type == 'LINK' and (resource.get('node_1_id') is None or resource.get('node_2_id') is None):
+            errors[i] = 'Links must have node_1_id and node_2_id'
+            continue
+        for rt in resource.get('types', []):
+            if rt.get('template_id') != template['id']:
+                continue
+            ttype = ttypes.get(rt['id'])
+            if ttype is None:
+                errors[i] = 'Unknown template type {}'.format(rt['id'])
+            elif ttype['resource_type'] != resource_type:
+                errors[i] = 'Template type {} is a {} type'.format(ttype['name'], ttype['resource_type'])
+    return errors
+
+
+def _run_batch(items, batch_fn, item_fn):
+    """Run a batch operation, falling back to one item at a time if the batch fails, to find the failed items.
+
+    Returns (results, errors), where results are in item order and errors are dicts with the item index.
+    """
+    results = []
+    errors = []
+    if not items:
+        return results, errors
+
+    values = [value for i, value in items]
+    batch_result = batch_fn(values)
+    if isinstance(batch_result, list) and len(batch_result) == len(values):
+        return list(batch_result), errors
+
+    for i, value in items:
+        result = item_fn(value)
+        if _is_error(result):
+            errors.append(_error(i, value, result['error']))
+        else:
+            results.append(result)
+    return results, errors
+
+
+def add_resources(hydra, network_id, template, resource_type, resources, indexes=None):
+    """Add many nodes or links to a network with one Hydra call, returning (added, errors).
+
+    indexes, if given, are the positions of the resources in the request, for errors to refer to.
+    """
+    invalid = validate_resources(template, resource_type, resources) if template else {}
+    errors = [_error(i, resources[i], msg) for i, msg in invalid.items()]
+    items = [(i, resource) for i, resource in enumerate(resources) if i not in invalid]
+    for i, resource in items:
+        resource.pop('id', None)
+
+    res = resource_type.lower()
+    added, _errors = _run_batch(
+        items,
+        lambda values: hydra.call('add_{}s'.format(res), network_id, values),
+        lambda value: hydra.call('add_{}'.format(res), network_id, value),
+    )
+    return added, _reindex(errors + _errors, indexes)
+
+
+def update_resources(hydra, network_id, template, resource_type, resources, indexes=None):
+    """Update many nodes and/or links of a network with one update_network call, returning (updated, errors).
+
+    indexes, if given, are the positions of the resources in the request, for errors to refer to.
+    """
+    invalid = validate_resources(template, resource_type, resources) if template else {}
+    errors = [_error(i, resources[i], msg) for i, msg in invalid.items()]
+    items = [(i, resource) for i, resource in enumerate(resources) if i not in invalid]
+    if not items:
+        return [], _reindex(errors, indexes)
+
+    network = hydra.call('get_network', network_id, include_resources=False, include_data=False, summary=True)
+    if 'error' in network:
+        return [], _reindex(errors + [_error(i, resource, network['error']) for i, resource in items], indexes)
+    network.update(nodes=[], links=[])
+
+    def _update(values):
+        session = EditSession(hydra, network)
+        for value in values:
+            if resource_type == 'NODE':
+                session.update_node(value)
+            else:
+                session.update_link(value)
+        try:
+            nodes, links = session.commit()
+        except EditSessionError as err:
+            return {'error': str(err)}
+        return nodes if resource_type == 'NODE' else links
+
+    res = resource_type.lower()
+    updated, _errors = _run_batch(items, _update, lambda value: hydra.call('update_{}'.format(res), value))
+    return updated, _reindex(errors + _errors, indexes)
+
+
+def update_network_resources(hydra, network_id, template, resource_type, resources):
+    """Update nodes and/or links of any networks, returning (updated, errors).
+
+    Each resource is updated in the network given by its network_id, or else by network_id, in one batch per network.
+    """
+    by_network = {}
+    for i, resource in enumerate(resources):
+        by_network.setdefault(resource.get('network_id') or network_id, []).append(i)
+
+    updated = []
+    errors = []
+    for _network_id, indexes in by_network.items():
+        _updated, _errors = update_resources(hydra, _network_id, template, resource_type,
+                                             [resources[i] for i in indexes], indexes=indexes)
+        updated.extend(_updated)
+        errors.extend(_errors)
+    return updated, sorted(errors, key=lambda error: error['index'])
+
+
+def delete_resources(hydra, resource_type, resource_ids, purge=True):
+    """Delete nodes or links, returning (deleted ids, errors)"""
+    fn = 'delete_{}'.format(resource_type.lower())
+    deleted = []
+    errors = []
+    for i, resource_id in enumerate(resource_ids):
+        result = hydra.call(fn, resource_id, purge)
+        if _is_error(result):
+            errors.append(_error(i, resource_id, result['error']))
+        else:
+            deleted.append(resource_id)
+    return deleted, errors
+
+
+def add_resource_attributes(hydra, resource_attributes):
+    """Add many resource attributes, each a dict of resource_type, resource_id, attr_id and is_var"""
+    added = []
+    errors = []
+    for i, ra in enumerate(resource_attributes):
+        missing = [key for key in ['resource_type', 'resource_id', 'attr_id'] if ra.get(key) is None]
+        if missing:
+            errors.append(_error(i, ra, 'Missing {}'.format(', '.join(missing))))
+            continue
+        result = hydra.call(
+            'add_resource_attribute',
+            resource_type=ra['resource_type'].upper(),
+            resource_id=ra['resource_id'],
+            attr_id=ra['attr_id'],
+            is_var='Y' if ra.get('is_var') in [True, 'Y'] else 'N'
+        )
+        if _is_error(result):
+            errors.append(_error(i, ra, result['error']))
+        else:
+            added.append(result)
+    return added, errors
+
+
+def update_resource_attributes(hydra, resource_attributes):
+    """Update many resource attributes, returning (updated ids, errors)"""
+    updated = []
+    errors = []
+    for i, ra in enumerate(resource_attributes):
+        result = hydra.call(
+            'update_resource_attribute',
+            resource_attr_id=ra['id'],
+            is_var=ra.get('attr_is_var', 'N'),
+            unit=ra.get('unit', ''),
+            data_type=ra.get('data_type', ''),
+            description=ra.get('description', ''),
+            properties=json.dumps(ra.get('properties') or {})
+        )
+        if _is_error(result):
+            errors.append(_error(i, ra, result['error']))
+        else:
+            updated.append(ra['id'])
+    return updated, errors
+
+
+def delete_resource_attributes(hydra, resource_attr_ids):
+    deleted = []
+    errors = []
+    for i, res_attr_id in enumerate(resource_attr_ids):
+        result = hydra.call('delete_resource_attribute', res_attr_id)
+        if _is_error(result):
+            errors.append(_error(i, res_attr_id, result['error']))
+        else:
+            deleted.append(res_attr_id)
+    return deleted, errors
+
+
+def assign_resource_types(hydra, template, resource_types):
+    """Assign template types to many resources in one Hydra call.
+
+    Each item is a dict of ref_key ('NODE', 'LINK' or 'NETWORK'), ref_id and type_id.
+    """
+    ttypes = {tt['id']: tt for tt in template['templatetypes']} if template else {}
+    errors = []
+    items = []
+    for i, rt in enumerate(resource_types):
+        ref_key = (rt.get('ref_key') or '').upper()
+        ttype = ttypes.get(rt.get('type_id'))
+        if template and ttype is None:
+            errors.append(_error(i, rt, 'Unknown template type {}'.format(rt.get('type_id'))))
+        elif ttype and ttype['resource_type'] != ref_key:
+            errors.append(_error(i, rt, 'Template type {} is a {} type'.format(ttype['name'], ttype['resource_type'])))
+        else:
+            items.append((i, {'ref_key': ref_key, 'ref_id': rt['ref_id'], 'type_id': rt['type_id']}))
+
+    assigned, _errors = _run_batch(
+        items,
+        lambda values: hydra.call('assign_types_to_resources', values),
+        lambda value: hydra.call('assign_type_to_resource', value['type_id'], value['ref_key'], value['ref_id']),
+    )
+    return assigned, errors + _errors
+
+
+def remove_resource_types(hydra, resource_types):
+    removed = []
+    errors = []
+    for i, rt in enumerate(resource_types):
+        result = hydra.call('remove_type_from_resource', type_id=rt['type_id'], resource_type=rt['ref_key'].upper(),
+                            resource_id=rt['ref_id'])
+        if _is_error(result):
+            errors.append(_error(i, rt, result['error']))
+        else:
+            removed.append(rt)
+    return removed, errors
@@ -0,0 +1,96 @@
+import json
+import hashlib
+from threading import RLock
+
+from cachetools import LRUCache, TTLCache
+
+
+class Cache(object):
+    """A small thread-safe wrapper around a cachetools cache.
+
+    Cached values are shared between requests (and threads) in a worker, so they should be treated as read-only.
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl) if ttl else LRUCache(maxsize=maxsize)
+        self._lock = RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._cache.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+        return value
+
+    def get_or_set(self, key, fn):
+        value = self.get(key)
+        if value is None:
+            value = self.set(key, fn())
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._cache.pop(key, default)
+
+    def invalidate(self, match):
+        """Remove all keys for which match(key) is True"""
+        with self._lock:
+            for key in [k for k in self._cache.keys() if match(k)]:
+                self._cache.pop(key, None)
+
+    def invalidate_items(self, match):
+        """Remove all items for which match(key, value) is True"""
+        with self._lock:
+            for key in [k for k, v in self._cache.items() if match(k, v)]:
+                self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+def fingerprint(*parts):
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(json.dumps(part, default=str, separators=(',', ':')).encode())
+    return h.hexdigest()
+
+
+def _types_summary(resource):
+    return [(rt.get('template_id'), rt.get('id')) for rt in resource.get('types', [])]
+
+
+def network_version(network):
+    """A cheap version key for a network's resources.
+
+    Hydra Platform does not bump a version number when nodes or links are edited, so the version is derived from
+    the resource content that affects downstream products (geometry, types and existence).
+    """
+    nodes = [
+        (n['id'], n['name'], n.get('x'), n.get('y'), _types_summary(n),
+         (n.get('layout') or {}).get('exists', True),
+         ((n.get('layout') or {}).get('geojson') or {}).get('geometry'))
+        for n in network.get('nodes', [])
+    ]
+    links = [
+        (l['id'], l['name'], l['node_1_id'], l['node_2_id'], _types_summary(l),
+         (l.get('layout') or {}).get('exists', True),
+         ((l.get('layout') or {}).get('geojson') or {}).get('geometry'))
+        for l in network.get('links', [])
+    ]
+    return '{}:{}'.format(network.get('id'), fingerprint(nodes, links))
+
+
+def template_version(template):
+    """A cheap version key for a template's types and their display layouts"""
+    ttypes = [
+        (tt['id'], tt.get('name'), tt.get('resource_type'), tt.get('layout'),
+         [(ta.get('attr_id'), ta.get('attr_is_var')) for ta in tt.get('typeattrs', [])])
+        for tt in template.get('templatetypes', [])
+    ]
+    return '{}:{}'.format(template.get('id'), fingerprint(ttypes))
@@ -0,0 +1,356 @@
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+from app import config
+from app.core.caching import Cache, fingerprint
+from app.core.files import s3_bucket
+from app.core.jobs import job_function, start_job
+from app.core.rollups import build_rollups, series_starts
+
+log = logging.getLogger(__name__)
+
+CUBE_FORMAT = 3
+
+# integer-coded columns, in sort order, followed by the values
+KEY_COLUMNS = ['resource', 'attr', 'subscenario', 'block', 'date']
+
+cube_cache = Cache(maxsize=32)
+rollup_cache = Cache(maxsize=128)
+build_locks = {}
+build_locks_lock = Lock()
+
+
+class ResultCube(object):
+    """The results of one (run, version, scenario), stored as one column per file and read with memory mapping.
+
+    Rows are sorted by resource, attribute, subscenario, block and date, and the row range of each (resource,
+    attribute) pair is kept, so selecting resources and attributes reads only their rows. Dates are filtered on the
+    distinct dates, so a date range costs a mask lookup per row rather than a date comparison.
+
+    Resources are keyed as they are stored: 'node/<id>' or 'link/<id>' (names instead of ids for human-readable
+    versions), or 'network' for network-level results. Attributes are the stored file names (attribute ids or names).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.levels = {key: self.meta[key] for key in KEY_COLUMNS}
+        self.perturbations = self.meta['perturbations']
+        self.pairs = np.load(os.path.join(path, 'pairs.npy'))  # resource, attr, start, end
+        self.dates = pd.DatetimeIndex(pd.to_datetime(self.levels['date']))
+        self.types = self.meta['types']  # template type of each resource, as stored
+        self._lookup = {key: {v: i for i, v in enumerate(self.levels[key])} for key in ['resource', 'attr']}
+        self.checked_at = time.time()  # when the result files were last compared with the cube's
+
+    def column(self, name):
+        return np.load(os.path.join(self.path, '{}.npy'.format(name)), mmap_mode='r')
+
+    def rollup(self, name):
+        """Get a precomputed rollup table (see app.core.rollups) as a dict of arrays"""
+        key = (self.path, name)
+        table = rollup_cache.get(key)
+        if table is None:
+            with np.load(os.path.join(self.path, 'rollups', '{}.npz'.format(name))) as f:
+                table = rollup_cache.set(key, dict(f))
+        return table
+
+    def rows(self, resources=None, attrs=None):
+        """Get the row numbers of the given resources and attributes (all if None), from the pair index"""
+        selected = np.ones(len(self.pairs), dtype=bool)
+        for key, values, col in [('resource', resources, 0), ('attr', attrs, 1)]:
+            if values is not None:
+                codes = [self._lookup[key][v] for v in values if v in self._lookup[key]]
+                selected &= np.isin(self.pairs[:, col], codes)
+        starts = self.pairs[selected, 2]
+        lengths = self.pairs[selected, 3] - starts
+        if not len(lengths):
+            return np.empty(0, dtype=np.int64)
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return np.arange(lengths.sum()) + offsets
+
+    def select(self, resources=None, attrs=None, start=None, end=None):
+        """Read a slice of the cube as codes, returning a DataFrame with a column per key, plus values.
+
+        Only the rows of the selected resources and attributes are read from disk.
+        """
+        rows = self.rows(resources, attrs)
+        frame = {key: self.column(key)[rows] for key in KEY_COLUMNS + ['value']}
+        if start or end:
+            keep = np.ones(len(self.dates), dtype=bool)
+            if start:
+                keep &= self.dates >= pd.Timestamp(start)
+            if end:
+                keep &= self.dates <= pd.Timestamp(end)
+            mask = keep[frame['date']]
+            frame = {key: values[mask] for key, values in frame.items()}
+        return pd.DataFrame(frame)
+
+
+def result_prefix(root_key, scenario, version):
+    """The storage prefix of the results of a scenario's run version"""
+    human_readable = version.get('human_readable', False)
+    return '{root_key}/results/{run_name}/{version}/{scenario}'.format(
+        root_key=root_key,
+        run_name=scenario['layout'].get('run'),
+        version=version.get(scenario['layout'].get('version_key', 'date')),
+        scenario=scenario['name'] if human_readable else scenario['id']
+    )
+
+
+def cube_path(bucket_name, prefix):
+    """The folder of a run version's cube, which holds a folder per build and current.json naming the current one"""
+    return os.path.join(config.RESULTS_CUBE_DIR, fingerprint(CUBE_FORMAT, bucket_name, prefix))
+
+
+def read_current(path):
+    """Get the current build of the cube at path, as {'version': <folder>, 'complete': <bool>}, or None if unbuilt"""
+    try:
+        with open(os.path.join(path, 'current.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def set_current(path, version, complete):
+    current = {'version': version, 'complete': complete}
+    fd, tmp = tempfile.mkstemp(dir=path)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(current, f)
+    os.replace(tmp, os.path.join(path, 'current.json'))
+    return current
+
+
+def list_result_files(bucket_name, prefix):
+    """List the result files under a prefix, as keys relative to it"""
+    if config.RESULTS_LOCAL_DIR:
+        folder = os.path.join(config.RESULTS_LOCAL_DIR, bucket_name, prefix)
+        return [os.path.relpath(os.path.join(root, name), folder) for root, _, names in os.walk(folder)
+                for name in names]
+
+    client = s3_bucket(bucket_name).meta.client
+    keys = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix + '/'):
+        keys.extend(obj['Key'][len(prefix) + 1:] for obj in page.get('Contents', []))
+    return keys
+
+
+def read_result_file(bucket_name, prefix, key, **kwargs):
+    if config.RESULTS_LOCAL_DIR:
+        return pd.read_csv(os.path.join(config.RESULTS_LOCAL_DIR, bucket_name, prefix, key), **kwargs)
+    client = s3_bucket(bucket_name).meta.client
+    body = client.get_object(Bucket=bucket_name, Key='{}/{}'.format(prefix, key))['Body'].read()
+    return pd.read_csv(io.BytesIO(body), **kwargs)
+
+
+def parse_result_key(key):
+    """Parse a result file key into (subscenario, resource, type, attr), or None if it is not a result file.
+
+    Keys are <subscenario>/network/<attr>.csv or <subscenario>/<node|link>/<type>/<resource>/<attr>.csv
+    """
+    parts = key.split('/')
+    if not key.endswith('.csv'):
+        return None
+    attr = parts[-1][:-4]
+    if len(parts) == 3 and parts[1] == 'network':
+        return parts[0], 'network', 'network', attr
+    if len(parts) == 5 and parts[1] in ['node', 'link']:
+        return parts[0], '{}/{}'.format(parts[1], parts[3]), '{}/{}'.format(parts[1], parts[2]), attr
+    return None
+
+
+def build_cube(bucket_name, prefix, path, max_workers=16, complete=False):
+    """Read every result file of a run version into a new build of the cube at path, and make it the current one.
+
+    Each build is written to a temporary folder first and then moved into a folder named by the result files read, so
+    a build is either whole or absent, and is never changed after. The build before is kept for any reads of it still
+    under way, and older ones are removed. complete marks a cube built once every run of the version has ended.
+    Returns the new current build (see read_current).
+    """
+    keys = sorted(list_result_files(bucket_name, prefix))
+    files = [(key, parse_result_key(key)) for key in keys]
+    files = [(key, parsed) for key, parsed in files if parsed]
+
+    perturbations = {}
+    if 'scenario_key.csv' in keys:
+        scenario_key = read_result_file(bucket_name, prefix, 'scenario_key.csv', index_col=0)
+        perturbations = {col: {str(sub): value for sub, value in scenario_key[col].items()}
+                         for col in scenario_key.columns}
+
+    def read(key):
+        df = read_result_file(bucket_name, prefix, key, index_col=0)
+        return df.index.astype(str).to_numpy(), df.to_numpy(dtype=float)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        tables = list(pool.map(read, [key for key, _ in files]))
+
+    levels = {key: [] for key in KEY_COLUMNS}
+    lookups = {key: {} for key in KEY_COLUMNS}
+
+    def code(key, value):
+        if value not in lookups[key]:
+            lookups[key][value] = len(levels[key])
+            levels[key].append(value)
+        return lookups[key][value]
+
+    types = {}
+    columns = {key: [] for key in KEY_COLUMNS + ['value']}
+    for (_, (subscenario, resource, rtype, attr)), (dates, values) in zip(files, tables):
+        n_dates, n_blocks = values.shape
+        types[resource] = rtype
+        date_codes = np.array([code('date', d) for d in dates], dtype=np.int32)
+        for block in range(n_blocks):
+            code('block', block)
+        columns['resource'].append(np.full(values.size, code('resource', resource), dtype=np.int32))
+        columns['attr'].append(np.full(values.size, code('attr', attr), dtype=np.int32))
+        columns['subscenario'].append(np.full(values.size, code('subscenario', subscenario), dtype=np.int32))
+        columns['block'].append(np.tile(np.arange(n_blocks, dtype=np.int32), n_dates))
+        columns['date'].append(np.repeat(date_codes, n_blocks))
+        columns['value'].append(values.ravel())
+
+    # re-code dates in time order, so that sorted codes are sorted dates
+    date_order = np.argsort(pd.to_datetime(levels['date']).values, kind='stable') if levels['date'] else []
+    date_rank = np.empty(len(date_order), dtype=np.int32)
+    date_rank[date_order] = np.arange(len(date_order))
+    levels['date'] = [levels['date'][i] for i in date_order]
+
+    columns = {key: np.concatenate(arrays) if arrays else np.empty(0, dtype=float if key == 'value' else np.int32)
+               for key, arrays in columns.items()}
+    if len(columns['date']):
+        columns['date'] = date_rank[columns['date']]
+    order = np.lexsort([columns[key] for key in reversed(KEY_COLUMNS)])
+    columns = {key: values[order] for key, values in columns.items()}
+
+    # row range of each (resource, attr) pair
+    pair = columns['resource'].astype(np.int64) * max(len(levels['attr']), 1) + columns['attr']
+    starts = np.flatnonzero(np.diff(pair, prepend=-1)) if len(pair) else np.empty(0, dtype=np.int64)
+    ends = np.append(starts[1:], len(pair)) if len(pair) else starts
+    pairs = np.column_stack([columns['resource'][starts], columns['attr'][starts], starts, ends]).astype(np.int64)
+
+    # dense cubes have every date for every series, and no missing values
+    n_series = series_starts(columns, KEY_COLUMNS[:-1]).sum()
+    dense = bool(len(pair) == n_series * len(levels['date']) and not np.isnan(columns['value']).any())
+
+    # sources identifies the result files read, to tell whether more have been written since
+    meta = dict(levels, format=CUBE_FORMAT, prefix=prefix, sources=fingerprint(*keys), rows=len(pair), dense=dense,
+                perturbations={
+                    name: [values.get(sub) for sub in levels['subscenario']] for name, values in perturbations.items()
+                }, types=[types[r] for r in levels['resource']])
+
+    os.makedirs(path, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=path)
+    try:
+        for key, values in columns.items():
+            np.save(os.path.join(tmp, '{}.npy'.format(key)), values)
+        np.save(os.path.join(tmp, 'pairs.npy'), pairs)
+        os.makedirs(os.path.join(tmp, 'rollups'))
+        rollups = build_rollups(columns, meta['types'], pd.DatetimeIndex(pd.to_datetime(levels['date'])))
+        for name, table in rollups.items():
+            np.savez(os.path.join(tmp, 'rollups', '{}.npz'.format(name)), **table)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.exists(os.path.join(path, meta['sources'])):  # built from the same files, e.g., by another worker
+            shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            os.replace(tmp, os.path.join(path, meta['sources']))
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    previous = read_current(path)
+    current = set_current(path, meta['sources'], complete)
+    keep = {current['version'], previous and previous['version']}
+    for name in os.listdir(path):
+        if name not in keep and not name.startswith('tmp') and os.path.isdir(os.path.join(path, name)):
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    rollup_cache.invalidate(lambda key: key[0].startswith(path + os.sep) and key[0] not in [
+        os.path.join(path, version) for version in keep if version])
+
+    return current
+
+
+def get_cube(bucket_name, prefix, build=True, refresh=False):
+    """Get the cube of a run version, building it on first access.
+
+    A run version's results are written by each of its runs as it ends, so a cube read while some are still running
+    has only the results written so far. Such a partial cube is rebuilt on access if the result files have changed,
+    checking at most every RESULTS_CUBE_RECHECK seconds, until the build job builds the complete cube once every run
+    of the version has ended (see start_cube_build). With refresh, the files are checked now and the cube is marked
+    complete. A cube rebuilt by another worker is used from the next call on, while reads of the one before finish
+    unchanged. Concurrent requests for a cube that is being built wait for the one build.
+    """
+    path = cube_path(bucket_name, prefix)
+    current = read_current(path)
+    cube = cube_cache.get(path)
+    if cube is not None and (current is None or cube.path != os.path.join(path, current['version'])):
+        cube = None  # rebuilt since, perhaps by another worker
+    if current is not None and not refresh and (
+            current['complete'] or cube is not None and time.time() - cube.checked_at < config.RESULTS_CUBE_RECHECK):
+        return cube or cube_cache.set(path, ResultCube(os.path.join(path, current['version'])))
+
+    if not build:
+        return cube or current and cube_cache.set(path, ResultCube(os.path.join(path, current['version'])))
+
+    with build_locks_lock:
+        lock = build_locks.setdefault(path, Lock())
+    with lock:
+        current = read_current(path)
+        if current is None or ((refresh or not current['complete']) and stale_cube(bucket_name, prefix, current)):
+            current = build_cube(bucket_name, prefix, path, max_workers=config.S3_COPY_WORKERS, complete=refresh)
+        elif refresh and not current['complete']:
+            current = set_current(path, current['version'], True)
+    build_locks.pop(path, None)
+
+    cube = cube_cache.get(path)
+    if cube is not None and cube.path == os.path.join(path, current['version']):
+        cube.checked_at = time.time()
+        return cube
+    return cube_cache.set(path, ResultCube(os.path.join(path, current['version'])))
+
+
+def stale_cube(bucket_name, prefix, current):
+    """Whether result files have been added (or removed) since the current build of a cube (see read_current)"""
+    return current['version'] != fingerprint(*sorted(list_result_files(bucket_name, prefix)))
+
+
+@job_function('build_result_cubes')
+def build_result_cubes_job(hydra, job, network_id, run=None):
+    """Build cubes for the latest version of each stored result scenario of a network, or rebuild them if results have
+    been added since they were built"""
+    network = hydra.call('get_network', network_id, include_data=False, summary=False, include_resources=False)
+    root_key = network['layout'].get('storage', {}).get('folder')
+    scenarios = hydra.call('get_scenarios', network_id=network_id)
+    scenarios = [s for s in scenarios if s['layout'].get('data_location') == 's3' and s['layout'].get('versions')]
+
+    built = list(job.state.get('built', []))
+    for i, scenario in enumerate(scenarios):
+        prefix = result_prefix(root_key, scenario, scenario['layout']['versions'][-1])
+        if prefix not in built:
+            get_cube(config.AWS_S3_BUCKET, prefix, refresh=True)
+            built.append(prefix)
+            job.checkpoint(built=built)
+        job.progress(i + 1, len(scenarios), 'Built results for {}'.format(scenario['name']))
+
+    return {'built': built}
+
+
+def start_cube_build(db, user_id, source_id, network_id, run):
+    """Build a network's result cubes in the background once a model run has ended.
+
+    run identifies the model run (see run_group_ended), which may have many sids, one per scenario combination; only
+    one build is started per run, however many times this is called for it.
+    """
+    job_id = str(uuid.uuid5(uuid.NAMESPACE_URL, 'build_result_cubes/{}/{}/{}'.format(source_id, network_id, run)))
+    return start_job(db, 'build_result_cubes', user_id, source_id, {'network_id': network_id, 'run': run},
+                     job_id=job_id)
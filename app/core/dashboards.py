@@ -2,6 +2,7 @@ import json
 from app.models import Dashboard, StudyDashboards, Card, DashboardCards
 from app.core.studies import get_study
 import bleach
+from app.core.aio import run_async
 
 
 def add_dashboard(db, study_id=None, network_id=None, dashboard=None):
@@ -138,3 +139,17 @@ def add_card_to_dashboard(db, dashboard_id, card_id):
     db.commit()
 
     return dc
+
+
+# async versions, for async routes (database work only)
+
+add_dashboard_async = run_async(add_dashboard)
+add_dashboard_to_study_async = run_async(add_dashboard_to_study)
+get_dashboards_async = run_async(get_dashboards)
+get_dashboard_async = run_async(get_dashboard)
+delete_dashboard_async = run_async(delete_dashboard)
+update_dashboard_async = run_async(update_dashboard)
+remove_card_from_dashboard_async = run_async(remove_card_from_dashboard)
+add_card_async = run_async(add_card)
+update_card_async = run_async(update_card)
+add_card_to_dashboard_async = run_async(add_card_to_dashboard)
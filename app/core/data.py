@@ -7,11 +7,17 @@ from ast import literal_eval
 import queue
 
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 
 from datetime import datetime
 # import dask.dataframe as dd
+import numpy as np
 import pandas as pd
 
+from app import config
+from app.core.aggregation import aggregate
+from app.core.cubes import get_cube, result_prefix
+from app.core.rollups import query_rollup
 from app.core.evaluators import OpenAguaEvaluator, PywrEvaluator
 from app.core.evaluators.utils import make_default_value, empty_data_timeseries, make_timesteps
 
@@ -872,68 +878,136 @@ def get_data_from_store(hydra, network, template_id, scenario, version, network_
     return all_dfs, perturbations, tag_names
 
 
+def get_result_resources(hydra, network, network_ids, node_ids, link_ids):
+    """Get the resources results are requested for, as needed to map the names in human-readable results to ids"""
+    if node_ids:
+        return hydra.call('get_nodes', node_ids=node_ids)
+    elif link_ids:
+        return hydra.call('get_links', link_ids=link_ids)
+    elif network_ids:
+        return [network]
+    return []
+
+
+def get_data_from_cube(network, scenario, version, network_ids, node_ids, link_ids, attr_ids, root_key,
+                       resources=None, agg=None):
+    """Read stored results from the run version's cube, in the same long form as get_data_from_store.
+
+    The requested resources, attributes and dates are pushed down to the cube, so only their rows are read. If the
+    aggregation can be answered exactly from the cube's rollups, the data is returned already aggregated, as
+    aggregate_data would return it. For human-readable versions, resources (from get_result_resources) map the stored
+    names to ids. No Hydra calls are made, so cubes can be read concurrently.
+
+    Returns (dfs, perturbations, tag_names, aggregated).
+    """
+    human_readable = version.get('human_readable', False)
+    cube = get_cube(config.AWS_S3_BUCKET, result_prefix(root_key, scenario, version))
+
+    if node_ids:
+        res_type, resource_ids = 'node', node_ids
+    elif link_ids:
+        res_type, resource_ids = 'link', link_ids
+    elif network_ids:
+        res_type, resource_ids = 'network', network_ids
+    else:
+        return [], None, [], False
+
+    # map the stored resource and attribute keys to resource keys and attribute ids
+    attr_keys = {str(a): a for a in attr_ids or []}
+    if res_type == 'network':
+        resource_keys = {'network': 'network/{}'.format(network['id'])}
+    else:
+        resource_keys = {'{}/{}'.format(res_type, r): '{}/{}'.format(res_type, r) for r in resource_ids}
+    if human_readable:
+        if res_type != 'network':
+            resource_keys = {'{}/{}'.format(res_type, r['name']): '{}/{}'.format(res_type, r['id'])
+                             for r in resources}
+        attr_keys = {ra['name']: ra['attr_id'] for r in resources for ra in r['attributes']
+                     if ra['attr_id'] in (attr_ids or [])}
+
+    agg = agg or {}
+    resources = list(resource_keys)
+    attrs = list(attr_keys) if attr_ids else None
+    rollup = query_rollup(cube, resources, attrs, agg) if agg else None
+    if rollup:
+        codes, time_index, time_name = rollup
+    else:
+        date_range = agg.get('range') or {}
+        date_range = date_range if date_range.get('mode') == 'custom' else {}
+        codes = cube.select(resources=resources, attrs=attrs, start=date_range.get('start'),
+                            end=date_range.get('end'))
+        time_index, time_name = cube.levels['date'], 'date'
+
+    def decode(level, column, lookup=None):
+        if lookup is not None:
+            level = [lookup.get(v, v) for v in level]
+        return np.asarray(level, dtype=object).take(codes[column].to_numpy())
+
+    data = {'scenario_id': scenario['id']}
+    for name, values in cube.perturbations.items():
+        data[name] = decode(values, 'subscenario')
+    if 'resource' in codes:
+        data['resource_key'] = decode(cube.levels['resource'], 'resource', resource_keys)
+    data['attr_id'] = decode(cube.levels['attr'], 'attr', attr_keys)
+    if rollup:
+        times = time_index.take(codes['time'].to_numpy())
+        data[time_name] = times.year if time_name == 'Year' else times
+    else:
+        data['date'] = decode(time_index, 'date')
+    data['block'] = codes['block'].to_numpy()
+    data['value'] = codes['value'].to_numpy()
+    df = pd.DataFrame(data, index=pd.RangeIndex(len(codes)))
+
+    return [df], list(cube.perturbations) or None, [], bool(rollup)
+
+
+def plan_results_query(hydra, network_id, scenario_ids, versions=None):
+    """Resolve the requested scenarios, their child scenarios and their versions in one metadata pass.
+
+    Returns a plan of {'source': [...], 'store': [...], 'network': ...}, where source lists the ids of scenarios to
+    read from Hydra (children in place of their parents), store lists (data_location, scenario, version) for stored
+    results, and network is the network (without resources) if stored results are needed.
+    """
+    if network_id:
+        all_scenarios = hydra.call('get_scenarios', network_id=network_id)
+    else:
+        all_scenarios = [hydra.call('get_scenario', scenario_id, include_data=False) for scenario_id in scenario_ids]
+    scenario_lookup = {s['id']: s for s in all_scenarios}
+    children = {}
+    for s in all_scenarios:
+        if s.get('parent_id'):
+            children.setdefault(s['parent_id'], []).append(s['id'])
+
+    plan = {'source': [], 'store': [], 'network': None}
+    for scenario_id in scenario_ids:
+        scenario = scenario_lookup.get(scenario_id) or hydra.call('get_scenario', scenario_id, include_data=False)
+        layout = scenario['layout']
+        data_location = layout.get('data_location', 'source')
+
+        if data_location == 'source':
+            child_ids = children.get(scenario_id) if layout.get('parent_ids') else None
+            plan['source'].extend(child_ids or [scenario_id])
+
+        elif data_location in ['s3', 'hdf5']:
+            all_versions = layout.get('versions', [])
+            version_ids = (versions or {}).get(str(scenario_id))
+            if not version_ids:
+                selected_versions = all_versions[-1:]
+            else:
+                version_lookup = {version['number']: version for version in all_versions}
+                selected_versions = [version_lookup.get(v) for v in version_ids]
+            plan['store'].extend((data_location, scenario, v) for v in selected_versions if v)
+
+    if plan['store'] and network_id:
+        plan['network'] = hydra.call('get_network', network_id, include_data=False, summary=False,
+                                     include_resources=False)
+
+    return plan
+
+
 def aggregate_data(data, agg, idx_names):
     if agg:
-
-        data = data.reset_index()
-        data['date'] = pd.to_datetime(data['date'])
-
-        # time filter
-        range = agg.get('range', {})
-        if range and range.get('mode') == 'custom':
-            start = range.get('start')
-            end = range.get('end')
-            if start or end:
-                data.set_index(['date'])
-                if start and end:
-                    mask = (data['date'] >= start) & (data['date'] <= end)
-                elif start and not end:
-                    mask = data['date'] >= start
-                else:
-                    mask = data['date'] <= end
-                data = data.loc[mask]
-                data.reset_index()
-
-        # spatial aggregation
-        spatial = agg.get('space', {})
-        f = spatial.get('function')
-        if f in ['sum', 'mean']:
-            idx_names.remove('resource_key')
-            data = data.groupby(idx_names).agg(f).reset_index()
-
-        # temporal aggregation
-        temporal = agg.get('time', {})
-        f = temporal.get('function')
-        p = temporal.get('step')
-
-        if p and f in ['sum', 'mean']:
-            # https://stackoverflow.com/questions/35295689/how-to-aggregate-data-by-date-and-string-multiindex-using-pandas-then-print-to
-            idx_names.remove('date')
-            if p == 'month':
-                time_group = ['year', 'month', 'day']
-                data['year'] = data['date'].dt.year
-                data['month'] = data['date'].dt.month
-                data['day'] = 1
-                data = data.groupby(idx_names + time_group).agg(f).reset_index()
-                data['date'] = pd.to_datetime(data[time_group])
-                cols = list(data.columns)
-                cols.remove('date')
-                for tg in time_group:
-                    cols.remove(tg)
-                cols.insert(cols.index('block'), 'date')
-                data = data[cols]
-            elif p == 'year':
-                data['Year'] = data['date'].dt.year
-                del data['date']
-                data = data.groupby(idx_names + ['Year']).agg(f).reset_index()
-                cols = list(data.columns)
-                cols.remove('Year')
-                cols.insert(cols.index('block'), 'Year')
-                data = data[cols]
-
-        new_cols = list(data.columns)
-        new_cols.remove('value')
-        data.set_index(new_cols, inplace=True)
+        data = aggregate(data, agg)
 
     return data
 
@@ -953,81 +1027,72 @@ def filter_results_data(hydra, filters, project_id=None, network_id=None, templa
     agg = filters.get('agg', {})
 
     data = []
-    perturbations = None
+    aggregated = []  # data already aggregated from rollups
+    perturbations = []
     tag_names = []
 
-    for scenario_id in scenarios:
-        scenario = hydra.call('get_scenario', scenario_id, include_data=False)
-
-        layout = scenario['layout']
-        run_name = layout.get('run')
-        data_location = layout.get('data_location', 'source')
-        all_versions = scenario['layout'].get('versions', [])
-
-        if data_location == 'source':
-
-            parent_ids = layout.get('parent_ids')
-            if parent_ids:
-                # check if child scenarios exist
-                child_scenarios = hydra.call('get_scenarios', network_id=network_id, parent_id=scenario_id)
-                if child_scenarios:
-                    scenario_ids = [s['id'] for s in child_scenarios]
-                else:
-                    scenario_ids = [scenario_id]
-
-            else:
-                scenario_ids = [scenario_id]
-
-            dfs, perturbations, tag_names = get_data_from_hydra(
-                hydra, network_id, scenario_ids, networks, nodes, links, ttypes, attrs,
+    def add_perturbations(names):
+        for name in names or []:
+            if name not in perturbations:
+                perturbations.append(name)
+
+    plan = plan_results_query(hydra, network_id, scenarios, versions=versions)
+
+    network = plan['network']
+    root_key = network['layout'].get('storage', {}).get('folder') if network else None
+    cube_reads = [(scenario, version) for location, scenario, version in plan['store'] if location == 's3']
+    resources = None
+    if any(version.get('human_readable') for _, version in cube_reads):
+        resources = get_result_resources(hydra, network, networks, nodes, links)
+
+    with ThreadPoolExecutor(max_workers=config.RESULTS_QUERY_WORKERS) as pool:
+        # stored results are read concurrently, while Hydra is queried on this thread
+        futures = [
+            pool.submit(get_data_from_cube, network, scenario, version, networks, nodes, links, attrs, root_key,
+                        resources=resources, agg=agg)
+            for scenario, version in cube_reads
+        ]
+
+        if plan['source']:
+            dfs, source_perturbations, tag_names = get_data_from_hydra(
+                hydra, network_id, plan['source'], networks, nodes, links, ttypes, attrs,
                 include_tags=include_tags, maxrows=maxrows)
+            add_perturbations(source_perturbations)
             data.extend(dfs)
 
-        elif data_location in ['s3', 'hdf5']:
+        for location, scenario, version in plan['store']:
+            if location == 'hdf5':
+                dfs, store_perturbations, tag_names = get_data_from_store(
+                    hydra, network, template_id, scenario, version, networks, nodes, links, attrs, root_key,
+                    data_location=location, include_tags=include_tags, maxrows=maxrows)
+                add_perturbations(store_perturbations)
+                data.extend(dfs)
 
-            root_key = None
-            network = None
-            if network_id:
-                network = hydra.call('get_network', network_id, include_data=False, summary=False,
-                                     include_resources=False)
-                root_key = network['layout'].get('storage', {}).get('folder')
+        for future in futures:
+            dfs, cube_perturbations, _, is_aggregated = future.result()
+            add_perturbations(cube_perturbations)
+            (aggregated if is_aggregated else data).extend(dfs)
 
-            if not versions:
-                if not all_versions:
-                    version = None
-                else:
-                    version = all_versions[-1]
-
-                dfs, perturbations, tag_names = get_data_from_store(hydra, network, template_id, scenario, version,
-                                                                    networks,
-                                                                    nodes, links,
-                                                                    attrs, root_key,
-                                                                    data_location=data_location,
-                                                                    include_tags=include_tags, maxrows=maxrows)
-                data.extend(dfs)
+    perturbations = perturbations or None
 
-            else:
-                version_lookup = {version['number']: version for version in all_versions}
-                for version_id in versions.get(str(scenario_id)):
-                    version = version_lookup.get(version_id)
-                    dfs, perturbations, tag_names = get_data_from_store(hydra, network, template_id, scenario, version,
-                                                                        networks,
-                                                                        nodes, links,
-                                                                        attrs, root_key,
-                                                                        data_location=data_location,
-                                                                        include_tags=include_tags, maxrows=maxrows)
-                    data.extend(dfs)
-
-    if data:
-
-        data = pd.concat(data)
-        data.fillna('', inplace=True)
+    if data or aggregated:
 
-        idx_names = [c for c in data.columns if c != 'value'] + tag_names
-        data.set_index(idx_names, inplace=True)
+        if data:
+            data = pd.concat(data)
+            data.fillna('', inplace=True)
+
+            idx_names = [c for c in data.columns if c != 'value'] + tag_names
+            data.set_index(idx_names, inplace=True)
+
+            if agg:
+                data = aggregate_data(data, agg, idx_names=idx_names)
 
-        if agg:
-            data = aggregate_data(data, agg, idx_names=idx_names)
+        if aggregated:
+            if len(data):
+                aggregated.append(data.reset_index())
+            data = pd.concat(aggregated)
+            data.fillna({c: '' for c in data.columns if c != 'value'}, inplace=True)
+            data.set_index([c for c in data.columns if c != 'value'], inplace=True)
 
         # reorganization
         if unstack:
@@ -0,0 +1,130 @@
+import time
+from collections import deque
+from threading import Lock
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+def pool_limits(workers, threads, jobs=0, max_connections=0):
+    """Size a worker process's connection pool.
+
+    Each worker can use a connection from every thread that runs sync routes or background jobs at once, so that is
+    the pool size, with a quarter again as overflow for bursts. If the database limits the app's connections, the limit
+    is shared between the workers, leaving a little headroom for migrations and consoles.
+
+    Returns (pool_size, max_overflow).
+    """
+    demand = threads + jobs
+    pool_size = demand
+    max_overflow = max(demand // 4, 1)
+    if max_connections:
+        per_worker = max((max_connections - 2) // max(workers, 1), 2)
+        pool_size = min(pool_size, per_worker)
+        max_overflow = min(max_overflow, per_worker - pool_size)
+    return pool_size, max_overflow
+
+
+class PoolStats(object):
+    """Counters for a connection pool: checkout waits, timeouts, overflow and connections held too long"""
+
+    def __init__(self, leak_seconds=300, window=1000):
+        self.leak_seconds = leak_seconds
+        self._lock = Lock()
+        self._waits = deque(maxlen=window)  # recent checkout waits, in seconds
+        self._held = {}  # id of checked out connection record -> checkout time
+        self.checkouts = 0
+        self.timeouts = 0
+        self.max_wait = 0.0
+        self.peak_checked_out = 0
+        self.peak_overflow = 0
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self._waits.append(seconds)
+            self.max_wait = max(self.max_wait, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def checkout(self, record, overflow):
+        with self._lock:
+            self.checkouts += 1
+            self._held[id(record)] = time.monotonic()
+            self.peak_checked_out = max(self.peak_checked_out, len(self._held))
+            self.peak_overflow = max(self.peak_overflow, overflow)
+
+    def checkin(self, record):
+        with self._lock:
+            self._held.pop(id(record), None)
+
+    def leaked(self):
+        cutoff = time.monotonic() - self.leak_seconds
+        with self._lock:
+            return sum(1 for started in self._held.values() if started < cutoff)
+
+    def summary(self, pool):
+        with self._lock:
+            waits = sorted(self._waits)
+
+        def percentile(q):
+            return round(waits[min(int(q * len(waits)), len(waits) - 1)] * 1000, 3) if waits else None
+
+        queued = isinstance(pool, QueuePool)
+        return {
+            'pool_size': pool.size() if queued else None,
+            'checked_out': pool.checkedout() if queued else len(self._held),
+            'overflow': max(pool.overflow(), 0) if queued else 0,
+            'peak_checked_out': self.peak_checked_out,
+            'peak_overflow': self.peak_overflow,
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'leaked': self.leaked(),
+            'wait_ms': {
+                'p50': percentile(0.5),
+                'p95': percentile(0.95),
+                'p99': percentile(0.99),
+                'max': round(self.max_wait * 1000, 3),
+            },
+        }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that times how long each checkout waits for a connection"""
+
+    stats = None
+
+    def _do_get(self):
+        if self.stats is None:
+            return super()._do_get()
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        self.stats.record_wait(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def instrument(engine, leak_seconds=300):
+    """Count checkouts, checkins and overflow on an engine's pool, returning its PoolStats"""
+    stats = PoolStats(leak_seconds=leak_seconds)
+    if isinstance(engine.pool, InstrumentedQueuePool):
+        engine.pool.stats = stats
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, record, proxy):
+        pool = engine.pool
+        stats.checkout(record, pool.overflow() if isinstance(pool, QueuePool) else 0)
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, record):
+        stats.checkin(record)
+
+    return stats
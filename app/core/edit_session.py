@@ -0,0 +1,181 @@
+from copy import deepcopy
+
+# GeoJSON properties that refer to resource ids, which are not known for new resources until they are committed
+ID_PROPERTIES = ['id', 'node_1_id', 'node_2_id']
+
+
+class EditSessionError(Exception):
+    pass
+
+
+class EditSession(object):
+    """Accumulate node and link edits to a network and commit them with a single Hydra call.
+
+    New nodes and links get negative temporary ids, which new or updated links can use to refer to new nodes. Nothing
+    is written until commit(), when all creates and updates are sent in one update_network call, so a failure leaves
+    the network as it was. Deletions are made only after that call succeeds.
+    """
+
+    def __init__(self, hydra, network):
+        self.hydra = hydra
+        self.network = network
+        self._nodes = {n['id']: n for n in network['nodes']}
+        self._links = {l['id']: l for l in network['links']}
+        self.names = {  # of all nodes and links, including new ones
+            'node': {n['name'] for n in network['nodes']},
+            'link': {l['name'] for l in network['links']},
+        }
+        self._next_id = -1
+
+        self.nodes = {}
+        self.links = {}
+        self.scenarios = {}
+        self.network_updates = {}
+        self.deleted_node_ids = []
+        self.deleted_link_ids = []
+        self.id_map = {}
+
+    def _temp_id(self):
+        temp_id = self._next_id
+        self._next_id -= 1
+        return temp_id
+
+    def unique_name(self, resource_type, name):
+        names = self.names[resource_type]
+        unique_name = name
+        i = 0
+        while unique_name in names:
+            i += 1
+            unique_name = '{} ({})'.format(name, i)
+        names.add(unique_name)
+        return unique_name
+
+    def get_node(self, node_id):
+        return self.nodes.get(node_id) or self._nodes.get(node_id)
+
+    def get_link(self, link_id):
+        return self.links.get(link_id) or self._links.get(link_id)
+
+    def add_node(self, node):
+        node = deepcopy(node)
+        node['id'] = self._temp_id()
+        self.nodes[node['id']] = node
+        return node
+
+    def update_node(self, node):
+        self.nodes[node['id']] = node
+        return node
+
+    def delete_node(self, node_id):
+        self.nodes.pop(node_id, None)
+        if node_id > 0:
+            self.deleted_node_ids.append(node_id)
+
+    def add_link(self, link):
+        link = deepcopy(link)
+        link['id'] = self._temp_id()
+        self.links[link['id']] = link
+        return link
+
+    def update_link(self, link):
+        self.links[link['id']] = link
+        return link
+
+    def delete_link(self, link_id):
+        self.links.pop(link_id, None)
+        if link_id > 0:
+            self.deleted_link_ids.append(link_id)
+
+    def update_scenario(self, scenario):
+        self.scenarios[scenario['id']] = scenario
+        return scenario
+
+    def update_network(self, **fields):
+        """Update network-level fields, such as layout, types or attributes"""
+        self.network_updates.update(fields)
+
+    def repoint_links(self, old_node_id, new_node_id):
+        """Connect all links attached to one node to another node instead"""
+        links = {**self._links, **self.links}
+        updated_links = []
+        for link in links.values():
+            if old_node_id not in [link['node_1_id'], link['node_2_id']] or link['id'] in self.deleted_link_ids:
+                continue
+            link = deepcopy(link)
+            properties = ((link.get('layout') or {}).get('geojson') or {}).get('properties', {})
+            for key in ['node_1_id', 'node_2_id']:
+                if link[key] == old_node_id:
+                    link[key] = new_node_id
+                    if key in properties:
+                        properties[key] = new_node_id
+            updated_links.append(self.update_link(link))
+        return updated_links
+
+    def _payload_resource(self, resource):
+        resource = deepcopy(resource)
+        gj = (resource.get('layout') or {}).get('geojson')
+        if gj and gj.get('properties'):
+            for key in ID_PROPERTIES:
+                value = gj['properties'].get(key)
+                if value is not None and value < 0:
+                    del gj['properties'][key]
+        return resource
+
+    def _map_new_ids(self, resources, existing, saved):
+        """Map the temporary ids of new resources to the ids Hydra gave them.
+
+        Hydra adds new resources in the order they are sent, so the ids of the saved resources that didn't exist before
+        ascend in that order. If the number of those differs, e.g., because another user added a resource at the same
+        time, they are matched by name instead.
+        """
+        temp_ids = [temp_id for temp_id in resources if temp_id < 0]
+        if not temp_ids:
+            return
+        new = sorted((r for r in saved.values() if r['id'] not in existing), key=lambda r: r['id'])
+        if len(new) == len(temp_ids):
+            matches = zip(temp_ids, new)
+        else:
+            by_name = {r['name']: r for r in new}
+            matches = [(temp_id, by_name[resources[temp_id]['name']]) for temp_id in temp_ids
+                       if resources[temp_id]['name'] in by_name]
+        for temp_id, resource in matches:
+            self.id_map[temp_id] = resource['id']
+
+    def commit(self):
+        """Write all edits to Hydra, returning the saved (nodes, links). Temporary ids are mapped in self.id_map."""
+        if self.nodes or self.links or self.scenarios or self.network_updates:
+            payload = {k: v for k, v in self.network.items() if k not in
+                       ['nodes', 'links', 'resourcegroups', 'scenarios', 'attributes', 'types', 'owners']}
+            payload.update(self.network_updates)
+            payload['nodes'] = [self._payload_resource(n) for n in self.nodes.values()]
+            payload['links'] = [self._payload_resource(l) for l in self.links.values()]
+            if self.scenarios:
+                payload['scenarios'] = list(self.scenarios.values())
+
+            result = self.hydra.call('update_network', payload)
+            if 'error' in result:
+                raise EditSessionError(result['error'])
+
+            if not result.get('nodes') or not result.get('links'):
+                result = self.hydra.call('get_network', self.network['id'], include_resources=True, include_data=False,
+                                         summary=True)
+
+            saved_nodes = {n['id']: n for n in result.get('nodes', [])}
+            saved_links = {l['id']: l for l in result.get('links', [])}
+            self._map_new_ids(self.nodes, self._nodes, saved_nodes)
+            self._map_new_ids(self.links, self._links, saved_links)
+
+            nodes = [saved_nodes.get(self.id_map.get(n['id'], n['id']), n) for n in self.nodes.values()]
+            links = [saved_links.get(self.id_map.get(l['id'], l['id']), l) for l in self.links.values()]
+            for link in links:
+                for key in ['node_1_id', 'node_2_id']:
+                    link[key] = self.id_map.get(link[key], link[key])
+        else:
+            nodes, links = [], []
+
+        for link_id in self.deleted_link_ids:
+            self.hydra.call('delete_link', link_id, True)
+        for node_id in self.deleted_node_ids:
+            self.hydra.call('delete_node', node_id, True)
+
+        return nodes, links
@@ -1,5 +1,6 @@
 from app.core.studies import get_study
 from app.models import Favorite
+from app.core.aio import run_async
 
 
 # favorites
@@ -18,8 +19,6 @@ def add_favorite(db, study_id, name, description, type, thumbnail, filters, pivo
     db.add(favorite)
     db.commit()
 
-    db.close()
-
     return favorite.id
 
 
@@ -115,3 +114,13 @@ def delete_favorites(db, favorite_ids=None):
     except:
         error = 1
     return error
+
+
+# async versions, for async routes (database work only)
+
+add_favorite_async = run_async(add_favorite)
+add_update_favorite_async = run_async(add_update_favorite)
+get_favorite_async = run_async(get_favorite)
+get_favorites_async = run_async(get_favorites)
+delete_favorite_async = run_async(delete_favorite)
+delete_favorites_async = run_async(delete_favorites)
@@ -3,6 +3,7 @@ import string
 import boto3
 from botocore.client import Config
 
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 from threading import Thread
 
@@ -306,6 +307,41 @@ def duplicate_folder(old_bucket_name, new_bucket_name, old_folder, new_folder, p
         new_obj.copy(old_source)
 
 
+def copy_folder_parallel(bucket_name, old_folder, new_folder, prefix=None, start_after=None, max_workers=16,
+                         batch_size=100, on_progress=None, s3=None):
+    """Copy everything under one folder to another folder in the same bucket.
+
+    Objects are copied server-side (with CopyObject), several at a time, so nothing is downloaded. They are copied in
+    key order, in batches of batch_size, and after each batch on_progress(last_key, copied, total) is called with the
+    last old key copied so far. Passing that key back as start_after (e.g., when resuming an interrupted job) skips
+    everything up to and including it. Returns the number of objects copied.
+    """
+    if prefix:
+        old_folder += '/' + prefix
+        new_folder += '/' + prefix
+    bucket = s3_bucket(bucket_name, s3=s3)
+    client = bucket.meta.client
+
+    keys = []
+    paginator = client.get_paginator('list_objects_v2')
+    kwargs = {'StartAfter': start_after} if start_after else {}
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=old_folder, **kwargs):
+        for obj in page.get('Contents', []):
+            keys.append((obj['Key'], new_folder + obj['Key'][len(old_folder):]))
+
+    if not keys:
+        return 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            for future in [pool.submit(copy_object, client, bucket_name, old_key, new_key)
+                           for old_key, new_key in batch]:
+                future.result()
+            if on_progress:
+                on_progress(batch[-1][0], i + len(batch), len(keys))
+    return len(keys)
+
+
 def delete_folder(bucket, folder):
     bucket.objects.filter(Prefix=folder).delete()
 
@@ -0,0 +1,157 @@
+import numpy
+
+from app.core.caching import Cache, network_version
+
+geometry_cache = Cache(maxsize=32)
+
+
+def _exists(resource):
+    return (resource.get('layout') or {}).get('exists', True)
+
+
+def _geojson_coords(resource):
+    gj = (resource.get('layout') or {}).get('geojson')
+    if gj:
+        return gj.get('geometry', {}).get('coordinates')
+    return None
+
+
+class NetworkGeometry(object):
+    """A compact, array-based index of a network's geometry and topology.
+
+    Nodes and links are stored as rows in NumPy arrays, in the order they appear in the network, with lookups from
+    resource id to row. Link vertices are stored in one flat coordinate array, with link i's vertices at
+    link_coords[link_indptr[i]:link_indptr[i + 1]]. Node-to-node adjacency is stored in CSR form, so that the
+    downstream links of node row i are adj_links[adj_indptr[i]:adj_indptr[i + 1]].
+    """
+
+    def __init__(self, network):
+        nodes = network.get('nodes', [])
+        links = network.get('links', [])
+
+        # nodes
+        self.node_ids = numpy.array([n['id'] for n in nodes], dtype=numpy.int64)
+        self.node_row = {node_id: i for i, node_id in enumerate(self.node_ids.tolist())}
+        self.node_names = [n['name'] for n in nodes]
+        self.node_exists = numpy.array([_exists(n) for n in nodes], dtype=bool)
+
+        # Hydra saves coordinates to the nearest 0.0001 degree, while OpenAgua also stores higher resolution
+        # coordinates in the node's GeoJSON, so both are kept.
+        self.node_xy = numpy.array([(float(n['x']), float(n['y'])) for n in nodes], dtype=float).reshape(-1, 2)
+        node_gj_xy = self.node_xy.copy()
+        for i, n in enumerate(nodes):
+            coords = _geojson_coords(n)
+            if coords:
+                node_gj_xy[i] = (float(coords[0]), float(coords[1]))
+        self.node_gj_xy = node_gj_xy
+
+        # links
+        self.link_ids = numpy.array([l['id'] for l in links], dtype=numpy.int64)
+        self.link_row = {link_id: i for i, link_id in enumerate(self.link_ids.tolist())}
+        self.link_names = [l['name'] for l in links]
+        self.link_exists = numpy.array([_exists(l) for l in links], dtype=bool)
+        self.link_node_ids = numpy.array([(l['node_1_id'], l['node_2_id']) for l in links],
+                                         dtype=numpy.int64).reshape(-1, 2)
+        node_row = self.node_row
+        self.link_nodes = numpy.array(
+            [(node_row.get(n1, -1), node_row.get(n2, -1)) for n1, n2 in self.link_node_ids.tolist()],
+            dtype=numpy.int64
+        ).reshape(-1, 2)
+
+        # link vertices, falling back to the end nodes if there is no GeoJSON
+        has_geojson = numpy.zeros(len(links), dtype=bool)
+        counts = numpy.zeros(len(links), dtype=numpy.int64)
+        vertices = []
+        for i, l in enumerate(links):
+            coords = _geojson_coords(l)
+            if coords:
+                has_geojson[i] = True
+                vertices.extend((float(c[0]), float(c[1])) for c in coords)
+                counts[i] = len(coords)
+            else:
+                n1, n2 = self.link_nodes[i]
+                for row in (n1, n2):
+                    vertices.append(tuple(self.node_xy[row]) if row >= 0 else (numpy.nan, numpy.nan))
+                counts[i] = 2
+        self.link_has_geojson = has_geojson
+        self.link_indptr = numpy.concatenate([[0], numpy.cumsum(counts)]).astype(numpy.int64)
+        self.link_coords = numpy.array(vertices, dtype=float).reshape(-1, 2)
+
+        # resource types, as (template_id, type_id, type_name) in resource order
+        self._node_types = [[(t['template_id'], t['id'], t.get('name')) for t in n.get('types', [])] for n in nodes]
+        self._link_types = [[(t['template_id'], t['id'], t.get('name')) for t in l.get('types', [])] for l in links]
+        self.type_names = {}
+        for types in self._node_types + self._link_types:
+            for template_id, type_id, type_name in types:
+                self.type_names[type_id] = type_name
+        self._type_id_cache = {}
+
+        self._build_adjacency()
+
+    def _build_adjacency(self):
+        n = len(self.node_ids)
+        valid = numpy.all(self.link_nodes >= 0, axis=1)
+        link_rows = numpy.flatnonzero(valid)
+        sources = self.link_nodes[valid, 0]
+        order = numpy.argsort(sources, kind='stable')
+        self.adj_links = link_rows[order]
+        self.adj_indices = self.link_nodes[self.adj_links, 1]
+        self.adj_indptr = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(sources, minlength=n))]) \
+            .astype(numpy.int64)
+
+    def type_ids(self, resource_type, template_id):
+        """Get an array of the first type id of each node or link in a template, with -1 where there is none"""
+        key = (resource_type, template_id)
+        if key not in self._type_id_cache:
+            resources = self._node_types if resource_type == 'NODE' else self._link_types
+            self._type_id_cache[key] = numpy.array(
+                [next((type_id for tid, type_id, name in types if tid == template_id), -1) for types in resources],
+                dtype=numpy.int64
+            )
+        return self._type_id_cache[key]
+
+    def type_names_for(self, resource_type, template_id, default='unknown'):
+        type_names = self.type_names
+        return [type_names.get(type_id, default) if type_id >= 0 else default
+                for type_id in self.type_ids(resource_type, template_id).tolist()]
+
+    def link_vertices(self, row):
+        return self.link_coords[self.link_indptr[row]:self.link_indptr[row + 1]]
+
+    def extents(self, template_id):
+        """Get (left, bottom, right, top) of existing nodes and GeoJSON links in the template"""
+        node_mask = self.node_exists & (self.type_ids('NODE', template_id) >= 0)
+        link_mask = self.link_exists & self.link_has_geojson & (self.type_ids('LINK', template_id) >= 0)
+
+        coords = [self.node_xy[node_mask]]
+        if link_mask.any():
+            counts = numpy.diff(self.link_indptr)
+            coords.append(self.link_coords[numpy.repeat(link_mask, counts)])
+        coords = numpy.concatenate(coords)
+        if not len(coords):
+            return 0, 0, 0, 0
+        left, bottom = coords.min(axis=0).tolist()
+        right, top = coords.max(axis=0).tolist()
+        return left, bottom, right, top
+
+    def downstream_nodes(self, node_id):
+        row = self.node_row[node_id]
+        rows = self.adj_indices[self.adj_indptr[row]:self.adj_indptr[row + 1]]
+        return self.node_ids[rows].tolist()
+
+    def iter_adjacency_csv(self):
+        """Yield the rows of a node-by-node adjacency matrix as CSV lines, without building the dense matrix"""
+        n = len(self.node_ids)
+        names = ['"{}"'.format(name) for name in self.node_names]
+        yield ','.join([''] + names)
+        row = numpy.zeros(n, dtype=numpy.int8)
+        for i in range(n):
+            cols = self.adj_indices[self.adj_indptr[i]:self.adj_indptr[i + 1]]
+            row[cols] = 1
+            yield ','.join([names[i]] + row.astype(str).tolist())
+            row[cols] = 0
+
+
+def get_network_geometry(network):
+    """Get (or build) the geometry index of a network. The index is cached per network version."""
+    return geometry_cache.get_or_set(network_version(network), lambda: NetworkGeometry(network))
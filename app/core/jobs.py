@@ -0,0 +1,224 @@
+import logging
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from os import getenv
+
+from sqlalchemy.exc import IntegrityError
+
+from app import config
+from app.database import SessionLocal
+from app.models import Job
+from app.core.hydra import HydraConnection
+from app.core.users import get_datauser
+
+log = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+executor = ThreadPoolExecutor(max_workers=config.JOB_WORKERS, thread_name_prefix='job')
+
+# job kind -> function(hydra, job, **params)
+job_functions = {}
+
+
+def job_function(kind):
+    """Register a function that can be run (and resumed) as a background job of the given kind"""
+
+    def decorator(fn):
+        job_functions[kind] = fn
+        return fn
+
+    return decorator
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext(object):
+    """Passed to job functions to report progress and save checkpoints.
+
+    Each job runs in its own thread, with its own database session. Anything saved with checkpoint() is passed back
+    as job.state when the job is resumed, so a job function can skip work that has already been done.
+    """
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.db = SessionLocal()
+        job = self._job()
+        self.user_id = job.user_id
+        self.source_id = job.source_id
+        self.state = dict(job.state or {})
+
+    def _job(self):
+        return self.db.get(Job, self.id)
+
+    def _update(self, **kwargs):
+        job = self._job()
+        for key, value in kwargs.items():
+            setattr(job, key, value)
+        job.updated_at = datetime.utcnow()
+        self.db.commit()
+        return job
+
+    def progress(self, done, total, message=None):
+        job = self._update(
+            progress=int(100 * done / total) if total else 0,
+            **({'message': message[:255]} if message else {})
+        )
+        if job.status != RUNNING:  # cancelled, and perhaps queued again since
+            raise JobCancelled()
+
+    def checkpoint(self, **state):
+        self.state.update(state)
+        self._update(state=dict(self.state))
+
+    def close(self):
+        self.db.close()
+
+
+class InlineJob(object):
+    """Stands in for a JobContext when a job function is called directly, rather than as a background job"""
+
+    def __init__(self):
+        self.state = {}
+
+    def progress(self, done, total, message=None):
+        pass
+
+    def checkpoint(self, **state):
+        self.state.update(state)
+
+
+def get_job_hydra(db, user_id, source_id):
+    """Make a Hydra connection for a job, as get_g would for the job's user"""
+    datauser = get_datauser(db, user_id=user_id, dataurl_id=source_id)
+    return HydraConnection(
+        id=datauser.dataurl_id,
+        url=datauser.data_url,
+        username=datauser.username,
+        user_id=datauser.userid,
+        app_name=getenv('APP_NAME')
+    )
+
+
+def _heartbeat(job_id, stopped):
+    """Touch a running job every JOB_HEARTBEAT_INTERVAL seconds, so that it isn't taken for one left by a crash"""
+    db = SessionLocal()
+    try:
+        while not stopped.wait(config.JOB_HEARTBEAT_INTERVAL):
+            if not _set_status(db, job_id, [RUNNING]):
+                break
+    except Exception:
+        log.error(traceback.format_exc())
+    finally:
+        db.close()
+
+
+def _run_job(job_id, hydra=None):
+    ctx = JobContext(job_id)
+    stopped = threading.Event()
+    try:
+        # only a queued job is started, so a job is never run twice at once
+        if not _set_status(ctx.db, job_id, [QUEUED], status=RUNNING):
+            return
+        threading.Thread(target=_heartbeat, args=(job_id, stopped), daemon=True).start()
+        job = ctx._job()
+        fn = job_functions[job.kind]
+        if hydra is None:
+            hydra = get_job_hydra(ctx.db, job.user_id, job.source_id)
+        result = fn(hydra, ctx, **(job.params or {}))
+        ctx._update(status=FINISHED, progress=100, result=result)
+    except JobCancelled:
+        log.info('Job {} cancelled'.format(job_id))
+    except Exception as err:
+        log.error(traceback.format_exc())
+        ctx._update(status=FAILED, error=str(err))
+    finally:
+        stopped.set()
+        ctx.close()
+
+
+def start_job(db, kind, user_id, source_id, params, hydra=None, job_id=None):
+    """Add a job and run it in the background, returning the job.
+
+    A job_id makes the job unique: if a job with that id has already been added, it is returned instead, and nothing
+    more is run.
+    """
+    if job_id is not None:
+        job = db.get(Job, job_id)
+        if job is not None:
+            return job
+
+    now = datetime.utcnow()
+    job = Job(
+        id=job_id or str(uuid.uuid4()),
+        kind=kind,
+        user_id=user_id,
+        source_id=source_id,
+        status=QUEUED,
+        progress=0,
+        params=params,
+        state={},
+        created_at=now,
+        updated_at=now,
+    )
+    db.add(job)
+    try:
+        db.commit()
+    except IntegrityError:  # added by another worker since
+        if job_id is None:
+            raise
+        db.rollback()
+        return db.get(Job, job_id)
+    executor.submit(_run_job, job.id, hydra)
+    return job
+
+
+def _set_status(db, job_id, from_statuses, updated_before=None, **values):
+    """Change a job that has one of from_statuses, in one conditional update, returning whether it was changed"""
+    query = db.query(Job).filter(Job.id == job_id, Job.status.in_(from_statuses))
+    if updated_before is not None:
+        query = query.filter(Job.updated_at < updated_before)
+    changed = query.update(dict(values, updated_at=datetime.utcnow()), synchronize_session=False)
+    db.commit()
+    return bool(changed)
+
+
+def resume_job(db, job):
+    """Run a failed or cancelled job again, starting from its last checkpoint.
+
+    A job that is still marked as running, but hasn't been touched for JOB_STALE_AFTER seconds, was left by a crash or
+    a restart, and is resumed too. Other jobs (e.g., one that is still running) are left as they are, even if another
+    request changes them at the same time.
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=config.JOB_STALE_AFTER)
+    if _set_status(db, job.id, [FAILED, CANCELLED], status=QUEUED, error=None) \
+            or _set_status(db, job.id, [RUNNING], updated_before=stale_before, status=QUEUED, error=None):
+        executor.submit(_run_job, job.id)
+    db.refresh(job)
+    return job
+
+
+def cancel_job(db, job):
+    _set_status(db, job.id, [QUEUED, RUNNING], status=CANCELLED)
+    db.refresh(job)
+    return job
+
+
+def get_job(db, job_id, user_id):
+    return db.query(Job).filter_by(id=job_id, user_id=user_id).first()
+
+
+def get_jobs(db, user_id, kind=None):
+    query = db.query(Job).filter_by(user_id=user_id)
+    if kind:
+        query = query.filter_by(kind=kind)
+    return query.order_by(Job.created_at.desc()).all()
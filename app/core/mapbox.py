@@ -0,0 +1,158 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Lock
+
+import requests
+
+from app.core.caching import fingerprint
+from app.models import MapboxSyncState
+
+log = logging.getLogger(__name__)
+
+# number of feature writes whose results are saved together
+BATCH_SIZE = 100
+MAX_RETRIES = 5
+
+
+class MapboxError(Exception):
+    pass
+
+
+class MapboxDatasetClient(object):
+    """A small client for writing features to a Mapbox dataset, which backs off when rate limited.
+
+    The Datasets API writes one feature per request. When a request is rate limited (HTTP 429), all threads using the
+    client pause until the limit resets, as given by the Retry-After or X-Rate-Limit-Reset header.
+    """
+
+    def __init__(self, api_url, username, dataset_id, access_token, session=None, max_retries=MAX_RETRIES):
+        self.base_url = '{}/datasets/v1/{}/{}/features'.format(api_url.rstrip('/'), username, dataset_id)
+        self.access_token = access_token
+        self.session = session or requests.Session()
+        self.max_retries = max_retries
+        self._lock = Lock()
+        self._resume_at = 0.0
+
+    def _wait(self):
+        with self._lock:
+            delay = self._resume_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _pause(self, resp, attempt):
+        retry_after = resp.headers.get('Retry-After')
+        reset = resp.headers.get('X-Rate-Limit-Reset')
+        if retry_after:
+            resume_at = time.time() + float(retry_after)
+        elif reset:
+            resume_at = float(reset)
+        else:
+            resume_at = time.time() + min(2 ** attempt * 0.5, 30)
+        with self._lock:
+            self._resume_at = max(self._resume_at, resume_at)
+
+    def _request(self, method, feature_id, feature=None):
+        url = '{}/{}'.format(self.base_url, feature_id)
+        for attempt in range(self.max_retries + 1):
+            self._wait()
+            resp = self.session.request(method, url, params={'access_token': self.access_token}, json=feature,
+                                        timeout=30)
+            if resp.status_code == 429 or resp.status_code >= 500:
+                self._pause(resp, attempt)
+                continue
+            if method == 'DELETE' and resp.status_code == 404:
+                return resp  # already gone
+            if resp.status_code >= 400:
+                raise MapboxError('{} {}: {} {}'.format(method, feature_id, resp.status_code, resp.text[:200]))
+            return resp
+        raise MapboxError('{} {}: too many retries'.format(method, feature_id))
+
+    def put_feature(self, feature):
+        return self._request('PUT', feature['id'], feature)
+
+    def delete_feature(self, feature_id):
+        return self._request('DELETE', feature_id)
+
+
+def feature_hash(feature):
+    return fingerprint(feature.get('geometry'), feature.get('properties'))
+
+
+def diff_features(features, old_hashes):
+    """Work out the minimal changes to a dataset, given the features wanted and the hashes of what was last sent.
+
+    Returns (puts, deletes, new_hashes), where puts are features that are new or changed and deletes are feature ids
+    that were sent before but are no longer wanted.
+    """
+    new_hashes = {}
+    puts = []
+    for feature in features:
+        h = new_hashes[feature['id']] = feature_hash(feature)
+        if old_hashes.get(feature['id']) != h:
+            puts.append(feature)
+    deletes = [feature_id for feature_id in old_hashes if feature_id not in new_hashes]
+    return puts, deletes, new_hashes
+
+
+def sync_features(client, features, old_hashes, max_workers=4, batch_size=BATCH_SIZE, on_batch=None):
+    """Send the changes between old_hashes and features to a Mapbox dataset.
+
+    Writes are made concurrently, a batch at a time. After each batch, on_batch(hashes, done, total) is called with the
+    hashes of what the dataset now holds, so that the progress of a sync that is interrupted is kept. Failed writes
+    keep their old hashes, so they are retried on the next sync.
+
+    Returns (hashes, stats).
+    """
+    puts, deletes, new_hashes = diff_features(features, old_hashes)
+    hashes = dict(old_hashes)
+    stats = {'put': 0, 'deleted': 0, 'unchanged': len(features) - len(puts), 'failed': 0}
+
+    def put(feature):
+        client.put_feature(feature)
+        return feature['id']
+
+    def delete(feature_id):
+        client.delete_feature(feature_id)
+        return feature_id
+
+    ops = [(put, feature) for feature in puts] + [(delete, feature_id) for feature_id in deletes]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for i in range(0, len(ops), batch_size):
+            batch = ops[i:i + batch_size]
+            futures = [(fn, pool.submit(fn, arg)) for fn, arg in batch]
+            for fn, future in futures:
+                try:
+                    feature_id = future.result()
+                except Exception as err:
+                    log.warning('Mapbox sync: {}'.format(err))
+                    stats['failed'] += 1
+                    continue
+                if fn is put:
+                    hashes[feature_id] = new_hashes[feature_id]
+                    stats['put'] += 1
+                else:
+                    hashes.pop(feature_id, None)
+                    stats['deleted'] += 1
+            if on_batch:
+                on_batch(hashes, i + len(batch), len(ops))
+
+    return hashes, stats
+
+
+def get_sync_state(db, source_id, network_id, dataset_id):
+    return db.query(MapboxSyncState).filter_by(dataurl_id=source_id, network_id=network_id,
+                                               dataset_id=dataset_id).first()
+
+
+def save_sync_state(db, source_id, network_id, dataset_id, hashes):
+    """Save the hashes of what a dataset holds for a network, in one transaction"""
+    state = get_sync_state(db, source_id, network_id, dataset_id)
+    if not state:
+        state = MapboxSyncState(dataurl_id=source_id, network_id=network_id, dataset_id=dataset_id)
+        db.add(state)
+    state.hashes = dict(hashes)
+    state.updated_at = datetime.utcnow()
+    db.commit()
+    return state
@@ -1,11 +1,21 @@
 from os import getenv, environ as env
 import json
 from datetime import datetime
+from functools import partial
 
-from app.core.runners import run_model_rabbitmq, run_model_local #, run_model_ec2
+from sqlalchemy import and_, case, func, select
+from sqlalchemy.orm import aliased
+
+from app import config as app_config
+from app.database import SessionLocal
+from app.core.runners import run_models_rabbitmq, run_model_local, LocalRunner, run_model_ec2, fleet, FleetBusy
+from app.core.ping_buffer import PingBuffer
+from app.core.run_scheduler import RunScheduler, DatabaseQueue, MemoryQueue, WAIT
+from app.realtime import publish, network_room, study_room
 from app.models import Ping, Run
 from app.core.utils import get_utc
 from app.core.modeling import get_model, get_network_model
+from app.core.aio import run_async
 
 
 class ProcessState:
@@ -18,6 +28,12 @@ class ProcessState:
     FINISHED = 'finished'
 
 
+ENDED = [ProcessState.FINISHED, ProcessState.ERROR, ProcessState.CANCELED]
+
+# sids per statement in bulk queries, to keep IN lists well under database parameter limits
+SID_BATCH_SIZE = 500
+
+
 def get_all_data_scenarios(hydra, network_id):
     data_scenarios = hydra.call('get_scenarios', {'network_id': network_id})
     all_scenarios = {
@@ -36,29 +52,80 @@ def get_all_data_scenarios(hydra, network_id):
     return all_scenarios
 
 
-def add_run(db, sid, model_id, layout=None):
+def add_run(db, sid, model_id, layout=None, commit=True):
     run = Run(sid=sid, model_id=model_id, layout=json.dumps(layout))
     db.add(run)
-    db.commit()
+    if commit:
+        db.commit()
     return
 
 
 def add_ping(db, sid, status, **data):
-    canceled_ping = get_ping(db, sid, status=ProcessState.CANCELED)
-    if canceled_ping:
-        return canceled_ping  # nothing more to add
-
-    # add ping info
-    ping = Ping(sid=sid, status=status)
-    for kwarg in data:
-        try:
-            setattr(ping, kwarg, data[kwarg])
-        except:
+    return add_pings(db, [dict(data, sid=sid, status=status)])[0]
+
+
+def add_pings(db, pings, commit=True):
+    """Record a batch of pings, each a dict with sid, status and any other Ping columns.
+
+    Pings for runs that have been canceled are not recorded, and neither are progress pings for runs that have ended
+    (e.g., buffered pings flushed late, by another worker); the ping that ended the run is returned in their place. An
+    existing ping with the same sid and status is updated. This takes two queries and one commit however many pings
+    there are.
+    """
+    sids = list({ping['sid'] for ping in pings})
+    existing = {}
+    ended = {}  # sid -> the ping that ended the run, the cancellation if there is one
+    for i in range(0, len(sids), SID_BATCH_SIZE):
+        for ping in db.query(Ping).filter(Ping.sid.in_(sids[i:i + SID_BATCH_SIZE])):
+            existing[(ping.sid, ping.status)] = ping
+            if ping.status in ENDED and (ping.sid not in ended or ping.status == ProcessState.CANCELED):
+                ended[ping.sid] = ping
+
+    now = get_utc()
+    ret = []
+    for data in pings:
+        end_ping = ended.get(data['sid'])
+        if end_ping is not None and (end_ping.status == ProcessState.CANCELED or data['status'] not in ENDED):
+            ret.append(end_ping)  # nothing more to add
             continue
-    ping.last_ping = get_utc()
-    db.merge(ping)
-    db.commit()
-    return ping
+
+        ping = existing.get((data['sid'], data['status']))
+        if ping is None:
+            ping = existing[(data['sid'], data['status'])] = Ping(sid=data['sid'], status=data['status'])
+            db.add(ping)
+        for kwarg in data:
+            if kwarg in ['sid', 'status']:
+                continue
+            try:
+                setattr(ping, kwarg, data[kwarg])
+            except:
+                continue
+        ping.last_ping = now
+        if data['status'] in ENDED:
+            ended[data['sid']] = ping
+        ret.append(ping)
+
+    if commit:
+        db.commit()
+    return ret
+
+
+def write_pings(pings):
+    db = SessionLocal()
+    try:
+        add_pings(db, pings)
+    finally:
+        db.close()
+
+
+ping_buffer = PingBuffer(write_pings, interval=app_config.PING_FLUSH_INTERVAL, max_pending=app_config.PING_BUFFER_SIZE)
+
+
+def buffer_ping(sid, status, **data):
+    """Record a progress ping for a run, to be written in bulk shortly (see end_model_run for pings that end a run)"""
+    if status in ENDED:
+        raise ValueError('Pings that end a run should be written with end_model_run')
+    ping_buffer.add(sid, status, **data)
 
 
 def get_ping(db, sid, status=None, last=True):
@@ -71,14 +138,15 @@ def get_ping(db, sid, status=None, last=True):
 
 
 def get_last_ping(db, sid):
-    return db.query(Ping).filter_by(sid=sid).last()
+    return db.query(Ping).filter_by(sid=sid).order_by(Ping.last_ping.desc()).first()
 
 
 def get_pings(db, source_id=None, network_id=None):
     return db.query(Ping).filter_by(source_id=source_id, network_id=network_id).all()
 
 
-def start_model_run(db, hydra, username, host_url, network_id, guid, config, scenarios, computer_id=None, mq=None):
+def start_model_run(db, hydra, username, host_url, network_id, guid, config, scenarios, computer_id=None, mq=None,
+                    user_id=None):
     # 1. get user input
 
     default_run_name = 'network-{}'.format(network_id)
@@ -105,6 +173,7 @@ def start_model_run(db, hydra, username, host_url, network_id, guid, config, sce
 
     # 4. define arguments
 
+    host_url = str(host_url)
     request_host = host_url if 'localhost' in host_url else host_url.replace('http://', 'https://')
 
     model_kwargs = dict(
@@ -128,19 +197,20 @@ def start_model_run(db, hydra, username, host_url, network_id, guid, config, sce
 
     # 4. record request
     # run_secret = uuid.uuid4().hex
+    source_id = hydra.id
+    for sid in sids:
+        add_run(db, sid=sid, model_id=model.id, layout={'run_key': run_key, 'guid': guid}, commit=False)
+    add_pings(db, [dict(
+        sid=sid,
+        status=ProcessState.REQUESTED,
+        name=run_name,
+        source_id=source_id,
+        network_id=network_id,
+        extra_info=json.dumps(model_kwargs)
+    ) for sid in sids])
+
     for i, scids in enumerate(scenario_ids):
-        source_id = hydra.id
         sid = sids[i]
-        add_run(db, sid=sid, model_id=model.id, layout={'run_key': run_key})
-
-        ping_data = dict(
-            name=run_name,
-            source_id=source_id,
-            network_id=network_id,
-            extra_info=json.dumps(model_kwargs)
-        )
-        add_ping(db, sid, ProcessState.REQUESTED, **ping_data)
-
         ping = {
             'action': 'request',
             'sid': sid,
@@ -153,38 +223,140 @@ def start_model_run(db, hydra, username, host_url, network_id, guid, config, sce
         }
         emit_progress(source_id=source_id, network_id=network_id, ping=ping)
 
-    error = None
+    # 5. queue each run, to be sent to the model when there is room
+    payload = dict(service=service, run_key=run_key, extra_args=extra_args, computer_id=computer_id)
+    errors = run_scheduler.submit([dict(
+        sid=sid,
+        user_id=user_id,
+        model_id=model.id,
+        priority=int(config.get('priority') or 0),
+        payload=dict(payload, model_kwargs=dict(model_kwargs, scenario_ids=[scids]))
+    ) for sid, scids in zip(sids, scenario_ids)])
+
+    return next((errors[sid] for sid in sids if sid in errors), None)
+
+
+def send_runs(runs):
+    """Send runs dispatched by the run scheduler to their models, returning a dict of sid -> error for failed runs"""
+    groups = {}
+    for run in runs:
+        key = (run.model_id, run.payload['service'], run.payload.get('run_key'))
+        groups.setdefault(key, []).append(run)
+
+    errors = {}
+    db = SessionLocal()
+    try:
+        for (model_id, service, run_key), group in groups.items():
+            model = get_model(db, id=model_id)
+            error = None
+
+            if service == 'amqp':
+                error = run_models_rabbitmq(model, run_key, [run.payload['model_kwargs'] for run in group])
+
+            elif service == 'local':
+                for run in group:
+                    model_kwargs = run.payload['model_kwargs']
+                    info = dict(source_id=model_kwargs['source_id'], network_id=model_kwargs['network_id'],
+                                name=model_kwargs['run_name'])
+                    run_model_local(local_runner, model, model_kwargs, run.sid,
+                                    extra_args=run.payload.get('extra_args', ''), info=info)
+
+            elif service == 'aws':
+                for run in group:
+                    model_kwargs = run.payload['model_kwargs']
+                    info = dict(source_id=model_kwargs['source_id'], network_id=model_kwargs['network_id'],
+                                name=model_kwargs['run_name'])
+                    try:
+                        run_error = run_model_ec2(model, model_kwargs, run.sid,
+                                                  extra_args=run.payload.get('extra_args', ''),
+                                                  computer_id=run.payload.get('computer_id'),
+                                                  on_error=partial(end_failed_run, run.sid, info))
+                    except FleetBusy:
+                        run_error = WAIT  # it stays queued until an instance is free
+                    if run_error:
+                        errors[run.sid] = run_error
+
+            if error:
+                errors.update((run.sid, error) for run in group)
+    finally:
+        db.close()
+
+    return errors
+
+
+def fail_runs(runs, errors):
+    """Record and report runs that could not be sent to their model"""
+    db = SessionLocal()
+    try:
+        add_pings(db, [dict(
+            sid=run.sid,
+            status=ProcessState.ERROR,
+            source_id=run.payload['model_kwargs']['source_id'],
+            network_id=run.payload['model_kwargs']['network_id'],
+            extra_info=errors[run.sid]
+        ) for run in runs])
+    finally:
+        db.close()
+    for run in runs:
+        model_kwargs = run.payload['model_kwargs']
+        source_id = model_kwargs['source_id']
+        network_id = model_kwargs['network_id']
+        ping = {
+            'action': 'fail',
+            'sid': run.sid,
+            'name': model_kwargs['run_name'],
+            'status': ProcessState.ERROR,
+            'scids': model_kwargs['scenario_ids'][0],
+            'progress': 0,
+            'network_id': network_id,
+            'source_id': source_id,
+            'extra_info': "Request failed. Please check main model parameters."
+        }
+        emit_progress(source_id=source_id, network_id=network_id, ping=ping)
+
 
-    if service == 'amqp':
-        run_model_rabbitmq(mq, model, run_key, model_kwargs)
+run_scheduler = RunScheduler(
+    DatabaseQueue(SessionLocal) if app_config.RUN_QUEUE_BACKEND == 'database' else MemoryQueue(),
+    send_runs,
+    on_error=fail_runs,
+    user_limit=app_config.RUN_QUEUE_USER_LIMIT,
+    model_limit=app_config.RUN_QUEUE_MODEL_LIMIT,
+    max_active=app_config.RUN_QUEUE_MAX_ACTIVE,
+    max_runtime=app_config.RUN_QUEUE_MAX_RUNTIME,
+    dispatch_interval=app_config.RUN_QUEUE_DISPATCH_INTERVAL
+)
+
+
+def end_failed_run(sid, info, error):
+    """Record and report a run that failed after it was sent, without the model reporting it"""
+    db = SessionLocal()
+    try:
+        end_model_run(db, sid, ProcessState.ERROR, dict(info, extra_info=error), report_to_browser=True)
+    finally:
+        db.close()
+
+
+def report_local_run(run, status, data):
+    """Record and report the progress of a run on the local runner, as a model would through the run actions"""
+    ping = dict(run.info, **data)
+    if status in ENDED:
+        db = SessionLocal()
+        try:
+            end_model_run(db, run.sid, status, ping, report_to_browser=True)
+        finally:
+            db.close()
+    else:
+        buffer_ping(run.sid, status, **ping)
+        emit_progress(source_id=ping.get('source_id'), network_id=ping.get('network_id'),
+                      ping=dict(ping, sid=run.sid, status=status))
 
-    elif service == 'local':
-        run_model_local(model, model_kwargs, extra_args=extra_args)
 
-    elif service == 'aws':
-        run_model_ec2(model, model_kwargs, computer_id, extra_args=extra_args)
+local_runner = LocalRunner(report_local_run, max_workers=app_config.LOCAL_RUN_WORKERS,
+                           cancel_grace=app_config.LOCAL_RUN_CANCEL_GRACE)
 
-    if error:
-        # for sid in sids:
-        for i, scids in enumerate(scenario_ids):
-            sid = sids[i]
-            source_id = hydra.id
-            add_ping(db, sid=sid, status=ProcessState.ERROR, source_id=source_id, network_id=network_id,
-                     extra_info=error)
-            ping = {
-                'action': 'fail',
-                'sid': sid,
-                'name': run_name,
-                'status': ProcessState.ERROR,
-                'scids': scids,
-                'progress': 0,
-                'network_id': network_id,
-                'source_id': source_id,
-                'extra_info': "Request failed. Please check main model parameters."
-            }
-            emit_progress(source_id=source_id, network_id=network_id, ping=ping)
 
-    return error
+def get_run_queue(user_id):
+    return run_scheduler.user_runs(user_id)
 
 
 def publish_callback(result, status):
@@ -220,57 +392,100 @@ def get_run(db, sid):
     return db.query(Run).filter_by(sid=sid).first()
 
 
+def run_group_ended(db, sid):
+    """Check whether sid and the other runs requested with it (one per scenario combination) have all ended.
+
+    Returns the guid of the request if they have, and at least one finished, or else None. Runs recorded without a
+    guid are taken to be on their own, and identified by their sid.
+    """
+    run = get_run(db, sid)
+    guid = run and run.layout and run.get_layout().get('guid')
+    if guid:
+        sids = db.scalars(select(Run.sid).where(Run.sid.like(guid + '-%'))).all()
+    else:
+        guid, sids = sid, [sid]
+
+    statuses = {}
+    for i in range(0, len(sids), SID_BATCH_SIZE):
+        for ping_sid, status in db.execute(select(Ping.sid, Ping.status).where(
+                Ping.sid.in_(sids[i:i + SID_BATCH_SIZE]), Ping.status.in_(ENDED))):
+            statuses.setdefault(ping_sid, set()).add(status)
+    if len(statuses) < len(sids):
+        return None
+    return guid if any(ProcessState.FINISHED in ended for ended in statuses.values()) else None
+
+
 def pause_model_run(db, pubnub, sid):
+    if local_runner.pause(sid):
+        return
     publish_model_run_state(db, pubnub, sid, ProcessState.PAUSED)
 
 
+def resume_model_run(db, pubnub, sid):
+    if local_runner.resume(sid):
+        return
+    publish_model_run_state(db, pubnub, sid, ProcessState.RUNNING)
+
+
 def cancel_model_run(db, pubnub, sid):
+    if run_scheduler.cancel([sid]):
+        return  # it was still queued, so there is no model to stop
+    if local_runner.cancel(sid):
+        return
     publish_model_run_state(db, pubnub, sid, ProcessState.CANCELED)
 
 
+def run_sids(source_id=None, network_id=None):
+    """A subquery of the sids of runs on a network"""
+    return select(Ping.sid).where(Ping.source_id == source_id, Ping.network_id == network_id).distinct()
+
+
 def get_run_records(db, source_id=None, network_id=None):
-    rows = get_pings(db, source_id=source_id, network_id=network_id)
-    sids = [row.sid for row in rows]
-    recs = db.query(Ping).filter(Ping.sid.in_(sids)).all() if sids else []
-    records = {r.sid: {} for r in recs}
-    for rec in recs:
-        records[rec.sid][rec.status] = rec
+    """Summarize each run on a network from its requested ping and its latest other ping, in one query"""
+
+    # rank each run's pings: any end state first, then progress (started, running or paused), then requested, and the
+    # latest first within those
+    ranked = select(
+        Ping.sid,
+        Ping.status,
+        Ping.last_ping,
+        Ping.extra_info,
+        func.row_number().over(
+            partition_by=Ping.sid,
+            order_by=[
+                case((Ping.status.in_(ENDED), 0), (Ping.status == ProcessState.REQUESTED, 2), else_=1),
+                Ping.last_ping.desc()
+            ]
+        ).label('rank')
+    ).where(Ping.sid.in_(run_sids(source_id, network_id))).subquery()
+    requested = aliased(Ping)
+    rows = db.execute(
+        select(ranked, requested.name, requested.extra_info.label('start_info'), requested.last_ping.label('start_time'))
+        .outerjoin(requested, and_(requested.sid == ranked.c.sid, requested.status == ProcessState.REQUESTED))
+        .where(ranked.c.rank == 1)
+        .order_by(requested.last_ping.desc())
+    )
+
     ret = []
-    for sid, rec in records.items():
+    for row in rows:
         ret_rec = {}
 
-        try:
-            end_info = rec.extra_info if rec.extra_info != '0' else ''
-        except:
-            end_info = ''
-
-        requested = rec.get('requested')
-        if requested:
-            parts = requested.extra_info.split(' --')
+        if row.start_info is not None:
+            parts = row.start_info.split(' --')
             exc = '\n'.join(parts[0].split(' '))
             start_params = exc + '\n--' + '\n--'.join(parts[1:])
-            ret_rec['name'] = requested.name
+            ret_rec['name'] = row.name
         else:
             start_params = ''
 
-        statuses = rec.keys()
-        status = [s for s in statuses if s not in ['requested', 'started']]
-        end_info = ''
-        if status:
-            status = status[0]
-            last = rec[status]
-            end_info = last.extra_info
-        else:
-            status = 'started' if rec.get('started') else 'requested'
-            last = None
-
+        ended = row.status in ENDED
         ret_rec.update(
-            id=sid,
-            status=status,
-            start_time=rec.get('requested') and rec['requested'].last_ping,
-            end_time=last.last_ping if last else None,
+            id=row.sid,
+            status=row.status,
+            start_time=row.start_time,
+            end_time=row.last_ping if ended else None,
             start_params=start_params,
-            end_info=end_info
+            end_info=row.extra_info if ended else ''
         )
 
         ret.append(ret_rec)
@@ -284,17 +499,19 @@ def delete_run_record(db, sid):
 
 
 def delete_run_records(db, source_id=None, network_id=None):
-    rows = get_pings(db, source_id=source_id, network_id=network_id)
-    sids = [row.sid for row in rows]
-    for sid in sids:
-        db.query(Ping).filter_by(sid=sid).delete()
+    # the sids are read first, since MySQL cannot delete from a table selected from in the same statement
+    sids = db.scalars(run_sids(source_id, network_id)).all()
+    for i in range(0, len(sids), SID_BATCH_SIZE):
+        db.query(Ping).filter(Ping.sid.in_(sids[i:i + SID_BATCH_SIZE])).delete(synchronize_session=False)
     db.commit()
 
 
 def end_model_run(db, sid, status, data, report_to_browser=False):
     data.pop('sid', None)
     data.pop('status', None)
-    ping = add_ping(db, sid, status, **data)
+    # the run's buffered progress is written now too, so it cannot land after the end
+    ping = add_pings(db, ping_buffer.take(sid) + [dict(data, sid=sid, status=status)])[-1]
+    run_scheduler.release([sid])  # make room for the next queued run
     if report_to_browser:
         ping = ping.to_json()
         for key in data:
@@ -303,12 +520,27 @@ def end_model_run(db, sid, status, data, report_to_browser=False):
         emit_progress(source_id=ping.get('source_id'), network_id=ping.get('network_id'), ping=ping)
 
 
-def emit_progress(source_id=None, network_id=None, ping=None):
+def emit_progress(source_id=None, network_id=None, project_id=None, ping=None):
     if network_id:
-        room = config['NETWORK_ROOM_NAME'].format(source_id=source_id, network_id=network_id)
+        room = network_room(source_id, network_id)
         event = 'network-run'
     else:
-        room = config['RUN_STUDY_ROOM_NAME'].format(source_id)
+        room = study_room(source_id, project_id)
         event = 'update-study-progress'
 
-    socketio.emit(event, ping, room=room)
+    publish(room, event, ping)
+
+
+# async versions, for async routes (database work only)
+
+add_run_async = run_async(add_run)
+add_ping_async = run_async(add_ping)
+get_ping_async = run_async(get_ping)
+get_last_ping_async = run_async(get_last_ping)
+get_pings_async = run_async(get_pings)
+get_run_async = run_async(get_run)
+run_group_ended_async = run_async(run_group_ended)
+get_run_records_async = run_async(get_run_records)
+delete_run_record_async = run_async(delete_run_record)
+delete_run_records_async = run_async(delete_run_records)
+end_model_run_async = run_async(end_model_run)
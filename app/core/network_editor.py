@@ -4,6 +4,8 @@ from copy import deepcopy
 from app import config
 from app.core.files import upload_network_data, add_storage, s3_bucket, object_url, s3_object_summary
 from app.core.templates import get_default_types
+from app.core.spatial import get_spatial_index, SNAP_TOLERANCE
+from app.core.edit_session import EditSession
 
 from hydra_base import JSONObject
 
@@ -253,116 +255,67 @@ def make_node_from_geojson(gj, template_id, type_id):
     return node
 
 
-def make_links_from_geojson(hydra, network, template, gj, existings, split_locs):
-    '''Create new a new link or set of links from a newly created geojson polyline.
-    This also splits intersected existing links as needed.
+def split_link_in_session(session, link_id, nodes, splits):
+    '''Split an existing link at new nodes, as in split_link_at_nodes2, but as part of an edit session.
+    The first piece keeps the original link's id (and data); the others are added as new links.
     '''
+    link = session.get_link(link_id)
+    old_coords = link['layout']['geojson']['geometry']['coordinates']
 
-    ttypes = {ttype['name']: ttype for ttype in template.templatetypes}
-    ttype = ttypes[gj['properties']['template_type_name']]
-
-    default_types = get_default_types(template)
-    inflow_type = default_types['inflow']
-    outflow_type = default_types['outflow']
-    junction_type = default_types['junction']
-
-    linestyle = get_linestyle(ttype)
-    gj['properties'].update(linestyle)
-
-    lname = gj['properties']['name']  # link name
-
-    # make nodes
-    new_nodes = {}
-    new_gjs = []
-    del_nodes = []
-    del_links = []
-    is_new = True
-    coords = gj['geometry']['coordinates']
-    new_coords = [(coords[0])]  # initialize
-    new_cnt = 0
-    for i, [x, y] in enumerate(coords):
-
-        if is_new:
-            new_gj = deepcopy(gj)
-            is_new = False
-        if i:
-            new_coords.append((x, y))
-
-        existing = existings[str(i)]
-        # split_existing = False
-
-        node_type = None
-        if existing['linkId']:
-            # split_existing = True
-            if i:
-                is_new = True
-        elif existing['nodeId']:
-            is_new = True
-        elif i == 0:
-            node_type = inflow_type['name']
-            node_name = '{} {}'.format(lname, node_type)
-        elif i == len(coords) - 1:
-            node_type = outflow_type['name']
-            node_name = '{} {}'.format(lname, node_type)
-            is_new = True
+    pieces = []
+    node_1 = session.get_node(link['node_1_id'])
+    for i, split in enumerate(splits):
+        idx = split['idx']
+        if idx is not None:
+            node_2 = nodes[idx]
         else:
-            continue
-
-        make_junction = False
-        if existing['linkId'] or existing['nodeId'] and existing['nodeType'] in [inflow_type['name'], outflow_type['name']]:
-            make_junction = True
-            node_type = junction_type['name']
-            xname = round(x, 3)
-            yname = round(y, 3)
-            if len(lname):
-                node_name = '{} {} ({},{})'.format(lname, node_type, xname, yname)
-            else:
-                node_name = '{} ({},{})'.format(node_type, xname, yname)
-
-        if node_type and not existing['nodeId'] or make_junction:
-            ttype = ttypes[node_type]
-            node = make_generic_node(template['id'], ttype['id'], node_name, x, y)
-            node = hydra.add_node(network['id'], node)
-            node['layout']['geojson'] = make_geojson_from_node(node, template)
-            node = hydra.call('update_node', node)
-            node = hydra.get_node(node['id'])
-
-            new_gjs.append(node['layout']['geojson'])
-
-            if make_junction:
-                new_links = update_links(hydra, network, existing['nodeId'], node['id'])
-                hydra.call('delete_node', existing['nodeId'], True)
-                new_gjs.extend([l['layout']['geojson'] for l in new_links])
-                del_nodes.append(existing['nodeId'])
-                del_links.extend([l['id'] for l in new_links])
+            node_2 = session.get_node(link['node_2_id'])
 
+        first_coord = (float(node_1['x']), float(node_1['y']))
+        last_coord = (float(node_2['x']), float(node_2['y']))
+        if i == 0:  # first new segment
+            first_coord = None
+            last_mid_pt = max(split['prev'], 0)
+            mid_coords = old_coords[0:last_mid_pt + 1]
         else:
-            node = hydra.get_node(node_id=existing['nodeId'])
+            first_mid_pt = max(splits[i - 1]['prev'], 0) + 1
+            if idx is not None:  # middle new segment (skipped if len(splits) == 2)
+                last_mid_pt = split['prev'] + 1
+            else:  # last new segment
+                last_mid_pt = None
+                last_coord = None
+            mid_coords = old_coords[first_mid_pt:last_mid_pt]
 
-        if i == 0:
-            node_1 = node
+        if first_coord and mid_coords and coords_are_equal(first_coord, mid_coords[0], precision=7):
+            first_coord = None
+        if last_coord and mid_coords and coords_are_equal(last_coord, mid_coords[-1], precision=7):
+            last_coord = None
 
-        if i and is_new:
-            new_cnt += 1
-            new_gj['geometry']['coordinates'] = new_coords
-            node_2 = node
-            new_link_gj = make_link(hydra, network['id'], template, new_gj, node_1, node_2, segment=new_cnt)
-            new_gjs.append(new_link_gj)
+        new_coords = ([first_coord] if first_coord else []) + list(mid_coords) + ([last_coord] if last_coord else [])
 
-            # prepare next link
-            node_1 = node  # first node of next link
-            new_coords = [(x, y)]  # first coords of next link
+        piece = deepcopy(link)
+        piece.update(
+            node_1_id=node_1['id'],
+            node_2_id=node_2['id'],
+            name=session.unique_name('link', '{}.{}'.format(link['name'], i + 1)),
+        )
+        piece['layout']['parent'] = link['layout'].get('parent', link['id'])
+        gj = piece['layout']['geojson']
+        gj['geometry']['coordinates'] = new_coords
+        gj.setdefault('properties', {}).update(name=piece['name'], node_1_id=piece['node_1_id'],
+                                               node_2_id=piece['node_2_id'])
 
-        new_nodes[i] = node
+        if i == 0:
+            piece = session.update_link(piece)
+        else:
+            piece.pop('attributes', None)
+            piece = session.add_link(piece)
+        pieces.append(piece)
 
-    for line_id, splits in split_locs.items():
-        idx = str(splits[0]['idx'])
-        link_id = existings[idx]['linkId']
-        divided_gjs = split_link_at_nodes(hydra, template_id=template['id'], network_id=network['id'],
-                                          link_id=int(link_id), nodes=new_nodes, splits=splits)
-        new_gjs.extend(divided_gjs)
+        if idx is not None:
+            node_1 = nodes[idx]
 
-    return new_gjs, del_nodes, del_links
+    return pieces
 
 
 def make_generic_geojson_from_node(node):
@@ -375,8 +328,9 @@ def make_generic_geojson_from_node(node):
     }
 
 
-def make_name(network, restype, type_name, base_name='', ending=None):
-    names = [n['name'] for n in network[restype + 's']]
+def make_name(network, restype, type_name, base_name='', ending=None, session=None):
+    """Make a name for a new node or link that no other in the network has, including any new in an edit session"""
+    names = session.names[restype] if session else {n['name'] for n in network[restype + 's']}
     i = 0
     name = base_name
     while True:
@@ -389,28 +343,45 @@ def make_name(network, restype, type_name, base_name='', ending=None):
         if name not in names:
             break
         i += 1
+    if session:
+        names.add(name)
     return name
 
 
-def add_link(hydra, network, template, ttypes, incoming_link, existings, split_locs, default_types, del_nodes=[]):
+def add_link(hydra, network, template, ttypes, incoming_link, existings, split_locs, default_types, del_nodes=None,
+             tolerance=SNAP_TOLERANCE):
     '''Create new a new link or set of links from a newly created polyline.
     This also splits intersected existing links as needed.
+
+    If existings is None, the existing nodes and links touched by the polyline are found from the network's spatial
+    index, splitting the polyline wherever it crosses an existing link.
+
+    All edits are made in one EditSession, so either the whole polyline is added (with any split links and replaced
+    nodes) or nothing is changed, and EditSessionError is raised. Returns the new and changed nodes and links, the ids
+    of deleted nodes and links, and the network, updated with the edits.
     '''
 
+    index = get_spatial_index(network, template['id'])
+    if existings is None:
+        geometry = incoming_link['layout']['geojson']['geometry']
+        coords, existings, split_locs = index.locate_line(geometry['coordinates'], tolerance)
+        geometry['coordinates'] = [list(c) for c in coords]
+    split_locs = split_locs or {}
+
     inflow_type = default_types.get('inflow')
     outflow_type = default_types.get('outflow')
     junction_type = default_types.get('junction')
 
     ttype = ttypes[incoming_link['types'][0]['id']]
 
+    session = EditSession(hydra, network)
+    del_nodes = list(del_nodes or [])
+
     # make nodes
     _new_nodes = {}
-    new_nodes = []
-    new_links = []
     is_new = True
     coords = incoming_link['layout']['geojson']['geometry']['coordinates']
     new_coords = [(coords[0])]  # initialize
-    new_cnt = 0
     for i, [x, y] in enumerate(coords):
 
         if is_new:
@@ -422,21 +393,17 @@ def add_link(hydra, network, template, ttypes, incoming_link, existings, split_l
             new_coords.append((x, y))
 
         existing = existings.get(str(i), {})
-        # split_existing = False
 
         node_type = None
         if existing.get("linkId"):
-            # split_existing = True
             if i:
                 is_new = True
         elif existing.get("nodeId"):
             is_new = True
         elif i == 0:
             node_type = inflow_type
-            # node_name = make_name(network, 'node', node_type['name'])
         elif i == len(coords) - 1:
             node_type = outflow_type
-            # node_name = make_name(network, 'node', node_type['name'])
             is_new = True
         else:
             continue
@@ -447,12 +414,11 @@ def add_link(hydra, network, template, ttypes, incoming_link, existings, split_l
         if existing.get('linkId') or replace_existing_node:
             make_junction = True
             node_type = junction_type
-            # node_name = make_name(network, 'node', node_type['name'])
 
         if node_type and not existing.get('nodeId') or make_junction:  # make new inflow, outflow or junction node
 
             if make_junction:
-                node_name = make_name(network, 'node', node_type['name'])
+                node_name = make_name(network, 'node', node_type['name'], session=session)
 
             else:
                 has_node = node_type['name'].split(' ')[-1].lower() == 'node'
@@ -461,41 +427,31 @@ def add_link(hydra, network, template, ttypes, incoming_link, existings, split_l
                 else:
                     ending = node_type['name']
                 node_name = make_name(network, 'node', node_type['name'], base_name=incoming_link.get('name'),
-                                      ending=ending)
-            node = make_generic_node(template['id'], node_type['id'], node_name, x, y)
-            node = hydra.add_node(network['id'], node)
-            network['nodes'].append(node)
-
-            new_nodes.append(node)
+                                      ending=ending, session=session)
+            node = session.add_node(make_generic_node(template['id'], node_type['id'], node_name, x, y))
 
             if replace_existing_node:
+                # the new junction takes the place of the old inflow or outflow node, whose links are kept
                 old_node_id = existing.get('nodeId')
-                _new_links = update_links(hydra, network, old_node_id=old_node_id, new_node_id=node['id'])
-                new_links.append(_new_links)
-                hydra.call('delete_node', old_node_id, True)
-                # network['nodes'] = [n for n in network['nodes'] if n['id'] != old_node_id]
+                session.repoint_links(old_node_id, node['id'])
+                session.delete_node(old_node_id)
                 del_nodes.append(old_node_id)
 
         else:
-            node = hydra.call('get_node', existing.get('nodeId'))
+            node = session.get_node(existing.get('nodeId')) or hydra.call('get_node', existing.get('nodeId'))
 
         if i == 0:
             node_1 = node
 
         if i and is_new:
-            new_cnt += 1
             node_2 = node
 
             _new_link['layout']['geojson']['geometry']['coordinates'] = new_coords
             _new_link.update({'node_1_id': node_1['id'], 'node_2_id': node_2['id']})
-            _new_link['name'] = make_name(network, 'link', ttype['name'], base_name=_new_link.get('name'))
-            # _new_link['attributes'] = [{'attr_id': ta['attr_id']} for ta in ttype['typeattrs']]
-            if new_links:
-                _new_link['layout']['parent'] = new_links[0]['id']
+            _new_link['name'] = make_name(network, 'link', ttype['name'], base_name=_new_link.get('name'),
+                                          session=session)
             _new_link.pop('coords', None)
-            new_link = hydra.add_link(network['id'], _new_link)
-            new_links.append(new_link)
-            network['links'].append(new_link)
+            session.add_link(_new_link)
 
             # prepare next link
             node_1 = node  # first node of next link
@@ -503,19 +459,33 @@ def add_link(hydra, network, template, ttypes, incoming_link, existings, split_l
 
         _new_nodes[i] = node
 
-    del_links = []
     for line_id, splits in split_locs.items():
         idx = str(splits[0]['idx'])
-        link_id = existings[idx]['linkId']
-        # divided_gjs = split_link_at_nodes(hydra=hydra, template_id=template['id'], network_id=network['id'],
-        #                                   link_id=int(link_id), nodes=_new_nodes, splits=splits)
-        _new_links = split_link_at_nodes2(hydra, network_id=network['id'], template_id=template['id'],
-                                          old_link_id=link_id, nodes=_new_nodes,
-                                          splits=splits)
-        new_links.extend(_new_links)
-        del_links.append(link_id)
-
-    return new_nodes, new_links, del_nodes, del_links, network
+        link_id = int(existings[idx]['linkId'])
+        # the first piece keeps the link's id, so the link is changed rather than deleted
+        split_link_in_session(session, link_id=link_id, nodes=_new_nodes, splits=splits)
+
+    nodes, links = session.commit()
+
+    # keep the network and its spatial index in step with the edits
+    type_names = {tt['id']: tt['name'] for tt in ttypes.values()}
+    with index.lock:
+        for node_id in session.deleted_node_ids:
+            index.remove_node(node_id)
+        for link_id in session.deleted_link_ids:
+            index.remove_link(link_id)
+        for node in nodes:
+            index.add_node(node, next((type_names.get(t['id']) for t in node['types']
+                                       if t['template_id'] == template['id']), None))
+        for link in links:
+            index.add_link(link)
+    for restype, saved, deleted in [('nodes', nodes, session.deleted_node_ids),
+                                    ('links', links, session.deleted_link_ids)]:
+        saved = {resource['id']: resource for resource in saved}
+        network[restype] = [saved.pop(resource['id'], resource) for resource in network[restype]
+                            if resource['id'] not in deleted] + list(saved.values())
+
+    return nodes, links, del_nodes, list(session.deleted_link_ids), network
 
 
 def make_generic_node(template_id, type_id, node_name, x, y):
@@ -544,7 +514,7 @@ def make_generic_node(template_id, type_id, node_name, x, y):
     return node
 
 
-def split_link_at_nodes(hydra, network_id, template_id, link_id=None, nodes=None, splits=None):
+def split_link_at_nodes(hydra, network_id, template_id, link_id=None, nodes=None, splits=None, index=None):
     link = hydra.call('get_link', link_id)
 
     new_gj = []
@@ -613,15 +583,19 @@ def split_link_at_nodes(hydra, network_id, template_id, link_id=None, nodes=None
         new_link = hydra.call('update_link', new_link)
         new_link = hydra.get_link(new_link['id'])
         new_gj.append(deepcopy(gj))
+        if index is not None:
+            index.add_link(new_link)
 
         if idx is not None:
             node_1 = nodes[idx]
     hydra.call('delete_link', link['id'], True)
+    if index is not None:
+        index.remove_link(link['id'])
 
     return new_gj
 
 
-def split_link_at_nodes2(hydra, network_id, template_id=None, old_link_id=None, nodes=None, splits=None):
+def split_link_at_nodes2(hydra, network_id, template_id=None, old_link_id=None, nodes=None, splits=None, index=None):
     link = hydra.get_link(old_link_id)
     new_links = []
 
@@ -712,6 +686,8 @@ def split_link_at_nodes2(hydra, network_id, template_id=None, old_link_id=None,
         new_link = hydra.call('update_link', new_link)
         new_link = hydra.get_link(new_link['id'])
         new_links.append(new_link)
+        if index is not None:
+            index.add_link(new_link)
 
         if idx is not None:
             node_1 = nodes[idx]
@@ -1,6 +1,7 @@
 from os import getenv
 import copy
 import json
+import re
 import requests
 from datetime import datetime
 import svgwrite
@@ -8,21 +9,33 @@ import numpy
 from boltons.iterutils import remap
 import io
 import xlsxwriter
-from itertools import chain
 from xml.dom import minidom
 
 import pendulum
 
-from app.core.network_editor import repair_network_references, update_links2, make_feature_collection
-from app.core.templates import clean_template, clean_template2, add_template
-from app.core.files import add_storage, upload_network_data, duplicate_folder
-from app.core.templates import change_active_template
+from app.core.network_editor import make_feature_collection
+from app.core.templates import clean_template, clean_template2, add_template, get_cached_template
+from app.core.files import add_storage, upload_network_data, copy_folder_parallel
+from app.core.caching import Cache, network_version, template_version
+from app.core.geometry import get_network_geometry
+from app.core.jobs import job_function, InlineJob
+from app.core.mapbox import MapboxDatasetClient, sync_features, get_sync_state, save_sync_state
 
 from app.models import UserNetworkSettings
+from app import config
 
 INVALID_CLASS_CHARACTERS = ['~', '!', '@', '$', '%', '^', '&', '*', '(', ')', '+', '=', ',', '.', '/', '\'', ';', ':',
                             '"', '?', '>', '<', '[', ']', '\\', '{', '}', '|', '`', '#', ' ']
 
+# a quoted "type/id/attr_id" key in a function, e.g., "node/12/345"
+FUNCTION_KEY_REGEX = re.compile(r'(["\'])(network|node|link)/(\d+)/(\d+)\1')
+
+# approximate thumbnail display size, in pixels; detail finer than this is not drawn
+THUMBNAIL_RESOLUTION = 400
+
+template_style_cache = Cache(maxsize=64)
+thumbnail_cache = Cache(maxsize=256)
+
 
 def check_url(url):
     try:
@@ -166,8 +179,7 @@ def add_network(hydra, net, location=None, template_id=None, add_baseline=True,
     return network
 
 
-def get_network(hydra, source_id, network_id, simple=False, summary=True, include_resources=True, repair=False,
-                repair_options=None):
+def get_network(hydra, source_id, network_id, simple=False, summary=True, include_resources=True):
     if simple:
         network = hydra.call('get_network', network_id, include_resources=include_resources, summary=summary,
                              include_data=False)
@@ -235,258 +247,79 @@ def get_network(hydra, source_id, network_id, simple=False, summary=True, includ
         location = getenv('NETWORK_FILES_STORAGE_LOCATION')
         network = add_storage(network, location)
 
-    if repair:
-        network = repair_network(hydra, source_id, network=network, options=repair_options)
-
     return network
 
 
-def autoname(ttype, network):
-    base = '{}-{}-{}'.format(network['name'].replace(' ', '')[:5].upper(), ttype['resource_type'][0],
-                             ttype['name'].replace(' ', '')[:3].upper())
+# parts of a network that can be requested with include=, and the resource fields that can be selected with fields=
+NETWORK_INCLUDES = ['nodes', 'links', 'resourcegroups', 'scenarios', 'attributes', 'types']
 
-    existing_names = [r['name'] for r in network[ttype['resource_type'].lower() + 's']]
+# fields that can only be returned if resource attributes are fetched from Hydra
+ATTRIBUTE_FIELDS = {'attributes'}
 
-    i = 1
-    while True:
-        name = base + str(i)
-        if name not in existing_names:
-            return name
-        i += 1
 
+def parse_fields(fields):
+    """Parse fields=nodes:id,x,y&fields=links:id,node_1_id,node_2_id into {'nodes': ['id', 'x', 'y'], ...}.
 
-def make_junction(x, y, junction_type, network, template_id):
-    return {
-        'x': x,
-        'y': y,
-        'name': autoname(junction_type, network),
-        'description': 'Created automatically by OpenAgua',
-        'types': [{'id': junction_type['id'], 'template_id': template_id}],
-        'layout': {
-            'geojson': {
-                'type': 'Feature',
-                'geometry': {
-                    'type': 'Point',
-                    'coordinates': [float(x), float(y)]
-                },
-                'properties': {}
-            }
-        }
-    }
-
-
-def repair_network(hydra, source_id, network_id=None, network=None, options=None):
-    network = network or hydra.call('get_network', network_id, include_resources=True, include_data=False)
-
-    if not options:
-        return network
+    A field without a section (e.g., fields=name,layout) applies to the network itself. Dotted fields (e.g.,
+    layout.geojson) select part of a nested dict.
+    """
+    parsed = {}
+    for item in fields or []:
+        section, _, names = item.rpartition(':')
+        parsed.setdefault(section or 'network', []).extend(name.strip() for name in names.split(',') if name.strip())
+    return parsed
 
-    network_id = network_id or network['id']
 
-    update_resources = False
-
-    # repair missing types
-    if 'types-attrs' in options:
-        network, template = change_active_template(hydra, source_id, network=network)
-        template_id = template['id']
-
-        junction_types = [tt for tt in template.templatetypes if 'junction' in tt['name'].lower()]
-        junction_type = junction_types[0] if junction_types else None
-
-        # TODO: get default junction from type layout rather than name
-        if junction_type:
-
-            update_resources = True
-
-            # repair network topology
-            positions = {}
-            for node in network['nodes']:
-                xy = (node['x'], node['y'])
-                positions[xy] = positions.get(xy, []) + [node]
-            for (x, y), old_nodes in positions.items():
-                if len(old_nodes) > 1:
-                    junction = make_junction(x, y, junction_type, network, template_id)
-                    new_node = hydra.add_node(network_id, junction)
-
-                    old_node_ids = [n['id'] for n in old_nodes]
-                    old_link_ids = [l['id'] for l in network['links'] if
-                                    l['node_1_id'] in old_node_ids or l['node_2_id'] in old_node_ids]
-
-                    all_new_links = []
-                    for old_node in old_nodes:
-                        # update existing links and delete old node
-                        new_links = update_links2(hydra, old_node_id=old_node['id'], new_node_id=new_node['id'],
-                                                  old_link_ids=old_link_ids)
-                        all_new_links.extend(new_links)
-                        hydra.call('delete_node', old_node['id'], False)
-
-                    network['nodes'] = [n for n in network['nodes'] if n['id'] not in old_node_ids] + [new_node]
-                    network['links'] = [l for l in network['links'] if l['id'] not in old_link_ids] + all_new_links
-
-    else:
-        template_id = network['layout'].get('active_template_id')
-        template = hydra.call('get_template', template_id)
-
-    # repair missing attributes
-    if {'types-attrs', 'topology'} & set(options):
-
-        update_resources = True
-
-        if 'types-attrs' in options:
-            ttypes = {tt['id']: tt for tt in template['templatetypes']}
-
-        if 'topology' in options:
-            node_coords = {}
-
-        def repair_resource(resource, resource_type):
-
-            if 'types-attrs' in options:
-                resource['attributes'] = resource.get('attributes', [])
-
-                # repair resource types - add missing attributes
-                updated_resource_types = []
-                for rt in resource['types']:
-                    if rt['template_id'] != template['id']:
-                        continue
-
-                    tt = ttypes[rt['id']]
-                    rt['id'] = tt['id']
-                    updated_resource_types.append(rt)
-                    rattrs = set([ra['attr_id'] for ra in resource['attributes']])
-                    tattrs = set([ta['attr_id'] for ta in tt['typeattrs']])
-                    missing_attrs = tattrs - rattrs
-                    new_attrs = []
-                    for ta in tt['typeattrs']:
-                        if ta['attr_id'] in missing_attrs:
-                            new_attrs.append({
-                                'ref_key': resource_type.upper(),
-                                'attr_id': ta['attr_id'],
-                                'attr_is_var': ta['attr_is_var']
-                            })
-                    resource['attributes'].extend(new_attrs)
-
-                resource['types'] = updated_resource_types
-
-            # repair geojson
-            if 'topology' in options:
-                if resource_type == 'node':
-                    geojson = resource['layout'].get('geojson')
-                    if geojson is None:
-                        x, y = float(resource['x']), float(resource['y'])
-                        resource['layout']['geojson'] = {
-                            'type': 'Feature',
-                            'geometry': {
-                                'type': 'Point',
-                                'coordinates': [x, y],
-                            },
-                            'properties': {}
-                        }
-                    else:
-                        x, y = geojson['geometry']['coordinates']
-                        if type(x) != float:
-                            x = float(resource['x'])
-                        if type(y) != float:
-                            y = float(resource['y'])
-                        resource['layout']['geojson']['geometry']['coordinates'] = [x, y]
-                        resource['x'] = str(x)
-                        resource['y'] = str(y)
-                    node_coords[resource['id']] = [x, y]
-
-                elif resource_type == 'link':
-                    up_coords = node_coords.get(resource['node_1_id'])
-                    down_coords = node_coords.get(resource['node_2_id'])
-                    geojson = resource['layout'].get('geojson')
-                    if geojson is None:
-                        resource['layout']['geojson'] = {
-                            'type': 'Feature',
-                            'geometry': {
-                                'type': 'LineString',
-                                'coordinates': [],
-                            },
-                            'properties': {}
-                        }
-
-                    link_coords = resource['layout']['geojson']['geometry']['coordinates']
-                    coords_len = len(link_coords)
-                    if coords_len == 0:
-                        resource['layout']['geojson']['geometry']['coordinates'] = [up_coords, down_coords]
-                    else:
-                        resource['layout']['geojson']['geometry']['coordinates'][0] = up_coords
-                        if coords_len == 1:
-                            resource['layout']['geojson']['geometry']['coordinates'] += down_coords
-                        else:
-                            resource['layout']['geojson']['geometry']['coordinates'][-1] = down_coords
-                    resource['layout']['geojson']['geometry']['coordinates'] \
-                        = [[round(x * 1e8) / 1e8, round(y * 1e8) / 1e8] for x, y in
-                           resource['layout']['geojson']['geometry']['coordinates']]
-
-            return resource
-
-        network = repair_resource(network, 'network')
-        network['nodes'] = [repair_resource(n, 'node') for n in network['nodes']]
-        network['links'] = [repair_resource(l, 'link') for l in network['links']]
-
-    # repair missing baseline scenario
-    repair_scenarios = False
-    if 'scenarios' in options:
-        repair_scenarios = True
-        baseline = [s for s in network.scenarios if s['layout'].get('class') == 'baseline']
-        if not baseline:
-            if network.scenarios:
-                baseline = network['scenarios'][0]
-                baseline.update({'class': 'baseline'})
-            else:
-                baseline = add_default_scenario(hydra, network['id'])
+def project(obj, fields):
+    """Get the selected (possibly dotted) fields of a dict, as a new dict (a copy of it if no fields are given)"""
+    if not fields:
+        return dict(obj)
+    projected = {}
+    for field in fields:
+        *path, key = field.split('.')
+        src, dest = obj, projected
+        for part in path:
+            src = (src or {}).get(part)
+            if not isinstance(src, dict):
+                break
+            dest = dest.setdefault(part, {})
         else:
-            baseline = baseline[0]
-
-        # repair parent-less options & scenarios
-        scenario_lookup = {s['id']: s for s in network['scenarios']}
-        for scenario in network['scenarios']:
-            scenario_class = scenario['layout'].get('class')
-            parent_id = original_parent_id = scenario['layout'].get('parent')
-            if scenario_class in ['option', 'scenario']:
-                ancestor_id = None
-                if not parent_id:
-                    ancestor_id = baseline['id']
-                while not ancestor_id:
-                    parent = scenario_lookup.get(parent_id)
-                    if parent:
-                        parent_id = parent['id']
-                        if parent_id == baseline['id']:
-                            ancestor_id = parent_id
-                        elif parent_id != scenario['id']:
-                            ancestor_id = parent_id
-                        else:
-                            parent_id = parent['layout'].get('parent')
-                    else:
-                        ancestor_id = baseline['id']
-
-                if original_parent_id != ancestor_id:
-                    scenario['layout']['parent'] = ancestor_id
-                    hydra.call('update_scenario', scen=scenario)
+            if key in src:
+                dest[key] = src[key]
+    return projected
 
-    # remove loop links
-    if 'topology' in options:
-        for link in network['links']:
-            if link['node_1_id'] == link['node_2_id']:
-                hydra.call('delete_link', link['id'], False)
-        network['links'] = [link for link in network['links'] if link['node_1_id'] != link['node_2_id']]
 
-    # repair reference layers
-    if 'layers' in options:
-        network = repair_network_references(network)
+def get_network_fields(hydra, network_id, include=None, fields=None):
+    """Get only the requested parts of a network, using the cheapest Hydra call that can provide them.
 
-    if not update_resources:
-        network.pop('nodes')
-        network.pop('links')
-        network.pop('attributes')
-    if not repair_scenarios:
-        network.pop('scenarios')
+    For example, the map only needs include=nodes,links with fields=nodes:id,x,y,types,layout.geojson, which does not
+    need resource attributes, while the scenario manager only needs include=scenarios.
+    """
+    include = {name.strip() for item in include or [] for name in item.split(',')}
+    fields = parse_fields(fields)
 
-    repaired = hydra.call('update_network', network)
+    include_resources = bool(include & {'nodes', 'links', 'resourcegroups'})
+    need_attributes = 'attributes' in include or any(
+        field.split('.')[0] in ATTRIBUTE_FIELDS for section, names in fields.items() if section != 'network'
+        for field in names
+    )
+    network = hydra.call('get_network', network_id, include_resources=include_resources, include_data=False,
+                         summary=not need_attributes)
+    if network is None or 'error' in network:
+        return network
 
-    return repaired
+    # the network's own fields, without its resources, scenarios or other lists unless they are included below
+    sparse = project(network, fields.get('network')) if fields.get('network') else {
+        key: value for key, value in network.items() if not isinstance(value, list)
+    }
+    for section in NETWORK_INCLUDES:
+        if section in include:
+            value = network.get(section, [])
+            if section in fields and isinstance(value, list):
+                value = [project(item, fields[section]) for item in value]
+            sparse[section] = value
+    sparse['id'] = network['id']
+    return sparse
 
 
 def add_default_scenario(hydra, network_id, start_time=None, end_time=None, time_step=None):
@@ -507,27 +340,71 @@ def has_template(resource, template_id):
 
 
 def get_network_extents(network, template_id):
-    coords = [((float(node['x']), float(node['y']))) for node in network['nodes'] if
-              node['layout'].get('exists', True) and has_template(node, template_id)]
-    link_coords = []
-    coords += list(chain.from_iterable(
-        [link['layout']['geojson']['geometry']['coordinates'] for link in network['links'] if
-         link['layout'].get('exists', True) and link['layout'].get('geojson') and has_template(link, template_id)]
-    ))
-    if coords:
-        left = min([coord[0] for coord in coords])
-        bottom = min([coord[1] for coord in coords])
-        right = max([coord[0] for coord in coords])
-        top = max([coord[1] for coord in coords])
-        extents = (left, bottom, right, top)
-    else:
-        extents = (0, 0, 0, 0)
-    return extents
+    return get_network_geometry(network).extents(template_id)
+
+
+def get_template_styles(template):
+    """Get the thumbnail style (class name, color, junction flag) of each template type, cached by template version"""
+    key = template_version(template)
+    return template_style_cache.get_or_set(key, lambda: make_template_styles(template))
+
+
+def make_template_styles(template):
+    styles = {}
+    for tt in template['templatetypes']:
+        layout = tt.get('layout', {}) or {}
+        color = '#000'
+        if tt.get('resource_type') == 'NODE':
+            svg = layout.get('svg')
+            if svg:
+                svg = minidom.parseString(svg)
+                path = svg.getElementsByTagName('path')
+                if path:
+                    path = path[0]
+                    color = path.getAttribute('fill')
+        elif tt.get('resource_type') == 'LINK':
+            linestyle = layout.get('linestyle', {})
+            if type(linestyle) == str:
+                linestyle = json.loads(linestyle)
+            color = linestyle.get('color', color)
+
+        resource_class = tt['name'].lower()
+        for s in INVALID_CLASS_CHARACTERS:
+            resource_class = resource_class.replace(s, '-')
+
+        styles[tt['id']] = {
+            'class': resource_class,
+            'color': color,
+            'is_junction': 'junction' in resource_class,
+        }
+
+    return styles
+
+
+def decimate_line(coords, tolerance):
+    """Drop polyline vertices closer than the tolerance to the last kept vertex. End points are always kept."""
+    if len(coords) <= 2 or not tolerance:
+        return coords
+    decimated = [coords[0]]
+    x0, y0 = float(coords[0][0]), float(coords[0][1])
+    for x, y in coords[1:-1]:
+        x, y = float(x), float(y)
+        if abs(x - x0) >= tolerance or abs(y - y0) >= tolerance:
+            decimated.append((x, y))
+            x0, y0 = x, y
+    decimated.append(coords[-1])
+    return decimated
 
 
 def make_network_thumbnail(network, template):
+    """Make (or get from cache) the SVG thumbnail of a network for the given template"""
     if template is None:
         return None
+    key = (network_version(network), template_version(template))
+    return thumbnail_cache.get_or_set(key, lambda: render_network_thumbnail(network, template))
+
+
+def render_network_thumbnail(network, template):
     left, bottom, right, top = get_network_extents(network, template['id'])
     if left == right:
         left -= 0.5
@@ -551,39 +428,17 @@ def make_network_thumbnail(network, template):
     default_radius = max([h / pointscale, w / pointscale])
     linewidth = max([h / linescale, w / linescale])
 
-    # output = io.StringIO()
+    # anything closer than this is indistinguishable at display resolution
+    tolerance = max([h, w]) / THUMBNAIL_RESOLUTION
+
     dwg = svgwrite.Drawing(profile='tiny')
     links = dwg.add(dwg.g())
     nodes = dwg.add(dwg.g())
 
-    ttypes = {}
-    colors = {}
-    styles = {}
-    if template:
-        for tt in template.templatetypes:
-            ttypes[tt['id']] = tt
-            layout = tt.get('layout', {}) or {}
-            color = '#000'
-            styles[tt['id']] = {'stroke': '#000'}
-            if 'resource_type' not in tt:
-                continue
-            if tt['resource_type'] == 'NODE':
-                svg = layout.get('svg')
-                if svg:
-                    svg = minidom.parseString(svg)
-                    path = svg.getElementsByTagName('path')
-                    if path:
-                        path = path[0]
-                        color = path.getAttribute('fill')
-            elif tt.resource_type == 'LINK':
-                linestyle = layout.get('linestyle', {})
-                if type(linestyle) == str:
-                    linestyle = json.loads(linestyle)
-                color = linestyle.get('color', color)
-
-            colors[tt['id']] = color
+    styles = get_template_styles(template)
 
     coord_lookup = {node['id']: [node['x'], node['y']] for node in network['nodes']}
+    drawn_nodes = set()
 
     for res_type in ['nodes', 'links']:
         for resource in network[res_type]:
@@ -595,17 +450,14 @@ def make_network_thumbnail(network, template):
             resource_class = 'undefined'
             color = '#000'
 
-            if template:
-                rts = [t for t in resource['types'] if t['template_id'] == template['id']]
-                if rts:
-                    rt = rts[-1]
-                    tt = ttypes[rt['id']]
-                    resource_class = tt['name'].lower()
-                    for s in INVALID_CLASS_CHARACTERS:
-                        resource_class = resource_class.replace(s, '-')
-                    if 'junction' in resource_class.lower():
-                        continue
-                    color = colors[tt['id']]
+            rts = [t for t in resource['types'] if t['template_id'] == template['id']]
+            if rts:
+                rt = rts[-1]
+                style = styles[rt['id']]
+                if style['is_junction']:
+                    continue
+                resource_class = style['class']
+                color = style['color']
 
             if gj:
                 coords = gj['geometry']['coordinates']
@@ -614,6 +466,12 @@ def make_network_thumbnail(network, template):
                                                                                coord_lookup[resource['node_2_id']]]
 
             if res_type == 'nodes':
+                # skip nodes that would be drawn on top of an identical node
+                cell = (round(float(coords[0]) / tolerance), round(float(coords[1]) / tolerance), resource_class)
+                if cell in drawn_nodes:
+                    continue
+                drawn_nodes.add(cell)
+
                 radius = default_radius
 
                 if rt:
@@ -629,7 +487,7 @@ def make_network_thumbnail(network, template):
                 circle = dwg.circle(center=coords, r=radius, **extras)
                 nodes.add(circle)
             else:
-                polyline = dwg.polyline(points=coords)
+                polyline = dwg.polyline(points=decimate_line(coords, tolerance))
                 polyline.stroke(color=color, width=linewidth).fill(opacity=0)
                 if resource_class:
                     polyline['class'] = resource_class
@@ -782,38 +640,6 @@ def get_node(network, node_id):
     return [node for node in network['nodes'] if node['id'] == node_id][0]
 
 
-def move_network(hydra, source, destination, project_id, network_id):
-    # _load_datauser(url=source)
-    # _make_connection()
-
-    if destination == source:
-        network = hydra.call('get_network', network_id, summary=True, include_resources=False)
-        network['project_id'] = project_id
-        hydra.call('update_network', network)
-
-    else:
-        network = hydra.call('get_network', network_id, summary=False, include_resources=True,
-                             include_data=False)
-        network['project_id'] = project_id
-        template_id = network['layout'].get('active_template_id')
-        cleaned_template = None
-        old_template = None
-        if template_id:
-            old_template = hydra.call('get_template', template_id)
-            cleaned_template = clean_template(template=old_template)
-
-        # _load_datauser(url=destination)
-        # _make_connection()
-        new_template = None
-        if template_id and cleaned_template:
-            new_template = add_template(template=cleaned_template, is_public=False)
-        cleaned_network = clean_network(net=network, old_template=old_template, new_template=new_template)
-        new_template_id = new_template['id'] if new_template else None
-        new_network = add_network(hydra=hydra, net=cleaned_network, template_id=new_template_id)
-
-    return
-
-
 def normalize_network(network, network_id=1):
     network['id'] = network_id
     node_map = {}
@@ -833,104 +659,144 @@ def normalize_network(network, network_id=1):
     return network
 
 
-def clone_network(hydra, network_id, **kwargs):
+def rewrite_function_keys(func, lookup, rewritten=None):
+    """Replace quoted "type/id/attr_id" keys in a function with the resource ids given by lookup[(type, old_id)].
+
+    Keys for resources not in the lookup are left as they are, as are keys for the (type, id) pairs in rewritten,
+    e.g., the new resources, so that rewriting a function twice changes nothing more. Rewritten keys always use double
+    quotes.
+    """
+
+    def replace(match):
+        quote, resource_type, resource_id, attr_id = match.groups()
+        if rewritten and (resource_type, int(resource_id)) in rewritten:
+            return match.group(0)
+        new_resource_id = lookup.get((resource_type, int(resource_id)))
+        if new_resource_id is None:
+            return match.group(0)
+        return '"{}/{}/{}"'.format(resource_type, new_resource_id, attr_id)
+
+    return FUNCTION_KEY_REGEX.sub(replace, func)
+
+
+def clone_network(hydra, network_id, job=None, **kwargs):
+    """Clone a network, including its files and (optionally) its data.
+
+    The clone is done in stages, each recorded with job.checkpoint(), so that an interrupted clone can be resumed
+    without adding the network again: adding the network, copying its files and updating function keys to refer to
+    the new resources.
+    """
+    job = job or InlineJob()
+    state = job.state
     duplicate_template = kwargs.get('duplicate_template', False)
     new_name = kwargs.get('name')
-    include_data = kwargs.get('include_data')
     include_input = kwargs.get('include_input')
 
-    net = get_filtered_network(hydra, network_id, **kwargs)
-
-    old_network_folder = net['layout']['storage']['folder']
+    bucket_name = config.AWS_S3_BUCKET
 
-    template_id = net['layout'].get('active_template_id')
-    old_template = new_template = None
-    if duplicate_template:
-        if template_id:
-            old_template = hydra.call('get_template', template_id)
+    # add the network
+    if not state.get('new_network_id'):
+        job.progress(0, 100, 'Copying network')
+        net = get_filtered_network(hydra, network_id, **kwargs)
 
-    net = clean_network(net, old_template=old_template, new_template=new_template, purpose='clone')
+        old_network_folder = net['layout']['storage']['folder']
 
-    s3_bucket = current_app.config['AWS_S3_BUCKET']
-    net = add_storage(net, current_app.config.get('NETWORK_FILES_STORAGE_LOCATION'), force=True)
+        template_id = net['layout'].get('active_template_id')
+        old_template = new_template = None
+        if duplicate_template:
+            if template_id:
+                old_template = hydra.call('get_template', template_id)
 
-    net['name'] = new_name
+        net = clean_network(net, old_template=old_template, new_template=new_template, purpose='clone')
+        net = add_storage(net, config.NETWORK_FILES_STORAGE_LOCATION, force=True)
 
-    if not include_input:
-        for scen in net['scenarios']:
-            scen['resourcescenarios'] = []
+        net['name'] = new_name
 
-    # add the network
-    new_network = add_network(hydra, net)
+        if not include_input:
+            for scen in net['scenarios']:
+                scen['resourcescenarios'] = []
 
-    new_network = hydra.call('get_network', new_network['id'], include_data=True)
+        # the network is marked as this job's before it is added, so that if the job is interrupted before the new
+        # network's id is saved, the network is found again when the job is resumed, rather than added twice
+        new_network = None
+        if getattr(job, 'id', None):
+            net['layout']['clone_job_id'] = job.id
+            if state.get('adding_network'):
+                new_network = find_cloned_network(hydra, net.get('project_id'), job.id)
+            else:
+                job.checkpoint(adding_network=True)
+        if new_network is None:
+            new_network = add_network(hydra, net)
+        if not new_network:
+            raise Exception('The network could not be added')
+        job.checkpoint(
+            new_network_id=new_network['id'],
+            old_folder=old_network_folder,
+            new_folder=new_network['layout']['storage']['folder'],
+            copied_through={},
+            updated_scenario_ids=[],
+        )
 
-    # copy reference layers
-    new_network_folder = new_network['layout']['storage']['folder']
+    new_network_id = state['new_network_id']
 
+    # copy reference layers and thumbnails, server-side and in parallel, recording the last key copied in each
+    copied_through = dict(state.get('copied_through', {}))
     for folder in ['.layers', '.thumbnail']:
-        duplicate_folder(s3_bucket, s3_bucket, old_network_folder, new_network_folder, prefix=folder + '/')
-
-    # UPDATE FUNCTIONS WITH NEW RESOURCE IDS
-
-    # get dictionary mapping old resource ID to new resource ID
-    new_resource_lookup = {}
-
-    def update_resource_lookup(resource_type, resource):
-        new_resource_lookup[(resource_type, resource['layout']['old_id'])] = resource['id']
-
-    update_resource_lookup('network', new_network)
-    for node in new_network['nodes']:
-        update_resource_lookup('node', node)
-    for link in new_network['links']:
-        update_resource_lookup('link', link)
-
-    def update_function(func):
-        # resultsA = re.findall(r'\'(.+)\'', func)
-        # resultsB = re.findall(r'\"(.+)\"', func)
-        resultsA = func.split("'")
-        resultsB = func.split('"')
-        for old_key in resultsA + resultsB:
-            parts = old_key.split('/')
-            if len(parts) == 3:
-                resource_type, resource_id, attr_id = parts
-                try:
-                    resource_id = int(resource_id)
-                    attr_id = int(attr_id)
-                except:
-                    continue
-                new_resource_id = new_resource_lookup.get((resource_type, resource_id))
-                if new_resource_id:
-                    new_key = '"{}/{}/{}"'.format(resource_type, new_resource_id, attr_id)
-                    old_key_extended = "{quote}{key}{quote}".format(
-                        key=old_key,
-                        quote="'" if old_key in resultsA else '"'
-                    )
-                    func = func.replace(old_key_extended, new_key)
-
-        return func
-
-    for scen in new_network['scenarios']:
-        # parent = scen['layout'].get('parent')
-        # if parent:
-        #     scen['layout']['parent'] = -scen['layout']['parent']
-        # children = scen['layout'].get('children')
-        # if children:
-        #     scen['layout']['children'] = [-c for c in set(scen['layout']['children'])]
+        def on_progress(last_key, copied, total):
+            copied_through[folder] = last_key
+            job.checkpoint(copied_through=dict(copied_through))
+            job.progress(copied, total, 'Copying {} files'.format(folder))
+
+        copy_folder_parallel(
+            bucket_name, state['old_folder'], state['new_folder'], prefix=folder + '/',
+            start_after=copied_through.get(folder), max_workers=config.S3_COPY_WORKERS, on_progress=on_progress
+        )
 
+    # update functions with new resource ids
+    new_network = hydra.call('get_network', new_network_id, include_data=True, include_resources=True)
+
+    # map old resource ids to new resource ids
+    lookup = {('network', new_network['layout']['old_id']): new_network['id']}
+    for resource_type in ['node', 'link']:
+        for resource in new_network[resource_type + 's']:
+            lookup[(resource_type, resource['layout']['old_id'])] = resource['id']
+
+    rewritten = set((resource_type, new_id) for (resource_type, old_id), new_id in lookup.items())
+
+    updated_scenario_ids = list(state.get('updated_scenario_ids', []))
+    scenarios = [s for s in new_network['scenarios'] if s['id'] not in updated_scenario_ids]
+    for i, scen in enumerate(scenarios):
+        job.progress(i, len(scenarios), 'Updating functions in {}'.format(scen['name']))
+        updated = []
         for rs in scen['resourcescenarios']:
-            metadata = json.loads(rs.get('value', {}).get('metadata', ''))
-            if metadata and 'function' in metadata:
-                metadata['function'] = update_function(metadata.get('function'))
-                rs['value']['metadata'] = json.dumps(metadata)
+            metadata = json.loads(rs.get('value', {}).get('metadata') or '{}')
+            if metadata and metadata.get('function'):
+                func = rewrite_function_keys(metadata['function'], lookup, rewritten)
+                if func != metadata['function']:
+                    metadata['function'] = func
+                    rs['value']['metadata'] = json.dumps(metadata)
+                    updated.append(rs)
+        if updated:
+            result = hydra.call('update_resourcedata', scen['id'], updated)
+            if isinstance(result, dict) and 'error' in result:
+                raise Exception(result['error'])
+        updated_scenario_ids.append(scen['id'])
+        job.checkpoint(updated_scenario_ids=updated_scenario_ids)
+
+    return hydra.call('get_network', new_network_id, summary=True, include_resources=False, include_data=False)
 
-    # reduce network size
-    new_network['nodes'] = []
-    new_network['links'] = []
 
-    newer_network = hydra.call('update_network', new_network)
+def find_cloned_network(hydra, project_id, job_id):
+    """Find the network that a clone job added, if any"""
+    networks = hydra.call('get_networks', project_id=project_id, include_resources=False, include_data=False,
+                          summary=True)
+    return next((network for network in networks or [] if isinstance(network, dict)
+                 and (network.get('layout') or {}).get('clone_job_id') == job_id), None)
 
-    return newer_network
+
+@job_function('clone_network')
+def clone_network_job(hydra, job, network_id, **options):
+    return clone_network(hydra, network_id, job=job, **options)
 
 
 def prepare_network_for_export(network):
@@ -979,37 +845,26 @@ def get_filtered_network(hydra, network_id, **kwargs):
 def nodes_to_array(network, template):
     # Note: Hydra saves coordinates to the nearest 0.0001 degree. However, OpenAgua also stores GeoJSON with the nodes, where higher resolution coordinates can be stored.
     # Here is the OpenAgua GeoJSON approach to getting the coordinates:
+    geometry = get_network_geometry(network)
+    type_names = geometry.type_names_for('NODE', template['id'])
+    coords = numpy.round(geometry.node_gj_xy, 6).tolist()
     nodes = [['ID', 'Name', 'Type', 'X', 'Y', 'Description']]
-    node_lookup = {}
-    template_id = template['id']
-    for node in network['nodes']:
-        coords = node['layout']['geojson']['geometry']['coordinates'] if node['layout'].get('geojson') else [node['x'],
-                                                                                                             node['y']]
-        resource_types = [rt for rt in node['types'] if rt['template_id'] == template_id]
-        nodes.append([
-            abs(node['id']),
-            node['name'],
-            resource_types[0]['name'] if resource_types else 'unknown',
-            round(float(coords[0]), 6),
-            round(float(coords[1]), 6),
-            node['description']
-        ])
-        node_lookup[node['id']] = node
+    nodes.extend(
+        [abs(node['id']), node['name'], type_name, x, y, node['description']]
+        for node, type_name, (x, y) in zip(network['nodes'], type_names, coords)
+    )
+    node_lookup = {node['id']: node for node in network['nodes']}
     return nodes, node_lookup
 
 
 def links_to_array(network, template, node_lookup):
+    geometry = get_network_geometry(network)
+    type_names = geometry.type_names_for('LINK', template['id'])
     links = [['ID', 'Name', 'Type', 'Node_1_ID', 'Node_2_ID', 'Description']]
-    for link in network['links']:
-        resource_types = [rt for rt in link['types'] if rt['template_id'] == template['id']]
-        links.append([
-            abs(link['id']),
-            link['name'],
-            resource_types[0]['name'] if resource_types else 'unknown',
-            link['node_1_id'],
-            link['node_2_id'],
-            link['description']
-        ])
+    links.extend(
+        [abs(link['id']), link['name'], type_name, link['node_1_id'], link['node_2_id'], link['description']]
+        for link, type_name in zip(network['links'], type_names)
+    )
     return links
 
 
@@ -1150,7 +1005,7 @@ def get_network_for_export(hydra, network_id, options, file_format):
         network = hydra.call('get_network', network_id, include_data=False, include_resources=True,
                              summary=True)
 
-        content = make_adjacency(network, flavor='csv')
+        content = make_adjacency(network, flavor='stream')
 
     elif file_format == 'zip':
         network = hydra.call('get_network', network_id, include_data=False, include_resources=True,
@@ -1227,7 +1082,7 @@ def get_network_for_export(hydra, network_id, options, file_format):
     return filename, content
 
 
-def save_network_preview(hydra, network, filename, contents, location, s3=None, bucket_name=None):
+def save_network_preview(hydra, network, filename, contents, location, s3=None, bucket_name=None, version=None):
     # add storage if needed
     network = add_storage(network, location)
 
@@ -1242,7 +1097,7 @@ def save_network_preview(hydra, network, filename, contents, location, s3=None,
     if url:
         url += '?{}'.format(datetime.now().timestamp())
 
-        network['layout']['preview'] = {'stale': False, 'url': url}
+        network['layout']['preview'] = {'stale': False, 'url': url, 'version': version}
         hydra.call('update_network', network)
 
     return url
@@ -1331,83 +1186,94 @@ def prepare_network_for_move(network, new_template=None):
 
 
 def make_adjacency(network, flavor='array'):
-    n = len(network['nodes'])
-    adj = numpy.zeros([n + 1, n + 1], dtype=object)
-    adj[0, 0] = ''
-    lookup = {}
-    for i, node in enumerate(network['nodes']):
-        i += 1
-        lookup[node['id']] = i
-        adj[0, i] = '"{}"'.format(node['name'])
-        adj[i, 0] = '"{}"'.format(node['name'])
+    """Make a node-by-node adjacency matrix, with node names in the first row and column.
 
-    for link in network['links']:
-        adj[lookup[link['node_1_id']], lookup[link['node_2_id']]] = 1
+    The 'stream' flavor is a generator of CSV lines, made row by row from the sparse adjacency, for a streaming
+    response.
+    """
+    geometry = get_network_geometry(network)
 
     if flavor == 'array':
-        adj = adj.tolist()
+        n = len(geometry.node_ids)
+        names = ['"{}"'.format(name) for name in geometry.node_names]
+        adj = [[''] + names]
+        for i in range(n):
+            row = [0] * n
+            for j in geometry.adj_indices[geometry.adj_indptr[i]:geometry.adj_indptr[i + 1]].tolist():
+                row[j] = 1
+            adj.append([names[i]] + row)
 
-    # resp.data.adjacency.map(d= > JSON.stringify(d)).join('\n').replace( / ( ^\[) | (\]$) / mg, '');
-    elif flavor == 'csv':
-        adj = "\n".join([",".join(map(str, row)) for row in adj])
+    else:
+        adj = (line + '\n' for line in geometry.iter_adjacency_csv())
 
     return adj
 
 
-def update_network_on_mapbox(network, template, endpoint_url, dataset_id, mapbox_creation_token, is_public):
-    kwargs = {
-        'endpoint': endpoint_url,
-        'access_token': mapbox_creation_token,  # "access_token" is mapbox terminology, so let's pass that
-        'dataset_id': dataset_id
-    }
+def update_network_on_mapbox(db, source_id, network, template, is_public, client=None, job=None):
+    """Publish a network's features to the public Mapbox dataset (or remove them, if the network is not public).
+
+    Only features that changed since the last sync are sent, as found from the hashes saved for the network. The
+    hashes are saved after each batch of writes, so a sync that is interrupted (or cancelled, as a job) is taken up
+    where it stopped by the next one.
+    """
+    job = job or InlineJob()
+    dataset_id = config.MAPBOX_DATASET_ID
+    client = client or MapboxDatasetClient(config.MAPBOX_API_URL, config.MAPBOX_USERNAME, dataset_id,
+                                           config.MAPBOX_CREATION_TOKEN)
+
+    features = make_mapbox_features(network, template)[0] if is_public else []
 
-    if is_public:
-        update_features, delete_feature_ids = make_mapbox_features(network, template)
+    state = get_sync_state(db, source_id, network['id'], dataset_id)
+    if state is not None:
+        old_hashes = state.hashes or {}
     else:
-        update_features = []
-        delete_feature_ids = get_feature_ids(network)
-
-    url = '{}/update_features'.format(kwargs.get('endpoint'))
-    data = {
-        'access_token': kwargs.get('access_token'),
-        'dataset_id': kwargs.get('dataset_id'),
-        'features': update_features + delete_feature_ids
-    }
-    requests.post(url, json=data)
+        # nothing is known about what was sent before, so any existing features are removed or replaced
+        old_hashes = {feature_id: None for feature_id in get_feature_ids(network)}
+
+    def on_batch(hashes, done, total):
+        save_sync_state(db, source_id, network['id'], dataset_id, hashes)
+        job.progress(done, total, 'Published {} of {} changes'.format(done, total))
+
+    hashes, stats = sync_features(client, features, old_hashes, max_workers=config.MAPBOX_SYNC_WORKERS,
+                                  on_batch=on_batch)
+    return stats
+
+
+@job_function('update_network_map')
+def update_network_map_job(hydra, job, network_id, is_public):
+    network = hydra.call('get_network', network_id, include_resources=True, include_data=False, summary=True)
+    template = get_cached_template(hydra, network['layout']['active_template_id'])
+    return update_network_on_mapbox(job.db, job.source_id, network, template, is_public, job=job)
 
 
 def make_mapbox_features(network, template):
-    ttypes = {tt['id']: tt for tt in template.templatetypes}
-    node_lookup = {node['id']: node for node in network['nodes']}
+    ttypes = {tt['id']: tt for tt in template['templatetypes']}
+    geometry = get_network_geometry(network)
 
     update_features = []
     delete_features = []
     for resource_type in ['NODE', 'LINK']:
-        for resource in network[resource_type.lower() + 's']:
+        resources = network[resource_type.lower() + 's']
+        type_ids = geometry.type_ids(resource_type, template['id'])
+        exists = geometry.node_exists if resource_type == 'NODE' else geometry.link_exists
 
-            ttype_ids = [t['id'] for t in resource['types'] if t['template_id'] == template['id']]
-            if not ttype_ids:
-                continue
+        for row in numpy.flatnonzero(type_ids >= 0).tolist():
+            resource = resources[row]
 
             feature_id = '{}{}'.format(resource_type, resource['id'])
 
-            if not resource.layout.get('exists', True):
+            if not exists[row]:
                 delete_features.append(feature_id)
                 continue
 
-            ttype_id = ttype_ids[0]
-            ttype = ttypes[ttype_id]
+            ttype = ttypes[int(type_ids[row])]
 
             if resource_type == 'NODE':
-                coordinates = [float(resource['x']), float(resource['y'])]
+                coordinates = geometry.node_xy[row].tolist()
                 geo_type = 'Point'
 
             else:
-                coordinates = resource.layout.get('geojson', {}).get('geometry', {}).get('coordinates')
-                if not coordinates:
-                    node1 = node_lookup[resource['node_1_id']]
-                    node2 = node_lookup[resource['node_2_id']]
-                    coordinates = [(node1['x'], node1['y']), (node2['x'], node2['y'])]
+                coordinates = geometry.link_vertices(row).tolist()
                 geo_type = 'LineString'
 
             feature = {
@@ -1418,8 +1284,8 @@ def make_mapbox_features(network, template):
                     'class': resource_type,
                     'type': ttype['name'],
                     'name': resource['name'],
-                    'display_name': resource.layout.get('display_name', resource['name']),
-                    'description': resource.description,
+                    'display_name': resource['layout'].get('display_name', resource['name']),
+                    'description': resource['description'],
                 }
             }
 
@@ -1432,18 +1298,23 @@ def get_feature_ids(network):
     return ['NODE{}'.format(n['id']) for n in network['nodes']] + ['LINK{}'.format(l['id']) for l in network['links']]
 
 
-def update_types(hydra, resource, resource_type):
-    tpl_ids = []
-    updated_types = []
-    for type in resource['types'][::-1]:
-        if type['template_id'] in tpl_ids:
-            hydra.call('remove_type_from_resource', type_id=type['id'], resource_type=resource_type,
-                       resource_id=resource['id'])
-        else:
-            tpl_ids.append(type['template_id'])
-            updated_types.append(type)
+def update_types(hydra, resources, resource_type):
+    """Keep only the last type of each template on each of a batch of nodes or links, removing the others in Hydra"""
+    for resource in resources:
+        if not resource.get('types'):
+            continue
+        tpl_ids = []
+        updated_types = []
+        for type in resource['types'][::-1]:
+            if type['template_id'] in tpl_ids:
+                hydra.call('remove_type_from_resource', type_id=type['id'], resource_type=resource_type,
+                           resource_id=resource['id'])
+            else:
+                tpl_ids.append(type['template_id'])
+                updated_types.append(type)
+        resource['types'] = updated_types
 
-    return updated_types
+    return resources
 
 
 def make_node(template_id, ttype, node_name, node_description, x, y, gj=None, id=None):
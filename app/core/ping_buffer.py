@@ -0,0 +1,124 @@
+import atexit
+import logging
+import time
+from threading import Event, Lock, Thread
+
+log = logging.getLogger(__name__)
+
+
+class PingBuffer(object):
+    """A write-behind buffer for model run pings.
+
+    Progress pings are coalesced in memory, keeping only the latest for each run and status, and written in bulk by a
+    background thread every `interval` seconds, or sooner if more than `max_pending` are waiting. Pings that end a run
+    should not be buffered; take() the run's pending pings and write them with the final ping instead.
+
+    write(pings) is called with a list of ping dicts (sid, status and other Ping columns) and should commit them.
+    """
+
+    def __init__(self, write, interval=2.0, max_pending=5000):
+        self.write = write
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}  # (sid, status) -> ping
+        self._received = {}  # (sid, status) -> when the oldest unwritten update was received
+        self._lock = Lock()
+        self._wake = Event()
+        self._thread = None
+
+        self.received = 0
+        self.coalesced = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.peak_depth = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.max_lag_ms = 0.0  # longest a ping has waited to be written
+
+    def add(self, sid, status, **data):
+        key = (sid, status)
+        with self._lock:
+            self.received += 1
+            if key in self._pending:
+                self.coalesced += 1
+                self._pending[key].update(data)
+            else:
+                self._pending[key] = dict(data, sid=sid, status=status)
+                self._received[key] = time.monotonic()
+            depth = len(self._pending)
+            self.peak_depth = max(self.peak_depth, depth)
+        self._start()
+        if depth >= self.max_pending:
+            self._wake.set()
+
+    def take(self, sid):
+        """Remove and return a run's pending pings, e.g., to write them along with the run's final ping"""
+        with self._lock:
+            keys = [key for key in self._pending if key[0] == sid]
+            for key in keys:
+                self._received.pop(key, None)
+            return [self._pending.pop(key) for key in keys]
+
+    def flush(self):
+        with self._lock:
+            pending, received = self._pending, self._received
+            self._pending, self._received = {}, {}
+        if not pending:
+            return 0
+
+        start = time.monotonic()
+        try:
+            self.write(list(pending.values()))
+        except Exception as err:
+            log.warning('Ping flush failed, retrying later: {}'.format(err))
+            with self._lock:
+                self.failed_flushes += 1
+                # put the pings back, unless newer ones have arrived since
+                for key, ping in pending.items():
+                    if key in self._pending:
+                        self._pending[key] = dict(ping, **self._pending[key])
+                    else:
+                        self._pending[key] = ping
+                    self._received[key] = min(received[key], self._received.get(key, received[key]))
+            return 0
+
+        end = time.monotonic()
+        with self._lock:
+            self.flushes += 1
+            self.written += len(pending)
+            self.last_flush_ms = (end - start) * 1000
+            self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+            self.max_lag_ms = max(self.max_lag_ms, (end - min(received.values())) * 1000)
+        return len(pending)
+
+    def stats(self):
+        with self._lock:
+            oldest = min(self._received.values()) if self._received else None
+            return {
+                'depth': len(self._pending),
+                'peak_depth': self.peak_depth,
+                'oldest_pending_ms': round((time.monotonic() - oldest) * 1000, 1) if oldest else 0,
+                'received': self.received,
+                'coalesced': self.coalesced,
+                'written': self.written,
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+                'last_flush_ms': round(self.last_flush_ms, 1),
+                'max_flush_ms': round(self.max_flush_ms, 1),
+                'max_lag_ms': round(self.max_lag_ms, 1),
+            }
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name='ping-buffer', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
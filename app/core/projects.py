@@ -1,116 +1,7 @@
 from urllib.parse import urlparse
-from app.core.users import get_datauser, get_dataurl
+from app.core.users import get_dataurl
 from app.core.templates import clean_template2
 from app.core.modeling import get_models, get_active_network_model
-from app.core.utils import decrypt
-from app.core.hydra import HydraConnection
-
-
-def move_project(db, user_id, key, **kwargs):
-    src = kwargs['source']
-    dest = kwargs['destination']
-
-    datauser1 = get_datauser(db, url=src, user_id=user_id)
-    hydra1 = HydraConnection(
-        url=src,
-        username=datauser1.username,
-        password=decrypt(datauser1.password, key)
-    )
-
-    datauser2 = get_datauser(db, url=dest, user_id=user_id)
-    hydra2 = HydraConnection(
-        url=dest,
-        username=datauser2.username,
-        password=decrypt(datauser2.password, key)
-    )
-
-    # get existing project
-    project1 = hydra1.call('get_project', kwargs['project_id'])
-
-    # create new project
-    project1['id'] = None
-    del project1['created_by']
-    del project1['cr_date']
-
-    projects2 = hydra2.call('get_projects', user_id=datauser2.userid)
-    existing_names = [p['name'] for p in projects2]
-    i = 2
-    badname = True
-    new_name = project1['name']
-    while badname:
-        if new_name in existing_names:
-            new_name = '{} ({})'.format(project1['name'], i)
-            i += 1
-        else:
-            badname = False
-
-    project1['name'] = new_name
-    project2 = hydra2.call('add_project', project1)
-
-    # get project networks
-    networks1 = hydra1.call('get_networks', project_id=kwargs['project_id'], include_data=True, include_resources=True,
-                           summary=False)
-    for network1 in networks1:
-        try:
-            template1 = hydra1.call('get_template', network1.types[0]['template_id'])
-            template2 = hydra2.call('get_template_by_name', template_name=template1['name'])
-
-            ttypes2 = {tt['name']: tt['id'] for tt in template2.templatetypes}
-
-            net = {
-                'name': network1['name'],
-                'description': network1['description'],
-                'layout': network1['layout'],
-                'project_id': project2['id'],
-                'nodes': [],
-                'links': [],
-                'network': []
-            }
-
-            # update some defaults
-            net['layout']['public'] = False  # assume not public on new database
-
-            # step 1: add network types
-            new_types = []
-            for type in network1['types']:
-                type['id'] = ttypes2[type['name']]
-                type['template_id'] = template2['id']
-                new_types.append(type)
-            net['types'] = new_types
-
-            # step 2: add nodes
-            for node in network1.nodes:
-                del node['id']
-                del node['cr_date']
-                new_types = []
-                for type in node['types']:
-                    type['id'] = ttypes2[type['name']]
-                    type['template_id'] = template2['id']
-                    new_types.append(type)
-                node['types'] = new_types
-                net['nodes'].append(node)
-            net = hydra2.call('add_network', net)
-
-            # step 3: add links
-            nodes1 = {node['id']: node['name'] for node in network1['nodes']}
-            nodes2 = {node['name']: node['id'] for node in net['nodes']}
-            for link in network1['links']:
-                del link['id']
-                del link['cr_date']
-                new_types = []
-                for type in link['types']:
-                    type['id'] = ttypes2[type['name']]
-                    type['template_id'] = template2['id']
-                    new_types.append(type)
-                for endnode in ['node_1_id', 'node_2_id']:
-                    link[endnode] = nodes2[nodes1[link[endnode]]]
-                net['links'].append(link)
-
-            hydra2.call('update_network', net=net)
-        except:
-            continue
-
-    return project2
 
 
 def get_project_url(db, request_url, source_url, project_id):
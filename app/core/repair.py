@@ -0,0 +1,328 @@
+import math
+from collections import defaultdict
+
+from app.core.caching import Cache, fingerprint, network_version, template_version
+from app.core.edit_session import EditSession
+from app.core.network_editor import repair_network_references
+from app.core.networks import add_default_scenario
+from app.core.templates import change_active_template, get_cached_template, invalidate_cached_template
+
+REPAIR_OPTIONS = ['types-attrs', 'topology', 'scenarios', 'layers']
+
+# the issues fixed by each repair option
+REPAIR_ISSUES = {
+    'types-attrs': ['missing_types', 'missing_attributes', 'duplicate_nodes'],
+    'topology': ['missing_geojson', 'misaligned_links', 'dangling_links', 'loop_links'],
+    'scenarios': ['missing_baseline', 'orphan_scenarios'],
+    'layers': ['bad_layer_refs'],
+}
+
+diagnosis_cache = Cache(maxsize=256)
+
+
+def autoname(ttype, network, existing_names=None):
+    base = '{}-{}-{}'.format(network['name'].replace(' ', '')[:5].upper(), ttype['resource_type'][0],
+                             ttype['name'].replace(' ', '')[:3].upper())
+
+    if existing_names is None:
+        existing_names = [r['name'] for r in network[ttype['resource_type'].lower() + 's']]
+
+    i = 1
+    while True:
+        name = base + str(i)
+        if name not in existing_names:
+            return name
+        i += 1
+
+
+def make_junction(x, y, junction_type, network, template_id, existing_names=None):
+    return {
+        'x': x,
+        'y': y,
+        'name': autoname(junction_type, network, existing_names=existing_names),
+        'description': 'Created automatically by OpenAgua',
+        'types': [{'id': junction_type['id'], 'template_id': template_id}],
+        'layout': {
+            'geojson': {
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': [float(x), float(y)]
+                },
+                'properties': {}
+            }
+        }
+    }
+
+
+def structure_version(network):
+    """A version key for everything the repair analyzer looks at: resources, their attributes, the scenarios and the
+    network's layer references"""
+    resources = [network] + network.get('nodes', []) + network.get('links', [])
+    attrs = [(r['id'], sorted(ra['attr_id'] for ra in r.get('attributes') or [])) for r in resources]
+    scenarios = [(s['id'], (s.get('layout') or {}).get('class'), (s.get('layout') or {}).get('parent'))
+                 for s in network.get('scenarios', [])]
+    refs = (network.get('layout') or {}).get('refs') or []
+    return '{}:{}'.format(network_version(network), fingerprint(attrs, scenarios, refs))
+
+
+def _node_coords(node):
+    """Get a node's GeoJSON coordinates, or None if it has no (valid) GeoJSON"""
+    gj = (node.get('layout') or {}).get('geojson')
+    coords = gj and (gj.get('geometry') or {}).get('coordinates')
+    if not isinstance(coords, (list, tuple)) or len(coords) != 2 \
+            or not all(isinstance(c, (int, float)) and not isinstance(c, bool) and math.isfinite(c) for c in coords):
+        return None
+    return list(coords)
+
+
+def _link_coords(link):
+    gj = (link.get('layout') or {}).get('geojson')
+    return gj and (gj.get('geometry') or {}).get('coordinates') or None
+
+
+def _junction_type(template):
+    # TODO: get default junction from type layout rather than name
+    junction_types = [tt for tt in template['templatetypes'] if 'junction' in tt['name'].lower()]
+    return junction_types[0] if junction_types else None
+
+
+def diagnose_network(network, template=None):
+    """Find what repair_network would fix, without changing anything.
+
+    Returns a report of the issues found, keyed by issue, along with the repair options that would fix them.
+    """
+    issues = defaultdict(list)
+    template_id = template and template['id']
+    ttypes = {tt['id']: tt for tt in template['templatetypes']} if template else {}
+
+    def check_types(resource, resource_type):
+        rts = [rt for rt in resource.get('types', []) if rt['template_id'] == template_id]
+        if not rts:
+            issues['missing_types'].append({'resource_type': resource_type, 'id': resource['id']})
+            return
+        rattrs = {ra['attr_id'] for ra in resource.get('attributes') or []}
+        missing = sorted({ta['attr_id'] for rt in rts if rt['id'] in ttypes
+                          for ta in ttypes[rt['id']]['typeattrs']} - rattrs)
+        if missing:
+            issues['missing_attributes'].append({'resource_type': resource_type, 'id': resource['id'],
+                                                 'attr_ids': missing})
+
+    nodes = {}
+    positions = defaultdict(list)
+    for node in network['nodes']:
+        nodes[node['id']] = node
+        positions[(node['x'], node['y'])].append(node['id'])
+        if template:
+            check_types(node, 'NODE')
+        if _node_coords(node) is None:
+            issues['missing_geojson'].append({'resource_type': 'NODE', 'id': node['id']})
+
+    if template and _junction_type(template):
+        issues['duplicate_nodes'] = [node_ids for node_ids in positions.values() if len(node_ids) > 1]
+
+    linked = set()
+    for link in network['links']:
+        node_1_id, node_2_id = link['node_1_id'], link['node_2_id']
+        linked.update([node_1_id, node_2_id])
+        if template:
+            check_types(link, 'LINK')
+        if node_1_id not in nodes or node_2_id not in nodes:
+            issues['dangling_links'].append(link['id'])
+            continue
+        if node_1_id == node_2_id:
+            issues['loop_links'].append(link['id'])
+            continue
+        coords = _link_coords(link)
+        if not coords:
+            issues['missing_geojson'].append({'resource_type': 'LINK', 'id': link['id']})
+        elif len(coords) < 2 or list(coords[0]) != _node_coords(nodes[node_1_id]) \
+                or list(coords[-1]) != _node_coords(nodes[node_2_id]):
+            issues['misaligned_links'].append(link['id'])
+
+    # orphan nodes are reported, but are not an error
+    issues['orphan_nodes'] = [node_id for node_id in nodes if node_id not in linked]
+
+    scenarios = {s['id']: s for s in network.get('scenarios', [])}
+    baseline = [s for s in scenarios.values() if (s.get('layout') or {}).get('class') == 'baseline']
+    if not baseline:
+        issues['missing_baseline'] = True
+    for scenario in scenarios.values():
+        layout = scenario.get('layout') or {}
+        if layout.get('class') in ['option', 'scenario']:
+            parent_id = layout.get('parent')
+            if not parent_id or parent_id == scenario['id'] or parent_id not in scenarios:
+                issues['orphan_scenarios'].append(scenario['id'])
+
+    # reference layers are stored in S3, so only their references in the network's layout are diagnosed
+    paths = set()
+    for i, ref in enumerate((network.get('layout') or {}).get('refs') or []):
+        url = isinstance(ref, dict) and ref.get('url')
+        path = '/'.join(url.split('/')[4:]) if url else isinstance(ref, dict) and ref.get('path')
+        if not path or path[:7] != '.layers' or path in paths:
+            issues['bad_layer_refs'].append(i)
+        paths.add(path)
+
+    issues = {key: value for key, value in issues.items() if value}
+    return {
+        'network_id': network['id'],
+        'template_id': template_id,
+        'version': structure_version(network),
+        'issues': issues,
+        'counts': {key: len(value) if type(value) == list else 1 for key, value in issues.items()},
+        'options': [option for option, keys in REPAIR_ISSUES.items() if set(keys) & set(issues)],
+    }
+
+
+def get_diagnosis(hydra, network, template=None):
+    """Get the repair diagnosis of a network, which is cached per network structure and template version"""
+    template_id = network['layout'].get('active_template_id')
+    if template is None and template_id:
+        template = get_cached_template(hydra, template_id)
+    key = (hydra.url, network['id'], structure_version(network), template and template_version(template))
+    return diagnosis_cache.get_or_set(key, lambda: diagnose_network(network, template))
+
+
+def invalidate_diagnosis(network_id):
+    diagnosis_cache.invalidate(lambda key: key[1] == network_id)
+
+
+def repair_network(db, hydra, source_id, network_id=None, network=None, options=None, dry_run=False):
+    """Repair a network, for the given repair options.
+
+    The network is first diagnosed (which is cached), and nothing is written unless the diagnosis finds something
+    that the options would fix. All fixes to nodes, links, scenarios and the network itself are then written with a
+    single update_network call. With dry_run, the diagnosis is returned instead.
+    """
+    network = network or hydra.call('get_network', network_id, include_resources=True, include_data=False)
+    network_id = network['id']
+    options = [option for option in options or [] if option in REPAIR_OPTIONS]
+
+    diagnosis = get_diagnosis(hydra, network)
+    if dry_run:
+        return dict(diagnosis, requested=options)
+
+    needed = [option for option in options if option in diagnosis['options']]
+    if not needed:
+        return network
+
+    issues = diagnosis['issues']
+    template_id = network['layout'].get('active_template_id')
+    template = get_cached_template(hydra, template_id) if template_id else None
+
+    # resources without a type in the active template need their types converted, which may add template types
+    if 'types-attrs' in needed and issues.get('missing_types'):
+        network, template = change_active_template(db, hydra, source_id, network=network)
+        invalidate_cached_template(template['id'])
+
+    session = EditSession(hydra, network)
+
+    if 'types-attrs' in needed and template:
+        ttypes = {tt['id']: tt for tt in template['templatetypes']}
+
+        def add_missing_attributes(resource, resource_type):
+            rattrs = {ra['attr_id'] for ra in resource.get('attributes') or []}
+            new_attrs = []
+            for rt in resource.get('types', []):
+                if rt['template_id'] != template['id'] or rt['id'] not in ttypes:
+                    continue
+                for ta in ttypes[rt['id']]['typeattrs']:
+                    if ta['attr_id'] not in rattrs:
+                        rattrs.add(ta['attr_id'])
+                        new_attrs.append({'ref_key': resource_type, 'attr_id': ta['attr_id'],
+                                          'attr_is_var': ta['attr_is_var']})
+            if new_attrs:
+                resource['attributes'] = (resource.get('attributes') or []) + new_attrs
+            return bool(new_attrs)
+
+        if add_missing_attributes(network, 'NETWORK'):
+            session.update_network(attributes=network['attributes'])
+        for node in network['nodes']:
+            if add_missing_attributes(node, 'NODE') or issues.get('missing_types'):
+                session.update_node(node)
+        for link in network['links']:
+            if add_missing_attributes(link, 'LINK') or issues.get('missing_types'):
+                session.update_link(link)
+
+        # merge nodes at the same location into a junction
+        junction_type = _junction_type(template)
+        if junction_type and issues.get('duplicate_nodes'):
+            names = [n['name'] for n in network['nodes']]
+            for node_ids in issues['duplicate_nodes']:
+                old_node = session.get_node(node_ids[0])
+                junction = make_junction(old_node['x'], old_node['y'], junction_type, network, template['id'],
+                                         existing_names=names)
+                names.append(junction['name'])
+                junction = session.add_node(junction)
+                for node_id in node_ids:
+                    for link in session.repoint_links(node_id, junction['id']):
+                        if link['node_1_id'] == link['node_2_id']:
+                            session.delete_link(link['id'])
+                    session.delete_node(node_id)
+
+    if 'topology' in needed:
+        deleted_link_ids = set(issues.get('dangling_links', []) + issues.get('loop_links', []))
+        for link_id in deleted_link_ids:
+            session.delete_link(link_id)
+
+        node_coords = {}
+        for node_id in {n['id'] for n in network['nodes']} | set(session.nodes):
+            node = session.get_node(node_id)
+            if node is None or node_id in session.deleted_node_ids:
+                continue
+            coords = _node_coords(node)
+            if coords is None:
+                coords = [float(node['x']), float(node['y'])]
+                node['layout'] = node.get('layout') or {}
+                node['layout']['geojson'] = {
+                    'type': 'Feature',
+                    'geometry': {'type': 'Point', 'coordinates': coords},
+                    'properties': {}
+                }
+                session.update_node(node)
+            node_coords[node_id] = coords
+
+        for link_id in {l['id'] for l in network['links']} | set(session.links):
+            link = session.get_link(link_id)
+            if link is None or link_id in deleted_link_ids or link_id in session.deleted_link_ids:
+                continue
+            up_coords = node_coords.get(link['node_1_id'])
+            down_coords = node_coords.get(link['node_2_id'])
+            if up_coords is None or down_coords is None:
+                continue
+            coords = [list(c) for c in _link_coords(link) or []]
+            if len(coords) >= 2 and coords[0] == up_coords and coords[-1] == down_coords:
+                continue
+            coords = [up_coords] + coords[1:-1] + [down_coords] if len(coords) >= 2 else [up_coords, down_coords]
+            link['layout'] = link.get('layout') or {}
+            link['layout']['geojson'] = dict(link['layout'].get('geojson') or {'type': 'Feature', 'properties': {}})
+            link['layout']['geojson']['geometry'] = {'type': 'LineString', 'coordinates': coords}
+            session.update_link(link)
+
+    if 'scenarios' in needed:
+        scenarios = {s['id']: s for s in network['scenarios']}
+        baseline = next((s for s in scenarios.values() if (s.get('layout') or {}).get('class') == 'baseline'), None)
+        if baseline is None:
+            if scenarios:
+                baseline = network['scenarios'][0]
+                baseline['layout'] = dict(baseline.get('layout') or {}, **{'class': 'baseline'})
+                session.update_scenario(baseline)
+            else:
+                baseline = add_default_scenario(hydra, network_id)
+
+        # repair parent-less options & scenarios
+        for scenario_id in issues.get('orphan_scenarios', []):
+            if scenario_id == baseline['id']:
+                continue
+            scenario = scenarios[scenario_id]
+            scenario['layout']['parent'] = baseline['id']
+            session.update_scenario(scenario)
+
+    if 'layers' in needed:
+        network = repair_network_references(network)
+        session.update_network(layout=network['layout'])
+
+    session.commit()
+    invalidate_diagnosis(network_id)
+
+    return hydra.call('get_network', network_id, include_resources=True, include_data=False)
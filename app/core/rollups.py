@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+
+from app.core.aggregation import TIME_STEPS, parse_function, resample_dates, time_filter
+
+# rollup tables keyed by resource, per temporal step
+RESOURCE_ROLLUPS = list(TIME_STEPS)
+
+SERIES_KEYS = ['attr', 'subscenario', 'block']
+
+
+def series_starts(columns, keys):
+    """Mark the first row of each run of equal keys in sorted columns"""
+    n = len(columns[keys[0]]) if keys else 0
+    starts = np.zeros(n, dtype=bool)
+    if n:
+        starts[0] = True
+        for key in keys:
+            starts[1:] |= columns[key][1:] != columns[key][:-1]
+    return starts
+
+
+def build_rollups(columns, types, dates):
+    """Precompute the sums and value counts of a cube's columns at coarser grains.
+
+    Returns a dict of tables, each a dict of arrays: month and year per resource, and type, type_month and type_year,
+    which also sum over the resources of each template type. Each table has its key columns (with 'time' as a date
+    or period code), plus 'sum' (ignoring missing values) and 'count' (of values present), from which sums and means
+    can be derived exactly.
+    """
+    value = columns['value']
+    present = ~np.isnan(value)
+    filled = np.where(present, value, 0.0)
+    _, resource_types = np.unique(np.asarray(types, dtype=object).astype(str), return_inverse=True)
+    rollups = {}
+
+    # per resource: rows are sorted by resource, attribute, subscenario, block and date, so each period is contiguous
+    keys = ['resource'] + SERIES_KEYS
+    periods = {}
+    for step in RESOURCE_ROLLUPS:
+        periods[step] = resample_dates(dates, step)[0][columns['date']]
+        starts = np.flatnonzero(series_starts(dict(columns, time=periods[step]), keys + ['time']))
+        table = {key: columns[key][starts] for key in keys}
+        table['time'] = periods[step][starts]
+        table['sum'] = np.add.reduceat(filled, starts) if len(starts) else np.empty(0)
+        table['count'] = np.add.reduceat(present.astype(np.int64), starts) if len(starts) else np.empty(0)
+        rollups[step] = table
+
+    # per template type
+    frame = pd.DataFrame({key: columns[key] for key in SERIES_KEYS})
+    frame['type'] = resource_types[columns['resource']] if len(value) else np.empty(0, dtype=np.intp)
+    frame['sum'] = filled
+    frame['count'] = present.astype(np.int64)
+    for name, time in [('type', columns['date'])] + [('type_{}'.format(step), periods[step]) for step in periods]:
+        frame['time'] = time
+        grouped = frame.groupby(['type'] + SERIES_KEYS + ['time'], sort=True)[['sum', 'count']].sum().reset_index()
+        rollups[name] = {key: grouped[key].to_numpy() for key in grouped.columns}
+
+    return rollups
+
+
+def query_rollup(cube, resources, attrs, agg):
+    """Answer an aggregation from the coarsest of a cube's rollups that answers it exactly, if any.
+
+    Spatial and temporal sums and means can be answered, with or without a date range, as long as the range does not
+    split a period. Rollups by template type are used when the resources selected are all the resources of their
+    types. Spatial and temporal aggregation together (other than sums of sums) also needs a dense cube, since means
+    then depend on every series having a value at every date.
+
+    Returns None, or (frame, time_index, time_name), where frame has the columns resource (unless aggregated in space),
+    attr, subscenario, block, time and value, as codes into the cube's levels and time_index.
+    """
+    space_f = parse_function(agg.get('space', {}).get('function'))
+    time_f = parse_function(agg.get('time', {}).get('function'))
+    step = agg.get('time', {}).get('step')
+    if step not in TIME_STEPS:
+        time_f = None
+    if not (space_f or time_f) or {space_f, time_f} - {None, 'sum', 'mean'}:
+        return None
+    if space_f and time_f and (space_f, time_f) != ('sum', 'sum') and not cube.meta['dense']:
+        return None
+
+    keep = time_filter(cube.dates, agg.get('range', {}))
+    if time_f:
+        period_codes, time_index = resample_dates(cube.dates, step)
+        n_dates = np.bincount(period_codes, minlength=len(time_index))
+        if keep is not None:
+            n_kept = np.bincount(period_codes, weights=keep, minlength=len(time_index))
+            if ((n_kept > 0) & (n_kept < n_dates)).any():
+                return None
+            keep = n_kept > 0
+    else:
+        time_index = cube.dates
+        n_dates = np.ones(len(time_index))
+
+    n_resources = len(cube.levels['resource'])
+    selected = np.arange(n_resources) if resources is None else \
+        np.array([cube._lookup['resource'][r] for r in resources if r in cube._lookup['resource']], dtype=np.intp)
+
+    name = None
+    if space_f:
+        _, resource_types = np.unique(np.asarray(cube.types, dtype=object).astype(str), return_inverse=True)
+        selected_types = np.unique(resource_types[selected])
+        if (np.isin(resource_types, selected_types) == np.isin(np.arange(n_resources), selected)).all():
+            name = 'type_{}'.format(step) if time_f else 'type'
+            key, key_codes = 'type', selected_types
+    if name is None:
+        if not time_f:
+            return None  # the daily rollup per resource is the cube itself
+        name, key, key_codes = step, 'resource', selected
+
+    table = cube.rollup(name)
+    rows = np.isin(table[key], key_codes)
+    if attrs is not None:
+        rows &= np.isin(table['attr'], [cube._lookup['attr'][a] for a in attrs if a in cube._lookup['attr']])
+    if keep is not None:
+        rows &= keep[table['time']]
+    frame = pd.DataFrame({column: values[rows] for column, values in table.items()})
+
+    if space_f:
+        frame = frame.groupby(SERIES_KEYS + ['time'], sort=True)[['sum', 'count']].sum().reset_index()
+    total = frame.pop('sum').to_numpy(dtype=float)
+    count = frame.pop('count').to_numpy(dtype=float)
+    days = n_dates[frame['time'].to_numpy()]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if space_f and time_f:
+            value = {
+                ('sum', 'sum'): total,
+                ('sum', 'mean'): total / days,
+                ('mean', 'sum'): total * days / count,
+                ('mean', 'mean'): total / count,
+            }[(space_f, time_f)]
+        elif (space_f or time_f) == 'sum':
+            value = total
+        else:
+            value = total / count
+    frame['value'] = np.where(np.isinf(value), np.nan, value)
+
+    return frame, time_index, TIME_STEPS[step][1] if time_f else 'date'
@@ -0,0 +1,383 @@
+import logging
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import count
+from threading import Event, Lock, Thread
+
+from sqlalchemy import or_
+
+from app.models import QueuedRun
+
+log = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+DISPATCHED = 'dispatched'
+
+# returned by send() in place of an error for a run that can't be sent yet, which goes back in the queue
+WAIT = 'wait'
+
+
+class QueueEntry(object):
+    """A run in the queue, detached from any database session"""
+
+    def __init__(self, id, sid, user_id, model_id, priority=0, payload=None, status=QUEUED, created_at=None,
+                 dispatched_at=None):
+        self.id = id
+        self.sid = sid
+        self.user_id = user_id
+        self.model_id = model_id
+        self.priority = priority or 0
+        self.payload = payload or {}
+        self.status = status
+        self.created_at = created_at
+        self.dispatched_at = dispatched_at
+
+    def to_json(self):
+        return {
+            'sid': self.sid,
+            'network_id': self.payload.get('model_kwargs', {}).get('network_id'),
+            'user_id': self.user_id,
+            'model_id': self.model_id,
+            'priority': self.priority,
+            'status': self.status,
+            'created_at': self.created_at and self.created_at.isoformat(),
+            'dispatched_at': self.dispatched_at and self.dispatched_at.isoformat(),
+        }
+
+
+def fair_order(queued, active, user_limit=None, model_limit=None, max_active=None):
+    """Yield queued runs in the order they should be dispatched, skipping any that the limits hold back.
+
+    The next run always goes to the user with the fewest active runs (counting those dispatched so far), so a user
+    with a large ensemble gets their turn without holding everyone else up. A user's own runs go highest priority
+    first, then oldest first. Ties between users go to whoever has been waiting longest.
+    """
+    user_active = Counter(run.user_id for run in active)
+    model_active = Counter(run.model_id for run in active)
+    total = len(active)
+
+    by_user = OrderedDict()
+    for run in sorted(queued, key=lambda run: (-run.priority, run.id)):
+        by_user.setdefault(run.user_id, []).append(run)
+    first = {user_id: min(run.id for run in runs) for user_id, runs in by_user.items()}
+
+    while by_user and (not max_active or total < max_active):
+        best = None
+        for user_id, runs in by_user.items():
+            if user_limit and user_active[user_id] >= user_limit:
+                continue
+            run = next((run for run in runs if not model_limit or model_active[run.model_id] < model_limit), None)
+            if run is None:
+                continue
+            key = (user_active[user_id], first[user_id])
+            if best is None or key < best[0]:
+                best = (key, run)
+        if best is None:
+            return
+
+        run = best[1]
+        runs = by_user[run.user_id]
+        runs.remove(run)
+        if not runs:
+            del by_user[run.user_id]
+        user_active[run.user_id] += 1
+        model_active[run.model_id] += 1
+        total += 1
+        yield run
+
+
+class MemoryQueue(object):
+    """The run queue in memory, for tests and single-process deployments"""
+
+    def __init__(self):
+        self._runs = OrderedDict()  # sid -> entry
+        self._ids = count(1)
+        self._lock = Lock()
+
+    def add(self, runs):
+        now = datetime.utcnow()
+        with self._lock:
+            for run in runs:
+                self._runs[run['sid']] = QueueEntry(next(self._ids), created_at=now, **run)
+
+    def snapshot(self, active_since):
+        with self._lock:
+            return self._split(active_since)
+
+    def claim(self, active_since, choose):
+        with self._lock:
+            runs = choose(*self._split(active_since))
+            now = datetime.utcnow()
+            for run in runs:
+                run.status = DISPATCHED
+                run.dispatched_at = now
+            return runs
+
+    def requeue(self, sids):
+        with self._lock:
+            for sid in sids:
+                run = self._runs.get(sid)
+                if run and run.status == DISPATCHED:
+                    run.status = QUEUED
+                    run.dispatched_at = None
+
+    def remove(self, sids, status=None):
+        removed = []
+        with self._lock:
+            for sid in sids:
+                run = self._runs.get(sid)
+                if run and (status is None or run.status == status):
+                    removed.append(self._runs.pop(sid).sid)
+        return removed
+
+    def _split(self, active_since):
+        queued, active = [], []
+        for sid, run in list(self._runs.items()):
+            if run.status == QUEUED:
+                queued.append(run)
+            elif run.dispatched_at >= active_since:
+                active.append(run)
+            else:
+                del self._runs[sid]  # it never reported an end; stop counting it
+        return queued, active
+
+
+class DatabaseQueue(object):
+    """The run queue in the metadata database, shared by every worker.
+
+    Dispatching locks the queued and active rows (SELECT ... FOR UPDATE), so that workers dispatching at the same time
+    don't both count the same free slots.
+    """
+
+    def __init__(self, Session):
+        self.Session = Session
+
+    def add(self, runs):
+        now = datetime.utcnow()
+        db = self.Session()
+        try:
+            db.add_all([QueuedRun(status=QUEUED, created_at=now, **run) for run in runs])
+            db.commit()
+        finally:
+            db.close()
+
+    def snapshot(self, active_since):
+        db = self.Session()
+        try:
+            return self._split(self._rows(db, active_since))
+        finally:
+            db.close()
+
+    def claim(self, active_since, choose):
+        db = self.Session()
+        try:
+            # runs that never reported an end stop counting against the limits
+            db.query(QueuedRun).filter(QueuedRun.status == DISPATCHED, QueuedRun.dispatched_at < active_since) \
+                .delete(synchronize_session=False)
+            rows = self._rows(db, active_since, lock=True)
+            runs = choose(*self._split(rows))
+            if runs:
+                now = datetime.utcnow()
+                claimed = {run.sid for run in runs}
+                for row in rows:
+                    if row.sid in claimed:
+                        row.status = DISPATCHED
+                        row.dispatched_at = now
+                for run in runs:
+                    run.status = DISPATCHED
+                    run.dispatched_at = now
+            db.commit()
+            return runs
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def requeue(self, sids):
+        db = self.Session()
+        try:
+            db.query(QueuedRun).filter(QueuedRun.sid.in_(sids), QueuedRun.status == DISPATCHED) \
+                .update({'status': QUEUED, 'dispatched_at': None}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def remove(self, sids, status=None):
+        db = self.Session()
+        try:
+            query = db.query(QueuedRun).filter(QueuedRun.sid.in_(sids))
+            if status:
+                query = query.filter_by(status=status)
+            removed = [sid for sid, in query.with_entities(QueuedRun.sid)]
+            if removed:
+                query.delete(synchronize_session=False)  # with the status condition, in case it was just dispatched
+                db.commit()
+            return removed
+        finally:
+            db.close()
+
+    def _rows(self, db, active_since, lock=False):
+        query = db.query(QueuedRun).filter(or_(QueuedRun.status == QUEUED, QueuedRun.dispatched_at >= active_since))
+        if lock:
+            query = query.with_for_update()
+        return query.all()
+
+    def _split(self, rows):
+        queued, active = [], []
+        for row in rows:
+            run = QueueEntry(row.id, row.sid, row.user_id, row.model_id, priority=row.priority, payload=row.payload,
+                             status=row.status, created_at=row.created_at, dispatched_at=row.dispatched_at)
+            (queued if row.status == QUEUED else active).append(run)
+        return queued, active
+
+
+class RunScheduler(object):
+    """Admission control for model runs: runs wait in a queue and are dispatched fairly, within limits.
+
+    At most `user_limit` runs per user and `model_limit` runs per model (and `max_active` in all, if set) are active at
+    once; zero means no limit. A dispatched run stays active until it is finished, or for `max_runtime` seconds if it
+    never reports an end. Queued runs can be canceled, and their place in the queue looked up.
+
+    send(runs) is called with the runs to start, a list of QueueEntry, and should return a dict of sid -> error for
+    any that could not be sent; those are taken off the queue, and the free slots given to other runs. Whichever
+    dispatch they failed in, on_error(runs, errors) is then called with them, so that their failure can be recorded.
+    A run whose error is WAIT (e.g., because every computer for its model is busy) is put back in the queue instead,
+    in the same place, to be sent on a later dispatch.
+
+    Runs are dispatched as they are submitted and as others finish, and, once start() has been called, every
+    `dispatch_interval` seconds too, so that slots freed by runs that were let go (or by another worker) are used.
+    """
+
+    def __init__(self, queue, send, on_error=None, user_limit=10, model_limit=50, max_active=0, max_runtime=86400,
+                 dispatch_interval=0):
+        self.queue = queue
+        self.send = send
+        self.on_error = on_error
+        self.user_limit = user_limit
+        self.model_limit = model_limit
+        self.max_active = max_active
+        self.max_runtime = max_runtime
+        self.dispatch_interval = dispatch_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='run-scheduler')
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def submit(self, runs):
+        """Queue runs, each a dict of sid, user_id, model_id, priority and payload, and dispatch what can be.
+
+        Returns a dict of sid -> error for any runs, these or others, that could not be sent.
+        """
+        self.queue.add(runs)
+        return self.dispatch()[1]
+
+    def dispatch(self):
+        """Send as many queued runs as the limits allow, returning the runs sent and a dict of sid -> error"""
+        dispatched, errors = [], {}
+        while True:
+            runs = self.queue.claim(self._active_since(), self._choose)
+            if not runs:
+                break
+            try:
+                failed = self.send(runs) or {}
+            except Exception as err:
+                log.error('Could not send model runs: {}'.format(err))
+                failed = {run.sid: str(err) for run in runs}
+            dispatched.extend(run for run in runs if run.sid not in failed)
+            waiting = [sid for sid, error in failed.items() if error == WAIT]
+            if waiting:
+                self.queue.requeue(waiting)
+                failed = {sid: error for sid, error in failed.items() if error != WAIT}
+            if failed:
+                errors.update(failed)
+                self.queue.remove(list(failed))  # and try again with the slots they took
+                self._fail([run for run in runs if run.sid in failed], failed)
+            if waiting or not failed:
+                break  # nothing more can be sent until something changes
+        return dispatched, errors
+
+    def start(self):
+        """Dispatch every dispatch_interval seconds in the background, if it is set"""
+        if self._thread is None and self.dispatch_interval:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name='run-dispatch', daemon=True)
+                    self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def finish(self, sids):
+        """Take ended runs off the queue, and dispatch others in their place"""
+        if self.queue.remove(sids):
+            self.dispatch()
+
+    def release(self, sids):
+        """finish() in the background, so that a request reporting the end of a run doesn't wait for the next"""
+        self._executor.submit(self._release, list(sids))
+
+    def _release(self, sids):
+        try:
+            self.finish(sids)
+        except Exception as err:
+            log.error('Could not release model runs {}: {}'.format(sids, err))
+
+    def cancel(self, sids):
+        """Take runs that have not been dispatched off the queue, returning the sids of those taken off"""
+        return self.queue.remove(sids, status=QUEUED)
+
+    def user_runs(self, user_id):
+        """A user's queued and active runs, with the place of each queued run in the queue"""
+        queued, active = self.queue.snapshot(self._active_since())
+        positions = {run.sid: position for position, run in enumerate(fair_order(queued, active), start=1)}
+        return [dict(run.to_json(), position=positions.get(run.sid)) for run in queued + active
+                if run.user_id == user_id]
+
+    def positions(self, sids=None):
+        """The place of queued runs in the queue (1 is next), as a dict of sid -> position.
+
+        This is where each run would be dispatched if slots were free, so a run held back by a limit may go later.
+        """
+        queued, active = self.queue.snapshot(self._active_since())
+        wanted = set(sids) if sids is not None else None
+        return {
+            run.sid: position for position, run in enumerate(fair_order(queued, active), start=1)
+            if wanted is None or run.sid in wanted
+        }
+
+    def stats(self):
+        queued, active = self.queue.snapshot(self._active_since())
+        waits = [(datetime.utcnow() - run.created_at).total_seconds() for run in queued if run.created_at]
+        return {
+            'queued': len(queued),
+            'active': len(active),
+            'users_waiting': len({run.user_id for run in queued}),
+            'longest_wait_seconds': round(max(waits), 1) if waits else 0,
+            'active_by_model': dict(Counter(run.model_id for run in active)),
+            'user_limit': self.user_limit,
+            'model_limit': self.model_limit,
+            'max_active': self.max_active,
+        }
+
+    def _fail(self, runs, errors):
+        if self.on_error:
+            try:
+                self.on_error(runs, errors)
+            except Exception as err:
+                log.error('Could not record failed model runs {}: {}'.format(list(errors), err))
+
+    def _run(self):
+        while not self._stop.wait(self.dispatch_interval):
+            try:
+                self.dispatch()
+            except Exception as err:
+                log.error('Could not dispatch model runs: {}'.format(err))
+
+    def _choose(self, queued, active):
+        return list(fair_order(queued, active, user_limit=self.user_limit, model_limit=self.model_limit,
+                               max_active=self.max_active))
+
+    def _active_since(self):
+        return datetime.utcnow() - timedelta(seconds=self.max_runtime)
@@ -1,3 +1,3 @@
-from .rabbitmq import run_model_rabbitmq
-from .local import run_model_local
-# from .ec2 import run_model_ec2
+from .rabbitmq import run_model_rabbitmq, run_models_rabbitmq
+from .local import run_model_local, LocalRunner
+from .ec2 import run_model_ec2, fleet, FleetBusy
@@ -1,7 +1,19 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from os import path
+
 import boto3
+
+from app import config as app_config
+from .fleet import Fleet
 from .utils import kwargs_to_cli
 
+log = logging.getLogger(__name__)
+
+# (region, filters) -> (when described, computers)
+_computers = {}
+
 
 class EC2:
     def __init__(self, aws_access_key_id, aws_secret_access_key, region='us-west-2', id=None):
@@ -106,27 +118,35 @@ def add_alarm(cloudwatch, action, instance_id, region, account, hours=1):
 
 
 def get_available_computers(filters, config):
+    """Describe computers matching filters, in as few calls as possible, reusing the answer for a few seconds"""
+    key = (config['AWS_DEFAULT_REGION'], repr(filters))
+    described = _computers.get(key)
+    if described and time.monotonic() - described[0] < app_config.FLEET_DESCRIBE_TTL:
+        return described[1]
+
     ec2client = boto3.client('ec2', region_name=config['AWS_DEFAULT_REGION'])
-    reservations = ec2client.describe_instances(
-        Filters=filters
-    )
-    reservations = reservations['Reservations']
-    instance_ids = [r['Instances'][0]['InstanceId'] for r in reservations]
-    statuses = ec2client.describe_instance_status(InstanceIds=instance_ids)
-    statuses = {s['InstanceId']: s for s in statuses['InstanceStatuses']}
+    reservations = []
+    for page in ec2client.get_paginator('describe_instances').paginate(Filters=filters):
+        reservations.extend(page['Reservations'])
+    instance_ids = [i['InstanceId'] for r in reservations for i in r['Instances']]
+    statuses = {}
+    for i in range(0, len(instance_ids), 100):
+        response = ec2client.describe_instance_status(InstanceIds=instance_ids[i:i + 100])
+        statuses.update((s['InstanceId'], s) for s in response['InstanceStatuses'])
     computers = get_reservations_data(reservations, statuses)
 
+    _computers[key] = (time.monotonic(), computers)
     return computers
 
 
 def get_reservations_data(reservations, statuses):
     reservations_data = []
     for r in reservations:
-        instance = r['Instances'][0]
-        status = statuses.get(instance['InstanceId'])
-        status = status and status['InstanceStatus']['Status']
-        instance_data = get_instance_data(instance, status)
-        reservations_data.append(instance_data)
+        for instance in r['Instances']:
+            status = statuses.get(instance['InstanceId'])
+            status = status and status['InstanceStatus']['Status']
+            instance_data = get_instance_data(instance, status)
+            reservations_data.append(instance_data)
     return reservations_data
 
 
@@ -177,35 +197,102 @@ def launch_instance(computer_type, image_id, init_script, tags, config, auto_ter
     return computers
 
 
-def run_model_ec2(model, model_kwargs, computer_id, extra_args=''):
-    import paramiko
+def parse_warm_pools(spec):
+    """Warm pool sizes from a string like "ami-123:2,ami-456:1", as a dict of image id -> size"""
+    pools = {}
+    for item in (spec or '').split(','):
+        if item.strip():
+            image_id, _, size = item.strip().partition(':')
+            pools[image_id] = int(size or 1)
+    return pools
 
-    args_list = kwargs_to_cli(model_kwargs, extra_args=extra_args, join=True)
 
+fleet = Fleet(
+    lambda: boto3.client('ec2', region_name=app_config.AWS_DEFAULT_REGION or None),
+    name=app_config.FLEET_NAME,
+    instance_type=app_config.FLEET_INSTANCE_TYPE,
+    launch_options={key: value for key, value in [
+        ('KeyName', app_config.AWS_MODEL_KEY_NAME),
+        ('SecurityGroupIds', [app_config.AWS_SSH_SECURITY_GROUP] if app_config.AWS_SSH_SECURITY_GROUP else None),
+    ] if value},
+    warm=parse_warm_pools(app_config.FLEET_WARM_POOLS),
+    max_size=app_config.FLEET_MAX_SIZE,
+    idle_timeout=app_config.FLEET_IDLE_TIMEOUT,
+    describe_ttl=app_config.FLEET_DESCRIBE_TTL,
+    reconcile_interval=app_config.FLEET_RECONCILE_INTERVAL,
+    claim_delay=app_config.FLEET_CLAIM_DELAY
+)
+
+# model runs in progress over SSH, at most one per fleet instance
+executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='ec2-run')
+
+
+class FleetBusy(Exception):
+    """Every instance the fleet may run for a model's image is in use"""
+
+
+class ModelError(RuntimeError):
+    """The model itself failed (rather than the instance it ran on)"""
+
+
+def run_model_ec2(model, model_kwargs, sid, extra_args='', computer_id=None, on_error=None):
+    """Start a model run on an EC2 instance: the given computer, or else one from the fleet for the model's image.
+
+    The model is run over SSH in the background. When it ends, a fleet instance is released for the next run, or
+    terminated if the run could not be made on it. Raises FleetBusy if the fleet has no instance for the run yet, and
+    returns an error if there is some other reason it can't be started; later errors are passed to on_error(error).
+    """
+    instance_id = computer_id or fleet.acquire(model.image_id, sid)
+    if instance_id is None:
+        raise FleetBusy('All computers for this model are busy')
+
+    args_list = kwargs_to_cli(model_kwargs, extra_args=extra_args, join=True)
     command = '{executable} {args}'.format(executable=model.executable, args=args_list)
+    executor.submit(_run_on_instance, instance_id, command, release=not computer_id, on_error=on_error)
 
-    # a. connect to ec2 to get ip address
-    ec2 = EC2(
-        app.config.get('AWS_ACCESS_KEY_ID'),
-        app.config.get('AWS_SECRET_ACCESS_KEY'),
-        region=app.config.get('AWS_DEFAULT_REGION')
-    )
-    instance = ec2.resource.Instance(computer_id)
 
-    # b. connect to ec2 via ssh
-    key_name = instance.key_name
-    key_file = path.join(app.config.get('KEYS_DIR'), key_name + '.pem')
+def _run_on_instance(instance_id, command, release=True, on_error=None):
+    broken = False
+    try:
+        if release:
+            worker = fleet.wait_ready(instance_id, timeout=app_config.FLEET_READY_TIMEOUT)
+            address = worker and worker.public_ip
+        else:
+            response = fleet.client.describe_instances(InstanceIds=[instance_id])
+            address = response['Reservations'][0]['Instances'][0].get('PublicIpAddress')
+        if not address:
+            raise RuntimeError('Computer {} is not available'.format(instance_id))
+        run_command(address, command)
+    except Exception as err:
+        broken = not isinstance(err, ModelError)
+        log.error('Model run on {} failed: {}'.format(instance_id, err))
+        if on_error:
+            on_error(str(err))
+    finally:
+        if release:
+            try:
+                if broken:
+                    fleet.retire(instance_id)
+                else:
+                    fleet.release(instance_id)
+            except Exception as err:
+                log.error('Could not return computer {} to the fleet: {}'.format(instance_id, err))
+
+
+def run_command(address, command):
+    import paramiko
+
+    key_file = path.join(app_config.KEYS_DIR, app_config.AWS_MODEL_KEY_NAME + '.pem')
     private_key = paramiko.RSAKey.from_private_key_file(key_file)
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(
-        hostname=instance.public_ip_address,
-        username=app.config['AWS_MODEL_EC2_USERNAME'],
-        pkey=private_key
-    )
-
-    # c. run command
-    stdin, stdout, stderr = client.exec_command(command)
-    stdout = stdout.read().decode().strip()
-    stderr = stderr.read().decode().strip()
-    data = {'stdout': stdout, 'stderr': stderr}
+    client.connect(hostname=address, username=app_config.AWS_MODEL_EC2_USERNAME, pkey=private_key)
+    try:
+        stdin, stdout, stderr = client.exec_command(command)
+        output = stdout.read().decode().strip()
+        errors = stderr.read().decode().strip()
+        if stdout.channel.recv_exit_status():
+            raise ModelError(errors[-1000:] or output[-1000:] or 'The model failed')
+        return output
+    finally:
+        client.close()
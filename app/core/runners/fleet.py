@@ -0,0 +1,308 @@
+import logging
+import time
+from threading import Event, Lock, Thread
+
+log = logging.getLogger(__name__)
+
+FLEET_TAG = 'openagua:fleet'
+IMAGE_TAG = 'openagua:image'
+RUN_TAG = 'openagua:run'  # the sid of the run using the instance, or empty if it is idle
+IDLE_TAG = 'openagua:idle-since'  # when the instance last became idle, in seconds since the epoch
+CLAIM_TAG = 'openagua:claim:'  # + the sid of a run claiming an idle instance, while the claim is checked
+
+USABLE = ['pending', 'running']
+STATUS_BATCH_SIZE = 100  # instance ids per describe_instance_status call
+
+
+class Worker(object):
+    """A fleet instance, as last described (or as changed by this process since)"""
+
+    def __init__(self, id, image_id, state, run='', idle_since=None, launched_at=None, public_ip=None, status=None):
+        self.id = id
+        self.image_id = image_id
+        self.state = state
+        self.run = run
+        self.idle_since = idle_since
+        self.launched_at = launched_at
+        self.public_ip = public_ip
+        self.status = status
+
+    @property
+    def usable(self):
+        return self.state in USABLE
+
+    @property
+    def ready(self):
+        return self.state == 'running' and self.status in [None, 'ok'] and bool(self.public_ip)
+
+    @classmethod
+    def from_instance(cls, instance, status=None):
+        tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+        launched_at = instance.get('LaunchTime')
+        return cls(
+            instance['InstanceId'],
+            tags.get(IMAGE_TAG) or instance.get('ImageId'),
+            instance['State']['Name'],
+            run=tags.get(RUN_TAG, ''),
+            idle_since=float(tags[IDLE_TAG]) if tags.get(IDLE_TAG) else None,
+            launched_at=launched_at.timestamp() if hasattr(launched_at, 'timestamp') else launched_at,
+            public_ip=instance.get('PublicIpAddress'),
+            status=status
+        )
+
+
+class Fleet(object):
+    """EC2 instances for model runs, reused from run to run and shared by every API worker.
+
+    Instances are tagged with the model image they run and the run using them, so any worker can see which are idle.
+    acquire() hands out an idle instance of a model's image, launching one only if there is none (up to `max_size`
+    per image), and release() returns it (or retire() terminates it, if it is broken). reconcile(), run every `reconcile_interval` seconds in the background,
+    keeps `warm` instances idle and ready for the images listed there, and terminates other instances once they have
+    been idle for `idle_timeout` seconds.
+
+    Instances are described in one paginated call (and their status in batches), cached for `describe_ttl` seconds,
+    rather than on every lookup. connect() should return a boto3 EC2 client, or anything with the same methods.
+
+    Tags are not locks, so an idle instance is claimed before it is used: the worker adds a tag of its own to it,
+    waits `claim_delay` seconds for other tags to be visible, and then reads its tags back. The instance is only taken
+    if it is still idle and no other worker has claimed it; otherwise the worker moves on to another instance (or
+    launches one). Two workers claiming the same instance at the same moment may then both give it up, but they never
+    both use it.
+    """
+
+    def __init__(self, connect, name='openagua', instance_type='t3.large', launch_options=None, warm=None,
+                 max_size=10, idle_timeout=900, describe_ttl=10, reconcile_interval=60, claim_delay=1.0,
+                 clock=time.time):
+        self.connect = connect
+        self.name = name
+        self.instance_type = instance_type
+        self.launch_options = launch_options or {}  # e.g., KeyName, SecurityGroupIds and UserData
+        self.warm = warm or {}  # image id -> idle instances to keep ready
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.describe_ttl = describe_ttl
+        self.reconcile_interval = reconcile_interval
+        self.claim_delay = claim_delay
+        self.clock = clock
+
+        self._client = None
+        self._workers = None  # instance id -> worker
+        self._described_at = None
+        self._lock = Lock()
+        self._acquire_lock = Lock()  # so that threads in this process don't pick the same idle instance
+        self._stop = Event()
+        self._thread = None
+
+        self.describes = 0
+        self.cache_hits = 0
+        self.reused = 0
+        self.lost_claims = 0
+        self.launched = 0
+        self.terminated = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.connect()
+        return self._client
+
+    def workers(self, fresh=False):
+        with self._lock:
+            if fresh or self._workers is None or self.clock() - self._described_at >= self.describe_ttl:
+                self._workers = {worker.id: worker for worker in self._describe()}
+                self._described_at = self.clock()
+                self.describes += 1
+            else:
+                self.cache_hits += 1
+            return dict(self._workers)
+
+    def acquire(self, image_id, sid, instance_type=None):
+        """An instance of a model image for a run, reused if one is idle or launched if not, or None if the image's
+        pool is full"""
+        self._start()
+        with self._acquire_lock:
+            workers = [worker for worker in self.workers().values() if worker.image_id == image_id and worker.usable]
+            # the most recently used of the idle instances, so the others can time out
+            idle = sorted([worker for worker in workers if not worker.run],
+                          key=lambda worker: (worker.ready, worker.idle_since or 0), reverse=True)
+            for worker in idle:
+                if self._claim(worker, sid):
+                    self.reused += 1
+                    return worker.id
+            if len(workers) < self.max_size:
+                return self._launch(image_id, 1, instance_type=instance_type, run=sid)[0].id
+            return None
+
+    def release(self, instance_id):
+        """Mark an instance idle, to be reused or, after idle_timeout, terminated"""
+        with self._lock:
+            worker = (self._workers or {}).get(instance_id)
+        if worker is None:
+            worker = Worker(instance_id, None, 'running')
+        self._tag(worker, run='', idle_since=self.clock())
+
+    def retire(self, instance_id):
+        """Terminate an instance that can't be used (e.g., it can't be reached), rather than release it"""
+        self.client.terminate_instances(InstanceIds=[instance_id])
+        with self._lock:
+            if self._workers is not None:
+                self._workers.pop(instance_id, None)
+            self.terminated += 1
+
+    def wait_ready(self, instance_id, timeout=600, poll=15):
+        """Wait for a (newly launched) instance to be running with a public address, returning it, or None"""
+        end = self.clock() + timeout
+        fresh = False
+        while True:
+            worker = self.workers(fresh=fresh).get(instance_id)
+            if worker is not None and worker.ready:
+                return worker
+            if (worker is not None and not worker.usable) or self.clock() >= end:
+                return None
+            time.sleep(poll)
+            fresh = True
+
+    def plan(self, workers, now):
+        """What reconcile() should do: a dict of image id -> instances to launch, and a list of instances to end"""
+        launch, terminate = {}, []
+        pools = {}
+        for worker in workers:
+            if worker.usable:
+                pools.setdefault(worker.image_id, []).append(worker)
+
+        for image_id in set(pools) | set(self.warm):
+            pool = pools.get(image_id, [])
+            warm = self.warm.get(image_id, 0)
+            idle = sorted([worker for worker in pool if not worker.run],
+                          key=lambda worker: worker.idle_since or worker.launched_at or 0, reverse=True)
+            for worker in idle[warm:]:
+                if now - (worker.idle_since or worker.launched_at or now) >= self.idle_timeout:
+                    terminate.append(worker.id)
+            short = min(warm - len(idle), self.max_size - len(pool))
+            if short > 0:
+                launch[image_id] = short
+        return launch, terminate
+
+    def reconcile(self):
+        launch, terminate = self.plan(self.workers(fresh=True).values(), self.clock())
+        if terminate:
+            self.client.terminate_instances(InstanceIds=terminate)
+            with self._lock:
+                for instance_id in terminate:
+                    self._workers.pop(instance_id, None)
+                self.terminated += len(terminate)
+        for image_id, count in launch.items():
+            self._launch(image_id, count)
+        return launch, terminate
+
+    def stats(self):
+        pools = {}
+        for worker in (self._workers or {}).values():
+            if worker.usable:
+                pool = pools.setdefault(worker.image_id, {'busy': 0, 'idle': 0, 'pending': 0})
+                pool['pending' if worker.state == 'pending' else 'busy' if worker.run else 'idle'] += 1
+        return {
+            'pools': pools,
+            'describes': self.describes,
+            'cache_hits': self.cache_hits,
+            'reused': self.reused,
+            'lost_claims': self.lost_claims,
+            'launched': self.launched,
+            'terminated': self.terminated,
+        }
+
+    def stop(self):
+        self._stop.set()
+
+    def _describe(self):
+        filters = [
+            {'Name': 'tag:' + FLEET_TAG, 'Values': [self.name]},
+            {'Name': 'instance-state-name', 'Values': USABLE + ['stopping', 'stopped']},
+        ]
+        instances = []
+        kwargs = {'Filters': filters}
+        while True:
+            response = self.client.describe_instances(**kwargs)
+            for reservation in response['Reservations']:
+                instances.extend(reservation['Instances'])
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+
+        statuses = {}
+        ids = [instance['InstanceId'] for instance in instances if instance['State']['Name'] == 'running']
+        for i in range(0, len(ids), STATUS_BATCH_SIZE):
+            response = self.client.describe_instance_status(InstanceIds=ids[i:i + STATUS_BATCH_SIZE])
+            for status in response['InstanceStatuses']:
+                statuses[status['InstanceId']] = status['InstanceStatus']['Status']
+
+        return [Worker.from_instance(instance, statuses.get(instance['InstanceId'])) for instance in instances]
+
+    def _launch(self, image_id, count, instance_type=None, run=''):
+        now = self.clock()
+        tags = [
+            {'Key': FLEET_TAG, 'Value': self.name},
+            {'Key': IMAGE_TAG, 'Value': image_id},
+            {'Key': RUN_TAG, 'Value': run},
+            {'Key': IDLE_TAG, 'Value': '' if run else str(now)},
+        ]
+        response = self.client.run_instances(
+            ImageId=image_id,
+            InstanceType=instance_type or self.instance_type,
+            MinCount=count,
+            MaxCount=count,
+            TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags}],
+            **self.launch_options
+        )
+        workers = [Worker(instance['InstanceId'], image_id, 'pending', run=run, idle_since=None if run else now,
+                          launched_at=now) for instance in response['Instances']]
+        with self._lock:
+            if self._workers is not None:
+                self._workers.update((worker.id, worker) for worker in workers)
+            self.launched += len(workers)
+        return workers
+
+    def _tag(self, worker, run, idle_since):
+        self.client.create_tags(Resources=[worker.id], Tags=[
+            {'Key': RUN_TAG, 'Value': run},
+            {'Key': IDLE_TAG, 'Value': '' if idle_since is None else str(idle_since)},
+        ])
+        with self._lock:
+            worker.run = run
+            worker.idle_since = idle_since
+
+    def _claim(self, worker, sid):
+        """Take an idle instance for a run, unless another worker is using or claiming it, returning whether it was
+        taken"""
+        claim = CLAIM_TAG + sid
+        self.client.create_tags(Resources=[worker.id], Tags=[{'Key': claim, 'Value': str(self.clock())}])
+        try:
+            if self.claim_delay:
+                time.sleep(self.claim_delay)
+            response = self.client.describe_tags(Filters=[{'Name': 'resource-id', 'Values': [worker.id]}])
+            tags = {tag['Key']: tag['Value'] for tag in response['Tags']}
+            claims = [key for key in tags if key.startswith(CLAIM_TAG)]
+            if tags.get(RUN_TAG) or claims != [claim]:
+                with self._lock:
+                    worker.run = tags.get(RUN_TAG) or worker.run
+                    self.lost_claims += 1
+                return False
+            self._tag(worker, run=sid, idle_since=None)
+            return True
+        finally:
+            # only once the run is tagged, so that other workers see it as claimed or used throughout
+            self.client.delete_tags(Resources=[worker.id], Tags=[{'Key': claim}])
+
+    def _start(self):
+        if self._thread is None and self.reconcile_interval:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name='fleet', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.reconcile_interval):
+            try:
+                self.reconcile()
+            except Exception as err:
+                log.error('Could not reconcile the model fleet: {}'.format(err))
@@ -1,9 +1,214 @@
+import json
+import logging
+import os
+import shlex
+import signal
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE, STDOUT
+from threading import Event, Lock, Timer
+
+from app.core.ProcessState import ProcessState
 from .utils import kwargs_to_cli
 
+log = logging.getLogger(__name__)
+
+POSIX = os.name == 'posix'
+
+
+class LocalRun(object):
+    def __init__(self, sid, args, info=None, cwd=None, env=None):
+        self.sid = sid
+        self.args = args
+        self.info = info or {}  # passed back with each report, e.g., source_id, network_id and name
+        self.cwd = cwd
+        self.env = env
+        self.process = None
+        self.state = ProcessState.REQUESTED
+        self.canceled = False
+        self.output = deque(maxlen=50)  # the last lines of output, reported if the run fails
+        self.done = Event()
+
+
+class LocalRunner(object):
+    """Runs model executables as child processes on this machine, at most `max_workers` at once.
+
+    Each run is watched by a thread that reads the process's output. A line of output that is a JSON object with a
+    "progress" key is reported as progress (at most every `progress_interval` seconds); other lines are kept, and the
+    last of them reported if the run fails.
+
+    report(run, status, data) is called as a run starts (started), progresses (running) and ends (finished, error or
+    stopped), with a dict of what to record. Runs can be paused and resumed (on POSIX systems) and canceled; a canceled
+    run is asked to stop (SIGTERM), and killed if it hasn't after `cancel_grace` seconds.
+
+    Runs live in this process, so in a multi-worker deployment a run can only be paused or canceled from the worker
+    that started it; this runner is meant for development, CI and single-machine installs.
+    """
+
+    def __init__(self, report, max_workers=4, cancel_grace=10, progress_interval=1.0):
+        self.report = report
+        self.max_workers = max_workers
+        self.cancel_grace = cancel_grace
+        self.progress_interval = progress_interval
+        self._runs = {}  # sid -> run, from start() until the run has ended
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='local-run')
+
+        self.started = 0
+        self.finished = 0
+        self.failed = 0
+        self.canceled = 0
+
+    def start(self, sid, args, info=None, cwd=None, env=None):
+        """Queue a run of a command (a list of arguments), which starts when one of the workers is free"""
+        run = LocalRun(sid, args, info=info, cwd=cwd, env=env)
+        with self._lock:
+            if sid in self._runs:
+                raise ValueError('Run {} is already running'.format(sid))
+            self._runs[sid] = run
+        self._executor.submit(self._supervise, run)
+        return run
+
+    def has(self, sid):
+        return sid in self._runs
+
+    def wait(self, sid, timeout=None):
+        run = self._runs.get(sid)
+        return run.done.wait(timeout) if run else True
+
+    def pause(self, sid):
+        return self._signal(sid, ProcessState.RUNNING, ProcessState.PAUSED, 'SIGSTOP')
+
+    def resume(self, sid):
+        return self._signal(sid, ProcessState.PAUSED, ProcessState.RUNNING, 'SIGCONT')
+
+    def cancel(self, sid):
+        with self._lock:
+            run = self._runs.get(sid)
+            if run is None:
+                return False
+            run.canceled = True
+            process = run.process
+        if process is not None:  # otherwise it ends as soon as a worker picks it up
+            self._kill(run, signal.SIGTERM)
+            if POSIX and run.state == ProcessState.PAUSED:
+                self._kill(run, signal.SIGCONT)  # so it can act on the SIGTERM
+            timer = Timer(self.cancel_grace, self._kill, [run, getattr(signal, 'SIGKILL', signal.SIGTERM)])
+            timer.daemon = True
+            timer.start()
+        return True
+
+    def stats(self):
+        with self._lock:
+            states = [run.state for run in self._runs.values()]
+        return {
+            'waiting': states.count(ProcessState.REQUESTED),
+            'running': states.count(ProcessState.RUNNING),
+            'paused': states.count(ProcessState.PAUSED),
+            'max_workers': self.max_workers,
+            'started': self.started,
+            'finished': self.finished,
+            'failed': self.failed,
+            'canceled': self.canceled,
+        }
+
+    def _signal(self, sid, from_state, to_state, name):
+        if not POSIX:
+            return False
+        with self._lock:
+            run = self._runs.get(sid)
+            if run is None or run.state != from_state or run.canceled:
+                return False
+            self._kill(run, getattr(signal, name))
+            run.state = to_state
+        self._report(run, to_state, {})
+        return True
+
+    def _kill(self, run, sig):
+        if run.process is None or run.process.poll() is not None:
+            return
+        try:
+            if POSIX:
+                os.killpg(run.process.pid, sig)  # the model's own child processes too
+            else:
+                run.process.send_signal(sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _report(self, run, status, data):
+        try:
+            self.report(run, status, data)
+        except Exception as err:
+            log.error('Could not report {} for run {}: {}'.format(status, run.sid, err))
+
+    def _supervise(self, run):
+        try:
+            status, data = (ProcessState.CANCELED, {}) if run.canceled else self._run(run)
+            with self._lock:
+                if status == ProcessState.FINISHED:
+                    self.finished += 1
+                elif status == ProcessState.CANCELED:
+                    self.canceled += 1
+                else:
+                    self.failed += 1
+            self._report(run, status, data)
+        finally:
+            with self._lock:
+                self._runs.pop(run.sid, None)
+            run.done.set()
+
+    def _run(self, run):
+        try:
+            process = Popen(run.args, stdout=PIPE, stderr=STDOUT, text=True, bufsize=1, cwd=run.cwd, env=run.env,
+                            start_new_session=POSIX)
+        except OSError as err:
+            return ProcessState.ERROR, {'extra_info': 'Could not start the model: {}'.format(err)}
+
+        with self._lock:
+            run.process = process
+            run.state = ProcessState.RUNNING
+            self.started += 1
+        if run.canceled:  # canceled while starting
+            self._kill(run, signal.SIGTERM)
+        self._report(run, ProcessState.STARTED, {'pid': process.pid})
+
+        pending = None
+        reported_at = 0
+        for line in process.stdout:
+            progress = parse_progress(line)
+            if progress is None:
+                run.output.append(line.rstrip())
+                continue
+            pending = progress
+            if time.monotonic() - reported_at >= self.progress_interval:
+                self._report(run, ProcessState.RUNNING, pending)
+                pending = None
+                reported_at = time.monotonic()
+        if pending is not None:
+            self._report(run, ProcessState.RUNNING, pending)
+
+        exit_code = process.wait()
+        if run.canceled:
+            return ProcessState.CANCELED, {'exit_code': exit_code}
+        elif exit_code == 0:
+            return ProcessState.FINISHED, {'exit_code': exit_code, 'progress': 100}
+        else:
+            return ProcessState.ERROR, {'exit_code': exit_code, 'extra_info': '\n'.join(run.output)}
+
+
+def parse_progress(line):
+    """A progress report in a line of model output, e.g., {"progress": 42}, or None"""
+    line = line.strip()
+    if not line.startswith('{'):
+        return None
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) and 'progress' in data else None
 
-def run_model_local(model, model_kwargs, extra_args=''):
-    from subprocess import Popen
 
-    args_list = kwargs_to_cli(model_kwargs, extra_args=extra_args)
-    args = [model.executable] + args_list
-    Popen(args)
+def run_model_local(runner, model, model_kwargs, sid, extra_args='', info=None):
+    args = shlex.split(model.executable) + kwargs_to_cli(model_kwargs, extra_args=extra_args)
+    return runner.start(sid, args, info=info)
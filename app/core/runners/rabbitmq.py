@@ -1,34 +1,137 @@
-from os import getenv, environ as env
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
 from celery import Celery
 
+from app import config
 
-def run_model_rabbitmq(mq, model, run_key, model_kwargs):
+log = logging.getLogger(__name__)
+
+
+def broker_url(vhost):
+    return 'pyamqp://{username}:{password}@{hostname}:5672/{vhost}'.format(
+        username=config.RABBITMQ_DEFAULT_USERNAME,
+        password=config.RABBITMQ_DEFAULT_PASSWORD,
+        hostname=config.RABBITMQ_HOST,
+        vhost=vhost
+    )
+
+
+# vhost -> Celery app, each with its own pool of broker connections and producers, kept for the life of the worker
+_apps = {}
+_apps_lock = Lock()
+
+
+def get_celery(vhost):
+    app = _apps.get(vhost)
+    if app is None:
+        with _apps_lock:
+            app = _apps.get(vhost)
+            if app is None:
+                app = Celery('openagua', broker=broker_url(vhost), set_as_current=False)
+                app.conf.update(
+                    task_default_exchange='tasks',
+                    result_expires=3600,
+                    broker_pool_limit=config.RABBITMQ_POOL_LIMIT,
+                    broker_transport_options={'confirm_publish': True},  # wait for the broker to accept each task
+                )
+                _apps[vhost] = app
+    return app
+
+
+def check_queue(vhost, queue_name):
+    """Check that a queue exists with a passive declare, rather than through the management API"""
+    app = get_celery(vhost)
+    with app.pool.acquire(block=True) as connection:
+        channel = connection.channel()
+        try:
+            channel.queue_declare(queue=queue_name, passive=True)
+            return True
+        except connection.channel_errors:
+            return False  # the broker closes the channel if the queue doesn't exist
+        finally:
+            try:
+                channel.close()
+            except Exception:
+                pass
+
+
+class QueueCache(object):
+    """Whether model queues exist, so that run requests don't wait on the broker to find out.
+
+    A queue found to exist is trusted for `ttl` seconds, then refreshed in the background while the cached answer is
+    still used, up to `max_age` seconds. A missing queue is checked again after `missing_ttl` seconds, so a computer
+    that has just come up is found quickly.
+    """
+
+    def __init__(self, check, ttl=30, max_age=300, missing_ttl=5):
+        self.check = check
+        self.ttl = ttl
+        self.max_age = max_age
+        self.missing_ttl = missing_ttl
+        self._entries = {}  # (vhost, queue name) -> (exists, when checked)
+        self._refreshing = set()
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='queue-cache')
+
+    def exists(self, vhost, queue_name):
+        key = (vhost, queue_name)
+        entry = self._entries.get(key)
+        if entry:
+            exists, checked = entry
+            age = time.monotonic() - checked
+            if age < (self.ttl if exists else self.missing_ttl):
+                return exists
+            if exists and age < self.max_age:
+                with self._lock:
+                    refresh = key not in self._refreshing
+                    self._refreshing.add(key)
+                if refresh:
+                    self._executor.submit(self._refresh, key)
+                return exists
+        return self._refresh(key)
+
+    def _refresh(self, key):
+        try:
+            exists = self.check(*key)
+            self._entries[key] = (exists, time.monotonic())
+            return exists
+        except Exception as err:
+            log.warning('Could not check queue {}: {}'.format(key, err))
+            raise
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+queue_cache = QueueCache(check_queue, ttl=config.RABBITMQ_QUEUE_TTL)
+
+
+def run_models_rabbitmq(model, run_key, runs):
+    """Send a batch of model runs (a list of model kwargs) to a model's queue, in one burst on one connection"""
     model_key = model.key
     queue_name = 'model-{}'.format(model_key)
     if run_key:
         queue_name += '-{}'.format(run_key)
     vhost = 'model-{}'.format(model_key)
 
-    queue = mq.get_queue(vhost, queue_name)
+    try:
+        if not queue_cache.exists(vhost, queue_name):
+            return 'No computer is set up for this run'
 
-    if queue.status_code == 404:
-        return 'No computer is set up for this run'
-
-    # Celery for starting tasks
-    broker_url = 'pyamqp://{username}:{password}@{hostname}:5672/{vhost}'.format(
-        username=getenv('RABBITMQ_DEFAULT_USERNAME'),
-        password=getenv('RABBITMQ_DEFAULT_PASSWORD'),
-        hostname=getenv('RABBITMQ_HOST'),
-        vhost=vhost
-    )
-    celery = Celery('openagua', broker=broker_url)
-    celery.conf.update(
-        task_default_exchange='tasks',
-        result_expires=3600,
-        broker_pool_limit=None,
-        # broker_connection_max_retries=1,
-    )
-    signature = celery.signature('model.run', expires=3600, retry=False)
-    resp = signature.apply_async(args=(), kwargs=model_kwargs, queue=queue_name, routing_key=queue_name)
+        app = get_celery(vhost)
+        with app.producer_or_acquire() as producer:
+            for model_kwargs in runs:
+                app.send_task('model.run', kwargs=model_kwargs, queue=queue_name, routing_key=queue_name,
+                              expires=3600, retry=False, producer=producer)
+    except Exception as err:
+        log.error('Could not send runs to {}: {}'.format(queue_name, err))
+        return 'The model run service is unavailable'
 
     return
+
+
+def run_model_rabbitmq(mq, model, run_key, model_kwargs):
+    return run_models_rabbitmq(model, run_key, [model_kwargs])
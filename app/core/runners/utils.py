@@ -3,7 +3,8 @@ def kwargs_to_cli(model_kwargs, extra_args=None, join=False):
     for k, v in model_kwargs.items():
         args_list.extend(['--' + k, str(v)])
 
-    args_list.extend(extra_args.split(' '))
+    if extra_args:
+        args_list.extend(extra_args.split())
 
     if join:
         args_list = ' '.join(args_list)
@@ -9,6 +9,7 @@ from sqlalchemy.exc import NoResultFound
 
 from app.core.users import add_user, get_user, get_user_by_email
 from app.core.hydra import root_connection
+from app.core.auth_cache import invalidate_user
 from app.models import User, APIKey
 
 from app.core.utils import generate_random_alphanumeric_key, hash_api_key, serializers, get_max_age, \
@@ -272,6 +273,7 @@ async def update_password(db, user_id, hydra_user_id, new_password):
     user = get_user(db, user_id)
     user.password = hash_password(new_password).encode()
     db.commit()
+    invalidate_user(user_id)
 
     # update the Hydra user
     hydra_admin = root_connection()
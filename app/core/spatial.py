@@ -0,0 +1,393 @@
+from collections import defaultdict
+from functools import wraps
+from math import ceil, floor, hypot, sqrt
+from threading import RLock
+
+import numpy
+
+from app.core.caching import Cache, network_version
+from app.core.geometry import get_network_geometry
+
+# default distance (in map units, i.e. degrees) within which a point snaps to an existing node or link
+SNAP_TOLERANCE = 1e-5
+
+# the most features, and the largest radius (in map units), that a nearest feature search looks for
+MAX_NEAREST_LIMIT = 100
+MAX_NEAREST_RADIUS = 10.0
+
+spatial_index_cache = Cache(maxsize=32)
+
+HASH_MASK = (1 << 64) - 1
+
+
+def _resource_coords(resource):
+    gj = (resource.get('layout') or {}).get('geojson')
+    coords = gj and gj.get('geometry', {}).get('coordinates')
+    return coords
+
+
+def _project(x, y, p, q):
+    """Project (x, y) onto segment pq, returning (distance, t, (px, py)), where t is the fraction along the segment"""
+    dx, dy = q[0] - p[0], q[1] - p[1]
+    d2 = dx * dx + dy * dy
+    t = 0.0 if not d2 else max(0.0, min(1.0, ((x - p[0]) * dx + (y - p[1]) * dy) / d2))
+    px, py = p[0] + t * dx, p[1] + t * dy
+    return hypot(x - px, y - py), t, (px, py)
+
+
+def _intersect(a, b, p, q):
+    """Get the fractions (s, t) along segments ab and pq where they cross, or None if they do not"""
+    r = (b[0] - a[0], b[1] - a[1])
+    s = (q[0] - p[0], q[1] - p[1])
+    denom = r[0] * s[1] - r[1] * s[0]
+    if not denom:
+        return None
+    ap = (p[0] - a[0], p[1] - a[1])
+    u = (ap[0] * s[1] - ap[1] * s[0]) / denom
+    v = (ap[0] * r[1] - ap[1] * r[0]) / denom
+    if 0.0 < u < 1.0 and 0.0 <= v <= 1.0:
+        return u, v
+    return None
+
+
+def _locked(method):
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return locked
+
+
+def _features(network, template_id=None):
+    """The nodes and links of a network as the spatial index holds them: ('NODE', id, x, y, type name) for existing
+    nodes and ('LINK', id, vertices, node_1_id, node_2_id) for existing links"""
+    geometry = get_network_geometry(network)
+    type_names = geometry.type_names_for('NODE', template_id, default=None) if template_id else []
+    for row, (node_id, (x, y)) in enumerate(zip(geometry.node_ids.tolist(), geometry.node_gj_xy.tolist())):
+        if geometry.node_exists[row]:
+            yield 'NODE', node_id, x, y, type_names[row] if type_names else None
+    for row, link_id in enumerate(geometry.link_ids.tolist()):
+        if geometry.link_exists[row]:
+            node_1_id, node_2_id = geometry.link_node_ids[row].tolist()
+            yield 'LINK', link_id, tuple(map(tuple, geometry.link_vertices(row).tolist())), node_1_id, node_2_id
+
+
+def _feature_hash(feature):
+    return hash(feature) & HASH_MASK
+
+
+def spatial_version(network, template_id=None):
+    """A version key of what the spatial index of a network holds, as SpatialIndex.content_version"""
+    return sum(_feature_hash(feature) for feature in _features(network, template_id)) & HASH_MASK
+
+
+class SpatialIndex(object):
+    """A uniform grid index over a network's node points and link segments.
+
+    Keys are ('NODE', node_id) for nodes and ('LINK', link_id, segment_index) for link segments, where segment i runs
+    from vertex i to vertex i + 1 of the link's coordinates. The index can be updated in place as nodes and links are
+    added, changed or removed.
+
+    version is the network version the index was built for. content_version is a hash of the indexed features, kept
+    up to date as they change, so that an index that was edited in step with its network is still found valid when
+    the edited network is next seen (see get_spatial_index).
+
+    A cached index is shared between threads, so reads and edits hold its lock, which is reentrant. Hold it around a
+    series of edits (with index.lock) so that no search sees them half made.
+    """
+
+    def __init__(self, cell_size, version=None):
+        self.cell_size = cell_size
+        self.version = version
+        self.content_version = 0
+        self.lock = RLock()
+        self._hashes = {}
+        self.cells = defaultdict(set)
+        self.nodes = {}
+        self.node_types = {}
+        self.node_links = defaultdict(set)
+        self.links = {}
+        self.link_ends = {}
+        self._bounds = None
+
+    @classmethod
+    def from_network(cls, network, template_id=None, version=None):
+        geometry = get_network_geometry(network)
+
+        # size the cells so that there are about as many cells as features
+        coords = numpy.concatenate([geometry.node_gj_xy, geometry.link_coords])
+        coords = coords[numpy.isfinite(coords).all(axis=1)]
+        size = float((coords.max(axis=0) - coords.min(axis=0)).max()) if len(coords) else 0
+        cell_size = size / (sqrt(len(coords)) + 1) if size else 0.01
+
+        index = cls(cell_size, version=version or network_version(network))
+        for feature in _features(network, template_id):
+            if feature[0] == 'NODE':
+                index._add_node(*feature[1:])
+            else:
+                index._add_link(*feature[1:])
+
+        return index
+
+    def _count(self, key, feature=None):
+        """Keep content_version up to date as a feature is added (or, with no feature, removed)"""
+        old = self._hashes.pop(key, 0)
+        new = _feature_hash(feature) if feature else 0
+        if feature:
+            self._hashes[key] = new
+        self.content_version = (self.content_version - old + new) & HASH_MASK
+
+    def _cell(self, x, y):
+        return int(floor(x / self.cell_size)), int(floor(y / self.cell_size))
+
+    def _segment_cells(self, p, q):
+        x0, y0 = self._cell(min(p[0], q[0]), min(p[1], q[1]))
+        x1, y1 = self._cell(max(p[0], q[0]), max(p[1], q[1]))
+        return [(cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)]
+
+    def _extend_bounds(self, cells):
+        for cx, cy in cells:
+            if self._bounds is None:
+                self._bounds = [cx, cy, cx, cy]
+            else:
+                b = self._bounds
+                b[0], b[1], b[2], b[3] = min(b[0], cx), min(b[1], cy), max(b[2], cx), max(b[3], cy)
+
+    def _add_node(self, node_id, x, y, node_type=None):
+        self._count(('NODE', node_id), ('NODE', node_id, x, y, node_type))
+        cell = self._cell(x, y)
+        self.nodes[node_id] = (x, y)
+        self.node_types[node_id] = node_type
+        self.cells[cell].add(('NODE', node_id))
+        self._extend_bounds([cell])
+
+    def _add_link(self, link_id, coords, node_1_id, node_2_id):
+        coords = [(float(c[0]), float(c[1])) for c in coords]
+        self._count(('LINK', link_id), ('LINK', link_id, tuple(coords), node_1_id, node_2_id))
+        self.links[link_id] = coords
+        self.link_ends[link_id] = (node_1_id, node_2_id)
+        self.node_links[node_1_id].add(link_id)
+        self.node_links[node_2_id].add(link_id)
+        for i in range(len(coords) - 1):
+            cells = self._segment_cells(coords[i], coords[i + 1])
+            for cell in cells:
+                self.cells[cell].add(('LINK', link_id, i))
+            self._extend_bounds(cells)
+
+    @_locked
+    def add_node(self, node, node_type=None):
+        """Add or update a (Hydra) node"""
+        self.remove_node(node['id'])
+        coords = _resource_coords(node) or (node['x'], node['y'])
+        self._add_node(node['id'], float(coords[0]), float(coords[1]), node_type)
+
+    @_locked
+    def add_link(self, link):
+        """Add or update a (Hydra) link. Links without GeoJSON are drawn between their end nodes."""
+        self.remove_link(link['id'])
+        coords = _resource_coords(link)
+        if not coords:
+            n1, n2 = self.nodes.get(link['node_1_id']), self.nodes.get(link['node_2_id'])
+            if n1 is None or n2 is None:
+                return
+            coords = [n1, n2]
+        self._add_link(link['id'], coords, link['node_1_id'], link['node_2_id'])
+
+    @_locked
+    def remove_node(self, node_id):
+        self._count(('NODE', node_id))
+        coords = self.nodes.pop(node_id, None)
+        self.node_types.pop(node_id, None)
+        if coords is not None:
+            self.cells[self._cell(*coords)].discard(('NODE', node_id))
+
+    @_locked
+    def remove_link(self, link_id):
+        self._count(('LINK', link_id))
+        coords = self.links.pop(link_id, None)
+        if coords is None:
+            return
+        for node_id in self.link_ends.pop(link_id):
+            self.node_links[node_id].discard(link_id)
+        for i in range(len(coords) - 1):
+            for cell in self._segment_cells(coords[i], coords[i + 1]):
+                self.cells[cell].discard(('LINK', link_id, i))
+
+    def _candidates(self, x0, y0, x1, y1):
+        keys = set()
+        if self._bounds is None:
+            return keys
+        b = self._bounds
+        cx0, cy0 = self._cell(x0, y0)
+        cx1, cy1 = self._cell(x1, y1)
+        cx0, cy0, cx1, cy1 = max(cx0, b[0]), max(cy0, b[1]), min(cx1, b[2]), min(cy1, b[3])
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                keys.update(self.cells.get((cx, cy), ()))
+        return keys
+
+    def _measure(self, key, x, y):
+        if key[0] == 'NODE':
+            px, py = self.nodes[key[1]]
+            return hypot(x - px, y - py), 0.0, (px, py)
+        coords = self.links[key[1]]
+        return _project(x, y, coords[key[2]], coords[key[2] + 1])
+
+    def _ring_cells(self, cx, cy, ring):
+        """The cells (within the index bounds) on the square ring `ring` cells out from cell (cx, cy)"""
+        if not ring:
+            return [(cx, cy)]
+        b = self._bounds
+        x0, x1 = max(cx - ring, b[0]), min(cx + ring, b[2])
+        y0, y1 = max(cy - ring + 1, b[1]), min(cy + ring - 1, b[3])
+        cells = []
+        for j in (cy - ring, cy + ring):
+            if b[1] <= j <= b[3]:
+                cells.extend((i, j) for i in range(x0, x1 + 1))
+        for i in (cx - ring, cx + ring):
+            if b[0] <= i <= b[2]:
+                cells.extend((i, j) for j in range(y0, y1 + 1))
+        return cells
+
+    @_locked
+    def nearest(self, x, y, radius=None, limit=1, resource_type=None):
+        """Find the nearest nodes and/or links to a point.
+
+        Returns up to limit dicts of resource_type, id, distance and the nearest point on the feature, closest first.
+        Without a radius, the search expands ring by ring until the nearest features are found. The limit and radius
+        are capped at MAX_NEAREST_LIMIT and MAX_NEAREST_RADIUS.
+        """
+        if self._bounds is None:
+            return []
+
+        limit = max(1, min(limit, MAX_NEAREST_LIMIT))
+        radius = min(radius, MAX_NEAREST_RADIUS) if radius is not None else None
+        cs = self.cell_size
+        cx, cy = self._cell(x, y)
+
+        # rings closer in than the index bounds are empty, and rings past their far corner add nothing
+        b = self._bounds
+        first_ring = max(b[0] - cx, cx - b[2], b[1] - cy, cy - b[3], 0)
+        last_ring = max(abs(cx - b[0]), abs(cx - b[2]), abs(cy - b[1]), abs(cy - b[3]))
+        if radius is not None:
+            last_ring = min(last_ring, int(ceil(radius / cs)))
+
+        best = {}
+        seen = set()
+        for ring in range(first_ring, last_ring + 1):
+            for cell in self._ring_cells(cx, cy, ring):
+                for key in self.cells.get(cell, ()):
+                    if key in seen or resource_type and key[0] != resource_type:
+                        continue
+                    seen.add(key)
+                    distance, t, point = self._measure(key, x, y)
+                    if radius is not None and distance > radius:
+                        continue
+                    feature = key[:2]
+                    if feature not in best or distance < best[feature]['distance']:
+                        best[feature] = {
+                            'resource_type': key[0],
+                            'id': key[1],
+                            'distance': distance,
+                            'x': point[0],
+                            'y': point[1],
+                            'segment': key[2] if key[0] == 'LINK' else None,
+                            't': t,
+                        }
+
+            # anything not yet seen is at least `ring` cells away
+            if len(best) >= limit:
+                distances = sorted(f['distance'] for f in best.values())
+                if distances[limit - 1] <= ring * cs:
+                    break
+
+        return sorted(best.values(), key=lambda f: f['distance'])[:limit]
+
+    @_locked
+    def locate_point(self, x, y, tolerance=SNAP_TOLERANCE):
+        """Find the node, or else the link, that a point snaps to, if any. Nodes take precedence over links."""
+        node = self.nearest(x, y, radius=tolerance, resource_type='NODE')
+        if node:
+            return node[0]
+        link = self.nearest(x, y, radius=tolerance, resource_type='LINK')
+        return link[0] if link else None
+
+    @_locked
+    def split_crossings(self, coords, tolerance=SNAP_TOLERANCE):
+        """Insert a vertex into a polyline wherever it crosses an existing link between its own vertices"""
+        coords = [(float(c[0]), float(c[1])) for c in coords]
+        new_coords = coords[:1]
+        for a, b in zip(coords[:-1], coords[1:]):
+            crossings = []
+            for key in self._candidates(min(a[0], b[0]), min(a[1], b[1]), max(a[0], b[0]), max(a[1], b[1])):
+                if key[0] != 'LINK':
+                    continue
+                link = self.links[key[1]]
+                hit = _intersect(a, b, link[key[2]], link[key[2] + 1])
+                if hit is None:
+                    continue
+                u = hit[0]
+                point = (a[0] + u * (b[0] - a[0]), a[1] + u * (b[1] - a[1]))
+                if hypot(point[0] - a[0], point[1] - a[1]) > tolerance \
+                        and hypot(point[0] - b[0], point[1] - b[1]) > tolerance:
+                    crossings.append((u, point))
+            new_coords.extend(point for u, point in sorted(crossings))
+            new_coords.append(b)
+        return new_coords
+
+    @_locked
+    def locate_line(self, coords, tolerance=SNAP_TOLERANCE, split_crossings=True):
+        """Work out which existing nodes and links a new polyline touches.
+
+        Returns (coords, existings, split_locs) in the form the network editor expects: existings maps each vertex
+        index (as a string) to the node or link found there, and split_locs maps each touched link to its ordered
+        split points, each with the index of the new vertex ('idx') and the link vertex preceding it ('prev'),
+        followed by a final {'idx': None}.
+        """
+        if split_crossings:
+            coords = self.split_crossings(coords, tolerance)
+
+        existings = {}
+        splits = defaultdict(list)
+        for i, (x, y) in enumerate(coords):
+            existing = {'nodeId': None, 'linkId': None, 'nodeType': None, 'linkIds': []}
+            feature = self.locate_point(x, y, tolerance)
+            if feature and feature['resource_type'] == 'NODE':
+                node_id = feature['id']
+                existing.update(
+                    nodeId=node_id,
+                    nodeType=self.node_types.get(node_id),
+                    linkIds=sorted(self.node_links.get(node_id, ()))
+                )
+            elif feature:
+                existing['linkId'] = feature['id']
+                splits[feature['id']].append((feature['segment'], feature['t'], i))
+            existings[str(i)] = existing
+
+        split_locs = {}
+        for link_id, locs in splits.items():
+            split_locs[link_id] = [{'idx': idx, 'prev': prev} for prev, t, idx in sorted(locs)] + [{'idx': None}]
+
+        return coords, existings, split_locs
+
+
+def get_spatial_index(network, template_id=None):
+    """Get the spatial index of a network, rebuilding it if the network has changed since it was indexed.
+
+    An index that has been edited in place (e.g., by the network editor) is kept if it holds what the network does,
+    even though the network's version has changed since the index was built.
+    """
+    key = (network['id'], template_id)
+    version = network_version(network)
+    index = spatial_index_cache.get(key)
+    if index is not None and index.version != version and index.content_version == spatial_version(network,
+                                                                                                   template_id):
+        index.version = version
+    if index is None or index.version != version:
+        index = spatial_index_cache.set(key, SpatialIndex.from_network(network, template_id, version=version))
+    return index
+
+
+def invalidate_spatial_index(network_id):
+    spatial_index_cache.invalidate(lambda key: key[0] == network_id)
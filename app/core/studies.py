@@ -2,6 +2,8 @@ import json
 
 from app.models import Study, Star
 from app.core.users import get_dataurl, get_datausers
+from app.core.auth_cache import invalidate_studies
+from app.core.aio import run_async
 
 
 def add_study(db, created_by, dataurl_id, project_id):
@@ -21,11 +23,13 @@ def update_study(db, id, user_id, **updates):
     settings.update(updates)
     study.settings = json.dumps(settings)
     db.commit()
+    invalidate_studies()
 
 
 def delete_studies(db, userid, network_id):
     db.query(Study).filter_by(userid=userid, network_id=network_id).delete()
     db.commit()
+    invalidate_studies()
 
 
 def delete_study(db, **kwargs):
@@ -33,6 +37,7 @@ def delete_study(db, **kwargs):
     if study:
         db.delete(study)
         db.commit()
+        invalidate_studies()
 
 
 def get_study(db, **kwargs):
@@ -118,3 +123,16 @@ def remove_star(db, user_id, source_id, project_id):
     star = db.query(Star).filter_by(user_id=user_id, study_id=study.id)
     star.delete()
     db.commit()
+
+
+# async versions, for async routes (database work only)
+
+add_study_async = run_async(add_study)
+update_study_async = run_async(update_study)
+delete_studies_async = run_async(delete_studies)
+delete_study_async = run_async(delete_study)
+get_study_async = run_async(get_study)
+get_studies_async = run_async(get_studies)
+get_stars_async = run_async(get_stars)
+add_star_async = run_async(add_star)
+remove_star_async = run_async(remove_star)
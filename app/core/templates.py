@@ -1,12 +1,34 @@
 import xml.etree.ElementTree as ET
 
 from app.core.users import get_datauser
+from app.core.caching import Cache
 
 from boltons.iterutils import remap
 
 unknown_svg = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 15 15" height="15" width="15"><title>circle-15.svg</title><rect fill="none" x="0" y="0" width="15" height="15"></rect><path fill="red" transform="translate(0 0)" d="M14,7.5c0,3.5899-2.9101,6.5-6.5,6.5S1,11.0899,1,7.5S3.9101,1,7.5,1S14,3.9101,14,7.5z"></path></svg>'
 
 
+# templates change rarely, so they are kept briefly per data user to avoid refetching them for every edit
+template_cache = Cache(maxsize=128, ttl=60)
+
+
+def get_cached_template(hydra, template_id):
+    key = (hydra.url, hydra.user_id, template_id)
+    template = template_cache.get(key)
+    if template is None:
+        template = hydra.call('get_template', template_id)
+        if 'error' not in template:
+            template_cache.set(key, template)
+    return template
+
+
+def invalidate_cached_template(template_id=None):
+    if template_id is None:
+        template_cache.clear()
+    else:
+        template_cache.invalidate(lambda key: key[2] == template_id)
+
+
 def make_ttypes(template):
     ttypes = {}
     for ttype in template['templatetypes']:
@@ -0,0 +1,242 @@
+from copy import deepcopy
+
+from app.core.caching import fingerprint
+from app.core.jobs import job_function, get_job_hydra, InlineJob
+from app.core.networks import add_network, clean_network
+from app.core.templates import clean_template2, add_template
+
+# number of resources whose data are read and written at a time
+PAGE_SIZE = 500
+
+
+def dataset_hash(value):
+    """Get a hash of a dataset's contents, ignoring its id"""
+    return fingerprint(value.get('type'), value.get('unit') or value.get('unit_id'), value.get('value'),
+                       value.get('metadata'))
+
+
+def _check(result):
+    if isinstance(result, dict) and 'error' in result:
+        raise Exception(result['error'])
+    return result
+
+
+class Transfer(object):
+    """Stream networks from one Hydra data source to another.
+
+    Network structure (nodes, links and resource attributes) is copied first, without data, and data is then copied
+    one scenario and one page of resources at a time, so that a large project is never held in memory. A dataset
+    that is identical (by hash) to the one a child scenario inherits from its parent is not copied again.
+
+    Progress is saved with job.checkpoint(), so an interrupted transfer can be resumed: networks and scenarios that
+    were finished are skipped.
+    """
+
+    def __init__(self, src, dest, job=None, page_size=PAGE_SIZE):
+        self.src = src
+        self.dest = dest
+        self.job = job or InlineJob()
+        self.page_size = page_size
+        self.templates = {}  # source template id -> (source template, destination template)
+        self.attrs = {}  # source attr id -> destination attr id
+        self.stats = {'datasets': 0, 'duplicates': 0}
+
+    def transfer_template(self, template_id):
+        if template_id not in self.templates:
+            old_template = _check(self.src.call('get_template', template_id))
+            new_template = self.dest.call('get_template_by_name', old_template['name'])
+            if not new_template or 'error' in new_template:
+                new_template = _check(add_template(self.dest, clean_template2(deepcopy(old_template))))
+                new_template = self.dest.call('get_template', new_template['id'])
+            self.templates[template_id] = (old_template, new_template)
+
+            # match template attributes by name
+            new_attrs = {}
+            for tt in new_template['templatetypes']:
+                for ta in tt['typeattrs']:
+                    new_attrs[ta['attr']['name']] = ta['attr_id']
+            for tt in old_template['templatetypes']:
+                for ta in tt['typeattrs']:
+                    if ta['attr']['name'] in new_attrs:
+                        self.attrs[ta['attr_id']] = new_attrs[ta['attr']['name']]
+
+        return self.templates[template_id]
+
+    def transfer_attr(self, attr_id):
+        if attr_id not in self.attrs:
+            attr = _check(self.src.call('get_attribute_by_id', attr_id))
+            new_attr = _check(self.dest.call('add_attribute', {'name': attr['name'],
+                                                               'description': attr.get('description', '')}))
+            self.attrs[attr_id] = new_attr['id']
+        return self.attrs[attr_id]
+
+    def _network_structure(self, network_id):
+        network = _check(self.src.call('get_network', network_id, include_resources=True, include_data=False,
+                                       summary=False))
+        for scen in network['scenarios']:
+            scen.setdefault('resourcescenarios', [])
+            scen.setdefault('resourcegroupitems', [])
+        return network
+
+    def transfer_network(self, network_id, project_id):
+        """Copy a network to a project in the destination, returning the new network id"""
+        key = str(network_id)
+        networks = self.job.state.get('networks', {})
+        old_network = self._network_structure(network_id)
+
+        if key not in networks:
+            template_id = (old_network.get('layout') or {}).get('active_template_id')
+            old_template = new_template = None
+            if template_id:
+                old_template, new_template = self.transfer_template(template_id)
+
+            net = clean_network(old_network, old_template=old_template, new_template=new_template, purpose='clone')
+            net['project_id'] = project_id
+            net['layout']['public'] = False  # assume not public on the new data source
+            net['layout'].pop('storage', None)
+            if new_template:
+                net['layout']['active_template_id'] = new_template['id']
+            for resource in [net] + net['nodes'] + net['links'] + net['resourcegroups']:
+                for ra in resource['attributes']:
+                    ra['attr_id'] = self.transfer_attr(ra['attr_id'])
+
+            new_network = add_network(self.dest, net, add_baseline=False)
+            if not new_network:
+                raise Exception('Network {} could not be added'.format(old_network['name']))
+            networks[key] = {'id': new_network['id'], 'scenario_ids': []}
+            self.job.checkpoint(networks=networks)
+
+        new_network_id = networks[key]['id']
+        self.transfer_data(old_network, new_network_id, networks[key]['scenario_ids'])
+        return new_network_id
+
+    def _resource_attr_map(self, old_network, new_network_id):
+        """Map source resource attribute ids to destination resource attribute ids"""
+        new_network = _check(self.dest.call('get_network', new_network_id, include_resources=True,
+                                            include_data=False, summary=False))
+        new_ras = {}
+        resources = [('NETWORK', new_network)] + [('NODE', n) for n in new_network['nodes']] \
+                    + [('LINK', l) for l in new_network['links']]
+        for ref_key, resource in resources:
+            old_id = resource['layout'].get('old_id')
+            for ra in resource['attributes']:
+                new_ras[(ref_key, old_id, ra['attr_id'])] = ra['id']
+
+        ra_map = {}
+        resources = [('NETWORK', old_network)] + [('NODE', n) for n in old_network['nodes']] \
+                    + [('LINK', l) for l in old_network['links']]
+        for ref_key, resource in resources:
+            for ra in resource['attributes']:
+                new_ra_id = new_ras.get((ref_key, resource['id'], self.attrs.get(ra['attr_id'])))
+                if new_ra_id:
+                    ra_map[ra['id']] = new_ra_id
+
+        new_scenarios = {s['name']: s['id'] for s in new_network['scenarios']}
+        return ra_map, new_scenarios
+
+    def _pages(self, old_network):
+        yield {'network_ids': [old_network['id']]}
+        for key, resources in [('node_ids', old_network['nodes']), ('link_ids', old_network['links'])]:
+            ids = [r['id'] for r in resources]
+            for i in range(0, len(ids), self.page_size):
+                yield {key: ids[i:i + self.page_size]}
+
+    def transfer_data(self, old_network, new_network_id, done_scenario_ids):
+        ra_map, new_scenarios = self._resource_attr_map(old_network, new_network_id)
+
+        # parents first, so that their hashes are known when their children are copied
+        parents = {s['id']: s.get('parent_id') for s in old_network['scenarios']}
+
+        def depth(scenario_id):
+            parent_id = parents.get(scenario_id)
+            return 1 + depth(parent_id) if parent_id in parents else 0
+
+        scenarios = sorted(old_network['scenarios'], key=lambda s: depth(s['id']))
+        hashes = {}  # scenario id -> {resource attr id: dataset hash}
+        for i, scen in enumerate(scenarios):
+            if scen['id'] in done_scenario_ids:
+                continue
+            self.job.progress(i, len(scenarios), 'Copying data for {} / {}'.format(old_network['name'], scen['name']))
+            new_scenario_id = new_scenarios.get(scen['name'])
+            if new_scenario_id is None:
+                continue
+
+            parent_hashes = hashes.get(scen.get('parent_id'), {})
+            scenario_hashes = hashes[scen['id']] = {}
+            for page in self._pages(old_network):
+                result = _check(self.src.call('get_scenarios_data', [scen['id']], None, None, **page))
+                resource_scenarios = []
+                for rs in (result[0].get('resourcescenarios', []) if result else []):
+                    new_ra_id = ra_map.get(rs['resource_attr_id'])
+                    if new_ra_id is None:
+                        continue
+                    value = {k: v for k, v in rs['value'].items() if k not in ['id', 'cr_date', 'created_by']}
+                    h = scenario_hashes[rs['resource_attr_id']] = dataset_hash(value)
+                    if parent_hashes.get(rs['resource_attr_id']) == h:
+                        self.stats['duplicates'] += 1
+                        continue
+                    resource_scenarios.append({'resource_attr_id': new_ra_id, 'value': value})
+                if resource_scenarios:
+                    _check(self.dest.call('update_resourcedata', new_scenario_id, resource_scenarios))
+                    self.stats['datasets'] += len(resource_scenarios)
+
+            done_scenario_ids.append(scen['id'])
+            self.job.checkpoint(networks=self.job.state.get('networks', {}))
+
+    def transfer_project(self, project_id):
+        """Copy a project and all its networks to the destination, returning the new project id"""
+        if not self.job.state.get('project_id'):
+            project = _check(self.src.call('get_project', project_id))
+            existing_names = [p['name'] for p in self.dest.call('get_projects', self.dest.user_id) or []]
+            name = project['name']
+            i = 2
+            while name in existing_names:
+                name = '{} ({})'.format(project['name'], i)
+                i += 1
+            new_project = _check(self.dest.call('add_project', {
+                'name': name,
+                'description': project.get('description', ''),
+                'layout': project.get('layout') or {},
+            }))
+            self.job.checkpoint(project_id=new_project['id'], networks={})
+
+        new_project_id = self.job.state['project_id']
+        networks = _check(self.src.call('get_networks', project_id=project_id, include_resources=False,
+                                        include_data=False, summary=True))
+        for i, network in enumerate(networks):
+            self.job.progress(i, len(networks), 'Copying {}'.format(network['name']))
+            self.transfer_network(network['id'], new_project_id)
+
+        return new_project_id
+
+
+def move_network(src, dest, project_id, network_id, job=None):
+    """Move a network to a project, possibly on another data source"""
+    if dest is src or dest.url == src.url:
+        network = src.call('get_network', network_id, summary=True, include_resources=False)
+        network['project_id'] = project_id
+        src.call('update_network', network)
+        return {'network_id': network_id}
+
+    transfer = Transfer(src, dest, job=job)
+    new_network_id = transfer.transfer_network(network_id, project_id)
+    return dict(transfer.stats, network_id=new_network_id)
+
+
+def move_project(src, dest, project_id, job=None):
+    """Copy a project, with its networks and data, to another data source"""
+    transfer = Transfer(src, dest, job=job)
+    new_project_id = transfer.transfer_project(project_id)
+    return dict(transfer.stats, project_id=new_project_id)
+
+
+@job_function('move_network')
+def move_network_job(hydra, job, destination_id, project_id, network_id):
+    dest = get_job_hydra(job.db, job.user_id, destination_id)
+    return move_network(hydra, dest, project_id, network_id, job=job)
+
+
+@job_function('move_project')
+def move_project_job(hydra, job, destination_id, project_id):
+    dest = get_job_hydra(job.db, job.user_id, destination_id)
+    return move_project(hydra, dest, project_id, job=job)
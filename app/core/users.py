@@ -7,6 +7,8 @@ from app.models import DataUrl, DataUser, User
 from app.core.hydra import root_connection
 from app.core.utils import encrypt, hash_password
 from app.config import config
+from app.core.aio import run_async
+from app.core.auth_cache import invalidate_user
 
 
 def get_users(db: Session, user_ids: list):
@@ -58,6 +60,7 @@ def save_user_settings(db: Session, user_id, settings):
     else:
         user.settings = settings
     db.commit()
+    invalidate_user(user_id)  # so the cached copy of the user has the new settings
 
 
 def update_socketid(db: Session, user, value):
@@ -231,3 +234,28 @@ def update_user_network_settings(db: Session, datauser_id: int, network_id: int,
     user_settings['networks'][network_id].update(settings)
     datauser.settings = json.dumps(user_settings)
     db.commit()
+    invalidate_user(datauser.user_id)
+
+
+# async versions, for async routes (database work only)
+
+get_users_async = run_async(get_users)
+add_user_async = run_async(add_user)
+get_user_async = run_async(get_user)
+get_user_by_email_async = run_async(get_user_by_email)
+get_user_settings_async = run_async(get_user_settings)
+get_user_setting_async = run_async(get_user_setting)
+save_user_setting_async = run_async(save_user_setting)
+save_user_settings_async = run_async(save_user_settings)
+update_socketid_async = run_async(update_socketid)
+update_datauser_sessionid_async = run_async(update_datauser_sessionid)
+add_dataurl_async = run_async(add_dataurl)
+add_update_datauser_async = run_async(add_update_datauser)
+update_datauser_async = run_async(update_datauser)
+add_datauser_async = run_async(add_datauser)
+delete_datauser_async = run_async(delete_datauser)
+get_datausers_async = run_async(get_datausers)
+get_datauser_async = run_async(get_datauser)
+get_dataurl_async = run_async(get_dataurl)
+get_dataurl_by_id_async = run_async(get_dataurl_by_id)
+update_user_network_settings_async = run_async(update_user_network_settings)
@@ -1,24 +1,53 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from app import config
+from app.core.dbpool import InstrumentedQueuePool, instrument, pool_limits
 
 DATABASE_URI = config.DATABASE_URI
 
 sql_flavor = DATABASE_URI.split(':')[0]
 
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'mysql+pymysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
 if sql_flavor in ['mysql+pymysql', 'postgresql']:
-    # TODO: Figure out what these numbers should really be, and make them variables based on infrastructure.
-    engine = create_engine(
-        DATABASE_URI,
-        pool_size=150,
-        max_overflow=30,
+    pool_size, max_overflow = pool_limits(
+        workers=config.WEB_CONCURRENCY,
+        threads=config.WEB_THREADS,
+        jobs=config.JOB_WORKERS,
+        max_connections=config.DB_MAX_CONNECTIONS
+    )
+    pool_options = dict(
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=config.DB_POOL_TIMEOUT,
         pool_recycle=600
     )
+    engine = create_engine(DATABASE_URI, poolclass=InstrumentedQueuePool, **pool_options)
 elif sql_flavor == 'sqlite':
+    pool_options = {}
     engine = create_engine(DATABASE_URI, connect_args={"check_same_thread": False})
 else:
     raise Exception('Unknown database type')
 
+pool_stats = instrument(engine, leak_seconds=config.DB_LEAK_SECONDS)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = None
+async_pool_stats = None
+AsyncSessionLocal = None
+if config.ASYNC_DATABASE:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+    async_uri = config.ASYNC_DATABASE_URI or DATABASE_URI.replace(sql_flavor, ASYNC_DRIVERS[sql_flavor], 1)
+    async_engine = create_async_engine(async_uri, **pool_options)
+    async_pool_stats = instrument(async_engine.sync_engine, leak_seconds=config.DB_LEAK_SECONDS)
+
+    # objects are not expired on commit, since reloading them lazily is not possible outside the session's greenlet
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
@@ -1,14 +1,16 @@
 from os import getenv
 from fastapi import Request, HTTPException, Depends, Security
+from starlette.requests import HTTPConnection
 from fastapi.security import APIKeyHeader
 import jwt
 from app.core.utils import decode_access_token
 from app.core.security import verify_api_key
 
-from app.database import SessionLocal
+from app.database import SessionLocal, AsyncSessionLocal
 from app.core.users import get_user_by_email, get_datauser
 from app.core.studies import get_study
 from app.core.hydra import HydraConnection, root_connection
+from app.core.auth_cache import get_cached_user, cache_user, get_or_set, CachedDataUser, CachedStudy
 
 api_key_header = APIKeyHeader(name='X-API-KEY', auto_error=False)
 
@@ -30,19 +32,46 @@ class AppSession:
 
 
 def get_db():
+    """A database session for the request, committed if the request succeeds and rolled back if it fails"""
     db = SessionLocal()
     try:
-        return db
+        yield db
+        db.commit()
+    except:
+        db.rollback()
+        raise
     finally:
         db.close()
 
 
+async def get_async_db(db=Depends(get_db)):
+    """A database session for async routes, for use with the repository functions' async versions.
+
+    This is an AsyncSession if the async engine is enabled (see config.ASYNC_DATABASE), or else the request's session.
+    """
+    if AsyncSessionLocal is None:
+        yield db
+        return
+
+    async with AsyncSessionLocal() as adb:
+        try:
+            yield adb
+            await adb.commit()
+        except:
+            await adb.rollback()
+            raise
+
+
 def get_pubnub():
     return None
 
 
-def authorized_user(request: Request, access_token=None, api_key=None):
-    db = get_db()
+def authorized_user(request: HTTPConnection, access_token=None, api_key=None, db=Depends(get_db)):
+    # the user is resolved once per request, however many dependencies ask for it
+    user = getattr(request.state, 'user', None)
+    if user is not None:
+        return user
+
     access_token = access_token or request.cookies.get('access_token')
     api_key = api_key or request.headers.get('X-API-KEY')
     if access_token:
@@ -53,32 +82,43 @@ def authorized_user(request: Request, access_token=None, api_key=None):
             raise HTTPException(401, 'Signature expired')
         except jwt.InvalidTokenError:
             raise HTTPException(401, 'Invalid token')
-        try:
-            user = get_user_by_email(db, payload['sub'])
-        except:
-            raise HTTPException(404)
+        user = get_cached_user('token', access_token)
+        if user is None:
+            try:
+                user = get_user_by_email(db, payload['sub'])
+            except:
+                raise HTTPException(404)
+            if user is not None:
+                user = cache_user('token', access_token, user, expires_at=payload.get('exp'))
     elif api_key:
-        try:
-            user = verify_api_key(db, api_key)
-        except:
-            raise NotAuthorizedException
+        user = get_cached_user('key', api_key)
+        if user is None:
+            try:
+                user = verify_api_key(db, api_key)
+            except:
+                raise NotAuthorizedException
+            if user is not None:
+                user = cache_user('key', api_key, user)
     else:
         raise NotAuthorizedException
 
+    if user is None:
+        raise NotAuthorizedException
+
+    request.state.user = user
+
     return user
 
 
 def get_g(request: Request, source_id: int = 1, project_id: int = 0, user: str = '', scope: str = '',
-                public: bool = False, api_key=Security(api_key_header)):
+                public: bool = False, api_key=Security(api_key_header), db=Depends(get_db)):
     """
     The purpose of this is to return a Flask-like "g" object to attach arbitrary objects to (e.g., db, current_user, etc.)
     This is a protected route, in that the user must be authorized, if viewing something as a "public" user.
     """
 
-    db = get_db()
-
     access_token = request.cookies.get('access_token')
-    current_user = authorized_user(request, access_token, api_key=api_key)
+    current_user = authorized_user(request, access_token, api_key=api_key, db=db)
 
     g = AppSession(db=db, current_user=current_user)
 
@@ -91,8 +131,16 @@ def get_g(request: Request, source_id: int = 1, project_id: int = 0, user: str =
         if source_id:
             g.source_id = source_id
             if project_id:
-                g.study = get_study(db, user_id=g.current_user.id, dataurl_id=source_id, project_id=project_id)
-            datauser = get_datauser(db, user_id=g.current_user.id, dataurl_id=source_id)
+                g.study = get_or_set(
+                    ('study', g.current_user.id, source_id, project_id),
+                    lambda: get_study(db, user_id=g.current_user.id, dataurl_id=source_id, project_id=project_id),
+                    CachedStudy
+                )
+            datauser = get_or_set(
+                ('datauser', g.current_user.id, source_id),
+                lambda: get_datauser(db, user_id=g.current_user.id, dataurl_id=source_id),
+                CachedDataUser
+            )
             # dataurl = get_dataurl_by_id(db, source_id)
             g.datauser = datauser
             g.hydra = HydraConnection(
@@ -6,11 +6,13 @@ from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
 from app.deps import authorized_user
+from app.database import engine, pool_stats, async_engine, async_pool_stats
+from app.core.model_control import ping_buffer, run_scheduler, local_runner, fleet
 
 from app.routers import (
     auth, users, accounts, maps, gui,
     projects, networks, templates, scenarios,
-    favorites, dashboards, modelruns, files, data, hydra
+    favorites, dashboards, modelruns, files, data, hydra, jobs, realtime
 )
 
 allowed_origins = [
@@ -42,11 +44,38 @@ async def homepage() -> str:
     return "Hello, world!"
 
 
+@app.on_event('startup')
+def _start_run_scheduler():
+    run_scheduler.start()  # so that runs queued before a restart are dispatched too
+
+
 api_prefix = '/v2'
 app.include_router(auth.api, prefix=api_prefix)
 
+
+@app.get(api_prefix + '/status/database', tags=['Default'], dependencies=[Depends(authorized_user)])
+def _database_status() -> dict:
+    """Connection pool usage for this worker, for sizing the pool and the database"""
+    status = pool_stats.summary(engine.pool)
+    if async_engine is not None:
+        status['async'] = async_pool_stats.summary(async_engine.pool)
+    return status
+
+
+@app.get(api_prefix + '/status/pings', tags=['Default'], dependencies=[Depends(authorized_user)])
+def _ping_status() -> dict:
+    """Model run ping buffer depth and flush latency for this worker"""
+    return ping_buffer.stats()
+
+
+@app.get(api_prefix + '/status/runs', tags=['Default'], dependencies=[Depends(authorized_user)])
+def _run_queue_status() -> dict:
+    """Model runs waiting and running, the limits they are dispatched within, and the computers they run on"""
+    return dict(run_scheduler.stats(), local=local_runner.stats(), fleet=fleet.stats())
+
+
 protected_routers = [users, accounts, maps, gui, projects, networks, templates, scenarios, dashboards,
-                     favorites, modelruns, files, data, hydra]
+                     favorites, modelruns, files, data, hydra, jobs, realtime]
 for protected_router in protected_routers:
     app.include_router(protected_router.api, prefix=api_prefix, dependencies=[Depends(authorized_user)])
 
@@ -2,7 +2,7 @@ import json
 
 from sqlalchemy_json import mutable_json_type
 
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, UniqueConstraint, JSON
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, UniqueConstraint, JSON, Index
 from sqlalchemy.orm import relationship, backref
 from app.database import Base
 
@@ -184,10 +184,67 @@ class Ping(Base):
     last_ping = Column(Integer)
     extra_info = Column(Text)
 
+    # run history is looked up by network, then by run
+    __table_args__ = (
+        Index('ix_ping_source_network_sid_status', 'source_id', 'network_id', 'sid', 'status'),
+    )
+
     def to_json(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
+class QueuedRun(Base):
+    __tablename__ = 'run_queue'
+    """Model runs waiting to be sent to a model, or sent and not yet ended (see app.core.run_scheduler)."""
+    id = Column(Integer, primary_key=True)  # order of arrival
+    sid = Column(String(255), unique=True)
+    user_id = Column(Integer, ForeignKey('user.id', ondelete='CASCADE'))
+    model_id = Column(Integer)
+    priority = Column(Integer, default=0)
+    status = Column(String(16))  # queued or dispatched
+    payload = Column(JSON)  # what is needed to send the run
+    created_at = Column(DateTime)
+    dispatched_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_run_queue_status_user', 'status', 'user_id'),
+    )
+
+
+class Job(Base):
+    __tablename__ = 'job'
+    """Long-running background jobs, such as network clones and moves."""
+    id = Column(String(36), primary_key=True)
+    kind = Column(String(32))
+    user_id = Column(Integer, ForeignKey('user.id', ondelete='CASCADE'))
+    source_id = Column(Integer, ForeignKey('dataurl.id'))
+    status = Column(String(16))  # queued, running, finished, failed or cancelled
+    progress = Column(Integer, default=0)  # percent complete
+    message = Column(String(255))
+    params = Column(mutable_json_type(dbtype=JSON, nested=True))
+    state = Column(mutable_json_type(dbtype=JSON, nested=True))  # checkpoint for resuming
+    result = Column(mutable_json_type(dbtype=JSON, nested=True))
+    error = Column(Text)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+
+    def to_json(self):
+        ret = {c.name: getattr(self, c.name) for c in self.__table__.columns if c.name != 'state'}
+        for key in ['created_at', 'updated_at']:
+            ret[key] = ret[key] and ret[key].isoformat()
+        return ret
+
+
+class MapboxSyncState(Base):
+    __tablename__ = 'mapbox_sync_state'
+    """Hashes of the features last published to a Mapbox dataset for a network, used to send only what changed."""
+    dataurl_id = Column(Integer, ForeignKey('dataurl.id', ondelete='CASCADE'), primary_key=True)
+    network_id = Column(Integer, primary_key=True)
+    dataset_id = Column(String(64), primary_key=True)
+    hashes = Column(mutable_json_type(dbtype=JSON, nested=True))  # feature id -> hash
+    updated_at = Column(DateTime)
+
+
 class Model(Base):
     __tablename__ = 'model'
     """Models available for simulation and/or optimization."""
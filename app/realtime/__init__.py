@@ -0,0 +1,25 @@
+"""Realtime updates for clients, e.g., model run progress, over WebSocket or server-sent events (see app.routers.realtime)
+
+Messages are published to rooms, such as a network's room, and fanned out to every subscribed client, in this worker
+or, with a broker backend (REALTIME_BACKEND=redis or amqp), in every worker.
+"""
+from app import config
+from app.realtime.hub import Hub
+
+hub = Hub(
+    backend=config.REALTIME_BACKEND,
+    url=config.REALTIME_BROKER_URL,
+    max_rate=config.REALTIME_MAX_RATE,
+)
+
+
+def network_room(source_id, network_id):
+    return config.NETWORK_ROOM_NAME.format(source_id=source_id, network_id=network_id)
+
+
+def study_room(source_id, project_id):
+    return config.RUN_STUDY_ROOM_NAME.format(source_id=source_id, project_id=project_id)
+
+
+def publish(room, event, data):
+    hub.publish(room, event, data)
@@ -0,0 +1,87 @@
+import json
+import logging
+import socket
+import time
+import uuid
+from threading import Lock, Thread
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'openagua-realtime'
+
+
+class MemoryBackend(object):
+    """Deliver messages within this process only, e.g., for a single worker or tests"""
+
+    def __init__(self, deliver, url=None):
+        self.deliver = deliver
+
+    def publish(self, message):
+        self.deliver(message)
+
+
+class RedisBackend(object):
+    """Fan messages out to every worker through a Redis pub/sub channel (needs the redis package)"""
+
+    def __init__(self, deliver, url=None):
+        import redis
+
+        self.deliver = deliver
+        self.client = redis.Redis.from_url(url or 'redis://localhost:6379/0')
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(**{CHANNEL: self._on_message})
+        self.thread = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def _on_message(self, item):
+        self.deliver(json.loads(item['data']))
+
+    def publish(self, message):
+        self.client.publish(CHANNEL, json.dumps(message, default=str))
+
+
+class AmqpBackend(object):
+    """Fan messages out to every worker through a RabbitMQ fanout exchange, with a temporary queue per worker"""
+
+    def __init__(self, deliver, url=None):
+        from kombu import Connection, Exchange, Queue
+
+        self.deliver = deliver
+        self.url = url
+        self.exchange = Exchange(CHANNEL, type='fanout', durable=False, auto_delete=True)
+        self.queue = Queue('{}-{}'.format(CHANNEL, uuid.uuid4().hex), exchange=self.exchange, exclusive=True,
+                           auto_delete=True, durable=False)
+        self.Connection = Connection
+        self._lock = Lock()  # kombu producers are not thread-safe
+        self._connection = Connection(url)
+        self._producer = self._connection.Producer(serializer='json')
+        self.thread = Thread(target=self._consume, name='realtime-amqp', daemon=True)
+        self.thread.start()
+
+    def _on_message(self, body, message):
+        message.ack()
+        self.deliver(body)
+
+    def _consume(self):
+        while True:
+            try:
+                with self.Connection(self.url) as connection:
+                    with connection.Consumer(self.queue, callbacks=[self._on_message]):
+                        while True:
+                            try:
+                                connection.drain_events(timeout=1)
+                            except socket.timeout:
+                                connection.heartbeat_check()
+            except Exception as err:
+                log.warning('Realtime consumer disconnected, reconnecting: {}'.format(err))
+                time.sleep(1)
+
+    def publish(self, message):
+        with self._lock:
+            self._producer.publish(message, exchange=self.exchange, declare=[self.exchange], retry=True)
+
+
+backends = {
+    'memory': MemoryBackend,
+    'redis': RedisBackend,
+    'amqp': AmqpBackend,
+}
@@ -0,0 +1,114 @@
+import asyncio
+import itertools
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from threading import Lock
+
+from app.realtime.backends import backends
+
+
+class Subscriber(object):
+    """A client's view of a room: the latest message for each key, handed out in batches at a bounded rate.
+
+    Messages whose data has a sid (model run pings) are keyed by event and sid, so a slow client gets only the latest
+    state of each run. Other messages are never coalesced, but at most max_pending messages are held, oldest dropped.
+    """
+
+    def __init__(self, room, loop, min_interval=0.25, max_pending=1000):
+        self.room = room
+        self.loop = loop
+        self.min_interval = min_interval
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._latest = OrderedDict()
+        self._ready = asyncio.Event()
+        self._sent_at = None
+        self._seq = itertools.count()
+
+    def put(self, message):
+        """Add a message; call on the subscriber's event loop"""
+        data = message.get('data')
+        sid = data.get('sid') if isinstance(data, dict) else None
+        key = (message.get('event'), sid) if sid is not None else next(self._seq)
+        self._latest.pop(key, None)
+        self._latest[key] = message
+        while len(self._latest) > self.max_pending:
+            self._latest.popitem(last=False)
+            self.dropped += 1
+        self._ready.set()
+
+    async def get(self):
+        """Wait for the next batch of messages, no sooner than min_interval after the last one"""
+        await self._ready.wait()
+        if self._sent_at is not None:
+            wait = self._sent_at + self.min_interval - self.loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        batch = list(self._latest.values())
+        self._latest.clear()
+        self._ready.clear()
+        self._sent_at = self.loop.time()
+        return batch
+
+
+class Hub(object):
+    """Publish messages to rooms, and deliver them to the clients subscribed to those rooms in this process.
+
+    Messages go through the backend, so with a broker backend (redis or amqp) they reach subscribers in every worker.
+    publish() can be called from any thread; subscribers live on the event loop that subscribed them.
+    """
+
+    def __init__(self, backend='memory', url=None, max_rate=4, max_pending=1000):
+        self.backend_name = backend
+        self.url = url
+        self.min_interval = 1 / max_rate if max_rate else 0
+        self.max_pending = max_pending
+        self._backend = None
+        self._rooms = {}  # room -> set of subscribers
+        self._lock = Lock()
+
+    @property
+    def backend(self):
+        # connected on first use, so importing the app does not connect to a broker
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = backends[self.backend_name](self.deliver, self.url)
+        return self._backend
+
+    def publish(self, room, event, data):
+        self.backend.publish({'room': room, 'event': event, 'data': data})
+
+    def deliver(self, message):
+        with self._lock:
+            subscribers = list(self._rooms.get(message['room'], ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber.put, message)
+            except RuntimeError:  # the subscriber's event loop is closed
+                self.unsubscribe(subscriber)
+
+    def subscribe(self, room):
+        """Subscribe to a room; call from the event loop that will read from the subscriber"""
+        self.backend  # connect before the first message can be missed
+        subscriber = Subscriber(room, asyncio.get_running_loop(), min_interval=self.min_interval,
+                                max_pending=self.max_pending)
+        with self._lock:
+            self._rooms.setdefault(room, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._rooms.get(subscriber.room, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._rooms.pop(subscriber.room, None)
+
+    @asynccontextmanager
+    async def subscription(self, room):
+        subscriber = self.subscribe(room)
+        try:
+            yield subscriber
+        finally:
+            self.unsubscribe(subscriber)
+
@@ -7,6 +7,7 @@ from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import validate_email, BaseModel, HttpUrl, EmailStr
 
 from app.deps import get_db, authorized_user
+from app.core.auth_cache import invalidate_credential
 from app.schemas import User
 from app.core.users import get_user_by_email, get_datauser, register_datauser
 from app.core.security import confirm_email_token_status, confirm_user, reset_password_token_status, \
@@ -49,7 +50,10 @@ async def _login(response: Response, form_data: OAuth2PasswordRequestForm = Depe
 
 
 @api.post('/logout')
-async def _logout(response: Response):
+async def _logout(request: Request, response: Response):
+    access_token = request.cookies.get('access_token')
+    if access_token:
+        invalidate_credential('token', access_token)
     expires = dt.datetime.utcnow() + dt.timedelta(seconds=1)
     expires_str = expires.strftime("%a, %d %b %Y %H:%M:%S GMT")
     for token in ['access', 'refresh']:
@@ -1,10 +1,10 @@
 from fastapi import APIRouter, Depends
 from typing import List
-from app.deps import get_g
+from app.deps import get_g, get_async_db
 from app.schemas import Favorite
 
 from app.core.users import get_dataurl
-from app.core.favorites import get_favorites, validate_favorites, add_update_favorite, delete_favorite
+from app.core.favorites import get_favorites, validate_favorites, add_update_favorite_async, delete_favorite
 
 api = APIRouter(tags=['Favorites'])
 
@@ -26,25 +26,26 @@ def _get_network_favorites(network_id: int, project_id: int | None = None, g=Dep
 
 
 @api.post('/favorites', status_code=201)
-async def _add_network_favorite(favorite: Favorite, g=Depends(get_g)) -> Favorite:
+async def _add_network_favorite(favorite: Favorite, g=Depends(get_g), db=Depends(get_async_db)) -> Favorite:
     study_id = g.study and g.study.id
 
     # TODO: fix this
     favorite['filters']['attr_data_type'] = 'timeseries'
     network_id = favorite['network_id']
 
-    ret = add_update_favorite(g.db, study_id=study_id, network_id=network_id, favorite=favorite)
+    ret = await add_update_favorite_async(db, study_id=study_id, network_id=network_id, favorite=favorite)
 
     return ret.to_json()
 
 
 @api.put('/favorites/{favorite_id}')
-async def _update_network_favorite(favorite: Favorite, favorite_id: int, g=Depends(get_g)) -> Favorite:
+async def _update_network_favorite(favorite: Favorite, favorite_id: int, g=Depends(get_g),
+                                   db=Depends(get_async_db)) -> Favorite:
     study_id = g.study and g.study.id
     # TODO: fix this
     favorite['filters']['attr_data_type'] = 'timeseries'
 
-    ret = add_update_favorite(g.db, study_id=study_id, favorite_id=favorite_id, favorite=favorite)
+    ret = await add_update_favorite_async(db, study_id=study_id, favorite_id=favorite_id, favorite=favorite)
 
     return ret.to_json()
 
@@ -0,0 +1,36 @@
+from fastapi import APIRouter, Depends, HTTPException
+from app.deps import get_g
+
+from app.core.jobs import get_job, get_jobs, resume_job, cancel_job
+
+api = APIRouter(tags=['Jobs'])
+
+
+@api.get('/jobs', description='Get background jobs (network clones, moves, etc.) started by the current user')
+def _get_jobs(kind: str | None = None, g=Depends(get_g)):
+    jobs = get_jobs(g.db, g.current_user.id, kind=kind)
+    return [job.to_json() for job in jobs]
+
+
+@api.get('/jobs/{job_id}')
+def _get_job(job_id: str, g=Depends(get_g)):
+    job = get_job(g.db, job_id, g.current_user.id)
+    if not job:
+        raise HTTPException(404, 'Job not found')
+    return job.to_json()
+
+
+@api.post('/jobs/{job_id}/resume', description='Resume a failed or cancelled job from its last checkpoint')
+def _resume_job(job_id: str, g=Depends(get_g)):
+    job = get_job(g.db, job_id, g.current_user.id)
+    if not job:
+        raise HTTPException(404, 'Job not found')
+    return resume_job(g.db, job).to_json()
+
+
+@api.post('/jobs/{job_id}/cancel')
+def _cancel_job(job_id: str, g=Depends(get_g)):
+    job = get_job(g.db, job_id, g.current_user.id)
+    if not job:
+        raise HTTPException(404, 'Job not found')
+    return cancel_job(g.db, job).to_json()
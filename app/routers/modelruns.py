@@ -1,10 +1,13 @@
 from fastapi import APIRouter, Request, Depends
+from fastapi.concurrency import run_in_threadpool
 from typing import List
-from app.deps import get_g, get_mq, get_pubnub
+from app.deps import get_g, get_async_db, get_mq, get_pubnub
 
+from app.core.cubes import start_cube_build
 from app.core.modeling import get_model, get_models, delete_model, update_model, add_model_template, add_model, get_network_model
-from app.core.model_control import start_model_run, pause_model_run, cancel_model_run, add_ping, ProcessState, \
-    end_model_run, get_run_records, delete_run_record, delete_run_records
+from app.core.model_control import start_model_run, pause_model_run, resume_model_run, cancel_model_run, \
+    buffer_ping, ProcessState, end_model_run_async, get_run_records, delete_run_record, delete_run_records, \
+    emit_progress, get_run_queue, run_group_ended_async, ENDED
 
 # api = Namespace('Model engines API', path='/models', description='Operations related to model engines.')
 
@@ -145,15 +148,25 @@ async def _add_model_run(request: Request, g=Depends(get_g), mq=Depends(get_mq))
     config = data.get('config', {})
     scenarios = data.get('scenarios', [])
     host_url = request.url
-    ret = start_model_run(g.db, g.hydra, g.current_user.email, host_url, network_id, guid, config, scenarios,
-                          computer_id=computer_id, mq=mq)
+    ret = await run_in_threadpool(start_model_run, g.db, g.hydra, g.current_user.email, host_url, network_id, guid,
+                                  config, scenarios, computer_id=computer_id, mq=mq, user_id=g.current_user.id)
     return ret
 
 
+@api.get('/runs/queue')
+def _get_model_run_queue(network_id: int | None = None, g=Depends(get_g)):
+    """The user's runs that are waiting for, or running on, a model, with each waiting run's place in the queue"""
+    runs = get_run_queue(g.current_user.id)
+    if network_id:
+        runs = [run for run in runs if run['network_id'] == network_id]
+    return runs
+
+
 @api.delete('/runs/{sid}', status_code=204)
 async def _delete_model_run(sid: str, source_id: int, network_id: int, name: str | None = None, scids: List[int] | None = None,
-                 progress: int | None = None, g=Depends(get_g), pubnub=Depends(get_pubnub)):
-    cancel_model_run(g.db, pubnub, sid)
+                 progress: int | None = None, g=Depends(get_g), db=Depends(get_async_db),
+                 pubnub=Depends(get_pubnub)):
+    await run_in_threadpool(cancel_model_run, g.db, pubnub, sid)
     data = dict(
         sid=sid,
         name=name,
@@ -162,42 +175,62 @@ async def _delete_model_run(sid: str, source_id: int, network_id: int, name: str
         scids=scids or [],
         progress=progress
     )
-    end_model_run(g.db, sid, ProcessState.CANCELED, data)
+    await end_model_run_async(db, sid, ProcessState.CANCELED, data)
+    emit_progress(source_id=source_id, network_id=network_id, ping=dict(data, sid=sid, status=ProcessState.CANCELED))
 
 
 @api.post('/runs/{sid}/actions/{action}', status_code=201)
 async def _add_model_run_action(request: Request, sid: str, action: str, source_id: int, network_id: int,
-                                 g=Depends(get_g), pubnub=Depends(get_pubnub)):
+                                 g=Depends(get_g), db=Depends(get_async_db), pubnub=Depends(get_pubnub)):
     data = await request.json()
+    status = None
     if action == 'start':
         data.pop('status', None)
         data.pop('sid', None)
-        ping = add_ping(sid, ProcessState.STARTED, **data)
-        # emit_progress(source_id=source_id, network_id=network_id, ping=ping.to_json())
+        buffer_ping(sid, ProcessState.STARTED, **data)
+        status = ProcessState.STARTED
+
+    elif action == 'progress':
+        data.pop('status', None)
+        data.pop('sid', None)
+        buffer_ping(sid, ProcessState.RUNNING, **data)
+        status = ProcessState.RUNNING
 
     elif action == 'save':
         # emit_progress(source_id=source_id, network_id=network_id, ping=data)
         pass
 
     elif action == 'error':
-        end_model_run(g.db, sid, ProcessState.ERROR, data)
+        await end_model_run_async(db, sid, ProcessState.ERROR, data)
+        status = ProcessState.ERROR
 
     elif action == 'done':
-        end_model_run(g.db, sid, ProcessState.FINISHED, data)
+        await end_model_run_async(db, sid, ProcessState.FINISHED, data)
+        status = ProcessState.FINISHED
 
     elif action == 'stop':
-        end_model_run(g.db, sid, ProcessState.CANCELED, data)
+        await end_model_run_async(db, sid, ProcessState.CANCELED, data)
+        status = ProcessState.CANCELED
 
     elif action == 'pause':
-        pause_model_run(g.db, pubnub, sid)
+        await run_in_threadpool(pause_model_run, g.db, pubnub, sid)
         pass  # TODO: update
 
     elif action == 'resume':
-        pass  # TODO: update
+        await run_in_threadpool(resume_model_run, g.db, pubnub, sid)
 
     elif action == 'clear':
         pass  # TODO: is this needed?
 
+    if status in ENDED:
+        # the run's results are complete once all of its scenario combinations have ended
+        run = await run_group_ended_async(db, sid)
+        if run:
+            await run_in_threadpool(start_cube_build, g.db, g.current_user.id, source_id, network_id, run)
+
+    if status:
+        emit_progress(source_id=source_id, network_id=network_id, ping=dict(data, sid=sid, status=status))
+
 
 @api.get('/runs/records')
 def _get_model_run_record(network_id: int, g=Depends(get_g)):
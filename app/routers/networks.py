@@ -1,8 +1,8 @@
 from os import environ as env
 from os.path import splitext
 
-from fastapi import APIRouter, Depends, Request, HTTPException
-from fastapi.responses import Response, FileResponse
+from fastapi import APIRouter, Depends, Request, HTTPException, Query
+from fastapi.responses import Response, FileResponse, StreamingResponse
 from typing import List
 from pydantic import HttpUrl
 
@@ -11,14 +11,25 @@ from app.services import s3
 from app.schemas import Network
 from app import config
 
-from app.core.networks import get_network, update_types, get_network_for_export, \
-    make_network_thumbnail, save_network_preview, clone_network, move_network, import_from_json, \
-    get_network_settings, add_update_network_settings, delete_network_settings
+from app.core.networks import get_network, get_network_fields, get_network_for_export, \
+    make_network_thumbnail, save_network_preview, import_from_json, \
+    get_network_settings, add_update_network_settings, delete_network_settings, update_types as update_resource_types
 from app.core.sharing import set_resource_permissions, share_resource
 from app.core.files import delete_all_network_files
-from app.core.network_editor import update_links2, split_link_at_nodes2
+from app.core.network_editor import update_links2, split_link_at_nodes2, add_link
+from app.core.edit_session import EditSessionError
 from app.core.modeling import update_network_model
-from app.core.templates import change_active_template
+from app.core.templates import change_active_template, get_cached_template, get_default_types
+from app.core.bulk import add_resources, update_resources, update_network_resources, delete_resources, \
+    add_resource_attributes, update_resource_attributes, delete_resource_attributes, assign_resource_types, \
+    remove_resource_types
+from app.core.caching import network_version, template_version
+from app.core.spatial import get_spatial_index, SNAP_TOLERANCE, MAX_NEAREST_LIMIT, MAX_NEAREST_RADIUS
+from app.core.jobs import start_job
+from app.core.transfer import move_network
+from app.core.repair import repair_network, REPAIR_OPTIONS
+from app.core.attribute_scenarios import get_attribute_scenarios, expand_attribute_scenarios, \
+    invalidate_attribute_scenarios
 
 # from openagua.lib.addins.weap_import import import_from_weap
 
@@ -73,16 +84,20 @@ async def _add_network(request: Request, purpose: str | None = None, g=Depends(g
     if purpose == 'clone':
         options = data.get('options')
         network_id = data.get('network_id')
-        network = clone_network(g.hydra, network_id=network_id, **options)
-        return network
+        job = start_job(g.db, 'clone_network', g.current_user.id, g.source_id,
+                        params=dict(options or {}, network_id=network_id), hydra=g.hydra)
+        return job.to_json()
 
     if purpose == 'move':
-        source = data.get('source')
-        destination = data.get('destination')
+        destination_id = data.get('destination_id', g.source_id)
         project_id = data.get('project_id')
         network_id = data.get('network_id')
-        move_network(g.hydra, source=source, destination=destination, project_id=project_id, network_id=network_id)
-        return Response(204)
+        if destination_id == g.source_id:
+            move_network(g.hydra, g.hydra, project_id=project_id, network_id=network_id)
+            return Response(status_code=204)
+        job = start_job(g.db, 'move_network', g.current_user.id, g.source_id, hydra=g.hydra,
+                        params=dict(destination_id=destination_id, project_id=project_id, network_id=network_id))
+        return job.to_json()
 
     net = data.get('network')
     # scen = request.json.get('scenario')
@@ -100,25 +115,41 @@ async def _add_network(request: Request, purpose: str | None = None, g=Depends(g
 def _get_network(network_id: int, simple: bool = False, summary: bool = True, purpose: str | None = None,
                  include_resources: bool = True,
                  repair: bool = False, repair_options: list = [], download_options: dict | None = None,
-                 file_format: str = 'json', g=Depends(get_g)):
+                 file_format: str = 'json', include: List[str] = Query(None), fields: List[str] = Query(None),
+                 g=Depends(get_g)):
     if purpose == 'download':
 
         if file_format in ['zip', 'xlsx', 'shapefile']:
             filename, file_buffer = get_network_for_export(g.hydra, network_id, repair_options, file_format)
             return FileResponse(file_buffer, filename=filename, content_disposition_type="attachment")
 
+        elif file_format == 'adjacency':
+            filename, lines = get_network_for_export(g.hydra, network_id, download_options or {}, file_format)
+            return StreamingResponse(lines, media_type='text/csv',
+                                     headers={'Content-Disposition': 'attachment; filename="{}"'.format(filename)})
+
         elif file_format:
             filename, network = get_network_for_export(g.hydra, network_id, download_options, file_format)
             return network
 
+    # sparse fieldsets, e.g., include=nodes&include=links&fields=nodes:id,x,y,types,layout.geojson
+    if include or fields:
+        network = get_network_fields(g.hydra, network_id, include=include, fields=fields)
+        if network is None:
+            raise HTTPException(511, 'No network found')
+        elif 'error' in network:
+            raise HTTPException(403, str(network))
+        if 'scenarios' in network:
+            network['scenarios'] = [s for s in network['scenarios'] if
+                                    not ((s.get('layout') or {}).get('class') == 'results' and s.get('parent_id'))]
+        return network
+
     network = get_network(
         g.hydra,
         g.source_id,
         network_id,
         simple=simple,
-        include_resources=include_resources,
-        repair=repair,
-        repair_options=repair_options
+        include_resources=include_resources
     )
 
     if network is None:
@@ -127,11 +158,33 @@ def _get_network(network_id: int, simple: bool = False, summary: bool = True, pu
     elif 'error' in network:
         raise HTTPException(403, str(network))
 
+    # this is cheap unless the (cached) diagnosis finds something to repair
+    if repair and not simple:
+        network = repair_network(g.db, g.hydra, g.source_id, network=network, options=repair_options)
+
     network['scenarios'] = [s for s in network['scenarios'] if
                             not (s['layout'].get('class') == 'results' and s['parent_id'])]
     return network
 
 
+@api.get('/networks/{network_id}/repair', description='Get a report of what a network repair would fix')
+def _get_network_repair_report(network_id: int, repair_options: List[str] = Query(REPAIR_OPTIONS),
+                               g=Depends(get_g)):
+    network = g.hydra.call('get_network', network_id, include_resources=True, include_data=False)
+    if 'error' in network:
+        raise HTTPException(403, network['error'])
+    return repair_network(g.db, g.hydra, g.source_id, network=network, options=repair_options, dry_run=True)
+
+
+@api.post('/networks/{network_id}/repair')
+def _repair_network(network_id: int, repair_options: List[str] = Query(REPAIR_OPTIONS),
+                    g=Depends(get_g)):
+    network = g.hydra.call('get_network', network_id, include_resources=True, include_data=False)
+    if 'error' in network:
+        raise HTTPException(403, network['error'])
+    return repair_network(g.db, g.hydra, g.source_id, network=network, options=repair_options)
+
+
 @api.put('/networks/{network_id}')
 def _update_network(network_id: int, network: Network, g=Depends(get_g)):
     return g.hydra.call('update_network', network)
@@ -205,47 +258,19 @@ async def _update_network_settings(request: Request, network_id: int, g=Depends(
 
 
 @api.get('/networks/{network_id}/attribute_scenarios')
-def _get_network_attribute_scenario(network_id: int, g=Depends(get_g)):
+def _get_network_attribute_scenario(network_id: int, compact: bool = False, g=Depends(get_g)):
+    """Get the input attributes of each node and link, and the scenarios they apply to.
+
+    By default, the attribute name and the scenario list are repeated for each resource attribute, as before;
+    compact=true lists the scenarios and attributes once instead, with index arrays per resource.
+    """
     network = g.hydra.call('get_network', network_id, include_data=False)
     template_id = g.hydra.get_template_id_from_network(network)
-    template = g.hydra.call('get_template', template_id)
-
-    tattrs = {tt['id']: {ta['attr_id']: ta for ta in tt['typeattrs']} for tt in template['templatetypes']}
-
-    def simplify(scenario):
-        return {
-            'id': scenario['id'],
-            'name': scenario['name'],
-            'class': scenario['layout']['class'] if 'class' in scenario['layout'] else 'baseline'
-        }
-
-    scenarios = [simplify(s) for s in network['scenarios'] if
-                 s['layout'].get('class') in ['baseline', 'option', 'scenario']]
-    # for i, scenario in enumerate(network.scenarios):
-    #     layout = scenario['layout']
-    #     if layout.get('class') in ['option', 'scenario']:
-    #         scenarios.append(simplify(scenario))
-
-    res_attr_scens = {'nodes': {}, 'links': {}}
-    for res_type in ['nodes', 'links']:
-        for resource in network[res_type]:
-            rattrs = []
-            typeids = [rt['id'] for rt in resource['types'] if rt['template_id'] == template_id]
-            if typeids:
-                typeid = typeids[0]
-                tas = tattrs.get(typeid)
-                for ra in resource['attributes']:
-                    # filter by attribute scope and limit to what's in the template
-                    ta = tas.get(ra['attr_id'])
-                    if ta and ta['attr_is_var'] == 'N':
-                        rattrs.append({
-                            'id': ra['id'],
-                            'name': ta['attr']['name'],
-                            'scenarios': scenarios
-                        })
-                res_attr_scens[res_type][resource['id']] = rattrs
-
-    return res_attr_scens
+    template = get_cached_template(g.hydra, template_id)
+
+    attribute_scenarios = get_attribute_scenarios(network, template)
+
+    return attribute_scenarios if compact else expand_attribute_scenarios(attribute_scenarios)
 
 
 @api.get('/networks/{network_id}/preview_url')
@@ -253,6 +278,13 @@ def _get_preview_url(network_id: int, g=Depends(get_g)) -> HttpUrl:
     network = g.hydra.call('get_network', network_id, summary=True, include_resources=True)
     template_id = network['layout'].get('active_template_id')
     template = template_id and g.hydra.call('get_template', template_id)
+
+    # skip rendering and uploading if the saved preview is already up to date
+    version = template and '{}|{}'.format(network_version(network), template_version(template))
+    preview = network['layout'].get('preview') or {}
+    if version and preview.get('url') and not preview.get('stale') and preview.get('version') == version:
+        return preview['url']
+
     svg = make_network_thumbnail(network, template)
     url = save_network_preview(
         g.hydra,
@@ -261,7 +293,8 @@ def _get_preview_url(network_id: int, g=Depends(get_g)) -> HttpUrl:
         contents=svg,
         location=config.NETWORK_FILES_STORAGE_LOCATION,
         s3=s3,
-        bucket_name=config.AWS_S3_BUCKET
+        bucket_name=config.AWS_S3_BUCKET,
+        version=version
     )
     return url
 
@@ -275,6 +308,18 @@ def _get_preview_svg(network_id: int, g=Depends(get_g)) -> str:
     return svg
 
 
+@api.get('/networks/{network_id}/nearest')
+def _get_nearest_features(network_id: int, x: float, y: float,
+                          radius: float | None = Query(None, gt=0, le=MAX_NEAREST_RADIUS),
+                          limit: int = Query(1, ge=1, le=MAX_NEAREST_LIMIT),
+                          resource_type: str | None = None, g=Depends(get_g)):
+    network = g.hydra.call('get_network', network_id, summary=True, include_resources=True)
+    template_id = network['layout'].get('active_template_id')
+    index = get_spatial_index(network, template_id)
+    resource_type = resource_type and resource_type.upper()
+    return index.nearest(x, y, radius=radius, limit=limit, resource_type=resource_type)
+
+
 # @api.route('/networks/{network_id}/reference_layers')
 # class ReferenceLayers(Resource):
 # 
@@ -357,8 +402,8 @@ async def put(request: Request, network_id: int, g=Depends(get_g)):
         set_resource_permissions(g.hydra, 'network', network_id, username, _permissions)
 
 
-@api.route('/nodes')
-async def post(request: Request, network_id: int, template_id: int, g=Depends(get_g)):
+@api.post('/nodes')
+async def _add_nodes(request: Request, network_id: int, template_id: int | None = None, g=Depends(get_g)):
     # for single nodes
     data = await request.json()
     incoming_node = data.get('node')
@@ -368,72 +413,124 @@ async def post(request: Request, network_id: int, template_id: int, g=Depends(ge
     # for multiple nodes
     incoming_nodes = data.get('nodes', [incoming_node])
 
+    tolerance = data.get('tolerance', SNAP_TOLERANCE)
+    template = template_id and get_cached_template(g.hydra, template_id)
+
     nodes = []
     links = []
     del_nodes = []
     del_links = []
+    errors = []
+    index = None
 
-    for incoming in incoming_nodes:
+    # each item is kept with its position in the request, which errors refer to
+    to_update = []
+    to_add = []
+    to_merge = []
+    for i, incoming in enumerate(incoming_nodes):
 
-        # create the new node
         if incoming.get('id', 0) > 0:
-            incoming['types'] = update_types(g.db, incoming, 'NODE')
-            node = g.hydra.call('update_node', incoming)
-            nodes.append(node)
+            to_update.append((i, incoming))
+            continue
+
+        locate = 'existing' not in incoming and 'existing' not in data
+        existing = incoming.pop('existing', _existing)
+        split_locs = incoming.pop('splitLocs', _split_locs)
+        incoming.pop('resType', None)
+
+        if locate:
+            # find the node or link the new node is dropped on, if any
+            if index is None:
+                network = g.hydra.call('get_network', network_id, include_resources=True, include_data=False,
+                                       summary=True)
+                index = get_spatial_index(network, template_id)
+            gj = incoming.get('layout', {}).get('geojson')
+            coords = gj['geometry']['coordinates'] if gj else [float(incoming['x']), float(incoming['y'])]
+            _, existing, split_locs = index.locate_line([coords], tolerance, split_crossings=False)
+            if not (existing['0']['nodeId'] or existing['0']['linkId']):
+                existing = None
+
+        if existing:
+            to_merge.append((i, incoming, existing, split_locs))
         else:
-
-            existing = incoming.pop('existing', _existing)
-            split_locs = incoming.pop('splitLocs', _split_locs)
-            incoming.pop('resType', None)
-
-            node = g.hydra.add_node(network_id, incoming)
-            nodes.append(node)
-
-            if existing:
-                old_node_id = existing['0'].get('nodeId')
-                old_link_id = existing['0'].get('linkId')
-                new_links = []
-                if old_node_id:
-
-                    # update existing links and delete old node
-                    old_link_ids = existing['0'].get('linkIds', [])
-                    new_links = update_links2(g.hydra, old_node_id=old_node_id, new_node_id=node['id'],
-                                              old_link_ids=old_link_ids)
-                    g.hydra.call('delete_node', old_node_id, False)
-                    del_nodes.append(old_node_id)
-
-                elif old_link_id:  # there should be only one, but existing includes an array
-                    splits = next(iter(split_locs.values()))
-                    new_links = split_link_at_nodes2(g.hydra, network_id=network_id,
-                                                     template_id=template_id,
-                                                     old_link_id=old_link_id,
-                                                     nodes=[node],
-                                                     splits=splits)
-                    del_links.append(old_link_id)
-                else:
-                    error = 1  # we shouldn't get here, obviously
-
-                links.extend(new_links)
-
-            error = 0
-
-    return dict(nodes=nodes, links=links, del_nodes=del_nodes, del_links=del_links)
-
-
-@api.put('/nodes', status_code=204)
-async def _update_nodes(request: Request, g=Depends(get_g)):
+            to_add.append((i, incoming))
+
+    # plain updates and additions are each made in one batch
+    update_resource_types(g.hydra, [item for _, item in to_update], 'NODE')
+    for batch_fn, items in [(update_resources, to_update), (add_resources, to_add)]:
+        done, _errors = batch_fn(g.hydra, network_id, template, 'NODE', [item for _, item in items],
+                                 indexes=[i for i, _ in items])
+        nodes.extend(done)
+        errors.extend(_errors)
+
+    # nodes dropped on an existing node or link replace the node or split the link
+    for i, incoming, existing, split_locs in to_merge:
+        node = g.hydra.add_node(network_id, incoming)
+        if 'error' in node:
+            errors.append({'index': i, 'id': None, 'error': node['error']})
+            continue
+        nodes.append(node)
+        if index is not None:
+            index.add_node(node, next((tt['name'] for t in node.get('types', []) for tt in template['templatetypes']
+                                       if tt['id'] == t['id']), None) if template else None)
+
+        old_node_id = existing['0'].get('nodeId')
+        old_link_id = existing['0'].get('linkId')
+        new_links = []
+        if old_node_id:
+
+            # update existing links and delete old node
+            old_link_ids = existing['0'].get('linkIds', [])
+            new_links = update_links2(g.hydra, old_node_id=old_node_id, new_node_id=node['id'],
+                                      old_link_ids=old_link_ids)
+            g.hydra.call('delete_node', old_node_id, False)
+            del_nodes.append(old_node_id)
+            if index is not None:
+                with index.lock:
+                    index.remove_node(old_node_id)
+                    for link in new_links:
+                        index.add_link(link)
+
+        elif old_link_id:  # there should be only one, but existing includes an array
+            splits = next(iter(split_locs.values()))
+            new_links = split_link_at_nodes2(g.hydra, network_id=network_id,
+                                             template_id=template_id,
+                                             old_link_id=old_link_id,
+                                             nodes=[node],
+                                             splits=splits,
+                                             index=index)
+            # the first piece keeps the split link's id, so it is not deleted
+
+        links.extend(new_links)
+
+    return dict(nodes=nodes, links=links, del_nodes=del_nodes, del_links=del_links, errors=errors)
+
+
+def _check_network_ids(resources, network_id):
+    missing = [str(i) for i, resource in enumerate(resources) if not (resource.get('network_id') or network_id)]
+    if missing:
+        raise HTTPException(422, 'No network_id given for items {}'.format(', '.join(missing[:10])))
+
+
+@api.put('/nodes')
+async def _update_nodes(request: Request, network_id: int | None = None, template_id: int | None = None,
+                        update_types: bool = False, g=Depends(get_g)):
     data = await request.json()
     nodes = data.get('nodes', [])
-    for node in nodes:
-        g.hydra.call('update_node', node)
+    template = template_id and get_cached_template(g.hydra, template_id)
+    if update_types:
+        update_resource_types(g.hydra, nodes, 'NODE')
+    _check_network_ids(nodes, network_id)
+    updated, errors = update_network_resources(g.hydra, network_id, template, 'NODE', nodes)
+    return dict(nodes=updated, errors=errors)
 
 
-@api.delete('/nodes', status_code=204,
+@api.delete('/nodes',
             description='Bulk delete multiple nodes. WARNING: This currently does not have the "merge" option as when \
             deleting a single node; adjacent links will also be deleted.')
 def _delete_nodes(ids: List[int], g=Depends(get_g)):
-    for id in ids:
-        g.hydra.call('delete_node', id, True)
+    deleted, errors = delete_resources(g.hydra, 'NODE', ids)
+    return dict(deleted=deleted, errors=errors)
 
 # @api.route('/nodes/<int:node_id>')
 # class Node(Resource):
@@ -502,143 +599,110 @@ def _delete_nodes(ids: List[int], g=Depends(get_g)):
 #             return jsonify(new_link)
 #
 #
-# links_fields = api.model('Links', {
-#     'link': fields.String,
-#     'links': fields.String,
-#     'existing': fields.String,
-#     'splitLocs': fields.String
-# })
-#
-#
-# @api.route('/links')
-# class Links(Resource):
-#
-#     @api.doc(description='Add multiple links to a network')
-#     @api.param('network_id', 'Network ID')
-#     @api.param('template_id', 'Template ID (optional)')
-#     @api.expect(links_fields)
-#     def post(self):
-#         network_id = request.args.get('network_id', type=int)
-#         template_id = request.args.get('template_id', type=int)
-#
-#         # for single link
-#         incoming_link = request.json.get('link')
-#         _existing = request.json.get('existing')
-#         _split_locs = request.json.get('splitLocs', {})
-#
-#         # for multiple links
-#         incoming_links = request.json.get('links', [incoming_link])
-#
-#         nodes = []
-#         links = []
-#         del_nodes = []
-#         del_links = []
-#
-#         if incoming_links:
-#             network = g.hydra.call('get_network', network_id, include_resources=True, include_data=False, summary=True)
-#             template_id = template_id or network['layout'].get('active_template_id')
-#             template = g.hydra.call('get_template', template_id)
-#             templatetypes = {tt['id']: tt for tt in template.templatetypes}
-#
-#             # TODO: get inflow/outflow node time from template
-#             default_types = get_default_types(template)
-#
-#             # create the new link(s)
-#             for incoming in incoming_links:
-#
-#                 existing = incoming.pop('existing', _existing)
-#                 split_locs = incoming.pop('splitLocs', _split_locs)
-#
-#                 incoming.pop('resType', None)
-#
-#                 if incoming.get('id', -1) <= 0 or existing:
-#
-#                     _new_nodes, _new_links, _del_nodes, _del_links, network = add_link(
-#                         hydra=g.hydra,
-#                         network=network,
-#                         template=template,
-#                         ttypes=templatetypes,
-#                         incoming_link=incoming_link,
-#                         existings=existing,
-#                         split_locs=split_locs,
-#                         default_types=default_types,
-#                         del_nodes=[]
-#                     )
-#
-#                     nodes.extend(_new_nodes)
-#                     links.extend(_new_links)
-#                     del_nodes.extend(_del_nodes)
-#                     del_links.extend(_del_links)
-#
-#                 else:
-#                     incoming['types'] = update_types(incoming, 'LINK')
-#                     g.hydra.call('update_link', incoming)
-#                     links.append(incoming)
-#
-#         return jsonify(nodes=nodes, links=links, del_nodes=del_nodes, del_links=del_links)
-#
-#     @api.doc('Update multiple links.')
-#     def put(self):
-#
-#         links = request.json.get('links', [])
-#         for link in links:
-#             g.hydra.call('update_link', link)
-#
-#         return '', 204
-#
-#     @api.doc(description='Bulk delete multiple links.')
-#     def delete(self):
-#         ids = request.args.getlist('ids[]')
-#         for id in ids:
-#             g.hydra.call('delete_link', id, True)
-#
-#         return '', 204
-#
-#
-# @api.route('/links/<int:link_id>')
-# class Link(Resource):
-#
-#     @api.doc(description='Update a link')
-#     def put(link_id):
-#         link = request.json.get('link')
-#         link.pop('coords', None)
-#         update_types = request.json.get('update_types', False)
-#         if update_types:
-#             link['types'] = update_types(link, 'LINK')
-#         updated_link = g.hydra.call('update_link', link)
-#         return jsonify(updated_link)
-#
-#     @api.doc(description='Delete a link')
-#     def delete(link_id):
-#         g.hydra.call('delete_link', link_id, True)
-#         return '', 204
-#
-#
-# @api.route('/resources')
-# class Resources(Resource):
-#
-#     @api.doc(description='Delete multiple resources (nodes and links)')
-#     @api.param('node_ids[]', 'The list of node IDs to delete')
-#     @api.param('link_ids[]', 'The list of link IDs to delete')
-#     def delete(self):
-#         node_ids = request.args.getlist('node_ids[]', type=int)
-#         link_ids = request.args.getlist('link_ids[]', type=int)
-#
-#         def _delete_resource(resource_type, resource_id):
-#             fn = 'delete_{}'.format(resource_type)
-#             try:
-#                 g.hydra.call(fn, resource_id, True)
-#             except:
-#                 g.hydra.call(fn, resource_id, False)
-#
-#         for link_id in link_ids:
-#             delete_resource('link', link_id)
-#         for node_id in node_ids:
-#             delete_resource('node', node_id)
-#
-#         return '', 204
-#
-#
+@api.post('/links')
+async def _add_links(request: Request, network_id: int, template_id: int | None = None, g=Depends(get_g)):
+    data = await request.json()
+
+    # for single link
+    incoming_link = data.get('link')
+    _existing = data.get('existing')
+    _split_locs = data.get('splitLocs', {})
+
+    # for multiple links
+    incoming_links = data.get('links', [incoming_link])
+
+    nodes = []
+    links = []
+    del_nodes = []
+    del_links = []
+    errors = []
+
+    # each item is kept with its position in the request, which errors refer to
+    to_update = []
+    to_add = []
+    to_draw = []
+    for i, incoming in enumerate(incoming_links):
+        existing = incoming.pop('existing', _existing)
+        split_locs = incoming.pop('splitLocs', _split_locs)
+        incoming.pop('resType', None)
+
+        if incoming.get('id', -1) > 0 and not existing:
+            to_update.append((i, incoming))
+        elif not existing and incoming.get('node_1_id') and incoming.get('node_2_id'):
+            to_add.append((i, incoming))
+        else:
+            # drawn links need end nodes and may split existing links
+            to_draw.append((i, incoming, existing, split_locs))
+
+    network = None
+    if to_draw or not template_id:
+        network = g.hydra.call('get_network', network_id, include_resources=bool(to_draw), include_data=False,
+                               summary=True)
+        template_id = template_id or network['layout'].get('active_template_id')
+    template = template_id and get_cached_template(g.hydra, template_id)
+
+    update_resource_types(g.hydra, [item for _, item in to_update], 'LINK')
+    for batch_fn, items in [(update_resources, to_update), (add_resources, to_add)]:
+        done, _errors = batch_fn(g.hydra, network_id, template, 'LINK', [item for _, item in items],
+                                 indexes=[i for i, _ in items])
+        links.extend(done)
+        errors.extend(_errors)
+
+    if to_draw:
+        templatetypes = {tt['id']: tt for tt in template['templatetypes']}
+        default_types = get_default_types(template)
+        for i, incoming, existing, split_locs in to_draw:
+            try:
+                _new_nodes, _new_links, _del_nodes, _del_links, network = add_link(
+                    hydra=g.hydra,
+                    network=network,
+                    template=template,
+                    ttypes=templatetypes,
+                    incoming_link=incoming,
+                    existings=existing,
+                    split_locs=split_locs,
+                    default_types=default_types,
+                )
+            except EditSessionError as err:
+                errors.append({'index': i, 'id': incoming.get('id'), 'error': str(err)})
+                continue
+
+            nodes.extend(_new_nodes)
+            links.extend(_new_links)
+            del_nodes.extend(_del_nodes)
+            del_links.extend(_del_links)
+
+    return dict(nodes=nodes, links=links, del_nodes=del_nodes, del_links=del_links, errors=errors)
+
+
+@api.put('/links')
+async def _update_links(request: Request, network_id: int | None = None, template_id: int | None = None,
+                        update_types: bool = False, g=Depends(get_g)):
+    data = await request.json()
+    links = data.get('links', [])
+    for link in links:
+        link.pop('coords', None)
+    template = template_id and get_cached_template(g.hydra, template_id)
+    if update_types:
+        update_resource_types(g.hydra, links, 'LINK')
+    _check_network_ids(links, network_id)
+    updated, errors = update_network_resources(g.hydra, network_id, template, 'LINK', links)
+    return dict(links=updated, errors=errors)
+
+
+@api.delete('/links', description='Bulk delete multiple links.')
+def _delete_links(ids: List[int], g=Depends(get_g)):
+    deleted, errors = delete_resources(g.hydra, 'LINK', ids)
+    return dict(deleted=deleted, errors=errors)
+
+
+@api.delete('/resources', description='Delete multiple resources (nodes and links)')
+def _delete_resources(node_ids: List[int] = [], link_ids: List[int] = [], g=Depends(get_g)):
+    deleted_links, link_errors = delete_resources(g.hydra, 'LINK', link_ids)
+    deleted_nodes, node_errors = delete_resources(g.hydra, 'NODE', node_ids)
+    return dict(del_nodes=deleted_nodes, del_links=deleted_links, node_errors=node_errors, link_errors=link_errors)
+
+
 # @api.route('/resource_groups')
 # class ResourceGroups(Resource):
 #
@@ -658,135 +722,73 @@ def _delete_nodes(ids: List[int], g=Depends(get_g)):
 #         group = request.json.get('group')
 #         rg = g.hydra.call('update_resourcegroup', group=group)
 #         return jsonify(rg)
-#
-#
-# @api.route('/resource_attributes')
-# class ResourceAttributes(Resource):
-#
-#     # def get(self):
-#     #     type_id = request.args.get('type_id', type=int)
-#     #     res_id = request.args.get('id', type=int)
-#     #     res_type = request.args.get('res_type').lower()
-#     #     active_res_attr_id = request.args.get('active_res_attr', type=int)
-#     #
-#     #     res_attrs = g.hydra.call('get_{}_attributes'.format(res_type), **{
-#     #         '{}_id'.format(res_type): res_id,
-#     #         'type_id': type_id
-#     #     })
-#     #
-#     #     # add templatetype attribute information to each resource attribute
-#     #     tattrs = {}
-#     #     if type_id:
-#     #         tt = g.hydra.call('get_templatetype', type_id)
-#     #         tattrs = {ta['attr_id']: ta for ta in tt['typeattrs'] if ta['attr_is_var'] == 'N'}
-#     #
-#     #     ret = []
-#     #     for ra in res_attrs:
-#     #         if ra['attr_id'] in tattrs:
-#     #             ra.update({
-#     #                 'tattr': tattrs[ra['attr_id']],
-#     #                 'active': ra.id == active_res_attr_id
-#     #             })
-#     #             ret.append(ra)
-#     #     return jsonify(res_attrs=ret)
-#
-#     @api.doc('Add resource attribute')
-#     def post(self):
-#         res_type = request.json['res_type']
-#         res_id = request.json['res_id']
-#         attr_id = request.json['attr_id']
-#         is_var = request.json['is_var']
-#         group = request.json.get('group')
-#
-#         # get/create group
-#         if group and group['id'] is None:
-#             group = g.hydra.call('add_group', group)
-#         else:
-#             group = None
-#
-#         # create attribute
-#         is_var = 'Y' if is_var else 'N'
-#         res_attr = g.hydra.call(
-#             'add_resource_attribute', **{
-#                 'resource_type': res_type,
-#                 'resource_id': res_id,
-#                 'attr_id': attr_id,
-#                 'is_var': is_var
-#             })
-#
-#         # add to group
-#         if group:
-#             group_attr = g.hydra.call('add_group_attribute', group_id=group.id, attr_id=res_attr.id, is_var=is_var)
-#             res_attr['group_id'] = group.id
-#
-#         return jsonify(res_attr)
-#
-#
-# @api.route('/resource_attributes/<int:res_attr_id>')
-# class ResourceAttribute(Resource):
-#
-#     @api.doc(
-#         description='Update a resource attribute'
-#     )
-#     def put(res_attr_id):
-#         res_attr = request.json
-#         is_var = res_attr.get('attr_is_var', 'N')
-#         unit = res_attr.get('unit', '')
-#         data_type = res_attr.get('data_type', '')
-#         description = res_attr.get('description', '')
-#         properties = res_attr.get('properties') or {}
-#         resp = g.hydra.call(
-#             'update_resource_attribute',
-#             resource_attr_id=res_attr_id, is_var=is_var, unit=unit, data_type=data_type,
-#             description=description, properties=json.dumps(properties))
-#         return '', 204
-#
-#     @api.doc(
-#         description='Delete a resource attribute'
-#     )
-#     def delete(res_attr_id):
-#         g.hydra.call('delete_resource_attribute', res_attr_id)
-#         return '', 200
-#
-#
-# @api.route('/nodes/<int:node_id>/resource_types/<int:type_id>')
-# class LinkResourceType(Resource):
-#
-#     @api.doc('Remove a type from a node')
-#     def delete(node_id, type_id):
-#         g.hydra.call('remove_type_from_resource', type_id=type_id, resource_type='NODE', resource_id=node_id)
-#         return '', 200
-#
-#
-# @api.route('/links/<int:link_id>/resource_types/<int:type_id>')
-# class LinkResourceType(Resource):
-#
-#     @api.doc('Remove a type from a link')
-#     def delete(link_id, type_id):
-#         g.hydra.call('remove_type_from_resource', type_id=type_id, resource_type='LINK', resource_id=link_id)
-#         return '', 200
-#
+
+
+@api.post('/resource_attributes', description='Add resource attributes, each with res_type, res_id, attr_id and is_var')
+async def _add_resource_attributes(request: Request, g=Depends(get_g)):
+    data = await request.json()
+    res_attrs = data.get('res_attrs', [data] if 'attr_id' in data else [])
+    res_attrs = [dict(ra, resource_type=ra.get('res_type'), resource_id=ra.get('res_id')) for ra in res_attrs]
+    added, errors = add_resource_attributes(g.hydra, res_attrs)
+    invalidate_attribute_scenarios()
+    return dict(res_attrs=added, errors=errors)
+
+
+@api.put('/resource_attributes', description='Update multiple resource attributes')
+async def _update_resource_attributes(request: Request, g=Depends(get_g)):
+    data = await request.json()
+    updated, errors = update_resource_attributes(g.hydra, data.get('res_attrs', []))
+    invalidate_attribute_scenarios()
+    return dict(updated=updated, errors=errors)
+
+
+@api.delete('/resource_attributes', description='Delete multiple resource attributes')
+def _delete_resource_attributes(ids: List[int], g=Depends(get_g)):
+    deleted, errors = delete_resource_attributes(g.hydra, ids)
+    invalidate_attribute_scenarios()
+    return dict(deleted=deleted, errors=errors)
+
+
+@api.post('/resource_types', description='Assign template types to resources, each with ref_key, ref_id and type_id')
+async def _add_resource_types(request: Request, template_id: int | None = None, g=Depends(get_g)):
+    data = await request.json()
+    template = template_id and get_cached_template(g.hydra, template_id)
+    assigned, errors = assign_resource_types(g.hydra, template, data.get('resource_types', []))
+    invalidate_attribute_scenarios()  # types come with their attributes
+    return dict(resource_types=assigned, errors=errors)
+
+
+@api.delete('/resource_types', description='Remove template types from resources')
+async def _delete_resource_types(request: Request, g=Depends(get_g)):
+    data = await request.json()
+    removed, errors = remove_resource_types(g.hydra, data.get('resource_types', []))
+    return dict(removed=removed, errors=errors)
+
+
+@api.delete('/nodes/{node_id}/resource_types/{type_id}')
+def _delete_node_resource_type(node_id: int, type_id: int, g=Depends(get_g)):
+    g.hydra.call('remove_type_from_resource', type_id=type_id, resource_type='NODE', resource_id=node_id)
+
+
+@api.delete('/links/{link_id}/resource_types/{type_id}')
+def _delete_link_resource_type(link_id: int, type_id: int, g=Depends(get_g)):
+    g.hydra.call('remove_type_from_resource', type_id=type_id, resource_type='LINK', resource_id=link_id)
+
+
+@api.put('/networks/{network_id}/public_map',
+         description='Publish a network to, or remove it from, the public map, as a background job')
+def _update_network_map(network_id: int, is_public: bool = False, g=Depends(get_g)):
+    network = g.hydra.call('get_network', network_id, include_resources=False, include_data=False,
+                           summary=True)
+    if not network['layout'].get('active_template_id'):
+        raise HTTPException(500, 'The network has no active template')
+    job = start_job(g.db, 'update_network_map', g.current_user.id, g.source_id, hydra=g.hydra,
+                    params=dict(network_id=network_id, is_public=is_public))
+    return job.to_json()
+
+
 # # CORS-protected routes
 #
-# # @api0.route('/networks/{network_id}/public_map', methods=['PUT'])
-# # @login_required
-# # def update_networks_map(network_id):
-# #     is_public = request.args.get('is_public') == 'true'
-# #
-# #     endpoint_url = current_app.config['MAPBOX_UPDATE_ENDPOINT']
-# #     dataset_id = current_app.config['MAPBOX_DATASET_ID']
-# #     mapbox_creation_token = current_app.config['MAPBOX_CREATION_TOKEN']
-# #
-# #     network = g.hydra.call('get_network', network_id, include_resources=True, include_data=False,
-# #                           summary=True)
-# #     template_id = network['layout'].get('active_template_id')
-# #     if not template_id:
-# #         return '', 500
-# #     template = g.hydra.call('get_template', template_id)
-# #     update_network_on_mapbox(network, template, endpoint_url, dataset_id, mapbox_creation_token, is_public)
-# #     return '', 200
-# #
-# #
 # # @api0.route('/network/settings', methods=['PUT'])
 # # @login_required
 # # def _update_network_settings():
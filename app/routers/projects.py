@@ -9,6 +9,7 @@ from app.core.files import delete_all_network_files
 from app.core.users import get_dataurl_by_id
 from app.core.sharing import set_resource_permissions, share_resource
 from app.core.projects import prepare_project_for_client, prepare_projects_for_client, copy_project
+from app.core.jobs import start_job
 
 api = APIRouter(tags=['Projects'])
 
@@ -63,6 +64,14 @@ def add_project(data: schemas.Project, purpose: str = '', g=Depends(get_g)):
     return project
 
 
+@api.post('/projects/{project_id}/move', status_code=202,
+          description='Copy a project, with its networks and data, to another data source, as a background job')
+def _move_project(project_id: int, destination_id: int, g=Depends(get_g)):
+    job = start_job(g.db, 'move_project', g.current_user.id, g.source_id, hydra=g.hydra,
+                    params=dict(destination_id=destination_id, project_id=project_id))
+    return job.to_json()
+
+
 @api.get('/projects/count')
 def _get_projects_count(page: int = 1, search: str = '', g=Depends(get_g)):
     projects_count = g.hydra.call('get_public_projects_count', search=search) if page == 1 else None
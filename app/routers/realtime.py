@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+from fastapi import APIRouter, Depends, HTTPException, Request, WebSocket, WebSocketException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from app.deps import get_g, get_db
+from app.realtime import hub, network_room
+
+api = APIRouter(tags=['Realtime'])
+
+KEEPALIVE_SECONDS = 15
+
+
+def check_network(g, network_id):
+    network = g.hydra.call('get_network', network_id, summary=True, include_resources=False, include_data=False)
+    return 'error' not in network
+
+
+def messages(batch):
+    return [json.dumps({'event': message['event'], 'data': message['data']}, default=str) for message in batch]
+
+
+@api.websocket('/networks/{network_id}/live')
+async def _network_live(websocket: WebSocket, network_id: int, source_id: int = 1, db=Depends(get_db)):
+    """Model run progress and other updates for a network, as JSON messages of {event, data}"""
+
+    g = await run_in_threadpool(get_g, websocket, source_id=source_id, project_id=0, user='', scope='', public=False,
+                                api_key=websocket.headers.get('X-API-KEY'), db=db)
+    allowed = await run_in_threadpool(check_network, g, network_id)
+    db.close()  # don't hold a database connection for the life of the socket
+    if not allowed:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
+
+    await websocket.accept()
+    async with hub.subscription(network_room(source_id, network_id)) as updates:
+        # the client doesn't send anything, but receiving is how a disconnect is noticed
+        receiving = asyncio.ensure_future(websocket.receive())
+        batch = asyncio.ensure_future(updates.get())
+        try:
+            while True:
+                await asyncio.wait([receiving, batch], return_when=asyncio.FIRST_COMPLETED)
+                if receiving.done():
+                    if receiving.result()['type'] == 'websocket.disconnect':
+                        break
+                    receiving = asyncio.ensure_future(websocket.receive())
+                if batch.done():
+                    for message in messages(batch.result()):
+                        await websocket.send_text(message)
+                    batch = asyncio.ensure_future(updates.get())
+        finally:
+            receiving.cancel()
+            batch.cancel()
+
+
+@api.get('/networks/{network_id}/events')
+async def _network_events(request: Request, network_id: int, source_id: int = 1, g=Depends(get_g),
+                          db=Depends(get_db)):
+    """The same updates as /networks/{network_id}/live, as server-sent events"""
+
+    if not await run_in_threadpool(check_network, g, network_id):
+        raise HTTPException(404, 'Network not found')
+    db.close()
+
+    async def stream():
+        async with hub.subscription(network_room(source_id, network_id)) as updates:
+            while not await request.is_disconnected():
+                try:
+                    batch = await asyncio.wait_for(updates.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                for message in messages(batch):
+                    yield 'data: {}\n\n'.format(message)
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
@@ -3,6 +3,7 @@ from typing import List
 from app.deps import get_g
 from app.schemas import Scenario, ResourceGroupItem
 from app.core.scenarios import delete_data_scenario
+from app.core.attribute_scenarios import invalidate_attribute_scenarios
 
 api = APIRouter(prefix='/scenarios', tags=['Scenarios'])
 
@@ -18,6 +19,7 @@ def _post_scenarios(scenario: Scenario, g=Depends(get_g)) -> Scenario:
         new_scenario = g.hydra.call('update_scenario', new_scenario)
     else:
         new_scenario = g.hydra.call('add_scenario', network_id, scenario, return_summary=True)
+    invalidate_attribute_scenarios(network_id)
 
     return new_scenario
 
@@ -26,6 +28,7 @@ def _post_scenarios(scenario: Scenario, g=Depends(get_g)) -> Scenario:
 def _update_scenarios(scenarios: List[Scenario], g=Depends(get_g)):
     for scenario in scenarios:
         g.hydra.call('update_scenario', scenario)
+        invalidate_attribute_scenarios(scenario.network_id)
 
 
 @api.get('/{scenario_id}')
@@ -37,6 +40,7 @@ def _get_scenario(scenario_id: int, include_data: bool = False, g=Depends(get_g)
 @api.put('/{scenario_id}')
 def _update_scenario(scenario: Scenario, scenario_id: int, return_summary: bool = False, g=Depends(get_g)) -> Scenario:
     updated_scenario = g.hydra.call('update_scenario', scenario)
+    invalidate_attribute_scenarios(scenario.network_id)
     return updated_scenario
 
 
@@ -45,6 +49,7 @@ def _patch_scenario(scenario_id: int, updates: dict, g=Depends(get_g)):
     scenario = g.hydra.call('get_scenario', scenario_id)
     scenario.update(updates)
     scenario = g.hydra.call('update_scenario', scenario)
+    invalidate_attribute_scenarios(scenario.get('network_id'))
     return scenario
 
 
@@ -55,6 +60,7 @@ def _delete_scenario(scenario_id: int, scenario_class: str = 'input', g=Depends(
         result = delete_data_scenario(g.db, g.hydra, scenario_id, study_id)
     else:
         result = delete_data_scenario(g.db, g.hydra, scenario_id)
+    invalidate_attribute_scenarios()
 
 
 @api.post('/{scenario_id}/resource_group_items', status_code=201)
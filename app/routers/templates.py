@@ -4,7 +4,7 @@ import json
 from fastapi import APIRouter, Request, HTTPException, Response, Depends
 from app import schemas
 from app.deps import get_g
-from app.core.templates import add_template, clean_template, prepare_template_for_import
+from app.core.templates import add_template, clean_template, prepare_template_for_import, invalidate_cached_template
 
 ALLOWED_EXTENSIONS = ['.json']
 
@@ -97,6 +97,7 @@ def _get_template(template_id: int, g=Depends(get_g)):
 @api.put('/templates/{template_id}', response_model=schemas.Template)
 def _update_template(template: schemas.Template, template_id: int, g=Depends(get_g)):
     updated = g.hydra.call('update_template', template)
+    invalidate_cached_template(template_id)
     return updated
 
 
@@ -105,6 +106,7 @@ def patch_template(updates: object, template_id: int, g=Depends(get_g)):
     template = g.hydra.call('get_template', template_id)
     template.update(updates)
     result = g.hydra.call('update_template', template)
+    invalidate_cached_template(template_id)
     if 'faultcode' in result:
         raise HTTPException(405, 'Name already taken.')
     else:
@@ -114,6 +116,7 @@ def patch_template(updates: object, template_id: int, g=Depends(get_g)):
 @api.patch('/templates/{template_id}')
 def _delete_template(template_id: int, delete_types: bool = False, g=Depends(get_g)):
     resp = g.hydra.call('delete_template', template_id, delete_resourcetypes=delete_types)
+    invalidate_cached_template(template_id)
     if 'error' in resp:
         raise HTTPException(501, 'Could not delete types')
     else:
@@ -123,6 +126,7 @@ def _delete_template(template_id: int, delete_types: bool = False, g=Depends(get
 @api.post('/templatetypes', status_code=201)
 def _add_template_type(templatetype, g=Depends(get_g)):
     ttype = g.hydra.call('add_templatetype', templatetype)
+    invalidate_cached_template(templatetype.get('template_id'))
     return ttype
 
 
@@ -133,12 +137,14 @@ def _update_template_type(templatetype, template_type_id: int, g=Depends(get_g))
     for ta in templatetype.get('typeattrs', []):
         ta.pop('default_dataset', None)  # it's unclear why this is needed
     g.hydra.call('update_templatetype', templatetype)
+    invalidate_cached_template(templatetype.get('template_id'))
     return Response(204)
 
 
 @api.delete('/templatetypes/{template_type_id}')
 def _delete_templatetype(template_type_id, g=Depends(get_g)):
     g.hydra.call('delete_templatetype', template_type_id)
+    invalidate_cached_template()
     return Response(204)
 
 
@@ -1,28 +1,28 @@
 import requests
 from fastapi import APIRouter, Request, Depends, HTTPException, Response
-from app.deps import get_g
+from app.deps import get_g, get_async_db
 from app.core.utils import verify_password
 from app.core.security import update_password
-from app.core.users import get_user, get_user_settings, get_user_setting, save_user_settings, get_datausers, \
-    get_dataurl_by_id
+from app.core.users import get_user_async, get_user_settings_async, get_user_setting, get_user_setting_async, \
+    save_user_settings_async, get_datausers, get_dataurl_by_id
 
 NotAuthorizedException = HTTPException(403, 'You can only get your own settings')
 
 
-def add_or_update(db, user_id, key, new_setting):
-    all_settings = get_user_settings(db, user_id)
+async def add_or_update(db, user_id, key, new_setting):
+    all_settings = await get_user_settings_async(db, user_id)
     all_settings.update({key: new_setting})
-    save_user_settings(db, user_id, all_settings)
+    await save_user_settings_async(db, user_id, all_settings)
 
 
 api = APIRouter(prefix='/users', tags=['Users'])
 
 
 @api.get('/{user_id}')
-async def _get_users(user_id: int, g=Depends(get_g)):
+async def _get_users(user_id: int, g=Depends(get_g), db=Depends(get_async_db)):
     if user_id != g.current_user.id:
         raise HTTPException(500, 'You cannot get other users.')
-    user = get_user(g.db, user_id)
+    user = await get_user_async(db, user_id)
     return user.to_json(include_id=False)
 
 
@@ -56,28 +56,28 @@ def _get_user_setting(user_id, key, g=Depends(get_g)):
 
 
 @api.post('/{user_id}/setting/{key}', status_code=201)
-async def _add_user_setting(user_id: int, key: str, new_setting, g=Depends(get_g)):
-    user_setting = get_user_setting(g.db, user_id, key)
+async def _add_user_setting(user_id: int, key: str, new_setting, g=Depends(get_g), db=Depends(get_async_db)):
+    user_setting = await get_user_setting_async(db, user_id, key)
     if user_setting is not None:
         raise HTTPException(status_code=405, detail='Setting already exists. Try PUT instead.')
 
-    add_or_update(g.db, user_id, key, new_setting)
+    await add_or_update(db, user_id, key, new_setting)
 
 
 @api.put('/{user_id}/setting/{key}', status_code=201)
-async def _update_user_setting(user_id, key, updated_setting, g=Depends(get_g)):
-    user_setting = get_user_setting(g.db, user_id, key)
+async def _update_user_setting(user_id, key, updated_setting, g=Depends(get_g), db=Depends(get_async_db)):
+    user_setting = await get_user_setting_async(db, user_id, key)
     if user_setting is None:
         raise HTTPException(status_code=405, detail='Setting does not exist yet')
 
-    add_or_update(g.db, user_id, key, updated_setting)
+    await add_or_update(db, user_id, key, updated_setting)
 
 
 @api.delete('/{user_id}/setting/{key}', status_code=201)
-async def _delete_user_setting(user_id, key, g=Depends(get_g)):
-    all_settings = get_user_settings(g.db, user_id)
+async def _delete_user_setting(user_id, key, g=Depends(get_g), db=Depends(get_async_db)):
+    all_settings = await get_user_settings_async(db, user_id)
     all_settings.pop(key, None)
-    save_user_settings(g.db, user_id, all_settings)
+    await save_user_settings_async(db, user_id, all_settings)
 
     return {}
 
@@ -90,23 +90,23 @@ def _get_user_settings(user_id: int, g=Depends(get_g)):
 
 
 @api.put('/{user_id}/settings')
-async def _update_user_settings(request: Request, user_id: int, g=Depends(get_g)):
+async def _update_user_settings(request: Request, user_id: int, g=Depends(get_g), db=Depends(get_async_db)):
     if g.current_user.id != user_id:
         raise NotAuthorizedException
     new_settings = await request.json()
     settings = g.current_user.get_settings()
     settings.update(new_settings)
 
-    save_user_settings(g.db, user_id, settings)
+    await save_user_settings_async(db, user_id, settings)
 
     return {}
 
 
 @api.put('/{user_id}/password')
-async def _change_password(request: Request, g=Depends(get_g)):
+async def _change_password(request: Request, g=Depends(get_g), db=Depends(get_async_db)):
     data = await request.json()
     password = data['password']
-    user = get_user(g.db, g.current_user.id)
+    user = await get_user_async(db, g.current_user.id)
     if not verify_password(password, user.password):
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
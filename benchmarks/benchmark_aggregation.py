@@ -0,0 +1,98 @@
+"""Latency benchmark for results aggregation on a large synthetic long-format results frame.
+
+Compares the aggregation engine with the previous approach of grouping on the raw columns, which parses every date
+string and builds year/month/day columns to resample.
+
+Run with: python -m benchmarks.benchmark_aggregation [n_resources] [n_days] [n_blocks]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.core.aggregation import aggregate
+
+AGGS = {
+    'time filter': {'range': {'mode': 'custom', 'start': '2001-01-01', 'end': '2005-12-31'}},
+    'space sum': {'space': {'function': 'sum'}},
+    'monthly mean': {'time': {'function': 'mean', 'step': 'month'}},
+    'yearly p90': {'time': {'function': 'p90', 'step': 'year'}},
+    'space + month sum': {'space': {'function': 'sum'}, 'time': {'function': 'sum', 'step': 'month'}},
+}
+
+
+def make_results(n_resources=100, n_days=3650, n_blocks=3):
+    dates = pd.date_range('2000-01-01', periods=n_days, freq='D').strftime('%Y-%m-%d')
+    n = n_resources * n_days * n_blocks
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({
+        'scenario_id': 1,
+        'resource_key': np.repeat(['node/{}'.format(i) for i in range(n_resources)], n_days * n_blocks),
+        'attr_id': 7,
+        'date': np.tile(np.repeat(dates, n_blocks), n_resources),
+        'block': np.tile(np.arange(n_blocks), n_resources * n_days),
+        'value': rng.random(n),
+    })
+    return data.set_index([c for c in data.columns if c != 'value'])
+
+
+def legacy_aggregate(data, agg):
+    """The previous aggregate_data, extended with percentiles so that each case can be compared"""
+    idx_names = list(data.index.names)
+    data = data.reset_index()
+    data['date'] = pd.to_datetime(data['date'])
+
+    date_range = agg.get('range', {})
+    if date_range.get('mode') == 'custom':
+        data = data.loc[(data['date'] >= date_range['start']) & (data['date'] <= date_range['end'])]
+
+    f = agg.get('space', {}).get('function')
+    if f:
+        idx_names.remove('resource_key')
+        data = data.groupby(idx_names).agg(f).reset_index()
+
+    f = agg.get('time', {}).get('function')
+    step = agg.get('time', {}).get('step')
+    if step:
+        if f.startswith('p'):
+            q = float(f[1:]) / 100
+            f = lambda s: s.quantile(q)
+        idx_names.remove('date')
+        data['year'] = data['date'].dt.year
+        time_group = ['year']
+        if step == 'month':
+            data['month'] = data['date'].dt.month
+            data['day'] = 1
+            time_group += ['month', 'day']
+        del data['date']
+        data = data.groupby(idx_names + time_group).agg(f).reset_index()
+        if step == 'month':
+            data['date'] = pd.to_datetime(data[time_group])
+            data.drop(columns=time_group, inplace=True)
+
+    new_cols = list(data.columns)
+    new_cols.remove('value')
+    data.set_index(new_cols, inplace=True)
+    return data
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main(n_resources=100, n_days=3650, n_blocks=3):
+    data = make_results(n_resources, n_days, n_blocks)
+    print('{:,} rows ({} resources x {} days x {} blocks)'.format(len(data), n_resources, n_days, n_blocks))
+    print('{:20} {:>10} {:>10} {:>8}'.format('aggregation', 'legacy ms', 'engine ms', 'speedup'))
+    for name, agg in AGGS.items():
+        legacy, legacy_ms = timed(legacy_aggregate, data, agg)
+        result, engine_ms = timed(aggregate, data, agg)
+        assert len(result) == len(legacy), name
+        print('{:20} {:10.0f} {:10.0f} {:7.1f}x'.format(name, legacy_ms, engine_ms, legacy_ms / engine_ms))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,108 @@
+"""Concurrency benchmark for async routes using the metadata database: sync repository calls made on the event loop
+(as async routes did), the same calls in worker threads, and the async engine.
+
+Each simulated request loads a user and their settings. Besides throughput, the event loop's worst stall is reported,
+since that delays every other request on the worker.
+
+Run with: python -m benchmarks.benchmark_async_db [n_requests] [concurrency] [database_uri]
+"""
+import asyncio
+import pathlib
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base, ASYNC_DRIVERS
+from app.models import User
+from app.core.users import get_user, get_user_settings, get_user_async, get_user_settings_async
+
+N_USERS = 100
+
+
+async def blocking_request(Session, user_id):
+    db = Session()
+    try:
+        get_user(db, user_id)
+        return get_user_settings(db, user_id)
+    finally:
+        db.close()
+
+
+async def threaded_request(Session, user_id):
+    db = Session()
+    try:
+        await get_user_async(db, user_id)
+        return await get_user_settings_async(db, user_id)
+    finally:
+        db.close()
+
+
+async def async_request(AsyncSession, user_id):
+    async with AsyncSession() as db:
+        await get_user_async(db, user_id)
+        return await get_user_settings_async(db, user_id)
+
+
+async def run(request, Session, n_requests, concurrency):
+    limit = asyncio.Semaphore(concurrency)
+    stalls = []
+    done = asyncio.Event()
+
+    async def heartbeat():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stalls.append(time.perf_counter() - start - 0.001)
+
+    async def limited(i):
+        async with limit:
+            return await request(Session, i % N_USERS + 1)
+
+    beat = asyncio.create_task(heartbeat())
+    start = time.perf_counter()
+    await asyncio.gather(*[limited(i) for i in range(n_requests)])
+    elapsed = time.perf_counter() - start
+    done.set()
+    await beat
+    return n_requests / elapsed, max(stalls) * 1000
+
+
+def main(n_requests=2000, concurrency=50, database_uri=None):
+    if not database_uri:
+        database_uri = 'sqlite:///{}'.format(pathlib.Path(tempfile.mkdtemp()) / 'benchmark.sqlite')
+    flavor = database_uri.split(':')[0]
+    pool_options = {} if flavor == 'sqlite' else dict(pool_size=concurrency, max_overflow=0)
+    engine = create_engine(database_uri, **pool_options)
+    async_engine = create_async_engine(database_uri.replace(flavor, ASYNC_DRIVERS[flavor], 1), **pool_options)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    AsyncSession = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+    Base.metadata.create_all(engine, tables=[User.__table__])
+    db = Session()
+    if not db.query(User).count():
+        db.add_all([User(email='user{}@example.com'.format(i), settings='{"theme": "dark"}') for i in range(N_USERS)])
+        db.commit()
+    db.close()
+
+    async def compare():
+        for name, request, factory in [
+            ('sync, on the event loop', blocking_request, Session),
+            ('sync, in worker threads', threaded_request, Session),
+            ('async engine', async_request, AsyncSession),
+        ]:
+            rate, stall = await run(request, factory, n_requests, concurrency)
+            print('{:28} {:12.0f} {:16.1f}'.format(name, rate, stall))
+        await async_engine.dispose()
+
+    print('{:,} requests, {} at a time, on {}'.format(n_requests, concurrency, flavor))
+    print('{:28} {:>12} {:>16}'.format('path', 'requests/s', 'max loop stall ms'))
+    asyncio.run(compare())
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(arg) for arg in args[:2]], *args[2:])
@@ -0,0 +1,79 @@
+"""Size and latency benchmark for /networks/{id}/attribute_scenarios on a large synthetic network.
+
+Run with: python -m benchmarks.benchmark_attribute_scenarios [n_resources] [n_attrs] [n_scenarios]
+"""
+import json
+import sys
+import time
+
+from app.core.attribute_scenarios import get_attribute_scenarios, expand_attribute_scenarios
+
+
+def make_template(n_types=10, n_attrs=20):
+    return {
+        'id': 1,
+        'templatetypes': [
+            {
+                'id': t + 1,
+                'name': 'Type {}'.format(t + 1),
+                'resource_type': 'NODE' if t % 2 else 'LINK',
+                'typeattrs': [
+                    {'attr_id': 1000 * (t + 1) + a, 'attr_is_var': 'Y' if a % 4 == 0 else 'N',
+                     'attr': {'name': 'Attribute {}'.format(a)}}
+                    for a in range(n_attrs)
+                ]
+            }
+            for t in range(n_types)
+        ]
+    }
+
+
+def make_network(template, n_resources=20000, n_scenarios=50):
+    ttypes = template['templatetypes']
+    ra_id = 0
+
+    def resource(i, tt):
+        nonlocal ra_id
+        attributes = []
+        for ta in tt['typeattrs']:
+            ra_id += 1
+            attributes.append({'id': ra_id, 'attr_id': ta['attr_id']})
+        return {'id': i + 1, 'types': [{'id': tt['id'], 'template_id': template['id']}], 'attributes': attributes}
+
+    nodes = [resource(i, ttypes[(2 * i + 1) % len(ttypes)]) for i in range(n_resources // 2)]
+    links = [resource(i, ttypes[(2 * i) % len(ttypes)]) for i in range(n_resources // 2)]
+    scenarios = [{'id': s + 1, 'name': 'Scenario {}'.format(s + 1), 'layout': {'class': 'option' if s else 'baseline'}}
+                 for s in range(n_scenarios)]
+    return {'id': 1, 'nodes': nodes, 'links': links, 'scenarios': scenarios}
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main(n_resources=20000, n_attrs=20, n_scenarios=50):
+    template = make_template(n_attrs=n_attrs)
+    network = make_network(template, n_resources=n_resources, n_scenarios=n_scenarios)
+
+    compact, first_ms = timed(get_attribute_scenarios, network, template)
+    _, cached_ms = timed(get_attribute_scenarios, network, template)
+    network['nodes'][0]['attributes'].pop()
+    _, edited_ms = timed(get_attribute_scenarios, network, template)
+    expanded, expand_ms = timed(expand_attribute_scenarios, compact)
+
+    compact_size = len(json.dumps(compact))
+    expanded_size = len(json.dumps(expanded))
+
+    print('{} resources, {} attributes per type, {} scenarios'.format(n_resources, n_attrs, n_scenarios))
+    print('first build:       {:8.1f} ms'.format(first_ms))
+    print('unchanged network: {:8.1f} ms'.format(cached_ms))
+    print('one resource edit: {:8.1f} ms'.format(edited_ms))
+    print('expand (legacy):   {:8.1f} ms'.format(expand_ms))
+    print('compact size:      {:8.1f} MB'.format(compact_size / 1e6))
+    print('expanded size:     {:8.1f} MB ({:.0f}x)'.format(expanded_size / 1e6, expanded_size / compact_size))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
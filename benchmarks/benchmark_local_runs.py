@@ -0,0 +1,86 @@
+"""Load test of the model run lifecycle on one machine: runs are queued with the run scheduler, started on the local
+runner as child processes, report progress into the ping buffer, and free their slot for the next run as they end.
+
+Several users submit ensembles at once. Besides throughput, the longest any run waited to start is reported for each
+user, which shows whether the queue is fair.
+
+Run with: python -m benchmarks.benchmark_local_runs [n_runs] [n_users] [workers] [steps]
+"""
+import sys
+import time
+from collections import defaultdict
+from threading import Event, Lock
+
+from app.core.ProcessState import ProcessState
+from app.core.ping_buffer import PingBuffer
+from app.core.run_scheduler import RunScheduler, MemoryQueue
+from app.core.runners.local import LocalRunner
+
+MODEL = '''
+import json, sys
+n = int(sys.argv[1])
+for i in range(n):
+    print(json.dumps({"progress": 100 * (i + 1) // n}), flush=True)
+'''
+
+ENDED = [ProcessState.FINISHED, ProcessState.ERROR, ProcessState.CANCELED]
+
+
+def main(n_runs=200, n_users=4, workers=8, steps=100):
+    n_runs = n_users * (n_runs // n_users)
+    written = []
+    pings = PingBuffer(written.extend, interval=0.5)
+    submitted = {}
+    started = {}
+    ended = Event()
+    lock = Lock()
+    ends = []
+
+    def report(run, status, data):
+        if status == ProcessState.STARTED:
+            started[run.sid] = time.perf_counter()
+        if status in ENDED:
+            pings.take(run.sid)
+            written.append(dict(data, sid=run.sid, status=status))
+            scheduler.release([run.sid])
+            with lock:
+                ends.append(status)
+                if len(ends) == n_runs:
+                    ended.set()
+        else:
+            pings.add(run.sid, status, **data)
+
+    runner = LocalRunner(report, max_workers=workers, progress_interval=0.1)
+
+    def send(runs):
+        for run in runs:
+            runner.start(run.sid, [sys.executable, '-c', MODEL, str(steps)], info=run.payload)
+
+    scheduler = RunScheduler(MemoryQueue(), send, user_limit=workers // 2 or 1, model_limit=workers)
+
+    start = time.perf_counter()
+    for user_id in range(n_users):
+        runs = [dict(sid='{}-{}'.format(user_id, i), user_id=user_id, model_id=1, payload={})
+                for i in range(n_runs // n_users)]
+        for run in runs:
+            submitted[run['sid']] = time.perf_counter()
+        scheduler.submit(runs)
+    ended.wait()
+    elapsed = time.perf_counter() - start
+    pings.flush()
+
+    waits = defaultdict(list)
+    for sid, started_at in started.items():
+        waits[sid.split('-')[0]].append(started_at - submitted[sid])
+
+    print('{} runs of {} steps from {} users, {} at a time'.format(n_runs, steps, n_users, workers))
+    print('{:.1f} runs/s, {} finished, {} pings written'.format(n_runs / elapsed, ends.count(ProcessState.FINISHED),
+                                                                  len(written)))
+    print('ping buffer: {}'.format(pings.stats()))
+    print('{:>6} {:>18}'.format('user', 'longest wait s'))
+    for user, user_waits in sorted(waits.items()):
+        print('{:>6} {:18.2f}'.format(user, max(user_waits)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,69 @@
+"""Latency benchmark for annual and basin-wide results views, answered from rollups versus daily data.
+
+Run with: python -m benchmarks.benchmark_rollups [n_resources] [n_years] [n_scenarios]
+"""
+import pathlib
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from app import config
+from app.core.aggregation import aggregate
+from app.core.cubes import get_cube
+from app.core.rollups import query_rollup
+
+AGGS = {
+    'annual mean': {'time': {'function': 'mean', 'step': 'year'}},
+    'monthly sum': {'time': {'function': 'sum', 'step': 'month'}},
+    'basin-wide total': {'space': {'function': 'sum'}},
+    'basin-wide annual': {'space': {'function': 'sum'}, 'time': {'function': 'mean', 'step': 'year'}},
+}
+
+
+def write_results(folder, n_resources, n_years):
+    dates = pd.date_range('2000-01-01', periods=365 * n_years, freq='D').strftime('%Y-%m-%d')
+    rng = np.random.default_rng(0)
+    for node in range(n_resources):
+        path = folder / '1' / 'node' / 'Reservoir' / str(node)
+        path.mkdir(parents=True)
+        pd.DataFrame({'value': rng.random(len(dates))}, index=pd.Index(dates, name='date')).to_csv(path / '1.csv')
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main(n_resources=200, n_years=20, n_scenarios=24):
+    tmp = pathlib.Path(tempfile.mkdtemp())
+    config.RESULTS_LOCAL_DIR = str(tmp / 'results')
+    config.RESULTS_CUBE_DIR = str(tmp / 'cubes')
+    write_results(tmp / 'results' / 'bucket' / 'results', n_resources, n_years)
+    _, build_ms = timed(get_cube, 'bucket', 'results')
+    cube = get_cube('bucket', 'results')
+
+    def from_daily(agg):
+        rows = cube.select()
+        data = pd.DataFrame({
+            'resource_key': np.asarray(cube.levels['resource'])[rows['resource']],
+            'date': np.asarray(cube.levels['date'])[rows['date']],
+            'value': rows['value'],
+        }).set_index(['resource_key', 'date'])
+        return aggregate(data, agg)
+
+    print('{} resources x {} years of daily data ({:,} rows), {} scenarios'.format(
+        n_resources, n_years, cube.meta['rows'], n_scenarios))
+    print('cube and rollup build: {:.0f} ms per scenario'.format(build_ms))
+    print('{:20} {:>10} {:>10}'.format('view', 'daily ms', 'rollup ms'))
+    for name, agg in AGGS.items():
+        _, daily_ms = timed(lambda: [from_daily(agg) for _ in range(n_scenarios)])
+        _, rollup_ms = timed(lambda: [query_rollup(cube, None, None, agg) for _ in range(n_scenarios)])
+        print('{:20} {:10.0f} {:10.1f}'.format(name, daily_ms, rollup_ms))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -2,7 +2,9 @@
 """
 Gunicorn with Uvicorn config to launch in Digital Ocean's App Platform.
 """
+from os import getenv
+
 bind = "0.0.0.0:8080"
-workers = 2
+workers = int(getenv("WEB_CONCURRENCY", 2))  # also used to size database pools
 # Uvicorn's Gunicorn worker class
 worker_class = "uvicorn.workers.UvicornWorker"
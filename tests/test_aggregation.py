@@ -0,0 +1,59 @@
+import pandas as pd
+import pytest
+
+from app.core.aggregation import aggregate, parse_function
+
+dates = pd.date_range('2000-01-01', '2001-12-31', freq='D').strftime('%Y-%m-%d')
+rows = [
+    {'scenario_id': 1, 'resource_key': 'node/{}'.format(r), 'attr_id': 5, 'date': d, 'block': 0, 'value': r + i}
+    for r in [1, 2, 3] for i, d in enumerate(dates)
+]
+idx_names = ['scenario_id', 'resource_key', 'attr_id', 'date', 'block']
+data = pd.DataFrame(rows).set_index(idx_names)
+expected = pd.DataFrame(rows)
+expected['date'] = pd.to_datetime(expected['date'])
+
+
+def test_parse_function():
+    assert parse_function('mean') == 'mean'
+    assert parse_function('p90') == 0.9
+    assert parse_function('p5') == 0.05
+    assert parse_function('mode') is None
+    assert parse_function(None) is None
+
+
+def test_time_filter():
+    result = aggregate(data, {'range': {'mode': 'custom', 'start': '2000-02-01', 'end': '2000-02-29'}})
+    assert list(result.index.names) == idx_names
+    assert len(result) == 3 * 29
+    dates = result.index.get_level_values('date')
+    assert dates.min() == pd.Timestamp('2000-02-01') and dates.max() == pd.Timestamp('2000-02-29')
+
+
+def test_space_sum():
+    result = aggregate(data, {'space': {'function': 'sum'}}).reset_index()
+    assert 'resource_key' not in result
+    assert len(result) == len(dates)
+    assert result['value'].tolist() == expected.groupby('date')['value'].sum().tolist()
+
+
+@pytest.mark.parametrize('f', ['sum', 'mean', 'p90'])
+def test_monthly(f):
+    result = aggregate(data, {'time': {'function': f, 'step': 'month'}}).reset_index()
+    assert list(result.columns) == idx_names + ['value']
+    assert len(result) == 3 * 24
+
+    grouped = expected.groupby(['resource_key', pd.Grouper(key='date', freq='MS')])['value']
+    grouped = grouped.quantile(0.9) if f == 'p90' else grouped.agg(f)
+    assert result['date'].tolist() == grouped.index.get_level_values('date').tolist()
+    assert result['value'].tolist() == pytest.approx(grouped.tolist())
+
+
+def test_space_then_yearly():
+    agg = {'space': {'function': 'sum'}, 'time': {'function': 'mean', 'step': 'year'}}
+    result = aggregate(data, agg).reset_index()
+    assert list(result.columns) == ['scenario_id', 'attr_id', 'Year', 'block', 'value']
+    assert result['Year'].tolist() == [2000, 2001]
+
+    daily = expected.groupby('date')['value'].sum()
+    assert result['value'].tolist() == pytest.approx(daily.groupby(daily.index.year).mean().tolist())
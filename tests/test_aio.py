@@ -0,0 +1,52 @@
+import asyncio
+
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session, declarative_base
+
+from app.core.aio import run_async
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = 'item'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+
+
+def add_item(db, name):
+    item = Item(name=name)
+    db.add(item)
+    db.commit()
+    return item
+
+
+def get_names(db):
+    return sorted(item.name for item in db.query(Item).all())
+
+
+add_item_async = run_async(add_item)
+get_names_async = run_async(get_names)
+
+
+def test_run_async(tmp_path):
+    path = tmp_path / 'aio.sqlite'
+    engine = create_engine('sqlite:///{}'.format(path))
+    Base.metadata.create_all(engine)
+    async_engine = create_async_engine('sqlite+aiosqlite:///{}'.format(path))
+
+    async def main():
+        # a regular session runs in a worker thread
+        with Session(engine) as db:
+            item = await add_item_async(db, 'sync')
+            assert item.id
+
+        # an async session runs on its async driver, and its results are usable after commit
+        async with AsyncSession(async_engine, expire_on_commit=False) as db:
+            item = await add_item_async(db, 'async')
+            assert item.name == 'async'
+            return await get_names_async(db)
+
+    assert asyncio.run(main()) == ['async', 'sync']
+    asyncio.run(async_engine.dispose())
@@ -0,0 +1,73 @@
+from app.core.attribute_scenarios import AttributeScenarioIndex, get_attribute_scenarios, \
+    expand_attribute_scenarios, get_template_attr_index, invalidate_attribute_scenarios, attribute_scenario_cache
+
+TEMPLATE = {'id': 1, 'templatetypes': [
+    {'id': 10, 'typeattrs': [
+        {'attr_id': 100, 'attr_is_var': 'N', 'attr': {'name': 'Storage'}},
+        {'attr_id': 101, 'attr_is_var': 'Y', 'attr': {'name': 'Release'}},  # an output
+    ]},
+    {'id': 20, 'typeattrs': [
+        {'attr_id': 100, 'attr_is_var': 'N', 'attr': {'name': 'Storage'}},
+        {'attr_id': 200, 'attr_is_var': 'N', 'attr': {'name': 'Flow'}},
+    ]},
+]}
+
+
+def make_network():
+    def resource(id, type_id, attr_ids):
+        return {'id': id, 'types': [{'id': type_id, 'template_id': 1}],
+                'attributes': [{'id': id * 10 + i, 'attr_id': attr_id} for i, attr_id in enumerate(attr_ids)]}
+
+    scenarios = [
+        {'id': 1, 'name': 'Baseline', 'layout': {'class': 'baseline'}},
+        {'id': 2, 'name': 'Option', 'layout': {'class': 'option'}},
+        {'id': 3, 'name': 'Results', 'layout': {'class': 'results'}},
+    ]
+    return {'id': 5, 'nodes': [resource(1, 10, [100, 101]), resource(2, 20, [200, 100])],
+            'links': [resource(3, 20, [200]), {'id': 4, 'types': [], 'attributes': []}], 'scenarios': scenarios}
+
+
+def test_template_index():
+    index = get_template_attr_index(TEMPLATE)
+    assert index['attrs'] == [{'id': 100, 'name': 'Storage'}, {'id': 200, 'name': 'Flow'}]
+    assert index['types'] == {10: {100: 0}, 20: {100: 0, 200: 1}}
+
+
+def test_index_updates_only_changed_resources():
+    network = make_network()
+    index = AttributeScenarioIndex(1, get_template_attr_index(TEMPLATE))
+    assert index.update(network) == 4
+    assert index.resources['nodes'] == {1: {'ids': [10], 'attrs': [0]}, 2: {'ids': [20, 21], 'attrs': [1, 0]}}
+    assert index.resources['links'] == {3: {'ids': [30], 'attrs': [1]}}  # link 4 has no type of the template
+
+    assert index.update(network) == 0
+
+    network['nodes'][0]['attributes'].append({'id': 12, 'attr_id': 100})
+    network['links'].pop()
+    assert index.update(network) == 2
+    assert index.resources['nodes'][1] == {'ids': [10, 12], 'attrs': [0, 0]}
+
+
+def test_compact_and_expanded():
+    attribute_scenario_cache.clear()
+    compact = get_attribute_scenarios(make_network(), TEMPLATE)
+    assert [s['name'] for s in compact['scenarios']] == ['Baseline', 'Option']
+    assert compact['nodes'][2] == {'ids': [20, 21], 'attrs': [1, 0]}
+
+    expanded = expand_attribute_scenarios(compact)
+    assert expanded['nodes'][2] == [
+        {'id': 20, 'name': 'Flow', 'scenarios': compact['scenarios']},
+        {'id': 21, 'name': 'Storage', 'scenarios': compact['scenarios']},
+    ]
+    assert expanded['links'] == {3: [{'id': 30, 'name': 'Flow', 'scenarios': compact['scenarios']}]}
+
+
+def test_invalidation():
+    attribute_scenario_cache.clear()
+    get_attribute_scenarios(make_network(), TEMPLATE)
+    assert len(attribute_scenario_cache) == 1
+
+    invalidate_attribute_scenarios(6)
+    assert len(attribute_scenario_cache) == 1
+    invalidate_attribute_scenarios(5)
+    assert len(attribute_scenario_cache) == 0
@@ -0,0 +1,96 @@
+import json
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app.models import User, DataUser, DataUrl, Study
+from app.core import auth_cache
+from app.core.auth_cache import get_cached_user, cache_user, get_or_set, invalidate_credential, invalidate_user, \
+    invalidate_studies, CachedDataUser, CachedStudy
+from app.core.users import get_datauser
+from app.core.studies import get_study
+
+
+@pytest.fixture
+def Session():
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False})
+    Base.metadata.create_all(engine, tables=[User.__table__, DataUrl.__table__, DataUser.__table__, Study.__table__])
+    Session = sessionmaker(bind=engine, autoflush=False)
+    db = Session()
+    for id, email in [(1, 'alice@example.com'), (2, 'bob@example.com')]:
+        user = User(email=email, username=email.split('@')[0])
+        user.id = id
+        user.settings = json.dumps({'theme': 'dark'})
+        db.add(user)
+        db.add(DataUser(id=id, user_id=id, dataurl_id=1, userid=10 + id, username=user.username))
+    db.add(DataUrl(id=1, url='https://data.example.com'))
+    db.add(Study(id=5, created_by=1, dataurl_id=1, project_id=7, settings='{}'))
+    db.commit()
+    db.close()
+    return Session
+
+
+def setup_function():
+    auth_cache.auth_cache.clear()
+
+
+def test_cached_credentials(Session):
+    db = Session()
+    user = cache_user('token', 'abc', db.get(User, 1), expires_at=time.time() + 60)
+    db.close()
+
+    assert get_cached_user('token', 'abc') is user
+    assert get_cached_user('key', 'abc') is None
+
+    invalidate_credential('token', 'abc')
+    assert get_cached_user('token', 'abc') is None
+
+    # an expired token is not served from the cache
+    db = Session()
+    cache_user('token', 'old', db.get(User, 1), expires_at=time.time() - 1)
+    db.close()
+    assert get_cached_user('token', 'old') is None
+
+
+def test_snapshots_outlive_the_session(Session):
+    db = Session()
+    user = cache_user('token', 'abc', db.get(User, 1))
+    datauser = get_or_set(('datauser', 1, 1), lambda: get_datauser(db, user_id=1, dataurl_id=1), CachedDataUser)
+    study = get_or_set(('study', 1, 1, 7), lambda: get_study(db, user_id=1, dataurl_id=1, project_id=7), CachedStudy)
+    db.commit()  # expiring the session's objects, as get_db does at the end of a request
+    db.close()
+
+    # the next request, in another session (and maybe another thread), reads the cached copies
+    user = get_cached_user('token', 'abc')
+    assert (user.id, user.email, user.get('theme')) == (1, 'alice@example.com', 'dark')
+    datauser = get_or_set(('datauser', 1, 1), lambda: pytest.fail('not cached'), CachedDataUser)
+    assert (datauser.dataurl_id, datauser.data_url, datauser.userid) == (1, 'https://data.example.com', 11)
+    assert get_or_set(('study', 1, 1, 7), lambda: pytest.fail('not cached'), CachedStudy).id == study.id == 5
+
+    with pytest.raises(AttributeError):
+        user.email = 'mallory@example.com'
+
+
+def test_invalidate_user(Session):
+    db = Session()
+    alice, bob = db.get(User, 1), db.get(User, 2)
+    cache_user('token', 'a', alice)
+    cache_user('key', 'a', alice)
+    bob = cache_user('token', 'b', bob)
+    for user_id in [1, 2]:
+        get_or_set(('datauser', user_id, 1), lambda: get_datauser(db, user_id=user_id, dataurl_id=1), CachedDataUser)
+    get_or_set(('study', 1, 1, 7), lambda: get_study(db, user_id=1, dataurl_id=1, project_id=7), CachedStudy)
+
+    invalidate_user(1)
+    assert get_cached_user('token', 'a') is None
+    assert get_cached_user('key', 'a') is None
+    assert get_cached_user('token', 'b') is bob
+    assert get_or_set(('datauser', 1, 1), lambda: db.get(DataUser, 1), CachedDataUser).id == 1
+    assert get_or_set(('datauser', 2, 1), lambda: pytest.fail('not cached'), CachedDataUser).userid == 12
+
+    invalidate_studies()
+    assert get_or_set(('study', 1, 1, 7), lambda: None, CachedStudy) is None
+    db.close()
@@ -0,0 +1,84 @@
+from app.core.bulk import add_resources, update_resources, update_network_resources, delete_resources
+
+TEMPLATE = {'id': 7, 'templatetypes': [
+    {'id': 1, 'name': 'Reservoir', 'resource_type': 'NODE'},
+    {'id': 2, 'name': 'River', 'resource_type': 'LINK'},
+]}
+
+
+class FakeHydra(object):
+    """Fails batch calls (unless batch_ok), and single calls for a node named 'bad' or link 13"""
+
+    def __init__(self, batch_ok=False):
+        self.batch_ok = batch_ok
+        self.calls = []
+        self.next_id = 100
+
+    def call(self, func, *args, **kwargs):
+        self.calls.append(func)
+        if func == 'get_network':
+            return {'id': 1, 'name': 'Basin'}
+        if func in ['add_nodes', 'update_network']:
+            if not self.batch_ok:
+                return {'error': 'Batch failed'}
+            return [self.saved(value) for value in args[-1]]
+        value = next((arg for arg in args if isinstance(arg, dict)), args[0])
+        if isinstance(value, dict) and value.get('name') == 'bad' or value == 13:
+            return {'error': 'Item failed'}
+        return self.saved(value) if isinstance(value, dict) else {}
+
+    def saved(self, value):
+        self.next_id += 1
+        return dict(value, id=value.get('id') or self.next_id)
+
+
+def node(name, type_id=1, id=None):
+    return {'id': id, 'name': name, 'types': [{'id': type_id, 'template_id': 7}]}
+
+
+def test_add_in_one_batch():
+    hydra = FakeHydra(batch_ok=True)
+    added, errors = add_resources(hydra, 1, TEMPLATE, 'NODE', [node('a'), node('b')])
+    assert hydra.calls == ['add_nodes']
+    assert [n['name'] for n in added] == ['a', 'b'] and errors == []
+
+
+def test_add_falls_back_to_items():
+    hydra = FakeHydra()
+    nodes = [node('a'), node('bad'), node(''), node('c', type_id=2)]
+    added, errors = add_resources(hydra, 1, TEMPLATE, 'NODE', nodes)
+
+    # invalid nodes are not sent; the batch fails, so the others are added one at a time to find the failure
+    assert hydra.calls == ['add_nodes', 'add_node', 'add_node']
+    assert [n['name'] for n in added] == ['a']
+    assert sorted((e['index'], e['error']) for e in errors) == [
+        (1, 'Item failed'), (2, 'Missing name'), (3, 'Template type River is a LINK type')
+    ]
+
+
+def test_errors_refer_to_request_positions():
+    # nodes picked from a request in which they were the 2nd, 5th and 6th items
+    hydra = FakeHydra()
+    nodes = [node('a', id=1), node('bad', id=2), node('', id=3)]
+    updated, errors = update_resources(hydra, 1, TEMPLATE, 'NODE', nodes, indexes=[1, 4, 5])
+    assert hydra.calls == ['get_network', 'update_network', 'update_node', 'update_node']
+    assert [n['id'] for n in updated] == [1]
+    assert sorted(e['index'] for e in errors) == [4, 5]
+
+    added, errors = add_resources(hydra, 1, TEMPLATE, 'NODE', [node('bad')], indexes=[3])
+    assert errors == [{'index': 3, 'id': None, 'error': 'Item failed'}]
+
+
+def test_delete():
+    deleted, errors = delete_resources(FakeHydra(), 'LINK', [11, 12, 13])
+    assert deleted == [11, 12]
+    assert errors == [{'index': 2, 'id': 13, 'error': 'Item failed'}]
+
+
+def test_update_in_each_network():
+    hydra = FakeHydra()
+    nodes = [dict(node('a', id=1), network_id=2), node('b', id=2), dict(node('', id=3), network_id=2)]
+    updated, errors = update_network_resources(hydra, 1, TEMPLATE, 'NODE', nodes)
+    assert hydra.calls == ['get_network', 'update_network', 'update_node'] * 2
+    assert sorted(n['id'] for n in updated) == [1, 2]
+    assert errors == [{'index': 2, 'id': 3, 'error': 'Missing name'}]
@@ -0,0 +1,165 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app import config
+from app.core.aggregation import aggregate
+from app.core.cubes import get_cube, build_cube, cube_path, cube_cache
+from app.core.rollups import query_rollup
+
+BUCKET = 'bucket'
+PREFIX = 'network-1/results/run/2024-01-01/10'
+dates = pd.date_range('2000-01-01', periods=365, freq='D').strftime('%Y-%m-%d')
+
+
+@pytest.fixture
+def results(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'RESULTS_LOCAL_DIR', str(tmp_path / 'results'), raising=False)
+    monkeypatch.setattr(config, 'RESULTS_CUBE_DIR', str(tmp_path / 'cubes'), raising=False)
+    cube_cache.clear()
+
+    folder = tmp_path / 'results' / BUCKET / PREFIX
+    folder.mkdir(parents=True)
+    scenario_key = pd.DataFrame({'Demand': [1.0, 2.0]}, index=pd.Index([1, 2], name='subscenario'))
+    scenario_key.to_csv(folder / 'scenario_key.csv')
+    for subscenario in [1, 2]:
+        for node in [1, 2, 3]:
+            for attr in [5, 6]:
+                ttype = 'Reservoir' if node < 3 else 'Demand'
+                path = folder / str(subscenario) / 'node' / ttype / str(node)
+                path.mkdir(parents=True, exist_ok=True)
+                values = subscenario * 1000 + node * 100 + attr + np.arange(len(dates)) / 1000
+                pd.DataFrame({'value': values}, index=pd.Index(dates, name='date')).to_csv(path / '{}.csv'.format(attr))
+    return folder
+
+
+def test_build_and_select(results):
+    cube = get_cube(BUCKET, PREFIX)
+    assert os.path.exists(cube_path(BUCKET, PREFIX))
+    assert cube.meta['rows'] == 2 * 3 * 2 * 365
+    assert dict(zip(cube.levels['subscenario'], cube.perturbations['Demand'])) == {'1': 1.0, '2': 2.0}
+
+    rows = cube.select(resources=['node/2'], attrs=['6'], start='2000-02-01', end='2000-02-29')
+    assert len(rows) == 2 * 29
+    assert set(np.asarray(cube.levels['resource'])[rows['resource']]) == {'node/2'}
+    assert set(np.asarray(cube.levels['attr'])[rows['attr']]) == {'6'}
+
+    assert cube.levels['date'][rows['date'].iloc[0]] == '2000-02-01'
+    assert rows['value'].iloc[0] == pytest.approx(1000 + 200 + 6 + 31 / 1000)
+
+    # an unknown resource selects nothing
+    assert len(cube.select(resources=['node/99'])) == 0
+
+
+def test_cube_is_built_once(results, monkeypatch):
+    get_cube(BUCKET, PREFIX)
+    cube_cache.clear()
+
+    def fail(*args, **kwargs):
+        raise AssertionError('cube rebuilt')
+
+    monkeypatch.setattr('app.core.cubes.build_cube', fail)
+    cube = get_cube(BUCKET, PREFIX)
+    assert len(cube.select()) == cube.meta['rows']
+
+
+def add_results(folder, subscenario):
+    path = folder / subscenario / 'network'
+    path.mkdir(parents=True)
+    pd.DataFrame({'value': np.ones(len(dates))}, index=pd.Index(dates, name='date')).to_csv(path / '7.csv')
+
+
+def test_cube_is_rebuilt_when_results_are_added(results, monkeypatch):
+    # a cube read while the version's runs are still writing their results
+    cube = get_cube(BUCKET, PREFIX)
+    add_results(results, '3')
+    assert get_cube(BUCKET, PREFIX) is cube
+
+    # is rebuilt on access, once it is due to be checked again
+    monkeypatch.setattr(config, 'RESULTS_CUBE_RECHECK', 0)
+    partial = get_cube(BUCKET, PREFIX)
+    assert partial.meta['rows'] == (2 * 3 * 2 + 1) * 365
+    assert len(cube.select()) == cube.meta['rows']  # reads of the cube before are unchanged
+
+    # once every run has ended, the build job refreshes it
+    add_results(results, '4')
+    cube = get_cube(BUCKET, PREFIX, refresh=True)
+    assert cube.meta['rows'] == (2 * 3 * 2 + 2) * 365
+    assert len(cube.select(resources=['network'])) == 2 * 365
+
+    monkeypatch.setattr('app.core.cubes.build_cube', lambda *args, **kwargs: pytest.fail('cube rebuilt'))
+    assert get_cube(BUCKET, PREFIX, refresh=True) is cube
+
+    # and a complete cube isn't checked again
+    monkeypatch.setattr('app.core.cubes.list_result_files', lambda *args: pytest.fail('results listed'))
+    assert get_cube(BUCKET, PREFIX) is cube
+
+
+def test_cube_rebuilt_by_another_worker(results):
+    cube = get_cube(BUCKET, PREFIX)
+    add_results(results, '3')
+    build_cube(BUCKET, PREFIX, cube_path(BUCKET, PREFIX), complete=True)  # as another worker's build job would
+
+    assert len(cube.select()) == cube.meta['rows']
+    rebuilt = get_cube(BUCKET, PREFIX)
+    assert rebuilt is not cube
+    assert rebuilt.meta['rows'] == (2 * 3 * 2 + 1) * 365
+
+
+def aggregate_raw(cube, resources, agg):
+    """Aggregate the cube's raw rows with the aggregation engine, for comparison with rollups"""
+    rows = cube.select(resources=resources)
+    data = pd.DataFrame({
+        'subscenario': np.asarray(cube.levels['subscenario'])[rows['subscenario']],
+        'resource_key': np.asarray(cube.levels['resource'])[rows['resource']],
+        'attr_id': np.asarray(cube.levels['attr'])[rows['attr']],
+        'date': np.asarray(cube.levels['date'])[rows['date']],
+        'block': rows['block'],
+        'value': rows['value'],
+    })
+    data = data.set_index([c for c in data.columns if c != 'value'])
+    return aggregate(data, agg).reset_index()
+
+
+@pytest.mark.parametrize('agg, resources, rollup', [
+    ({'time': {'function': 'mean', 'step': 'month'}}, ['node/1', 'node/3'], 'month'),
+    ({'time': {'function': 'sum', 'step': 'year'}}, None, 'year'),
+    ({'space': {'function': 'sum'}}, ['node/1', 'node/2'], 'type'),
+    ({'space': {'function': 'mean'}, 'time': {'function': 'sum', 'step': 'month'}}, None, 'type_month'),
+    ({'space': {'function': 'sum'}, 'time': {'function': 'mean', 'step': 'year'}}, ['node/1', 'node/3'], 'year'),
+    ({'time': {'function': 'mean', 'step': 'month'},
+      'range': {'mode': 'custom', 'start': '2000-03-01', 'end': '2000-05-31'}}, None, 'month'),
+])
+def test_rollups_match_aggregation(results, monkeypatch, agg, resources, rollup):
+    cube = get_cube(BUCKET, PREFIX)
+    used = []
+    monkeypatch.setattr(cube, 'rollup', lambda name, rollup=cube.rollup: used.append(name) or rollup(name))
+
+    frame, time_index, time_name = query_rollup(cube, resources, None, agg)
+    assert used == [rollup]
+
+    expected = aggregate_raw(cube, resources, agg)
+    times = time_index.take(frame['time'].to_numpy())
+    frame[time_name] = times.year if time_name == 'Year' else times
+    frame['subscenario'] = np.asarray(cube.levels['subscenario'])[frame['subscenario']]
+    frame['attr_id'] = np.asarray(cube.levels['attr'])[frame['attr']]
+    keys = ['subscenario', 'attr_id', time_name, 'block']
+    if 'resource' in frame:
+        frame['resource_key'] = np.asarray(cube.levels['resource'])[frame['resource']]
+        keys.insert(1, 'resource_key')
+    actual = frame.set_index(keys)['value'].sort_index()
+    expected = expected.set_index(keys)['value'].sort_index()
+    assert actual.index.equals(expected.index)
+    assert actual.to_numpy() == pytest.approx(expected.to_numpy())
+
+
+@pytest.mark.parametrize('agg', [
+    {'space': {'function': 'p90'}},
+    {'space': {'function': 'sum'}},  # node/1 without node/2 is not all of the Reservoir type
+    {'time': {'function': 'mean', 'step': 'month'}, 'range': {'mode': 'custom', 'start': '2000-03-15'}},
+])
+def test_rollups_not_exact(results, agg):
+    cube = get_cube(BUCKET, PREFIX)
+    assert query_rollup(cube, ['node/1', 'node/3'], None, agg) is None
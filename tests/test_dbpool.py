@@ -0,0 +1,96 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from app.core.dbpool import InstrumentedQueuePool, instrument, pool_limits
+
+
+def test_pool_limits():
+    assert pool_limits(workers=2, threads=40, jobs=4) == (44, 11)
+    # a database limit is shared between the workers
+    assert pool_limits(workers=4, threads=40, jobs=4, max_connections=100) == (24, 0)
+    assert pool_limits(workers=2, threads=8, max_connections=100) == (8, 2)
+
+
+def test_pool_stats(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'pool.sqlite'), poolclass=InstrumentedQueuePool,
+                           pool_size=1, max_overflow=1, pool_timeout=0.1)
+    stats = instrument(engine, leak_seconds=0.05)
+
+    first = engine.connect()
+    second = engine.connect()
+    first.execute(text('select 1'))
+    assert stats.summary(engine.pool)['overflow'] == 1
+
+    # both connections are out, so a third checkout waits and times out
+    with pytest.raises(PoolTimeoutError):
+        engine.connect()
+
+    time.sleep(0.1)
+    summary = stats.summary(engine.pool)
+    assert summary['leaked'] == 2
+    second.close()
+    first.close()
+
+    summary = stats.summary(engine.pool)
+    assert summary['checkouts'] == 2
+    assert summary['timeouts'] == 1
+    assert summary['checked_out'] == 0
+    assert summary['leaked'] == 0
+    assert summary['peak_checked_out'] == 2
+    assert summary['peak_overflow'] == 1
+    assert summary['wait_ms']['max'] >= 100
+
+
+def test_cached_records_across_request_sessions(tmp_path, monkeypatch):
+    from types import SimpleNamespace
+    from sqlalchemy import event
+    from sqlalchemy.orm import sessionmaker
+
+    from app import deps
+    from app.database import Base
+    from app.models import User, DataUser, DataUrl, Study
+    from app.core.auth_cache import auth_cache
+    from app.core.utils import create_access_token
+
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'requests.sqlite'))
+    Base.metadata.create_all(engine, tables=[User.__table__, DataUrl.__table__, DataUser.__table__, Study.__table__])
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)  # expiring objects on commit
+    db = Session()
+    db.add(User(email='alice@example.com', username='alice'))
+    db.add(DataUrl(id=1, url='https://data.example.com'))
+    db.add(DataUser(user_id=1, dataurl_id=1, userid=11, username='alice'))
+    db.add(Study(created_by=1, dataurl_id=1, project_id=7))
+    db.commit()
+    db.close()
+
+    monkeypatch.setattr(deps, 'SessionLocal', Session)
+    monkeypatch.setattr(deps, 'HydraConnection', lambda **kwargs: SimpleNamespace(**kwargs))  # no connecting
+    auth_cache.clear()
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    token = create_access_token('alice@example.com')
+
+    def request():
+        """get_g as FastAPI would call it, in a request's own get_db session, returning g after the session ends"""
+        sessions = deps.get_db()
+        db = next(sessions)
+        connection = SimpleNamespace(cookies={'access_token': token}, headers={}, state=SimpleNamespace())
+        g = deps.get_g(connection, source_id=1, project_id=7, api_key=None, db=db)
+        with pytest.raises(StopIteration):
+            next(sessions)  # commits and closes the session
+        return g
+
+    first = request()
+    assert (first.current_user.email, first.datauser.data_url, first.study.project_id) == \
+           ('alice@example.com', 'https://data.example.com', 7)
+
+    # the next request gets the same records from the cache, without queries, after the first session has closed
+    del statements[:]
+    second = request()
+    assert not [statement for statement in statements if statement.lstrip().upper().startswith('SELECT')]
+    assert second.current_user.id == first.current_user.id == 1
+    assert (second.datauser.username, second.datauser.userid, second.study.id) == ('alice', 11, first.study.id)
+    assert second.hydra.user_id == 11
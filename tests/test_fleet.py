@@ -0,0 +1,243 @@
+import itertools
+
+from app.core.runners.fleet import Fleet, FLEET_TAG, IMAGE_TAG, RUN_TAG, IDLE_TAG, CLAIM_TAG
+
+
+class StubEC2(object):
+    """Enough of an EC2 client for the fleet, keeping instances in memory"""
+
+    def __init__(self, page_size=2):
+        self.instances = {}
+        self.calls = []
+        self.page_size = page_size
+        self._ids = itertools.count(1)
+
+    def run_instances(self, ImageId, InstanceType, MinCount, MaxCount, TagSpecifications, **kwargs):
+        self.calls.append('run_instances')
+        tags = {tag['Key']: tag['Value'] for tag in TagSpecifications[0]['Tags']}
+        instances = []
+        for _ in range(MaxCount):
+            instance_id = 'i-{}'.format(next(self._ids))
+            self.instances[instance_id] = dict(tags=dict(tags), image_id=ImageId, state='pending')
+            instances.append({'InstanceId': instance_id})
+        return {'Instances': instances}
+
+    def describe_instances(self, Filters, NextToken=None):
+        self.calls.append('describe_instances')
+        name = Filters[0]['Values'][0]
+        matching = [instance_id for instance_id, instance in self.instances.items()
+                    if instance['tags'].get(FLEET_TAG) == name and instance['state'] in Filters[1]['Values']]
+        start = int(NextToken or 0)
+        page = matching[start:start + self.page_size]
+        response = {'Reservations': [{'Instances': [self._describe(instance_id)]} for instance_id in page]}
+        if start + self.page_size < len(matching):
+            response['NextToken'] = str(start + self.page_size)
+        return response
+
+    def describe_instance_status(self, InstanceIds):
+        self.calls.append('describe_instance_status')
+        return {'InstanceStatuses': [{'InstanceId': instance_id, 'InstanceStatus': {'Status': 'ok'}}
+                                     for instance_id in InstanceIds]}
+
+    def create_tags(self, Resources, Tags):
+        self.calls.append('create_tags')
+        for instance_id in Resources:
+            self.instances[instance_id]['tags'].update({tag['Key']: tag['Value'] for tag in Tags})
+
+    def delete_tags(self, Resources, Tags):
+        self.calls.append('delete_tags')
+        for instance_id in Resources:
+            for tag in Tags:
+                self.instances[instance_id]['tags'].pop(tag['Key'], None)
+
+    def describe_tags(self, Filters):
+        self.calls.append('describe_tags')
+        return {'Tags': [{'ResourceId': instance_id, 'ResourceType': 'instance', 'Key': key, 'Value': value}
+                         for instance_id in Filters[0]['Values']
+                         for key, value in self.instances[instance_id]['tags'].items()]}
+
+    def terminate_instances(self, InstanceIds):
+        self.calls.append('terminate_instances')
+        for instance_id in InstanceIds:
+            self.instances[instance_id]['state'] = 'terminated'
+
+    def boot(self):
+        for instance in self.instances.values():
+            if instance['state'] == 'pending':
+                instance['state'] = 'running'
+
+    def _describe(self, instance_id):
+        instance = self.instances[instance_id]
+        return {
+            'InstanceId': instance_id,
+            'ImageId': instance['image_id'],
+            'State': {'Name': instance['state']},
+            'PublicIpAddress': '10.0.0.1' if instance['state'] == 'running' else None,
+            'Tags': [{'Key': key, 'Value': value} for key, value in instance['tags'].items()],
+        }
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def fleet(ec2, clock, **kwargs):
+    options = dict(max_size=3, idle_timeout=600, describe_ttl=10, reconcile_interval=0, claim_delay=0)
+    options.update(kwargs)
+    return Fleet(lambda: ec2, clock=clock, **options)
+
+
+def test_reuse():
+    ec2, clock = StubEC2(), Clock()
+    pool = fleet(ec2, clock)
+    first = pool.acquire('ami-a', 'run-1')
+    assert ec2.instances[first]['tags'][RUN_TAG] == 'run-1'
+    ec2.boot()
+    pool.release(first)
+    assert ec2.instances[first]['tags'][RUN_TAG] == ''
+    assert pool.acquire('ami-a', 'run-2') == first  # reused, not launched
+    assert pool.acquire('ami-b', 'run-3') != first  # another image gets its own
+    assert ec2.calls.count('run_instances') == 2
+    assert pool.stats()['reused'] == 1
+
+
+def test_pool_limit():
+    ec2, clock = StubEC2(), Clock()
+    pool = fleet(ec2, clock, max_size=2)
+    assert pool.acquire('ami-a', 'run-1')
+    assert pool.acquire('ami-a', 'run-2')
+    assert pool.acquire('ami-a', 'run-3') is None
+
+
+def test_describe_cache():
+    ec2, clock = StubEC2(page_size=2), Clock()
+    pool = fleet(ec2, clock, max_size=10)
+    for i in range(5):
+        pool.acquire('ami-a', 'run-{}'.format(i))
+    ec2.boot()
+    ec2.calls.clear()
+
+    for _ in range(10):
+        pool.workers()
+    assert ec2.calls == []  # answered from the cache, which includes this fleet's own launches
+
+    clock.now += 10
+    workers = pool.workers()
+    assert len(workers) == 5
+    assert all(worker.ready for worker in workers.values())
+    assert ec2.calls == ['describe_instances'] * 3 + ['describe_instance_status']  # paginated, statuses batched
+
+
+def test_idle_scale_down():
+    ec2, clock = StubEC2(), Clock()
+    pool = fleet(ec2, clock)
+    instances = [pool.acquire('ami-a', 'run-{}'.format(i)) for i in range(3)]
+    ec2.boot()
+    pool.release(instances[0])
+    clock.now += 300
+    pool.release(instances[1])
+
+    clock.now += 301  # the first has been idle past the timeout, the second not yet
+    assert pool.reconcile() == ({}, [instances[0]])
+    assert ec2.instances[instances[0]]['state'] == 'terminated'
+    assert ec2.calls.count('terminate_instances') == 1
+
+    clock.now += 300
+    assert pool.reconcile() == ({}, [instances[1]])
+    assert ec2.instances[instances[2]]['state'] == 'running'  # still busy
+
+
+def test_warm_pool():
+    ec2, clock = StubEC2(), Clock()
+    pool = fleet(ec2, clock, warm={'ami-a': 2})
+    assert pool.reconcile() == ({'ami-a': 2}, [])
+    assert ec2.calls.count('run_instances') == 1  # both in one call
+    ec2.boot()
+
+    # warm instances are kept however long they are idle
+    clock.now += 10000
+    assert pool.reconcile() == ({}, [])
+
+    # one is taken for a run, so another is launched to keep two ready
+    instance = pool.acquire('ami-a', 'run-1')
+    assert ec2.instances[instance]['tags'][IMAGE_TAG] == 'ami-a'
+    assert pool.reconcile() == ({'ami-a': 1}, [])
+    ec2.boot()
+
+    # once the run ends there are three idle, and the one idle longest goes after the timeout
+    pool.release(instance)
+    clock.now += 600
+    launch, terminate = pool.reconcile()
+    assert launch == {} and len(terminate) == 1 and terminate[0] != instance
+
+
+def test_plan_is_bounded_by_max_size():
+    ec2, clock = StubEC2(), Clock()
+    pool = fleet(ec2, clock, warm={'ami-a': 5}, max_size=3)
+    assert pool.plan([], clock()) == ({'ami-a': 3}, [])
+
+
+def test_idle_since_survives_restarts():
+    ec2, clock = StubEC2(), Clock()
+    pool = fleet(ec2, clock)
+    instance = pool.acquire('ami-a', 'run-1')
+    ec2.boot()
+    pool.release(instance)
+    assert float(ec2.instances[instance]['tags'][IDLE_TAG]) == clock()
+
+    clock.now += 600
+    assert fleet(ec2, clock).reconcile() == ({}, [instance])  # another worker, or after a restart
+
+
+def test_claimed_instance_is_not_shared():
+    ec2, clock = StubEC2(), Clock()
+    pool, other = fleet(ec2, clock), fleet(ec2, clock)
+    instance = pool.acquire('ami-a', 'run-1')
+    ec2.boot()
+    pool.release(instance)
+    assert other.acquire('ami-a', 'run-2') == instance
+    assert not any(key.startswith(CLAIM_TAG) for key in ec2.instances[instance]['tags'])
+
+    # the first worker still sees the instance as idle, but the other worker has it
+    assert pool.acquire('ami-a', 'run-3') != instance
+    assert ec2.instances[instance]['tags'][RUN_TAG] == 'run-2'
+    assert pool.stats()['lost_claims'] == 1
+
+
+def test_simultaneous_claims():
+    ec2, clock = StubEC2(), Clock()
+    pool, other = fleet(ec2, clock), fleet(ec2, clock)
+    instance = pool.acquire('ami-a', 'run-1')
+    ec2.boot()
+    pool.release(instance)
+    other.workers()  # both see it idle
+
+    # the other worker claims the instance after this one has, but before this one reads its claim back
+    describe_tags = ec2.describe_tags
+    acquired = []
+
+    def claim_in_between(**kwargs):
+        ec2.describe_tags = describe_tags
+        acquired.append(other.acquire('ami-a', 'run-3'))
+        return describe_tags(**kwargs)
+
+    ec2.describe_tags = claim_in_between
+    assert pool.acquire('ami-a', 'run-2') == instance
+    assert acquired[0] != instance  # launched instead
+    assert ec2.instances[instance]['tags'][RUN_TAG] == 'run-2'
+    assert ec2.instances[acquired[0]]['tags'][RUN_TAG] == 'run-3'
+
+
+def test_broken_instances_are_retired():
+    ec2, clock = StubEC2(), Clock()
+    pool = fleet(ec2, clock)
+    instance = pool.acquire('ami-a', 'run-1')
+    ec2.boot()
+    pool.retire(instance)
+    assert ec2.instances[instance]['state'] == 'terminated'
+    assert pool.acquire('ami-a', 'run-2') != instance
+    assert pool.stats()['terminated'] == 1
@@ -0,0 +1,48 @@
+import numpy
+
+from app.core.geometry import NetworkGeometry, get_network_geometry, geometry_cache
+from app.core.networks import make_adjacency
+
+
+def make_network():
+    nodes = [{'id': i, 'name': 'n{}'.format(i), 'x': str(i), 'y': '0', 'layout': {}, 'types': []} for i in [1, 2, 3, 4]]
+    links = [
+        {'id': 10, 'name': 'a', 'node_1_id': 1, 'node_2_id': 2, 'layout': {}, 'types': []},
+        {'id': 11, 'name': 'b', 'node_1_id': 1, 'node_2_id': 3, 'layout': {}, 'types': []},
+        {'id': 12, 'name': 'c', 'node_1_id': 3, 'node_2_id': 4, 'layout': {
+            'geojson': {'geometry': {'coordinates': [[3, 0], [3.5, 1], [4, 0]]}}}, 'types': []},
+        {'id': 13, 'name': 'dangling', 'node_1_id': 2, 'node_2_id': 99, 'layout': {}, 'types': []},
+    ]
+    return {'id': 1, 'name': 'Basin', 'nodes': nodes, 'links': links}
+
+
+def test_csr_adjacency():
+    geometry = NetworkGeometry(make_network())
+    assert geometry.adj_indptr.tolist() == [0, 2, 2, 3, 3]
+    assert geometry.node_ids[geometry.adj_indices].tolist() == [2, 3, 4]
+    assert geometry.link_ids[geometry.adj_links].tolist() == [10, 11, 12]
+    assert geometry.downstream_nodes(1) == [2, 3]
+    assert geometry.downstream_nodes(4) == []
+
+    # links without GeoJSON run between their end nodes
+    assert geometry.link_vertices(2).tolist() == [[3, 0], [3.5, 1], [4, 0]]
+    assert geometry.link_vertices(0).tolist() == [[1, 0], [2, 0]]
+    assert numpy.isnan(geometry.link_vertices(3)[1]).all()
+
+
+def test_adjacency_csv_matches_array():
+    network = make_network()
+    array = make_adjacency(network, flavor='array')
+    lines = list(make_adjacency(network, flavor='stream'))
+    assert lines == [','.join(str(value) for value in row) + '\n' for row in array]
+    assert lines[1] == '"n1",0,1,1,0\n'
+
+
+def test_geometry_cached_by_version():
+    geometry_cache.clear()
+    network = make_network()
+    geometry = get_network_geometry(network)
+    assert get_network_geometry(make_network()) is geometry
+
+    network['links'][0]['node_2_id'] = 4
+    assert get_network_geometry(network).downstream_nodes(1) == [4, 3]
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app import config
+from app.core import jobs
+from app.models import Job
+
+
+class Executor(object):
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append(args[0])
+
+
+@pytest.fixture
+def Session(monkeypatch):
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    Job.__table__.create(engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    monkeypatch.setattr(jobs, 'SessionLocal', Session)
+    monkeypatch.setattr(jobs, 'executor', Executor())
+    return Session
+
+
+@pytest.fixture
+def steps():
+    """A job of five steps that can be told to cancel itself (from another session) at one of them"""
+    done = []
+
+    @jobs.job_function('test')
+    def run(hydra, job, cancel_at=None):
+        for step in range(job.state.get('step', 0), 5):
+            if step == cancel_at:
+                db = jobs.SessionLocal()
+                jobs.cancel_job(db, db.get(Job, job.id))
+            job.progress(step, 5)
+            done.append(step)
+            job.checkpoint(step=step + 1)
+        return {'steps': len(done)}
+
+    yield done
+    jobs.job_functions.pop('test')
+
+
+def add_job(Session, job_id, status, **params):
+    db = Session()
+    now = datetime.utcnow()
+    db.add(Job(id=job_id, kind='test', user_id=1, source_id=1, status=status, progress=0, params=params, state={},
+               created_at=now, updated_at=now))
+    db.commit()
+    return db
+
+
+@pytest.mark.parametrize('status', [jobs.QUEUED, jobs.RUNNING, jobs.FINISHED])
+def test_only_failed_or_cancelled_jobs_resume(Session, status):
+    db = add_job(Session, 'a', status)
+    assert jobs.resume_job(db, db.get(Job, 'a')).status == status
+    assert jobs.executor.submitted == []
+
+
+def test_resume_once(Session):
+    db = add_job(Session, 'a', jobs.FAILED)
+    job = db.get(Job, 'a')
+    other_db = Session()
+    other = other_db.get(Job, 'a')  # as loaded by a request resuming it at the same time
+    assert jobs.resume_job(db, job).status == jobs.QUEUED
+    assert jobs.resume_job(other_db, other).status == jobs.QUEUED
+    assert jobs.executor.submitted == ['a']
+
+
+def test_queued_job_runs_once(Session, steps):
+    add_job(Session, 'a', jobs.QUEUED)
+    jobs._run_job('a', hydra=object())
+    jobs._run_job('a', hydra=object())
+    assert steps == [0, 1, 2, 3, 4]
+    job = Session().get(Job, 'a')
+    assert (job.status, job.progress, job.result) == (jobs.FINISHED, 100, {'steps': 5})
+
+
+def test_cancel_and_resume(Session, steps):
+    db = add_job(Session, 'a', jobs.QUEUED, cancel_at=2)
+    jobs._run_job('a', hydra=object())
+    assert steps == [0, 1]
+    assert db.get(Job, 'a').status == jobs.CANCELLED
+
+    # resumed from its checkpoint, without cancelling it again
+    job = jobs.resume_job(db, db.get(Job, 'a'))
+    assert jobs.executor.submitted == ['a']
+    job.params = {}
+    db.commit()
+    jobs._run_job('a', hydra=object())
+    assert steps == [0, 1, 2, 3, 4]
+    assert Session().get(Job, 'a').status == jobs.FINISHED
+
+    # a finished job can't be cancelled
+    assert jobs.cancel_job(db, db.get(Job, 'a')).status == jobs.FINISHED
+
+
+def test_cancelled_job_does_not_start(Session, steps):
+    db = add_job(Session, 'a', jobs.QUEUED)
+    jobs.cancel_job(db, db.get(Job, 'a'))
+    jobs._run_job('a', hydra=object())
+    assert steps == []
+    assert Session().get(Job, 'a').status == jobs.CANCELLED
+
+
+def test_stale_running_job_resumes(Session, steps):
+    db = add_job(Session, 'a', jobs.RUNNING)
+    db.get(Job, 'a').updated_at = datetime.utcnow() - timedelta(seconds=config.JOB_STALE_AFTER + 1)
+    db.commit()
+
+    # left running by a worker that has since gone
+    assert jobs.resume_job(db, db.get(Job, 'a')).status == jobs.QUEUED
+    assert jobs.executor.submitted == ['a']
+    jobs._run_job('a', hydra=object())
+    assert steps == [0, 1, 2, 3, 4]
+    assert Session().get(Job, 'a').status == jobs.FINISHED
@@ -0,0 +1,117 @@
+import sys
+import time
+
+import pytest
+
+from app.core.ProcessState import ProcessState
+from app.core.runners.local import LocalRunner, POSIX, parse_progress
+
+MODEL = '''
+import json, sys, time
+n = int(sys.argv[1])
+for i in range(n):
+    print(json.dumps({"progress": 100 * (i + 1) // n}), flush=True)
+    time.sleep(float(sys.argv[2]))
+print("model output")
+sys.exit(int(sys.argv[3]))
+'''
+
+
+def model(steps=5, delay=0.0, exit_code=0):
+    return [sys.executable, '-c', MODEL, str(steps), str(delay), str(exit_code)]
+
+
+class Reports(object):
+    def __init__(self):
+        self.reports = []
+
+    def __call__(self, run, status, data):
+        self.reports.append((run.sid, status, dict(data)))
+
+    def statuses(self, sid):
+        return [status for report_sid, status, data in self.reports if report_sid == sid]
+
+    def last(self, sid):
+        return [data for report_sid, status, data in self.reports if report_sid == sid][-1]
+
+
+def wait_for(condition, timeout=10):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.01)
+
+
+def test_parse_progress():
+    assert parse_progress('{"progress": 50, "step": 3}\n') == {'progress': 50, 'step': 3}
+    assert parse_progress('{"other": 1}') is None
+    assert parse_progress('50% done') is None
+
+
+def test_run_lifecycle():
+    reports = Reports()
+    runner = LocalRunner(reports, max_workers=2, progress_interval=0)
+    runner.start('a', model(), info={'network_id': 1})
+    runner.start('b', model(exit_code=3))
+    assert runner.wait('a', 10) and runner.wait('b', 10)
+
+    assert reports.statuses('a') == [ProcessState.STARTED] + [ProcessState.RUNNING] * 5 + [ProcessState.FINISHED]
+    assert reports.last('a')['progress'] == 100
+    assert reports.statuses('b')[-1] == ProcessState.ERROR
+    assert reports.last('b')['extra_info'] == 'model output'
+    assert reports.last('b')['exit_code'] == 3
+    assert not runner.has('a')
+    assert runner.stats()['finished'] == 1 and runner.stats()['failed'] == 1
+
+
+def test_progress_is_throttled():
+    reports = Reports()
+    runner = LocalRunner(reports, progress_interval=60)
+    runner.start('a', model(steps=100))
+    runner.wait('a', 10)
+    running = [data for sid, status, data in reports.reports if status == ProcessState.RUNNING]
+    assert [data['progress'] for data in running] == [1, 100]  # the first, then the last
+
+
+def test_concurrency_limit():
+    reports = Reports()
+    runner = LocalRunner(reports, max_workers=2)
+    for sid in 'abcd':
+        runner.start(sid, model(steps=1, delay=0.3))
+    wait_for(lambda: runner.stats()['running'] == 2)
+    assert runner.stats()['waiting'] == 2
+    for sid in 'abcd':
+        runner.wait(sid, 10)
+    assert runner.stats()['finished'] == 4
+
+
+def test_cancel():
+    reports = Reports()
+    runner = LocalRunner(reports, max_workers=1, cancel_grace=1)
+    runner.start('a', model(steps=100, delay=0.1))
+    runner.start('b', model())
+    wait_for(lambda: ProcessState.STARTED in reports.statuses('a'))
+    assert runner.cancel('b')  # before it starts
+    assert runner.cancel('a')
+    assert runner.wait('a', 10) and runner.wait('b', 10)
+    assert reports.statuses('a')[-1] == ProcessState.CANCELED
+    assert reports.statuses('b') == [ProcessState.CANCELED]
+    assert not runner.cancel('a')
+
+
+@pytest.mark.skipif(not POSIX, reason='pausing needs POSIX signals')
+def test_pause_and_resume():
+    reports = Reports()
+    runner = LocalRunner(reports, progress_interval=0)
+    runner.start('a', model(steps=20, delay=0.05))
+    wait_for(lambda: ProcessState.RUNNING in reports.statuses('a'))
+    assert runner.pause('a')
+    assert not runner.pause('a')
+    time.sleep(0.2)
+    count = len(reports.statuses('a'))
+    time.sleep(0.3)
+    assert len(reports.statuses('a')) == count  # no progress while paused
+    assert runner.resume('a')
+    runner.wait('a', 10)
+    assert reports.statuses('a')[-1] == ProcessState.FINISHED
+    assert ProcessState.PAUSED in reports.statuses('a')
@@ -0,0 +1,152 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.core.jobs import JobCancelled
+from app.core.mapbox import MapboxDatasetClient, sync_features, diff_features, get_sync_state
+from app.core.networks import update_network_on_mapbox
+from app.models import MapboxSyncState
+
+
+class MapboxStandIn(BaseHTTPRequestHandler):
+    """A stand-in for the Mapbox Datasets API features endpoint, which rate limits every fifth request"""
+
+    def _feature_id(self):
+        return self.path.split('?')[0].rstrip('/').split('/')[-1]
+
+    def _respond(self, status, body=None, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(json.dumps(body).encode())
+
+    def _rate_limited(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            if server.requests % 5 == 0:
+                server.rate_limited += 1
+                self._respond(429, {'message': 'Too Many Requests'}, {'Retry-After': '0.01'})
+                return True
+        return False
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self._rate_limited():
+            return
+        feature = json.loads(body)
+        with self.server.lock:
+            self.server.features[self._feature_id()] = feature
+            self.server.writes.append(('PUT', self._feature_id()))
+        self._respond(200, feature)
+
+    def do_DELETE(self):
+        if self._rate_limited():
+            return
+        with self.server.lock:
+            existed = self.server.features.pop(self._feature_id(), None)
+            self.server.writes.append(('DELETE', self._feature_id()))
+        self._respond(204 if existed else 404)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mapbox():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MapboxStandIn)
+    server.lock = threading.Lock()
+    server.features = {}
+    server.writes = []
+    server.requests = 0
+    server.rate_limited = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def make_features(n, moved=()):
+    return [{
+        'id': 'NODE{}'.format(i),
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [float(i), 1.0 if i in moved else 0.0]},
+        'properties': {'name': 'Node {}'.format(i)},
+    } for i in range(n)]
+
+
+def test_diff_features():
+    features = make_features(3)
+    puts, deletes, hashes = diff_features(features, {})
+    assert len(puts) == 3 and deletes == []
+
+    puts, deletes, _ = diff_features(make_features(2, moved=[1]), hashes)
+    assert [f['id'] for f in puts] == ['NODE1']
+    assert deletes == ['NODE2']
+
+
+def test_sync_features(mapbox):
+    client = MapboxDatasetClient('http://127.0.0.1:{}'.format(mapbox.server_port), 'user', 'dataset', 'token')
+
+    hashes, stats = sync_features(client, make_features(50), {}, max_workers=4, batch_size=10)
+    assert stats['put'] == 50 and stats['failed'] == 0
+    assert len(mapbox.features) == 50
+    assert mapbox.rate_limited > 0
+
+    # a small edit to a large network only sends what changed
+    mapbox.writes.clear()
+    hashes, stats = sync_features(client, make_features(49, moved=[3]), hashes, max_workers=4, batch_size=10)
+    assert sorted(mapbox.writes) == [('DELETE', 'NODE49'), ('PUT', 'NODE3')]
+    assert stats == {'put': 1, 'deleted': 1, 'unchanged': 48, 'failed': 0}
+    assert mapbox.features['NODE3']['geometry']['coordinates'] == [3.0, 1.0]
+
+    mapbox.writes.clear()
+    _, stats = sync_features(client, make_features(49, moved=[3]), hashes)
+    assert mapbox.writes == []
+    assert stats['unchanged'] == 49
+
+
+class CancelledJob(object):
+    """Stands in for a job that is cancelled once some of the changes have been published"""
+
+    def __init__(self, after):
+        self.after = after
+
+    def progress(self, done, total, message=None):
+        if done >= self.after:
+            raise JobCancelled()
+
+
+def test_sync_state_is_saved_per_batch(mapbox, monkeypatch):
+    monkeypatch.setattr('app.core.networks.config.MAPBOX_DATASET_ID', 'dataset', raising=False)
+    engine = create_engine('sqlite://')
+    MapboxSyncState.__table__.create(engine)
+    db = sessionmaker(bind=engine)()
+    writes = []
+    event.listen(engine, 'before_cursor_execute',
+                 lambda *args: args[2].startswith(('INSERT', 'UPDATE')) and writes.append(args[2]))
+
+    client = MapboxDatasetClient('http://127.0.0.1:{}'.format(mapbox.server_port), 'user', 'dataset', 'token')
+    template = {'id': 1, 'templatetypes': [{'id': 5, 'name': 'Junction'}]}
+    nodes = [{'id': i, 'name': 'n{}'.format(i), 'description': '', 'x': str(i), 'y': '0', 'layout': {},
+              'types': [{'id': 5, 'template_id': 1}]} for i in range(1, 251)]
+    network = {'id': 1, 'name': 'Basin', 'nodes': nodes, 'links': []}
+
+    # cancelled after two batches, which are saved, one write each
+    with pytest.raises(JobCancelled):
+        update_network_on_mapbox(db, 1, network, template, True, client=client, job=CancelledJob(after=200))
+    assert len(writes) == 2
+    assert len([h for h in get_sync_state(db, 1, 1, 'dataset').hashes.values() if h]) == 200
+
+    # the next sync sends only the rest
+    mapbox.writes.clear()
+    stats = update_network_on_mapbox(db, 1, network, template, True, client=client)
+    assert (stats['put'], stats['unchanged']) == (50, 200)
+    assert len(mapbox.writes) == 50
+    assert len(get_sync_state(db, 1, 1, 'dataset').hashes) == 250
@@ -0,0 +1,177 @@
+from copy import deepcopy
+
+import pytest
+
+from app.core.edit_session import EditSession, EditSessionError
+from app.core.network_editor import add_link
+from app.core.spatial import get_spatial_index, spatial_index_cache
+
+TEMPLATE_ID = 7
+INFLOW, OUTFLOW, JUNCTION, RIVER = [{'id': i, 'name': name, 'resource_type': rtype} for i, name, rtype in [
+    (1, 'Inflow', 'NODE'), (2, 'Outflow', 'NODE'), (3, 'Junction', 'NODE'), (4, 'River', 'LINK')
+]]
+TEMPLATE = {'id': TEMPLATE_ID, 'templatetypes': [INFLOW, OUTFLOW, JUNCTION, RIVER], 'layout': {}}
+DEFAULT_TYPES = {'inflow': INFLOW, 'outflow': OUTFLOW, 'junction': JUNCTION}
+
+
+class FakeHydra(object):
+    """Saves update_network payloads as Hydra does, giving new resources ids and mapping links to new nodes"""
+
+    def __init__(self, network, fail=False):
+        self.network = deepcopy(network)
+        self.fail = fail
+        self.calls = []
+        self.next_id = 100
+
+    def call(self, func, *args, **kwargs):
+        self.calls.append((func,) + args)
+        if func == 'update_network':
+            if self.fail:
+                return {'error': 'Duplicate entry'}
+            return self.update_network(deepcopy(args[0]))
+        elif func == 'delete_node':
+            self.network['nodes'] = [n for n in self.network['nodes'] if n['id'] != args[0]]
+        elif func == 'delete_link':
+            self.network['links'] = [l for l in self.network['links'] if l['id'] != args[0]]
+        elif func == 'get_node':
+            return next(n for n in self.network['nodes'] if n['id'] == args[0])
+        return {}
+
+    def update_network(self, payload):
+        ids = {}
+        for restype in ['nodes', 'links']:
+            saved = {resource['id']: resource for resource in self.network[restype]}
+            for resource in payload[restype]:
+                if resource['id'] < 0:
+                    ids[resource['id']] = self.next_id
+                    resource['id'] = self.next_id
+                    self.next_id += 1
+                if restype == 'links':
+                    resource['node_1_id'] = ids.get(resource['node_1_id'], resource['node_1_id'])
+                    resource['node_2_id'] = ids.get(resource['node_2_id'], resource['node_2_id'])
+                saved[resource['id']] = resource
+            self.network[restype] = list(saved.values())
+        return deepcopy(self.network)
+
+
+def node(id, name, x, y, ttype):
+    gj = {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [x, y]}, 'properties': {}}
+    return {'id': id, 'name': name, 'x': str(x), 'y': str(y), 'layout': {'geojson': gj},
+            'types': [{'id': ttype['id'], 'name': ttype['name'], 'template_id': TEMPLATE_ID}]}
+
+
+def link(id, name, node_1, node_2):
+    coords = [[float(node_1['x']), float(node_1['y'])], [float(node_2['x']), float(node_2['y'])]]
+    gj = {'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': coords}, 'properties': {}}
+    return {'id': id, 'name': name, 'node_1_id': node_1['id'], 'node_2_id': node_2['id'], 'layout': {'geojson': gj},
+            'types': [{'id': RIVER['id'], 'template_id': TEMPLATE_ID}]}
+
+
+@pytest.fixture
+def network():
+    spatial_index_cache.clear()
+    top, bottom = node(1, 'Top', 0.0, 0.0, INFLOW), node(2, 'Bottom', 1.0, 0.0, OUTFLOW)
+    return {'id': 1, 'name': 'Basin', 'layout': {}, 'nodes': [top, bottom], 'links': [link(10, 'Main', top, bottom)]}
+
+
+def drawn_link(name, coords):
+    gj = {'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': coords}, 'properties': {}}
+    return {'name': name, 'description': '', 'layout': {'geojson': gj},
+            'types': [{'id': RIVER['id'], 'template_id': TEMPLATE_ID}]}
+
+
+def test_edit_session_maps_temporary_ids(network):
+    hydra = FakeHydra(network)
+    session = EditSession(hydra, network)
+    a = session.add_node(node(None, 'A', 0.5, 1.0, JUNCTION))
+    b = session.add_node(node(None, 'B', 0.5, 2.0, JUNCTION))
+    new = session.add_link(link(None, 'A to B', a, b))
+    assert (a['id'], b['id'], new['id']) == (-1, -2, -3)
+    assert session.unique_name('link', 'Main') == 'Main (1)'
+
+    # the link from the node to be deleted is moved to the new node
+    repointed = session.repoint_links(2, a['id'])
+    session.delete_node(2)
+    session.delete_node(a['id'] - 100)  # a new node that was never added is not deleted in Hydra
+    assert [l['node_2_id'] for l in repointed] == [-1]
+
+    nodes, links = session.commit()
+    assert [call[0] for call in hydra.calls] == ['update_network', 'delete_node']
+    assert session.id_map == {-1: 100, -2: 101, -3: 102}
+    assert {l['id']: (l['node_1_id'], l['node_2_id']) for l in links} == {10: (1, 100), 102: (100, 101)}
+    assert [n['name'] for n in nodes] == ['A', 'B']
+    assert session.deleted_node_ids == [2] and session.deleted_link_ids == []
+
+
+def test_edit_session_maps_renamed_resources(network):
+    class RenamingHydra(FakeHydra):
+        def update_network(self, payload):
+            for resource in payload['nodes']:
+                resource['name'] = resource['name'].strip()
+            return FakeHydra.update_network(self, payload)
+
+    hydra = RenamingHydra(network)
+    session = EditSession(hydra, network)
+    a = session.add_node(node(None, 'A ', 0.5, 1.0, JUNCTION))
+    b = session.add_node(node(None, 'B ', 0.5, 2.0, JUNCTION))
+    session.add_link(link(None, 'A to B', a, b))
+
+    nodes, links = session.commit()
+    assert session.id_map == {-1: 100, -2: 101, -3: 102}
+    assert [(n['id'], n['name']) for n in nodes] == [(100, 'A'), (101, 'B')]
+    assert (links[0]['node_1_id'], links[0]['node_2_id']) == (100, 101)
+
+
+def test_edit_session_failure_changes_nothing(network):
+    hydra = FakeHydra(network, fail=True)
+    session = EditSession(hydra, network)
+    session.add_node(node(None, 'A', 0.5, 1.0, JUNCTION))
+    session.delete_link(10)
+    with pytest.raises(EditSessionError):
+        session.commit()
+    assert [call[0] for call in hydra.calls] == ['update_network']  # nothing deleted
+
+
+def test_add_link_splits_crossed_link(network):
+    hydra = FakeHydra(network)
+    ttypes = {tt['id']: tt for tt in TEMPLATE['templatetypes']}
+    incoming = drawn_link('Canal', [[0.5, -1.0], [0.5, 1.0]])
+
+    nodes, links, del_nodes, del_links, network = add_link(hydra, network, TEMPLATE, ttypes, incoming, None, None,
+                                                           DEFAULT_TYPES)
+
+    # one update_network call, for an inflow, a junction where the canal crosses Main, an outflow and four links
+    assert [call[0] for call in hydra.calls] == ['update_network']
+    assert sorted(n['types'][0]['id'] for n in nodes) == [INFLOW['id'], OUTFLOW['id'], JUNCTION['id']]
+    assert {'Canal Inflow', 'Canal Outflow'} < {n['name'] for n in nodes}
+    junction = next(n for n in nodes if n['types'][0]['id'] == JUNCTION['id'])
+    ends = {l['name']: (l['node_1_id'], l['node_2_id']) for l in links}
+    assert ends['Main.1'] == (1, junction['id']) and ends['Main.2'] == (junction['id'], 2)
+    assert sorted(ends) == ['Canal', 'Canal.1', 'Main.1', 'Main.2']
+
+    # the first piece of Main keeps its id, so nothing is deleted
+    assert next(l['id'] for l in links if l['name'] == 'Main.1') == 10
+    assert del_nodes == [] and del_links == []
+    assert all(resource['id'] > 0 for resource in nodes + links)
+
+    # the network and its spatial index are up to date
+    assert len(network['nodes']) == 5 and len(network['links']) == 4
+    index = get_spatial_index(network, TEMPLATE_ID)
+    assert index.locate_point(0.5, 0.0)['id'] == junction['id']
+
+
+def test_add_link_replaces_outflow_with_junction(network):
+    hydra = FakeHydra(network)
+    ttypes = {tt['id']: tt for tt in TEMPLATE['templatetypes']}
+    incoming = drawn_link('Tail', [[1.0, 0.0], [2.0, 0.0]])
+
+    nodes, links, del_nodes, del_links, network = add_link(hydra, network, TEMPLATE, ttypes, incoming, None, None,
+                                                           DEFAULT_TYPES)
+
+    junction = next(n for n in nodes if n['types'][0]['id'] == JUNCTION['id'])
+    assert del_nodes == [2] and del_links == []
+    assert [call[0] for call in hydra.calls] == ['update_network', 'delete_node']
+    # Main is repointed to the new junction, rather than deleted
+    main = next(l for l in links if l['id'] == 10)
+    assert main['node_2_id'] == junction['id']
+    assert {n['id'] for n in network['nodes']} == {1} | {n['id'] for n in nodes}
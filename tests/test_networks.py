@@ -0,0 +1,109 @@
+import copy
+
+from app.core.networks import get_network_fields, make_network_thumbnail, get_template_styles, thumbnail_cache, \
+    template_style_cache, rewrite_function_keys
+
+
+class FakeHydra(object):
+    def __init__(self, network):
+        self.network = network
+        self.calls = []
+
+    def call(self, func, *args, **kwargs):
+        self.calls.append((func, kwargs))
+        return self.network
+
+
+def make_network():
+    return {
+        'id': 1,
+        'name': 'Basin',
+        'layout': {'geojson': {'type': 'Feature'}, 'storage': {'folder': 'basin'}},
+        'nodes': [{'id': i, 'name': 'node {}'.format(i), 'x': i, 'y': -i, 'types': [], 'layout': {}} for i in [1, 2]],
+        'links': [{'id': 3, 'node_1_id': 1, 'node_2_id': 2, 'name': 'link'}],
+        'scenarios': [{'id': 4, 'name': 'Baseline'}],
+        'types': [{'id': 5}],
+    }
+
+
+def test_sparse_fieldsets():
+    network = make_network()
+    hydra = FakeHydra(network)
+
+    sparse = get_network_fields(hydra, 1, include=['nodes'], fields=['nodes:id,x,y'])
+    assert sparse == {'id': 1, 'name': 'Basin', 'layout': network['layout'], 'nodes': [
+        {'id': 1, 'x': 1, 'y': -1}, {'id': 2, 'x': 2, 'y': -2}
+    ]}
+    assert hydra.calls[-1][1]['include_resources'] and hydra.calls[-1][1]['summary']
+
+    # sections that were not asked for are left out, and the network's own fields can be selected too
+    sparse = get_network_fields(hydra, 1, include=['scenarios,links'], fields=['layout.geojson'])
+    assert sparse == {'id': 1, 'layout': {'geojson': {'type': 'Feature'}}, 'links': network['links'],
+                      'scenarios': network['scenarios']}
+
+    # attribute fields need the full network
+    get_network_fields(hydra, 1, include=['nodes'], fields=['nodes:id,attributes'])
+    assert not hydra.calls[-1][1]['summary']
+
+
+def test_sparse_fieldsets_leave_the_network_alone():
+    network = make_network()
+    original = copy.deepcopy(network)
+    sparse = get_network_fields(FakeHydra(network), 1)
+    assert sparse == {'id': 1, 'name': 'Basin', 'layout': network['layout']}
+    sparse['nodes'] = []
+    sparse['name'] = 'changed'
+    assert network == original
+
+
+def make_template(color='#f00'):
+    return {'id': 7, 'templatetypes': [
+        {'id': 8, 'name': 'Reservoir', 'resource_type': 'NODE', 'typeattrs': [],
+         'layout': {'svg': '<svg><path fill="{}"/></svg>'.format(color)}},
+        {'id': 9, 'name': 'River', 'resource_type': 'LINK', 'typeattrs': [], 'layout': {}},
+    ]}
+
+
+def make_typed_network():
+    network = make_network()
+    for node in network['nodes']:
+        node['types'] = [{'id': 8, 'template_id': 7}]
+    network['links'][0].update(types=[{'id': 9, 'template_id': 7}], layout={})
+    return network
+
+
+def test_thumbnail_cache_follows_versions():
+    thumbnail_cache.clear()
+    template_style_cache.clear()
+    network, template = make_typed_network(), make_template()
+    thumbnail = make_network_thumbnail(network, template)
+    assert 'fill="#f00"' in thumbnail.replace("'", '"')
+
+    # the same network and template, as fetched again
+    assert make_network_thumbnail(make_typed_network(), make_template()) is thumbnail
+    assert get_template_styles(make_template()) is get_template_styles(template)
+
+    # edits that don't change what is drawn keep the cached thumbnail
+    network['scenarios'][0]['name'] = 'Base'
+    assert make_network_thumbnail(network, template) is thumbnail
+
+    # a moved node or a restyled type are drawn again
+    network['nodes'][1]['x'] = 5
+    moved = make_network_thumbnail(network, template)
+    assert moved != thumbnail
+
+    restyled = make_network_thumbnail(network, make_template(color='#00f'))
+    assert 'fill="#00f"' in restyled.replace("'", '"')
+    assert get_template_styles(make_template(color='#00f'))[8]['color'] == '#00f'
+    assert len(thumbnail_cache) == 3
+
+
+def test_function_keys_are_rewritten_once():
+    lookup = {('network', 1): 11, ('node', 1): 21, ('node', 2): 22}
+    rewritten = {('network', 11), ('node', 21), ('node', 22)}
+    func = "return self.GET('node/1/5') + self.GET(\"node/22/5\") + self.GET('link/1/5')"
+    once = rewrite_function_keys(func, lookup, rewritten)
+    assert once == 'return self.GET("node/21/5") + self.GET("node/22/5") + self.GET(\'link/1/5\')'
+
+    # as when a clone is resumed after some of its scenarios have been updated
+    assert rewrite_function_keys(once, lookup, rewritten) == once
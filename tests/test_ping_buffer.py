@@ -0,0 +1,65 @@
+import time
+
+from app.core.ping_buffer import PingBuffer
+
+
+def test_coalesce_and_flush():
+    written = []
+    buffer = PingBuffer(written.append, interval=60)
+    for progress in range(100):
+        for sid in ['a', 'b']:
+            buffer.add(sid, 'running', progress=progress)
+    buffer.add('a', 'started', name='run a')
+
+    assert buffer.stats()['depth'] == 3
+    assert buffer.flush() == 3
+    assert len(written) == 1
+    pings = {(ping['sid'], ping['status']): ping for ping in written[0]}
+    assert pings[('a', 'running')]['progress'] == 99
+    assert pings[('a', 'started')]['name'] == 'run a'
+
+    stats = buffer.stats()
+    assert stats['depth'] == 0
+    assert stats['received'] == 201
+    assert stats['coalesced'] == 198
+    assert stats['written'] == 3
+    assert buffer.flush() == 0
+
+
+def test_take():
+    written = []
+    buffer = PingBuffer(written.append, interval=60)
+    buffer.add('a', 'running', progress=10)
+    buffer.add('b', 'running', progress=20)
+    assert buffer.take('a') == [{'sid': 'a', 'status': 'running', 'progress': 10}]
+    buffer.flush()
+    assert [ping['sid'] for ping in written[0]] == ['b']
+
+
+def test_failed_flush_is_retried():
+    calls = []
+
+    def write(pings):
+        calls.append(pings)
+        if len(calls) == 1:
+            raise RuntimeError('database unavailable')
+
+    buffer = PingBuffer(write, interval=60)
+    buffer.add('a', 'running', progress=10, name='run a')
+    assert buffer.flush() == 0
+    buffer.add('a', 'running', progress=20)
+    assert buffer.flush() == 1
+    assert calls[-1] == [{'sid': 'a', 'status': 'running', 'progress': 20, 'name': 'run a'}]
+    assert buffer.stats()['failed_flushes'] == 1
+
+
+def test_background_flush():
+    written = []
+    buffer = PingBuffer(written.extend, interval=0.05, max_pending=10)
+    buffer.add('a', 'running', progress=1)
+    for _ in range(100):
+        if written:
+            break
+        time.sleep(0.01)
+    assert written == [{'sid': 'a', 'status': 'running', 'progress': 1}]
+    assert buffer.stats()['max_lag_ms'] > 0
@@ -0,0 +1,62 @@
+import time
+from types import SimpleNamespace
+
+from app.core.runners import rabbitmq
+from app.core.runners.rabbitmq import QueueCache
+
+
+def test_queue_cache_ttl():
+    checks = []
+
+    def check(vhost, queue_name):
+        checks.append(queue_name)
+        return queue_name == 'model-a'
+
+    cache = QueueCache(check, ttl=60, missing_ttl=0.05)
+    for _ in range(10):
+        assert cache.exists('model-a', 'model-a')
+        assert not cache.exists('model-b', 'model-b')
+    assert checks == ['model-a', 'model-b']
+
+    time.sleep(0.06)  # a missing queue is checked again soon
+    assert not cache.exists('model-b', 'model-b')
+    assert checks == ['model-a', 'model-b', 'model-b']
+
+
+def test_queue_cache_refreshes_in_background():
+    checks = []
+    answers = {'model-a': True}
+
+    def check(vhost, queue_name):
+        checks.append(queue_name)
+        return answers[queue_name]
+
+    cache = QueueCache(check, ttl=0.05, max_age=60)
+    assert cache.exists('model-a', 'model-a')
+    time.sleep(0.06)
+    answers['model-a'] = False
+    assert cache.exists('model-a', 'model-a')  # the stale answer is used while refreshing
+    for _ in range(100):
+        if len(checks) == 2:
+            break
+        time.sleep(0.01)
+    assert not cache.exists('model-a', 'model-a')
+    assert checks == ['model-a', 'model-a']
+
+
+def test_send_batch(monkeypatch):
+    sent = []
+    monkeypatch.setattr(rabbitmq, 'broker_url', lambda vhost: 'memory://')
+    monkeypatch.setattr(rabbitmq, 'queue_cache', QueueCache(lambda vhost, queue_name: True))
+    model = SimpleNamespace(key='abc')
+
+    app = rabbitmq.get_celery('model-abc')
+    monkeypatch.setattr(app, 'send_task', lambda name, **kwargs: sent.append((name, kwargs)))
+    runs = [dict(sid='run-{}'.format(i)) for i in range(5)]
+    assert rabbitmq.run_models_rabbitmq(model, 'key', runs) is None
+    assert [kwargs['kwargs']['sid'] for name, kwargs in sent] == ['run-{}'.format(i) for i in range(5)]
+    assert len({id(kwargs['producer']) for name, kwargs in sent}) == 1
+    assert all(kwargs['queue'] == 'model-abc-key' for name, kwargs in sent)
+
+    monkeypatch.setattr(rabbitmq, 'queue_cache', QueueCache(lambda vhost, queue_name: False))
+    assert rabbitmq.run_model_rabbitmq(None, model, 'key', {}) == 'No computer is set up for this run'
@@ -0,0 +1,70 @@
+import asyncio
+import threading
+
+from app.realtime.hub import Hub
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 5))
+
+
+def test_rooms():
+    hub = Hub(max_rate=0)
+
+    async def main():
+        async with hub.subscription('1-1') as one, hub.subscription('1-2') as two:
+            hub.publish('1-1', 'network-run', {'sid': 'a', 'progress': 10})
+            assert [m['data'] for m in await one.get()] == [{'sid': 'a', 'progress': 10}]
+            assert not two._latest
+        assert not hub._rooms
+
+    run(main())
+
+
+def test_coalesced_per_sid():
+    hub = Hub(max_rate=0)
+
+    async def main():
+        async with hub.subscription('room') as updates:
+            for progress in range(50):
+                hub.publish('room', 'network-run', {'sid': 'a', 'progress': progress})
+                hub.publish('room', 'network-run', {'sid': 'b', 'progress': progress})
+            hub.publish('room', 'network-run', {'sid': 'a', 'status': 'finished'})
+            hub.publish('room', 'notice', 'one')
+            hub.publish('room', 'notice', 'two')
+            batch = await updates.get()
+            return [(m['event'], m['data']) for m in batch]
+
+    assert run(main()) == [
+        ('network-run', {'sid': 'b', 'progress': 49}),
+        ('network-run', {'sid': 'a', 'status': 'finished'}),
+        ('notice', 'one'),
+        ('notice', 'two'),
+    ]
+
+
+def test_rate_limited_from_threads():
+    hub = Hub(max_rate=10)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        async with hub.subscription('room') as updates:
+            def report():
+                for progress in range(1000):
+                    hub.publish('room', 'network-run', {'sid': 'a', 'progress': progress})
+
+            threads = [threading.Thread(target=report) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+
+            start = loop.time()
+            batches = []
+            while not batches or batches[-1][-1]['data']['progress'] < 999:
+                batches.append(await updates.get())
+            for thread in threads:
+                thread.join()
+            return batches, loop.time() - start
+
+    batches, elapsed = run(main())
+    assert all(len(batch) == 1 for batch in batches)  # only the latest progress of the run is sent
+    assert elapsed >= (len(batches) - 1) * 0.1 * 0.9
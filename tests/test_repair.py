@@ -0,0 +1,58 @@
+from app.core.repair import diagnose_network, repair_network, diagnosis_cache
+
+
+class FakeHydra(object):
+    url = 'http://hydra'
+
+    def __init__(self, network):
+        self.network = network
+        self.calls = []
+
+    def call(self, fn, *args, **kwargs):
+        self.calls.append(fn)
+        return self.network
+
+
+def make_network(refs):
+    nodes = [{'id': i, 'name': 'n{}'.format(i), 'x': str(i), 'y': '0', 'types': [], 'layout': {
+        'geojson': {'geometry': {'coordinates': [float(i), 0.0]}}}} for i in [1, 2]]
+    links = [{'id': 10, 'name': 'a', 'node_1_id': 1, 'node_2_id': 2, 'types': [], 'layout': {
+        'geojson': {'geometry': {'coordinates': [[1.0, 0.0], [2.0, 0.0]]}}}}]
+    scenarios = [{'id': 1, 'name': 'Baseline', 'layout': {'class': 'baseline'}}]
+    return {'id': 1, 'name': 'Basin', 'layout': {'refs': refs}, 'nodes': nodes, 'links': links,
+            'scenarios': scenarios}
+
+
+def test_layer_refs_are_diagnosed():
+    refs = [
+        {'id': 1, 'path': '.layers/rivers.json'},
+        {'id': 2, 'path': '.layers/rivers.json'},
+        {'id': 3, 'url': 'https://bucket.s3.amazonaws.com/folder/.layers/lakes.json'},
+        {'id': 4, 'path': '.thumbnail/thumbnail.png'},
+        {'id': 5},
+    ]
+    diagnosis = diagnose_network(make_network(refs))
+    assert diagnosis['issues'] == {'bad_layer_refs': [1, 3, 4]}
+    assert diagnosis['options'] == ['layers']
+
+    diagnosis = diagnose_network(make_network(refs[:1]))
+    assert diagnosis['issues'] == {}
+    assert diagnosis['options'] == []
+
+
+def test_sound_layers_are_not_repaired():
+    diagnosis_cache.clear()
+    network = make_network([{'id': 1, 'path': '.layers/rivers.json'}])
+    hydra = FakeHydra(network)
+    assert repair_network(None, hydra, 1, network=network, options=['layers']) is network
+    assert hydra.calls == []
+
+
+def test_node_coordinates_are_checked():
+    network = make_network([])
+    coords = [[1, 0], [1.0, float('nan')], [True, 0.0], ['1', '0'], [1.0], 5]
+    network['nodes'] = [{'id': i, 'name': 'n{}'.format(i), 'x': '1', 'y': '0', 'types': [], 'layout': {
+        'geojson': {'geometry': {'coordinates': c}}}} for i, c in enumerate(coords, start=1)]
+    network['links'] = []
+    missing = diagnose_network(network)['issues']['missing_geojson']
+    assert [issue['id'] for issue in missing] == [2, 3, 4, 5, 6]
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app import config
+from app.core.cubes import cube_cache
+from app.core.data import plan_results_query, filter_results_data, get_data_from_cube, aggregate_data
+
+BUCKET = 'bucket'
+dates = pd.date_range('2000-01-01', periods=365, freq='D').strftime('%Y-%m-%d')
+
+NETWORK = {'id': 1, 'layout': {'storage': {'folder': 'network-1'}}}
+SCENARIOS = [
+    {'id': 10, 'name': 'Baseline', 'layout': {'data_location': 's3', 'run': 'run', 'versions': [
+        {'number': 1, 'date': 'v1', 'variations': 2}]}},
+    {'id': 11, 'name': 'Option', 'layout': {'data_location': 's3', 'run': 'run', 'versions': [
+        {'number': 1, 'date': 'v1'}, {'number': 2, 'date': 'v2'}]}},
+    {'id': 12, 'name': 'Not run', 'layout': {'data_location': 's3', 'run': 'run', 'versions': [
+        {'number': 1, 'date': 'v1'}]}},
+]
+
+
+class FakeHydra(object):
+    def __init__(self):
+        self.calls = []
+
+    def call(self, fn, *args, **kwargs):
+        self.calls.append(fn)
+        if fn == 'get_network':
+            return NETWORK
+        if fn == 'get_scenarios':
+            return SCENARIOS
+        if fn == 'get_scenario':
+            return next(s for s in SCENARIOS if s['id'] == args[0])
+        raise AssertionError('unexpected call to {}'.format(fn))
+
+
+def write_results(folder, subscenarios, offset=0):
+    for subscenario in subscenarios:
+        for node in [1, 2, 3]:
+            for attr in [5, 6]:
+                path = folder / str(subscenario) / 'node' / ('Reservoir' if node < 3 else 'Demand') / str(node)
+                path.mkdir(parents=True, exist_ok=True)
+                values = offset + subscenario * 1000 + node * 100 + attr + np.arange(len(dates)) / 1000
+                pd.DataFrame({'value': values}, index=pd.Index(dates, name='date')).to_csv(path / '{}.csv'.format(attr))
+
+
+@pytest.fixture
+def results(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'RESULTS_LOCAL_DIR', str(tmp_path / 'results'), raising=False)
+    monkeypatch.setattr(config, 'RESULTS_CUBE_DIR', str(tmp_path / 'cubes'), raising=False)
+    monkeypatch.setattr(config, 'AWS_S3_BUCKET', BUCKET, raising=False)
+    cube_cache.clear()
+
+    root = tmp_path / 'results' / BUCKET / 'network-1' / 'results' / 'run'
+    baseline = root / 'v1' / '10'
+    write_results(baseline, [1, 2])
+    pd.DataFrame({'Demand': [1.0, 2.0]}, index=pd.Index([1, 2], name='subscenario')).to_csv(
+        baseline / 'scenario_key.csv')
+    write_results(root / 'v1' / '11', [1], offset=10000)
+    write_results(root / 'v2' / '11', [1], offset=20000)
+    # scenario 12 has no results stored
+
+
+def legacy_results(hydra, filters, network_id):
+    """Read results as filter_results_data did before queries were planned: one scenario and version at a time, each
+    with its own Hydra calls, aggregating the raw rows"""
+    dfs = []
+    for scenario_id in filters['scenarios']:
+        scenario = hydra.call('get_scenario', scenario_id, include_data=False)
+        network = hydra.call('get_network', network_id, include_data=False, summary=False, include_resources=False)
+        all_versions = scenario['layout'].get('versions', [])
+        version_ids = filters.get('versions', {}).get(str(scenario_id))
+        selected = [v for v in all_versions if v['number'] in version_ids] if version_ids else all_versions[-1:]
+        for version in selected:
+            _dfs, _, _, _ = get_data_from_cube(network, scenario, version, [], filters.get('nodes', []), [],
+                                               filters.get('attrs'), network['layout']['storage']['folder'])
+            dfs.extend(_dfs)
+    data = pd.concat(dfs)
+    data.fillna('', inplace=True)
+    idx_names = [c for c in data.columns if c != 'value']
+    data = aggregate_data(data.set_index(idx_names), filters.get('agg'), idx_names)
+    return data.reset_index()
+
+
+def sort_rows(data):
+    keys = sorted(c for c in data.columns if c != 'value')
+    data = data.astype({c: str for c in keys})
+    return data.sort_values(keys).reset_index(drop=True)[sorted(data.columns)]
+
+
+def test_plan():
+    hydra = FakeHydra()
+    plan = plan_results_query(hydra, 1, [10, 11, 12], versions={'11': [1, 2]})
+    assert hydra.calls == ['get_scenarios', 'get_network']
+    assert plan['source'] == []
+    assert [(scenario['id'], version['number']) for _, scenario, version in plan['store']] == [
+        (10, 1), (11, 1), (11, 2), (12, 1)]
+    assert plan['network'] is NETWORK
+
+
+@pytest.mark.parametrize('agg', [
+    {},
+    {'time': {'function': 'mean', 'step': 'month'}},  # from rollups
+    {'time': {'function': 'max', 'step': 'year'}},  # aggregated from the rows
+    {'space': {'function': 'sum'}, 'range': {'mode': 'custom', 'start': '2000-03-01', 'end': '2000-05-31'}},
+])
+def test_planned_query_matches_legacy(results, agg):
+    # node 99 and attribute 99 have no results, nor does scenario 12
+    filters = {'scenarios': [10, 11, 12], 'versions': {'11': [2]}, 'nodes': [1, 3, 99], 'attrs': [5, 99],
+               'agg': agg}
+
+    hydra = FakeHydra()
+    data, perturbations = filter_results_data(hydra, filters, network_id=1)
+    assert hydra.calls == ['get_scenarios', 'get_network']
+    assert perturbations == ['Demand']
+
+    expected = legacy_results(FakeHydra(), filters, 1)
+    assert len(data) == len(expected) > 0
+    actual, expected = sort_rows(data), sort_rows(expected)
+    assert list(actual.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(actual.drop(columns='value'), expected.drop(columns='value'))
+    assert actual['value'].to_numpy(dtype=float) == pytest.approx(expected['value'].to_numpy(dtype=float))
+
+
+def test_missing_results_only(results):
+    filters = {'scenarios': [12], 'nodes': [1], 'attrs': [5]}
+    data, perturbations = filter_results_data(FakeHydra(), filters, network_id=1)
+    assert len(data) == 0 and perturbations is None
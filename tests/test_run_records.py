@@ -0,0 +1,103 @@
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.models import Ping, Run
+from app.core.model_control import ProcessState, add_pings, add_ping, add_run, get_run_records, delete_run_records, \
+    run_group_ended
+
+
+@pytest.fixture
+def db():
+    engine = create_engine('sqlite://')
+    Ping.__table__.create(engine)
+    Run.__table__.create(engine)
+    session = sessionmaker(bind=engine, autoflush=False)()
+    session.statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: session.statements.append(args[2]))
+    yield session
+    session.close()
+
+
+def request(sid, network_id=1):
+    return dict(sid=sid, status=ProcessState.REQUESTED, name='run ' + sid, source_id=1, network_id=network_id,
+                extra_info='python main.py --debug')
+
+
+def test_add_pings(db):
+    add_pings(db, [request('a'), request('b'), request('c')])
+    assert db.query(Ping).count() == 3
+
+    add_ping(db, 'a', ProcessState.CANCELED, source_id=1, network_id=1)
+    ping = add_ping(db, 'a', ProcessState.FINISHED, source_id=1, network_id=1)
+    assert ping.status == ProcessState.CANCELED  # nothing is added to a canceled run
+
+    db.statements.clear()
+    add_pings(db, [dict(sid=sid, status=ProcessState.STARTED) for sid in 'bc'] + [request('d')])
+    assert len([s for s in db.statements if s.startswith('SELECT')]) == 1
+    assert db.query(Ping).filter_by(status=ProcessState.STARTED).count() == 2
+
+
+def test_run_records(db):
+    add_pings(db, [request('a'), request('b'), request('c'), request('x', network_id=2)])
+    add_pings(db, [dict(sid=sid, status=ProcessState.STARTED) for sid in 'abc'])
+    add_pings(db, [dict(sid='a', status=ProcessState.FINISHED, extra_info='done'),
+                   dict(sid='b', status=ProcessState.ERROR, extra_info='failed')])
+
+    db.statements.clear()
+    records = {record['id']: record for record in get_run_records(db, source_id=1, network_id=1)}
+    assert len(db.statements) == 1
+    assert set(records) == {'a', 'b', 'c'}
+    assert records['a']['status'] == ProcessState.FINISHED and records['a']['end_info'] == 'done'
+    assert records['b']['status'] == ProcessState.ERROR and records['b']['end_time'] is not None
+    assert records['c']['status'] == ProcessState.STARTED and records['c']['end_time'] is None
+    assert records['c']['name'] == 'run c'
+    assert records['c']['start_params'] == 'python\nmain.py\n--debug'
+
+    delete_run_records(db, source_id=1, network_id=1)
+    assert {ping.sid for ping in db.query(Ping)} == {'x'}
+
+
+def test_run_group_ended(db):
+    # a run requested for two scenario combinations, and an older run recorded without its request's guid
+    for sid in ['g1-1', 'g1-2']:
+        add_run(db, sid=sid, model_id=1, layout={'run_key': None, 'guid': 'g1'})
+    add_run(db, sid='old', model_id=1, layout={'run_key': None})
+    add_pings(db, [request('g1-1'), request('g1-2'), request('old')])
+
+    add_ping(db, 'g1-1', ProcessState.FINISHED)
+    assert run_group_ended(db, 'g1-1') is None  # g1-2 is still running
+    add_ping(db, 'g1-2', ProcessState.ERROR)
+    assert run_group_ended(db, 'g1-2') == run_group_ended(db, 'g1-1') == 'g1'
+
+    add_ping(db, 'old', ProcessState.CANCELED)
+    assert run_group_ended(db, 'old') is None  # nothing finished, so there are no results
+    add_pings(db, [dict(sid='old', status=ProcessState.FINISHED)])
+    assert run_group_ended(db, 'old') is None  # pings after a cancellation are not recorded
+
+
+def test_progress_after_the_end(db):
+    add_pings(db, [request('a'), request('b')])
+    add_pings(db, [dict(sid=sid, status=ProcessState.STARTED) for sid in 'ab'])
+    add_pings(db, [dict(sid=sid, status=ProcessState.RUNNING, progress=50, extra_info='50%') for sid in 'ab'])
+
+    # a run in progress has not ended
+    records = {record['id']: record for record in get_run_records(db, source_id=1, network_id=1)}
+    assert records['a']['status'] == ProcessState.RUNNING
+    assert records['a']['end_time'] is None and records['a']['end_info'] == ''
+
+    # buffered progress flushed (e.g., by another worker) after the run ended is not recorded
+    add_ping(db, 'a', ProcessState.FINISHED, extra_info='done')
+    ping = add_pings(db, [dict(sid='a', status=ProcessState.RUNNING, progress=99, extra_info='99%'),
+                          dict(sid='b', status=ProcessState.RUNNING, progress=99, extra_info='99%')])[0]
+    assert ping.status == ProcessState.FINISHED
+    assert db.query(Ping).filter_by(sid='a', status=ProcessState.RUNNING).one().extra_info == '50%'
+
+    # nor is it in the same batch as the end
+    add_pings(db, [dict(sid='b', status=ProcessState.ERROR, extra_info='failed'),
+                   dict(sid='b', status=ProcessState.RUNNING, progress=100, extra_info='100%')])
+
+    records = {record['id']: record for record in get_run_records(db, source_id=1, network_id=1)}
+    assert (records['a']['status'], records['a']['end_info']) == (ProcessState.FINISHED, 'done')
+    assert (records['b']['status'], records['b']['end_info']) == (ProcessState.ERROR, 'failed')
+    assert records['a']['end_time'] is not None
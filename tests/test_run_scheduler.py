@@ -0,0 +1,178 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.models import QueuedRun
+from app.core.run_scheduler import RunScheduler, MemoryQueue, DatabaseQueue, QUEUED, DISPATCHED, WAIT
+
+
+def database_queue():
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    QueuedRun.__table__.create(engine)
+    return DatabaseQueue(sessionmaker(bind=engine, autoflush=False))
+
+
+@pytest.fixture(params=['memory', 'database'])
+def queue(request):
+    return MemoryQueue() if request.param == 'memory' else database_queue()
+
+
+def runs(user_id, n, model_id=1, priority=0, prefix=None):
+    prefix = prefix or 'u{}'.format(user_id)
+    return [dict(sid='{}-{}'.format(prefix, i), user_id=user_id, model_id=model_id, priority=priority, payload={})
+            for i in range(n)]
+
+
+class Sender(object):
+    def __init__(self, fail=()):
+        self.sent = []
+        self.fail = fail
+
+    def __call__(self, runs):
+        self.sent.extend(run.sid for run in runs)
+        return {run.sid: 'no computer' for run in runs if run.sid in self.fail}
+
+
+def test_fair_share(queue):
+    send = Sender()
+    scheduler = RunScheduler(queue, send, user_limit=3, model_limit=0)
+    scheduler.submit(runs(1, 100))  # a large ensemble
+    assert send.sent == ['u1-0', 'u1-1', 'u1-2']
+
+    # another user's runs are next, not after the ensemble
+    scheduler.submit(runs(2, 2))
+    assert send.sent[3:] == ['u2-0', 'u2-1']
+    assert scheduler.positions(['u1-3', 'u1-4']) == {'u1-3': 1, 'u1-4': 2}
+
+    scheduler.finish(['u1-0', 'u2-0'])
+    assert send.sent[5:] == ['u1-3']
+    stats = scheduler.stats()
+    assert stats['queued'] == 96
+    assert stats['active'] == 4
+
+
+def test_interleaving_and_priority(queue):
+    send = Sender()
+    scheduler = RunScheduler(queue, send, user_limit=0, model_limit=0, max_active=1)
+    scheduler.submit(runs(9, 1))  # takes the only slot
+    scheduler.submit(runs(1, 3) + runs(2, 2))
+    scheduler.submit(runs(2, 1, priority=5, prefix='urgent'))
+
+    positions = scheduler.positions()
+    order = sorted(positions, key=positions.get)
+    assert order == ['u1-0', 'urgent-0', 'u1-1', 'u2-0', 'u1-2', 'u2-1']
+
+    scheduler.finish(['u9-0'])
+    assert send.sent == ['u9-0', 'u1-0']
+
+
+def test_model_limit(queue):
+    send = Sender()
+    scheduler = RunScheduler(queue, send, user_limit=0, model_limit=2)
+    scheduler.submit(runs(1, 4, model_id=1) + runs(2, 1, model_id=2))
+    assert sorted(send.sent) == ['u1-0', 'u1-1', 'u2-0']
+
+
+def test_cancel(queue):
+    send = Sender()
+    scheduler = RunScheduler(queue, send, user_limit=1)
+    scheduler.submit(runs(1, 3))
+    assert scheduler.cancel(['u1-0', 'u1-1']) == ['u1-1']  # u1-0 was already sent
+    scheduler.finish(['u1-0'])
+    assert send.sent == ['u1-0', 'u1-2']
+    assert scheduler.positions() == {}
+
+
+def test_failed_runs_free_their_slots(queue):
+    send = Sender(fail={'u1-0'})
+    scheduler = RunScheduler(queue, send, user_limit=1)
+    errors = scheduler.submit(runs(1, 2))
+    assert errors == {'u1-0': 'no computer'}
+    assert send.sent == ['u1-0', 'u1-1']
+    assert [run['sid'] for run in scheduler.user_runs(1)] == ['u1-1']
+
+
+def test_user_runs(queue):
+    scheduler = RunScheduler(queue, Sender(), user_limit=1)
+    scheduler.submit(runs(1, 3))
+    user_runs = {run['sid']: run for run in scheduler.user_runs(1)}
+    assert user_runs['u1-0']['status'] == DISPATCHED
+    assert user_runs['u1-0']['position'] is None
+    assert user_runs['u1-2']['status'] == QUEUED
+    assert user_runs['u1-2']['position'] == 2
+    assert scheduler.user_runs(2) == []
+
+
+def test_silent_runs_are_let_go(queue):
+    send = Sender()
+    scheduler = RunScheduler(queue, send, user_limit=1, max_runtime=0)
+    scheduler.submit(runs(1, 2))
+    scheduler.dispatch()
+    assert send.sent == ['u1-0', 'u1-1']
+
+
+def test_failures_in_any_dispatch_are_recorded(queue):
+    failed = {}
+    send = Sender(fail={'u2-0'})
+    scheduler = RunScheduler(queue, send, on_error=lambda runs, errors: failed.update(errors), user_limit=0,
+                             model_limit=0, max_active=1)
+    scheduler.submit(runs(1, 1))
+    assert scheduler.submit(runs(2, 1)) == {}  # queued behind the first
+
+    # it fails when the first run finishes, so only on_error hears of it
+    scheduler.finish(['u1-0'])
+    assert failed == {'u2-0': 'no computer'}
+
+    def broken(runs):
+        raise ConnectionError('broker down')
+
+    scheduler.send = broken
+    scheduler.submit(runs(3, 1))
+    assert failed['u3-0'] == 'broker down'
+    assert scheduler.stats()['queued'] == 0
+
+
+def test_periodic_dispatch(queue):
+    send = Sender()
+    scheduler = RunScheduler(queue, send, user_limit=1, dispatch_interval=0.01)
+    scheduler.submit(runs(1, 2))
+    assert send.sent == ['u1-0']
+
+    # the first run ends on another worker, which leaves its slot free here
+    queue.remove(['u1-0'])
+    scheduler.start()
+    try:
+        for _ in range(100):
+            if len(send.sent) == 2:
+                break
+            time.sleep(0.01)
+    finally:
+        scheduler.stop()
+    assert send.sent == ['u1-0', 'u1-1']
+
+
+def test_busy_runs_wait_in_the_queue(queue):
+    busy = {'u1-0'}
+    failed = {}
+    sent = []
+
+    def send(runs):
+        sent.extend(run.sid for run in runs)
+        return {run.sid: WAIT for run in runs if run.sid in busy}
+
+    scheduler = RunScheduler(queue, send, on_error=lambda runs, errors: failed.update(errors), user_limit=0,
+                             model_limit=0)
+    assert scheduler.submit(runs(1, 2)) == {}
+    assert sent == ['u1-0', 'u1-1']
+    assert failed == {}
+    user_runs = {run['sid']: run for run in scheduler.user_runs(1)}
+    assert user_runs['u1-0']['status'] == QUEUED and user_runs['u1-0']['position'] == 1
+
+    # sent again once there is room
+    busy.clear()
+    scheduler.dispatch()
+    assert sent == ['u1-0', 'u1-1', 'u1-0']
+    assert scheduler.stats()['queued'] == 0
@@ -0,0 +1,77 @@
+from app.core.spatial import SpatialIndex, get_spatial_index, spatial_index_cache
+
+
+def make_network():
+    types = [{'id': 7, 'template_id': 1, 'name': 'Junction'}]
+    nodes = [{'id': i, 'name': 'n{}'.format(i), 'x': str(x), 'y': str(y), 'layout': {}, 'types': types}
+             for i, (x, y) in [(1, (0, 0)), (2, (10, 0)), (3, (5, 5))]]
+    links = [{'id': 10, 'name': 'a', 'node_1_id': 1, 'node_2_id': 2, 'layout': {}, 'types': []}]
+    return {'id': 1, 'name': 'Basin', 'nodes': nodes, 'links': links}
+
+
+def test_snapping():
+    index = SpatialIndex.from_network(make_network(), 1)
+
+    node = index.locate_point(0.001, 0, tolerance=0.01)
+    assert (node['resource_type'], node['id']) == ('NODE', 1)
+    assert index.node_types[1] == 'Junction'
+
+    link = index.locate_point(4, 0.001, tolerance=0.01)
+    assert (link['resource_type'], link['id']) == ('LINK', 10)
+
+    assert index.locate_point(4, 1, tolerance=0.01) is None
+
+
+def test_splitting():
+    index = SpatialIndex.from_network(make_network(), 1)
+
+    # from node 3 across link 10, ending on node 1
+    coords, existings, split_locs = index.locate_line([(5, 5), (5, -5), (0, 0)], tolerance=0.01)
+    assert coords == [(5, 5), (5, 0), (5, -5), (0, 0)]
+    assert existings['0']['nodeId'] == 3
+    assert existings['1']['linkId'] == 10
+    assert existings['3'] == {'nodeId': 1, 'linkId': None, 'nodeType': 'Junction', 'linkIds': [10]}
+    assert split_locs == {10: [{'idx': 1, 'prev': 0}, {'idx': None}]}
+
+    # without splitting at crossings, only vertices dropped on the link split it
+    _, _, split_locs = index.locate_line([(5, 5), (5, -5)], tolerance=0.01, split_crossings=False)
+    assert split_locs == {}
+
+
+def test_incremental_edits_keep_the_index():
+    spatial_index_cache.clear()
+    network = make_network()
+    index = get_spatial_index(network, 1)
+    assert get_spatial_index(make_network(), 1) is index
+
+    # a node and a link added to both the network and its index
+    node = {'id': 4, 'name': 'n4', 'x': '20', 'y': '0', 'layout': {}, 'types': network['nodes'][0]['types']}
+    link = {'id': 11, 'name': 'b', 'node_1_id': 2, 'node_2_id': 4, 'layout': {}, 'types': []}
+    network['nodes'].append(node)
+    network['links'].append(link)
+    index.add_node(node, 'Junction')
+    index.add_link(link)
+    assert get_spatial_index(network, 1) is index
+
+    # and removed again
+    network['links'].pop()
+    index.remove_link(11)
+    assert get_spatial_index(network, 1) is index
+
+    # an edit the index doesn't know about
+    network['nodes'][0]['x'] = '1'
+    rebuilt = get_spatial_index(network, 1)
+    assert rebuilt is not index
+    assert rebuilt.nodes[1] == (1, 0)
+
+
+def test_nearest_far_from_the_network():
+    nodes = [{'id': i, 'name': 'n{}'.format(i), 'x': str(i % 100 * 0.001), 'y': str(i // 100 * 0.001), 'layout': {},
+              'types': []} for i in range(10000)]
+    index = SpatialIndex.from_network({'id': 2, 'nodes': nodes, 'links': []})
+
+    nearest = index.nearest(10, 10)
+    assert [f['id'] for f in nearest] == [9999]
+    assert index.nearest(10, 10, radius=1) == []
+    assert len(index.nearest(0, 0, limit=1000)) == 100  # capped
+    assert len(index.nearest(-5, 0.05, limit=3)) == 3